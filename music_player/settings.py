@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 import os
+import tempfile
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -53,6 +54,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "player.metrics.MetricsMiddleware",  # レイテンシ等の記録と Server-Timing（最初に置いて全体を測る）
+    "player.tracing.TracingMiddleware",  # 処理段階ごとのトレース（セッションの保存も含める）
     "django.middleware.security.SecurityMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",  # Heroku用
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -156,11 +159,33 @@ CRISPY_TEMPLATE_PACK = "bootstrap5"
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# キャッシュ設定
+# セッションはワーカー間で共有する必要があるため、同一マシンの全ワーカーから
+# 見えるファイルベースのキャッシュを使う（ページキャッシュに載るので実質メモリ読み出し）。
+# 共有されるのは同じホストの中だけなので、複数のホスト・dyno で動かす場合は
+# SESSION_CACHE_BACKEND=db などで共有のキャッシュにする（ホストごとだと古いセッションを返す）
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "sessions": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.getenv('SESSION_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'music_player_sessions')),
+    } if os.getenv('SESSION_CACHE_BACKEND', 'file') == 'file' else {
+        "BACKEND": "django.core.cache.backends.db.DatabaseCache",
+        "LOCATION": "player_session_cache",
+    },
+}
+
 # セッション設定
-SESSION_ENGINE = 'django.contrib.sessions.backends.signed_cookies'
+# セッションの中身はサーバー側（DB + キャッシュ）に置き、Cookie にはセッションIDだけを入れる
+SESSION_ENGINE = 'player.sessions'  # cached_db + 保存時間のトレース
+SESSION_CACHE_ALIAS = 'sessions'
 SESSION_COOKIE_AGE = 3600  # 1時間
-SESSION_SAVE_EVERY_REQUEST = True
-# SESSION_COOKIE_MAX_SIZE = 4096  # 4KB制限 - コメントアウト（Herokuの制限に従う）
+# 内容が変わったリクエストでのみ保存する（再生中は再生位置の保存で期限を延ばす）
+SESSION_SAVE_EVERY_REQUEST = False
+# 再生位置の保存でセッションを保存し直して期限を延ばす最短間隔（秒）
+PLAYER_SESSION_REFRESH_INTERVAL = 300
 
 # 一時ディレクトリの作成（ローカル開発環境のみ）
 if DEBUG and not os.environ.get('DYNO'):
@@ -187,3 +212,105 @@ if DEBUG:
             }
         }
     }
+
+# プレイヤー設定
+# ストリーミング配信時の1回あたりの読み出しサイズ
+PLAYER_STREAM_CHUNK_SIZE = 64 * 1024
+# 1 リクエストで受け付ける Range の数（重なる・隣接する範囲をまとめた後。超えたら全体を返す）
+PLAYER_MAX_RANGES = 16
+# 波形ピーク第 0 段の 1 ピークあたりのサンプル数（以降 2 倍ずつ間引く）
+PLAYER_PEAKS_BASE_SAMPLES = 256
+# 区間指定が無い場合に返すピーク数と、1 リクエストで返す最大ピーク数
+PLAYER_PEAKS_TARGET_LENGTH = 2000
+PLAYER_PEAKS_MAX_WIDTH = 8192
+# アップロード可能な最大ファイルサイズ（受信しながら検証する）
+PLAYER_MAX_UPLOAD_SIZE = int(os.getenv('PLAYER_MAX_UPLOAD_SIZE', 100 * 1024 * 1024))
+# 内容ハッシュ単位のメタデータをプロセス内に保持する件数
+PLAYER_METADATA_CACHE_SIZE = 1024
+# 再生位置をまとめて DB に書き込む間隔（秒）。0 以下なら毎回書き込む
+PLAYER_POSITION_FLUSH_INTERVAL = float(os.getenv('PLAYER_POSITION_FLUSH_INTERVAL', 5.0))
+# リクエストが途絶えても書き込むバックグラウンドスレッドを使うか
+PLAYER_POSITION_FLUSH_THREAD = True
+# 一括保存 API で受け付ける最大件数
+PLAYER_POSITION_BATCH_LIMIT = 500
+# アップロード・配信・再生位置の API を非同期 View にするか（ASGI + uvicorn ワーカー用）
+PLAYER_ASYNC_VIEWS = os.getenv('PLAYER_ASYNC_VIEWS', 'False').lower() == 'true'
+# 非同期 View からファイル I/O・解析・DB アクセスを実行するスレッド数
+PLAYER_BLOCKING_THREADS = int(os.getenv('PLAYER_BLOCKING_THREADS', 8))
+# アップロード済みファイルの合計サイズの上限（バイト）。超えた分は最終アクセスの古い順に削除。0 なら無制限
+PLAYER_STORAGE_QUOTA = int(os.getenv('PLAYER_STORAGE_QUOTA', 2 * 1024 * 1024 * 1024))
+# リーパーが作成・アクセスから何秒経ったファイルを対象にするか
+PLAYER_REAPER_GRACE = int(os.getenv('PLAYER_REAPER_GRACE', SESSION_COOKIE_AGE))
+# reap_uploads --loop の実行間隔（秒）
+PLAYER_REAPER_INTERVAL = int(os.getenv('PLAYER_REAPER_INTERVAL', 300))
+# 配信時に最終アクセス時刻を更新する最短間隔（秒）
+PLAYER_BLOB_TOUCH_INTERVAL = 300
+# オフライン音声コマンド認識: 一致とみなす DTW 距離の上限と、2 番目の候補との最小差
+PLAYER_KWS_THRESHOLD = 2.5
+PLAYER_KWS_MARGIN = 0.3
+# 受け付けるクリップの最大サイズ（16kHz・16bit・モノラルで約 10 秒）
+PLAYER_KWS_MAX_CLIP_SIZE = 320 * 1024
+# 登録音声のキャッシュ: 所有者ごとの件数と有効期間（秒、他プロセスでの登録・削除を反映するまで）
+PLAYER_KWS_CACHE_SIZE = 1024
+PLAYER_KWS_CACHE_TTL = 60
+# 所有者・コマンドごとに残す登録音声の数（超えた分は古いものから削除。所有者ごとの上限はこの数 × コマンド数）
+PLAYER_KWS_MAX_TEMPLATES_PER_ACTION = 5
+# 音声コマンド照合: ユーザーごとのオートマトンのキャッシュ件数と有効期間（秒、他プロセスでの変更を反映するまで）
+PLAYER_COMMAND_CACHE_SIZE = 1024
+PLAYER_COMMAND_CACHE_TTL = 60
+# 完全一致が無い場合に、パターン長 × 比率までの編集距離で曖昧一致させるか
+# （テキストとの長さの差がその編集距離以内のパターンだけと比べる。既定は完全一致のみ）
+PLAYER_COMMAND_FUZZY = os.getenv('PLAYER_COMMAND_FUZZY', 'False').lower() == 'true'
+PLAYER_COMMAND_FUZZY_RATIO = 0.34
+
+# シークインデックスのエントリ間隔（秒）。t 指定の配信はこの秒数まで手前から始まる
+PLAYER_SEEK_INDEX_INTERVAL = 0.5
+
+# 分割アップロードのチャンク長と、1 ファイルあたりの上限
+PLAYER_UPLOAD_CHUNK_SIZE = int(os.getenv('PLAYER_UPLOAD_CHUNK_SIZE', 4 * 1024 * 1024))
+PLAYER_RESUMABLE_MAX_SIZE = int(os.getenv('PLAYER_RESUMABLE_MAX_SIZE', 1024 * 1024 * 1024))
+# 所有者（ユーザー・セッション）ごとに同時に進められる分割アップロードの数
+PLAYER_RESUMABLE_MAX_OPEN = int(os.getenv('PLAYER_RESUMABLE_MAX_OPEN', 3))
+
+# リクエストのメトリクスを記録して /metrics で返すか
+PLAYER_METRICS = os.getenv('PLAYER_METRICS', 'True').lower() == 'true'
+# ワーカーごとのメトリクスファイルを置くディレクトリ（同じホストのワーカーで共有する）
+PLAYER_METRICS_DIR = os.getenv('PLAYER_METRICS_DIR', os.path.join(tempfile.gettempdir(), 'music_player_metrics'))
+# /metrics に必要な Bearer トークン（スタッフのユーザーは不要。空なら DEBUG のときだけ誰でも取得できる）
+PLAYER_METRICS_TOKEN = os.getenv('PLAYER_METRICS_TOKEN', '')
+# 応答に Server-Timing ヘッダーを付けるか
+PLAYER_SERVER_TIMING = True
+
+# 処理段階ごとのトレースを記録するリクエストの割合（0 で無効）と、書き出し先・ローテート
+PLAYER_TRACE_SAMPLE_RATE = float(os.getenv('PLAYER_TRACE_SAMPLE_RATE', 0.0))
+PLAYER_TRACE_FILE = os.getenv('PLAYER_TRACE_FILE', os.path.join(tempfile.gettempdir(), 'music_player_traces.jsonl'))
+PLAYER_TRACE_MAX_BYTES = int(os.getenv('PLAYER_TRACE_MAX_BYTES', 10 * 1024 * 1024))
+PLAYER_TRACE_BACKUPS = 3
+
+# 波形ピークなどのアップロード後の処理を runworker のワーカーで実行するか（False ならリクエスト内で実行）。
+# ワーカーは音声ファイルを読むので、web と同じファイルシステム（同じホスト・共有ボリューム）で動かす場合だけ True にする
+PLAYER_BACKGROUND_JOBS = os.getenv('PLAYER_BACKGROUND_JOBS', 'False').lower() == 'true'
+# ジョブの制限時間（秒）・最大試行回数・再試行までの最初の待ち時間（秒、以降倍々）
+PLAYER_JOB_TIMEOUT = int(os.getenv('PLAYER_JOB_TIMEOUT', 300))
+PLAYER_JOB_MAX_ATTEMPTS = 3
+PLAYER_JOB_RETRY_DELAY = 10
+# 待機中のジョブが無い場合の確認間隔（秒）
+PLAYER_JOB_POLL_INTERVAL = 1.0
+# 制限時間をこの秒数過ぎても running のジョブはワーカーが落ちたものとして再試行する
+PLAYER_JOB_STALE_GRACE = 60
+
+# 再生音量を揃える目標の積分ラウドネス（LUFS、ReplayGain 2.0 の基準）と、揃えた後のトゥルーピークの上限（dBTP）
+PLAYER_LOUDNESS_TARGET = float(os.getenv('PLAYER_LOUDNESS_TARGET', -18.0))
+PLAYER_TRUE_PEAK_CEILING = -1.0
+
+# 埋め込みアートワークのサムネイルの長辺（px）と画質（WebP / JPEG 共通）
+PLAYER_ARTWORK_SIZES = [64, 128, 256, 512]
+PLAYER_ARTWORK_QUALITY = int(os.getenv('PLAYER_ARTWORK_QUALITY', 80))
+
+# ライブラリの一覧の 1 ページの既定の件数と上限
+PLAYER_LIBRARY_PAGE_SIZE = 50
+PLAYER_LIBRARY_MAX_PAGE_SIZE = 200
+
+# 再生キュー（次に再生する曲の先読み）の既定の曲数と上限
+PLAYER_QUEUE_SIZE = 3
+PLAYER_QUEUE_MAX_SIZE = 10
@@ -1,13 +1,58 @@
 from django.contrib import admin
-from .models import MusicFile, VoiceCommand
+from .models import AudioArtwork, AudioBlob, AudioFingerprint, AudioLoudness, Job, MusicAnalysis, MusicFile, VoiceCommand, VoiceTemplate
 
 @admin.register(MusicFile)
 class MusicFileAdmin(admin.ModelAdmin):
     list_display = ('title', 'user', 'duration', 'file_size', 'uploaded_at')
     search_fields = ('title', 'user__username')
 
+@admin.register(AudioBlob)
+class AudioBlobAdmin(admin.ModelAdmin):
+    list_display = ('sha256', 'extension', 'size', 'ref_count', 'last_accessed_at')
+    search_fields = ('sha256',)
+    readonly_fields = ('created_at',)
+
 @admin.register(VoiceCommand)
 class VoiceCommandAdmin(admin.ModelAdmin):
     list_display = ('command', 'action', 'user', 'is_active')
     search_fields = ('command', 'user__username')
     list_filter = ('is_active',)
+
+@admin.register(VoiceTemplate)
+class VoiceTemplateAdmin(admin.ModelAdmin):
+    list_display = ('action', 'owner', 'frames', 'created_at')
+    search_fields = ('action', 'owner')
+    list_filter = ('action',)
+    exclude = ('features',)
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('kind', 'blob', 'status', 'attempts', 'run_after', 'locked_by')
+    search_fields = ('blob__sha256',)
+    list_filter = ('kind', 'status')
+    readonly_fields = ('created_at', 'updated_at')
+
+@admin.register(MusicAnalysis)
+class MusicAnalysisAdmin(admin.ModelAdmin):
+    list_display = ('sha256', 'bpm', 'analyzed_at')
+    search_fields = ('sha256',)
+    readonly_fields = ('analyzed_at',)
+
+@admin.register(AudioLoudness)
+class AudioLoudnessAdmin(admin.ModelAdmin):
+    list_display = ('sha256', 'integrated', 'true_peak', 'analyzed_at')
+    search_fields = ('sha256',)
+    readonly_fields = ('analyzed_at',)
+
+@admin.register(AudioArtwork)
+class AudioArtworkAdmin(admin.ModelAdmin):
+    list_display = ('sha256', 'artwork', 'width', 'height', 'sizes', 'extracted_at')
+    search_fields = ('sha256', 'artwork')
+    readonly_fields = ('extracted_at',)
+
+@admin.register(AudioFingerprint)
+class AudioFingerprintAdmin(admin.ModelAdmin):
+    list_display = ('sha256', 'track', 'offset', 'matches', 'hashes', 'fingerprinted_at')
+    search_fields = ('sha256',)
+    raw_id_fields = ('track',)
+    readonly_fields = ('fingerprinted_at',)
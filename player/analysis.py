@@ -0,0 +1,308 @@
+"""
+曲のテンポ・ビート・セクションの解析（NumPy のみ）
+
+以前は librosa で解析していたが、アップロードのたびに数十秒かかるため
+廃止していた（0002_remove_music_analysis）。ここでは必要な処理だけを
+NumPy で行い、アップロード後のジョブ（jobs.py の 'analysis'）として
+リクエストの外で実行する。結果は内容ハッシュごとに MusicAnalysis に保存する。
+
+    1. PCM をブロック単位で読みながら STFT し、フレームごとの帯域エネルギーだけを残す
+    2. 帯域エネルギーの増加分（スペクトルフラックス）をオンセット強度とする
+    3. オンセット強度の自己相関のピークからテンポを求める（120 BPM 付近を優先）
+    4. テンポの周期で位相を合わせたグリッドを、近くのオンセットに寄せてビートとする
+    5. ビートごとに平均した特徴量の自己類似度に市松模様のカーネルを当て（Foote の
+       ノベルティ）、変化の大きいビートをセクションの境界とする
+
+自己類似度は境界付近の帯（カーネルの幅）だけを計算するので、長い曲でも
+ビート数の 2 乗のメモリは使わない。
+"""
+import bisect
+import math
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from .audio import open_pcm
+from .models import MusicAnalysis
+
+SAMPLE_RATE = 22050  # 高いレートの WAV もこのレートに変換して解析する
+BLOCK_FRAMES = 8192
+FRAME_RATE = 86.0  # 目標のフレームレート（hop はこれに近い 2 の累乗にする）
+N_BANDS = 32
+MIN_FREQUENCY = 30.0
+MAX_FREQUENCY = 11025.0
+COMPRESSION = 1000.0  # 帯域エネルギーの対数圧縮の強さ（振幅 1 の正弦波のエネルギーが 1 になる基準で）
+
+MIN_BPM = 60.0
+MAX_BPM = 200.0
+PRIOR_BPM = 120.0
+PRIOR_OCTAVES = 1.0  # テンポの事前分布の広さ（オクターブ単位の標準偏差）
+MIN_PERIODICITY = 0.1  # 自己相関のピークがこれ（ラグ 0 に対する比）未満ならテンポ無し
+
+SECTION_DECIMATION = 4  # セクション用の帯域エネルギーは 4 フレームずつまとめる
+KERNEL_BEATS = 16  # ノベルティのカーネルの片側の幅（4 拍子で 4 小節）
+MIN_SECTION_SECONDS = 8.0
+LABEL_SIMILARITY = 0.9  # これ以上似ているセクションは同じラベルにする
+
+# 「戻って」で直前のセクションに戻る場合、境界の直後ならもう 1 つ前に戻る
+PREVIOUS_SECTION_GAP = 2.0
+
+
+def _hop_length(sample_rate):
+    return 2 ** max(5, int(round(math.log2(sample_rate / FRAME_RATE))))
+
+
+def _band_matrix(sample_rate, n_fft):
+    """rfft のビン -> 対数間隔の帯域への集約行列"""
+    frequencies = np.fft.rfftfreq(n_fft, 1.0 / sample_rate)
+    edges = np.geomspace(MIN_FREQUENCY, min(MAX_FREQUENCY, sample_rate / 2), N_BANDS + 1)
+    band = np.searchsorted(edges, frequencies, side='right') - 1
+    matrix = np.zeros((len(frequencies), N_BANDS), dtype=np.float32)
+    inside = (band >= 0) & (band < N_BANDS)
+    matrix[np.flatnonzero(inside), band[inside]] = 1.0
+    return matrix
+
+
+def spectral_features(source):
+    """
+    PCMSource をブロック単位で STFT し、対数圧縮した帯域エネルギーとオンセット強度を求める
+
+    フレーム k の中心は k * hop サンプル目（先頭は n_fft / 2 の無音で埋める）。
+    圧縮の基準は振幅 1 の正弦波なので、曲全体を読み終える前にブロックごとに
+    計算でき、スペクトルの一時配列はブロック分で済む。セクションの解析には
+    ビート単位の細かさで足りるので、曲全体分残す帯域エネルギーは
+    SECTION_DECIMATION フレームずつ合計しておく。
+    戻り値は (帯域エネルギー [フレーム数 / SECTION_DECIMATION, N_BANDS], オンセット強度,
+    フレームレート, 長さ（秒）)。
+    """
+    hop = _hop_length(source.sample_rate)
+    n_fft = 4 * hop
+    window = np.hanning(n_fft).astype(np.float32)
+    bank = _band_matrix(source.sample_rate, n_fft)
+    scale = COMPRESSION / (window.sum() / 2) ** 2
+
+    # 総フレーム数が分かっていれば最初に確保する（分からない・足りない場合は倍々に広げる）
+    rows = (source.frames // hop + 2) // SECTION_DECIMATION + 1 if source.frames else 1024
+    bands = np.zeros((rows, N_BANDS), dtype=np.float32)
+    used = 0
+    flux = []
+    previous = None
+    carry = np.zeros(n_fft // 2, dtype=np.float32)
+    samples = 0
+    for block in source.blocks(BLOCK_FRAMES):
+        samples += len(block)
+        buffer = np.concatenate([carry, block.astype(np.float32, copy=False)])
+        count = (len(buffer) - n_fft) // hop + 1
+        if count <= 0:
+            carry = buffer
+            continue
+        frames = sliding_window_view(buffer, n_fft)[::hop][:count]
+        spectrum = np.fft.rfft(frames * window, axis=1)
+        energy = (spectrum.real ** 2 + spectrum.imag ** 2).astype(np.float32) @ bank
+        energy *= scale
+        np.log1p(energy, out=energy)
+
+        coarse = (used + np.arange(count)) // SECTION_DECIMATION
+        if coarse[-1] >= len(bands):
+            bands = np.concatenate([bands, np.zeros((max(len(bands), count), N_BANDS), dtype=np.float32)])
+        np.add.at(bands, coarse, energy)
+        used += count
+
+        # 帯域ごとの増加分の合計（スペクトルフラックス）
+        step = np.diff(energy, axis=0, prepend=energy[:1] if previous is None else previous)
+        np.maximum(step, 0.0, out=step)
+        flux.append(step.sum(axis=1))
+        previous = energy[-1:]
+        carry = buffer[count * hop:]
+
+    frame_rate = source.sample_rate / hop
+    flux = np.concatenate(flux) if flux else np.zeros(0, dtype=np.float32)
+    bands = bands[:-(-used // SECTION_DECIMATION)]
+    return bands, onset_strength(flux, frame_rate), frame_rate, samples / source.sample_rate
+
+
+def onset_strength(flux, frame_rate):
+    """スペクトルフラックスから 0.5 秒の移動平均を引いたオンセット強度"""
+    if len(flux) < 2:
+        return np.zeros(len(flux), dtype=np.float32)
+    width = max(1, int(frame_rate * 0.5)) | 1
+    local = np.convolve(flux, np.ones(width, dtype=np.float32) / width, mode='same')
+    return np.maximum(flux - local, 0.0)
+
+
+def estimate_tempo(onset, frame_rate):
+    """
+    オンセット強度の自己相関からテンポを求める
+
+    戻り値は (BPM, ビート周期のフレーム数)。周期性が無い場合は None。
+    """
+    length = len(onset)
+    min_lag = max(1, int(frame_rate * 60.0 / MAX_BPM))
+    max_lag = min(int(math.ceil(frame_rate * 60.0 / MIN_BPM)), length - 2)
+    if max_lag <= min_lag or not onset.any():
+        return None
+
+    # 周期が整数フレームでない場合もピークが鋭く欠けないよう、少しぼかしてから相関を取る
+    smoothed = np.convolve(onset, np.hanning(5)[1:-1] / 2.0, mode='same')
+    centered = smoothed - smoothed.mean()
+    size = 1 << int(math.ceil(math.log2(2 * length)))
+    spectrum = np.fft.rfft(centered, size)
+    autocorrelation = np.fft.irfft(spectrum * np.conj(spectrum), size)[:max_lag + 2]
+
+    lags = np.arange(min_lag, max_lag + 1)
+    prior = np.exp(-0.5 * (np.log2(60.0 * frame_rate / lags / PRIOR_BPM) / PRIOR_OCTAVES) ** 2)
+    best = int(lags[np.argmax(autocorrelation[lags] * prior)])
+    if autocorrelation[best] <= MIN_PERIODICITY * autocorrelation[0]:
+        return None
+
+    # 放物線補間で周期を 1 フレームより細かく求める
+    period = float(best)
+    left, center, right = autocorrelation[best - 1:best + 2]
+    curvature = left - 2 * center + right
+    if curvature < 0:
+        period += 0.5 * (left - right) / curvature
+    return 60.0 * frame_rate / period, period
+
+
+def track_beats(onset, period):
+    """周期 period のグリッドの位相をオンセットに合わせ、各ビートを近くのピークに寄せる"""
+    length = len(onset)
+    phases = np.arange(int(math.ceil(period)))
+    positions = np.rint(phases[:, None] + period * np.arange(int(length / period) + 1)[None, :]).astype(int)
+    valid = positions < length
+    scores = np.where(valid, onset[np.minimum(positions, length - 1)], 0.0).sum(axis=1)
+    grid = positions[np.argmax(scores)]
+    grid = grid[grid < length]
+
+    radius = max(1, int(period * 0.1))
+    padded = np.pad(onset, radius)
+    windows = sliding_window_view(padded, 2 * radius + 1)[grid]
+    beats = grid + np.argmax(windows, axis=1) - radius
+    return np.unique(np.clip(beats, 0, length - 1))
+
+
+def novelty_curve(features, half=KERNEL_BEATS):
+    """
+    行ごとに正規化した特徴量の自己類似度に、幅 2 * half の市松模様カーネルを当てる
+
+    S[i + a, i + b]（a, b は -half 〜 half - 1）は S[j, j + lag] の帯
+    （j = i + min(a, b), lag = |a - b|）から引けるので、帯だけを計算する。
+    """
+    count, dimension = features.shape
+    padded = np.zeros((count + 4 * half, dimension), dtype=np.float32)
+    padded[half:half + count] = features
+    rows = count + 2 * half
+    banded = np.stack(
+        [(padded[:rows] * padded[lag:lag + rows]).sum(axis=1) for lag in range(2 * half)], axis=1
+    )
+
+    offsets = np.arange(-half, half)
+    centers = offsets + 0.5
+    sign = np.sign(centers)[:, None] * np.sign(centers)[None, :]
+    gauss = np.exp(-0.5 * (centers[:, None] ** 2 + centers[None, :] ** 2) / (half / 2.0) ** 2)
+    kernel = sign * gauss
+
+    index = np.arange(count)
+    novelty = np.zeros(count, dtype=np.float32)
+    for a, offset in enumerate(offsets):
+        starts = np.minimum(offset, offsets) + half
+        lags = np.abs(offset - offsets)
+        novelty += (banded[index[:, None] + starts[None, :], lags[None, :]] * kernel[a]).sum(axis=1)
+    return novelty
+
+
+def _pick_boundaries(novelty, beat_times, min_gap):
+    """ノベルティの極大のうち強いものから、min_gap 秒以上離れた境界を選ぶ"""
+    if len(novelty) < 3 or not novelty.any():
+        return []
+    radius = KERNEL_BEATS // 2
+    local_max = sliding_window_view(np.pad(novelty, radius, constant_values=-np.inf), 2 * radius + 1).max(axis=1)
+    threshold = novelty.mean() + 0.5 * novelty.std()
+    candidates = np.flatnonzero((novelty >= local_max) & (novelty > threshold) & (novelty > 0))
+
+    chosen = []
+    for index in candidates[np.argsort(-novelty[candidates])]:
+        time = beat_times[index]
+        if time < min_gap or time > beat_times[-1] - min_gap / 2:
+            continue
+        if all(abs(time - beat_times[other]) >= min_gap for other in chosen):
+            chosen.append(index)
+    return sorted(chosen)
+
+
+def _label_sections(features, starts, count):
+    """平均特徴量が似ているセクションに同じラベル（A, B, C ...）を付ける"""
+    labels = []
+    representatives = []
+    for start, end in zip(starts, starts[1:] + [count]):
+        mean = features[start:end].mean(axis=0)
+        mean /= np.linalg.norm(mean) or 1.0
+        similarities = [float(mean @ other) for other in representatives]
+        if similarities and max(similarities) >= LABEL_SIMILARITY:
+            labels.append(labels[int(np.argmax(similarities))])
+            continue
+        representatives.append(mean)
+        labels.append(chr(ord('A') + (len(representatives) - 1) % 26))
+    return labels
+
+
+def find_sections(log_bands, beats, frame_rate, duration):
+    """ビート同期の特徴量のノベルティからセクションを求める"""
+    if len(beats) < 2:
+        return [{'start': 0.0, 'end': round(duration, 3), 'label': 'A'}]
+
+    rows = beats // SECTION_DECIMATION
+    lengths = np.diff(np.append(rows, len(log_bands)))
+    features = np.add.reduceat(log_bands, rows, axis=0) / np.maximum(lengths, 1)[:, None]
+    features -= features.mean(axis=0)
+    features /= np.maximum(np.linalg.norm(features, axis=1, keepdims=True), 1e-6)
+
+    beat_times = beats / frame_rate
+    starts = [0] + _pick_boundaries(novelty_curve(features), beat_times, MIN_SECTION_SECONDS)
+    labels = _label_sections(features, starts, len(beats))
+    times = [0.0] + [float(beat_times[index]) for index in starts[1:]] + [duration]
+    return [
+        {'start': round(start, 3), 'end': round(end, 3), 'label': label}
+        for start, end, label in zip(times, times[1:], labels)
+    ]
+
+
+def analyze(path, duration=None):
+    """
+    音声ファイルのテンポ・ビート位置（秒）・セクションを求める
+
+    戻り値は MusicAnalysis の各列の dict。デコードできない場合は AudioDecodeError。
+    """
+    log_bands, onset, frame_rate, duration = spectral_features(open_pcm(path, duration=duration, sample_rate=SAMPLE_RATE))
+    tempo = estimate_tempo(onset, frame_rate)
+    if tempo is None:
+        return {'bpm': None, 'beat_times': [], 'sections': find_sections(log_bands, [], frame_rate, duration)}
+
+    bpm, period = tempo
+    beats = track_beats(onset, period)
+    return {
+        'bpm': round(float(bpm), 2),
+        'beat_times': [round(float(time), 3) for time in beats / frame_rate],
+        'sections': find_sections(log_bands, beats, frame_rate, duration),
+    }
+
+
+def get_analysis(sha256):
+    """保存済みの解析結果（未解析なら None）"""
+    return MusicAnalysis.objects.filter(sha256=sha256).first()
+
+
+def save_analysis(sha256, result):
+    MusicAnalysis.objects.update_or_create(sha256=sha256, defaults={
+        'bpm': result.get('bpm'),
+        'beat_times': result.get('beat_times', []),
+        'sections': result.get('sections', []),
+        'error': result.get('error', ''),
+    })
+
+
+def previous_boundary(sections, position, gap=PREVIOUS_SECTION_GAP):
+    """position（秒）より gap 秒以上前にある最後のセクションの先頭"""
+    starts = [section['start'] for section in sections]
+    index = bisect.bisect_right(starts, position - gap) - 1
+    return starts[index] if index >= 0 else 0.0
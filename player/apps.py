@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class PlayerConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "player"
+
+    def ready(self):
+        # 登録音声・コマンドのキャッシュの破棄と、音声を削除したときの後始末のシグナルを接続
+        from . import artwork, fingerprint, keywords, matcher  # noqa: F401
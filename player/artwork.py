@@ -0,0 +1,176 @@
+"""
+埋め込みアートワークの抽出とサムネイル
+
+mp3（ID3 の APIC）・FLAC（PICTURE ブロック）・m4a（covr）・Ogg
+（METADATA_BLOCK_PICTURE）・WAV（id3 チャンク）に埋め込まれた画像を mutagen で
+取り出し、Pillow で PLAYER_ARTWORK_SIZES の各サイズの WebP と JPEG を作っておく
+（jobs.py の 'artwork'）。元の画像は数 MB のこともあるので配信しない。
+
+サムネイルは画像の内容ハッシュをキーに MEDIA_ROOT/artwork/ab/<hash>-<size>.<ext> に
+保存する。同じアルバムの曲のように同じ画像が埋め込まれていれば 1 組で済む。
+URL が内容で決まるので、配信（views.get_artwork）は immutable で長期間キャッシュ
+させ、クライアントは表示に必要な大きさの 1 枚を一度だけ取得する。
+音声を削除すると AudioArtwork も削除し、どの AudioArtwork からも参照されなくなった
+サムネイルはリーパーが削除する。
+"""
+import base64
+import hashlib
+import io
+import os
+import re
+
+from django.conf import settings
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.urls import reverse
+from mutagen import File as MutagenFile
+from mutagen.flac import Picture
+from PIL import Image, ImageOps
+
+from .models import AudioArtwork, AudioBlob
+
+FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpg': ('JPEG', 'image/jpeg'),
+}
+FRONT_COVER = 3  # ID3 / FLAC の画像の種類
+ARTWORK_KEY_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+class ArtworkError(Exception):
+    """埋め込み画像を読めない場合の例外"""
+
+
+def artwork_root():
+    return os.path.join(settings.MEDIA_ROOT, 'artwork')
+
+
+def thumbnail_path(key, size, extension):
+    return os.path.join(artwork_root(), key[:2], f'{key}-{size}.{extension}')
+
+
+def _pictures(audio):
+    """(画像の種類, バイト列) の列"""
+    pictures = [(picture.type, picture.data) for picture in getattr(audio, 'pictures', None) or []]
+    tags = audio.tags
+    if tags is None:
+        return pictures
+    if hasattr(tags, 'getall'):
+        # ID3（mp3 / WAV）
+        return pictures + [(frame.type, frame.data) for frame in tags.getall('APIC')]
+    for value in tags.get('covr', []):
+        pictures.append((FRONT_COVER, bytes(value)))
+    for value in tags.get('metadata_block_picture', []):
+        try:
+            picture = Picture(base64.b64decode(value))
+        except Exception:
+            continue
+        pictures.append((picture.type, picture.data))
+    return pictures
+
+
+def extract_picture(path):
+    """埋め込まれた画像（表紙を優先）のバイト列。無ければ None"""
+    try:
+        audio = MutagenFile(path)
+    except Exception as e:
+        raise ArtworkError(f'mutagen failed: {e}') from e
+    if audio is None:
+        return None
+    pictures = [picture for picture in _pictures(audio) if picture[1]]
+    if not pictures:
+        return None
+    return min(pictures, key=lambda picture: picture[0] != FRONT_COVER)[1]
+
+
+def render_thumbnails(data):
+    """
+    画像から各サイズのサムネイルを作って保存する
+
+    長辺が元の画像より大きいサイズは作らない（元の画像が最小のサイズより
+    小さければ、そのままの大きさで最小のサイズとして作る）。作成済みの
+    サムネイルは作り直さない。戻り値は AudioArtwork の各列の dict。
+    """
+    key = hashlib.sha256(data).hexdigest()
+    try:
+        image = Image.open(io.BytesIO(data))
+        width, height = image.size
+        largest = max(settings.PLAYER_ARTWORK_SIZES)
+        # JPEG は必要な大きさに近い縮小率でデコードする
+        image.draft('RGB', (largest, largest))
+        image = ImageOps.exif_transpose(image)
+        if image.mode in ('RGBA', 'LA', 'P', 'PA'):
+            # 透過は白で埋める（JPEG には透過が無い）
+            rgba = image.convert('RGBA')
+            image = Image.new('RGB', rgba.size, 'white')
+            image.paste(rgba, mask=rgba.getchannel('A'))
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise ArtworkError(f'unreadable picture: {e}') from e
+
+    sizes = sorted(size for size in settings.PLAYER_ARTWORK_SIZES if size <= max(width, height))
+    sizes = sizes or [min(settings.PLAYER_ARTWORK_SIZES)]
+    os.makedirs(os.path.dirname(thumbnail_path(key, 0, 'jpg')), exist_ok=True)
+    # 大きいサイズから順に縮小し、小さいサイズは直前のサムネイルから作る
+    for size in reversed(sizes):
+        image.thumbnail((size, size), Image.Resampling.LANCZOS)
+        for extension, (format_name, _) in FORMATS.items():
+            path = thumbnail_path(key, size, extension)
+            try:
+                # 作成済みなら更新時刻だけ進め、保存するまでにリーパーが消さないようにする
+                os.utime(path)
+                continue
+            except FileNotFoundError:
+                pass
+            temp_path = f'{path}.{os.getpid()}.tmp'
+            image.save(temp_path, format_name, quality=settings.PLAYER_ARTWORK_QUALITY)
+            os.replace(temp_path, path)
+    return {'artwork': key, 'width': width, 'height': height, 'sizes': sizes}
+
+
+def extract(path):
+    """音声ファイルの埋め込み画像のサムネイルを作る（画像が無ければ artwork が空の dict）"""
+    data = extract_picture(path)
+    if data is None:
+        return {'artwork': '', 'width': 0, 'height': 0, 'sizes': []}
+    return render_thumbnails(data)
+
+
+def save_artwork(sha256, result):
+    AudioArtwork.objects.update_or_create(sha256=sha256, defaults={
+        'artwork': result.get('artwork', ''),
+        'width': result.get('width', 0),
+        'height': result.get('height', 0),
+        'sizes': result.get('sizes', []),
+        'error': result.get('error', ''),
+    })
+
+
+@receiver(post_delete, sender=AudioBlob)
+def _forget_artwork(sender, instance, **kwargs):
+    """
+    音声を削除したら AudioArtwork も削除する
+
+    サムネイルは他の音声と共有していることがあるので、どこからも参照されなくなった
+    ものをリーパーが消す（reaper.Reaper.sweep_artwork）。
+    """
+    AudioArtwork.objects.filter(sha256=instance.sha256).delete()
+
+
+def get_artwork(sha256):
+    """
+    クライアントに渡すサムネイルの一覧（無い・未抽出なら None）
+
+    [{size, webp, jpg}, ...] の URL の列で、クライアントは srcset で選ぶ。
+    """
+    artwork = AudioArtwork.objects.filter(sha256=sha256).exclude(artwork='').values('artwork', 'sizes').first()
+    if artwork is None:
+        return None
+    return [
+        {'size': size, **{
+            extension: reverse('player:get_artwork', args=[artwork['artwork'], size, extension])
+            for extension in FORMATS
+        }}
+        for size in artwork['sizes']
+    ]
@@ -0,0 +1,59 @@
+"""
+ASGI（uvicorn ワーカー）用の非同期 View
+
+アップロード・ファイル URL 取得・音声配信・再生位置の API を非同期で処理する。
+リクエスト本文の受信やレスポンスの送信を待つ間はワーカーを占有せず、
+ファイル I/O・mutagen・DB アクセスなどのブロッキング処理だけを
+上限付きスレッドプール（executor.run_blocking）で実行する。
+
+settings.PLAYER_ASYNC_VIEWS が True の場合に urls.py から使われる。
+処理内容は views の同期版と同じなので、同期版をプール上で呼び出す。
+"""
+import functools
+import os
+
+from django.http import HttpResponseNotAllowed, JsonResponse
+
+from . import storage, views
+from .executor import run_blocking
+
+
+def _offload(view):
+    """同期 View をスレッドプールで実行する非同期 View を作る"""
+    @functools.wraps(view)
+    async def async_view(request, *args, **kwargs):
+        return await run_blocking(view, request, *args, **kwargs)
+    return async_view
+
+
+upload_file = _offload(views.upload_file)
+upload_file_lightweight = _offload(views.upload_file_lightweight)
+get_file_url_lightweight = _offload(views.get_file_url_lightweight)
+create_upload = _offload(views.create_upload)
+upload_status = _offload(views.upload_status)
+upload_chunk = _offload(views.upload_chunk)
+finalize_upload = _offload(views.finalize_upload)
+save_playback_position = _offload(views.save_playback_position)
+save_playback_positions = _offload(views.save_playback_positions)
+get_playback_position = _offload(views.get_playback_position)
+
+
+def _stream_response(request, file_id):
+    file_info = views._find_session_file(request, file_id)
+    if not file_info or not os.path.exists(file_info.get('file_path', '')):
+        return None
+    sha256 = file_info.get('sha256')
+    if sha256:
+        storage.touch(sha256)
+    return views._media_response(request, file_info, asynchronous=True)
+
+
+async def stream_file(request, file_id):
+    """Range リクエスト対応の音声ストリーミング配信（チャンクごとにプールで読み出す）"""
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET', 'HEAD'])
+
+    response = await run_blocking(_stream_response, request, file_id)
+    if response is None:
+        return JsonResponse({'error': 'ファイルが見つかりません'}, status=404)
+    return response
@@ -0,0 +1,317 @@
+"""
+サーバー側解析用の PCM 読み出し（波形ピーク・テンポ・ラウドネス・音声コマンドで共通）
+
+    source = open_pcm(path, duration=duration, sample_rate=22050)
+    for block in source.blocks(65536):      # float32、最後のブロック以外は 65536 フレーム
+        ...
+
+PCM の WAV（8/16/24/32bit 整数・32/64bit 浮動小数点、WAVE_FORMAT_EXTENSIBLE を含む）は
+data チャンクを numpy.memmap で開き、ブロックごとにその範囲だけを float32 に変換する。
+ファイル全体を読み込んだり、wave.readframes のように bytes へコピーしたりしない
+（bytes で渡された録音クリップも np.frombuffer でコピーせずに読む）。
+それ以外の形式（mp3 / flac / aac / ogg）は ffmpeg がインストールされている場合のみ
+パイプ経由でストリーミングデコードする。
+
+チャンネルの平均（mono=True）とサンプリングレートの変換（sample_rate）は
+ブロックごとに行い、フィルターの状態だけを次のブロックへ引き継ぐ。
+どの形式でもメモリはブロックの大きさに比例し、曲の長さや同時に解析する
+曲の数 × 長さにはよらない。
+"""
+import io
+import shutil
+import struct
+import subprocess
+
+import numpy as np
+
+# ffmpeg でデコードする場合の既定のサンプリングレート（波形解析用途なので低めで十分）
+DECODE_SAMPLE_RATE = 22050
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# (形式, ビット数) -> (memmap の dtype, 0 の値, float32 への倍率)
+WAV_SAMPLE_TYPES = {
+    (WAVE_FORMAT_PCM, 8): (np.uint8, 128.0, 1 / 128.0),
+    (WAVE_FORMAT_PCM, 16): (np.dtype('<i2'), 0.0, 1 / 32768.0),
+    (WAVE_FORMAT_PCM, 24): (np.uint8, 0.0, 1 / 8388608.0),  # 3 バイトずつ組み立てる
+    (WAVE_FORMAT_PCM, 32): (np.dtype('<i4'), 0.0, 1 / 2147483648.0),
+    (WAVE_FORMAT_IEEE_FLOAT, 32): (np.dtype('<f4'), 0.0, 1.0),
+    (WAVE_FORMAT_IEEE_FLOAT, 64): (np.dtype('<f8'), 0.0, 1.0),
+}
+
+RESAMPLE_TAPS = 31  # ダウンサンプリング前のローパス FIR のタップ数
+
+
+class AudioDecodeError(Exception):
+    """PCM にデコードできない場合の例外"""
+
+
+def fixed_blocks(stream, block_frames):
+    """任意の長さのブロックの列を、最後以外は block_frames フレームのブロックに詰め直す"""
+    pending = []
+    filled = 0
+    for block in stream:
+        if not filled and len(block) == block_frames:
+            yield block
+            continue
+        pending.append(block)
+        filled += len(block)
+        while filled >= block_frames:
+            joined = np.concatenate(pending) if len(pending) > 1 else pending[0]
+            yield joined[:block_frames]
+            rest = joined[block_frames:]
+            pending = [rest] if len(rest) else []
+            filled = len(rest)
+    if filled:
+        yield np.concatenate(pending) if len(pending) > 1 else pending[0]
+
+
+class Resampler:
+    """
+    ブロックごとに渡す PCM のサンプリングレートを変換する
+
+    解析用途なので線形補間だが、ダウンサンプリングの場合は先に窓付き sinc の
+    ローパスを掛けて折り返しを抑える。フィルターの遅延は出力位置をずらして打ち消す。
+    """
+
+    def __init__(self, source_rate, target_rate):
+        self.step = source_rate / target_rate
+        self.kernel = None
+        delay = 0.0
+        if target_rate < source_rate:
+            n = np.arange(RESAMPLE_TAPS) - (RESAMPLE_TAPS - 1) / 2
+            cutoff = 0.45 * target_rate / source_rate
+            kernel = np.sinc(2 * cutoff * n) * np.hamming(RESAMPLE_TAPS)
+            self.kernel = (kernel / kernel.sum()).astype(np.float32)
+            delay = (RESAMPLE_TAPS - 1) / 2
+        self.history = None  # ローパスに使う直前の入力
+        self.tail = None  # 補間に使う直前の出力（1 サンプル）
+        self.consumed = 0  # これまでに受け取った入力サンプル数
+        self.position = delay  # 次の出力サンプルの入力上の位置
+
+    def _lowpass(self, samples):
+        if self.kernel is None:
+            return samples
+        if self.history is None:
+            self.history = np.zeros((len(self.kernel) - 1,) + samples.shape[1:], dtype=np.float32)
+        buffer = np.concatenate([self.history, samples])
+        self.history = buffer[len(buffer) - (len(self.kernel) - 1):]
+        if samples.ndim == 1:
+            return np.convolve(buffer, self.kernel, mode='valid')
+        return np.stack(
+            [np.convolve(buffer[:, channel], self.kernel, mode='valid') for channel in range(samples.shape[1])],
+            axis=1,
+        )
+
+    def process(self, samples):
+        """入力ブロックを変換する（出力の長さはブロックごとに 1 サンプル程度前後する）"""
+        filtered = self._lowpass(samples)
+        data = filtered if self.tail is None else np.concatenate([self.tail, filtered])
+        start = self.consumed - (0 if self.tail is None else 1)  # data[0] の入力上の位置
+        self.consumed += len(filtered)
+        self.tail = filtered[-1:]
+
+        last = self.consumed - 1
+        if self.position > last:
+            return filtered[:0]
+        count = int((last - self.position) // self.step) + 1
+        positions = self.position + self.step * np.arange(count) - start
+        self.position += self.step * count
+
+        index = np.minimum(positions.astype(np.int64), len(data) - 2) if len(data) > 1 else np.zeros(count, int)
+        fraction = (positions - index).astype(np.float32)
+        following = np.minimum(index + 1, len(data) - 1)
+        if data.ndim > 1:
+            fraction = fraction[:, None]
+        return (data[index] * (1 - fraction) + data[following] * fraction).astype(np.float32)
+
+    def stream(self, blocks):
+        for block in blocks:
+            if len(block):
+                yield self.process(block)
+
+
+class PCMSource:
+    """
+    ブロック単位で float32 PCM を返す音声ソース
+
+    blocks() は既定ではチャンネルを平均したモノラルの 1 次元配列を、
+    mono=False の場合は [フレーム数, channels] の配列を返す。sample_rate は
+    blocks() が返す PCM のサンプリングレートで、元のレート（native_rate）と
+    違う場合はブロックごとに変換する。
+    """
+
+    def __init__(self, path, sample_rate, frames=None, channels=1, native_rate=None):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.native_rate = native_rate or sample_rate
+        self.frames = frames  # 出力のフレーム数（不明な場合は None）
+        self.channels = channels
+
+    def decode(self, block_frames, mono):
+        """元のサンプリングレートの PCM をブロック単位で返す（サブクラスで実装）"""
+        raise NotImplementedError
+
+    def blocks(self, block_frames=65536, mono=True):
+        stream = self.decode(block_frames, mono)
+        if self.native_rate != self.sample_rate:
+            stream = Resampler(self.native_rate, self.sample_rate).stream(stream)
+        return fixed_blocks(stream, block_frames)
+
+
+def _parse_wav(f):
+    """RIFF のチャンクをたどって (形式, チャンネル数, レート, ビット数, data の位置, data の長さ) を返す"""
+    riff = f.read(12)
+    if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:12] != b'WAVE':
+        raise AudioDecodeError('not a RIFF/WAVE file')
+    fmt = None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            raise AudioDecodeError('data chunk not found')
+        chunk_id, size = struct.unpack('<4sI', header)
+        if chunk_id == b'fmt ':
+            body = f.read(size)
+            if len(body) < 16:
+                raise AudioDecodeError('truncated fmt chunk')
+            format_tag, channels, sample_rate, _, _, bits = struct.unpack_from('<HHIIHH', body)
+            if format_tag == WAVE_FORMAT_EXTENSIBLE and len(body) >= 26:
+                # SubFormat GUID の先頭 2 バイトが実際の形式
+                format_tag = struct.unpack_from('<H', body, 24)[0]
+            fmt = (format_tag, channels, sample_rate, bits)
+            f.seek(size % 2, io.SEEK_CUR)
+        elif chunk_id == b'data':
+            if fmt is None:
+                raise AudioDecodeError('fmt chunk not found')
+            return fmt + (f.tell(), size)
+        else:
+            f.seek(size + size % 2, io.SEEK_CUR)
+
+
+class WavSource(PCMSource):
+    """
+    PCM の WAV を numpy.memmap（bytes の場合は np.frombuffer）で読む
+
+    sample_rate を指定すると、そのレートに変換しながら返す。
+    """
+
+    def __init__(self, path, sample_rate=None):
+        self.data = path if isinstance(path, (bytes, bytearray, memoryview)) else None
+        try:
+            if self.data is not None:
+                format_tag, channels, native_rate, bits, offset, size = _parse_wav(io.BytesIO(self.data))
+                size = min(size, len(self.data) - offset)
+            else:
+                with open(path, 'rb') as f:
+                    format_tag, channels, native_rate, bits, offset, size = _parse_wav(f)
+                    size = min(size, f.seek(0, io.SEEK_END) - offset)
+        except (OSError, struct.error) as e:
+            raise AudioDecodeError(str(e))
+        if (format_tag, bits) not in WAV_SAMPLE_TYPES:
+            raise AudioDecodeError(f'unsupported WAV format: tag={format_tag:#x} bits={bits}')
+        if channels <= 0 or native_rate <= 0:
+            raise AudioDecodeError('invalid WAV header')
+
+        self.bits = bits
+        self.dtype, self.zero, self.scale = WAV_SAMPLE_TYPES[(format_tag, bits)]
+        self.offset = offset
+        native_frames = max(size, 0) // (channels * bits // 8)
+        sample_rate = sample_rate or native_rate
+        super().__init__(
+            None if self.data is not None else path, sample_rate,
+            int(native_frames * sample_rate / native_rate), channels, native_rate,
+        )
+        self.native_frames = native_frames
+
+    def _samples(self):
+        """data チャンク全体のビュー（[フレーム数, チャンネル数]、24bit は [.., .., 3] のバイト）"""
+        shape = (self.native_frames, self.channels) + ((3,) if self.bits == 24 else ())
+        if self.native_frames == 0:
+            return np.zeros(shape, dtype=self.dtype)
+        if self.data is not None:
+            count = int(np.prod(shape))
+            return np.frombuffer(self.data, dtype=self.dtype, count=count, offset=self.offset).reshape(shape)
+        return np.memmap(self.path, dtype=self.dtype, mode='r', offset=self.offset, shape=shape)
+
+    def _to_float(self, raw):
+        if self.bits == 24:
+            raw = raw.astype(np.int32)
+            packed = raw[..., 0] | (raw[..., 1] << 8) | (raw[..., 2] << 16)
+            samples = ((packed << 8) >> 8).astype(np.float32)  # 符号拡張
+        else:
+            samples = raw.astype(np.float32)
+            if self.zero:
+                samples -= self.zero
+        if self.scale != 1.0:
+            samples *= self.scale
+        return samples
+
+    def decode(self, block_frames, mono):
+        samples = self._samples()
+        try:
+            for start in range(0, self.native_frames, block_frames):
+                block = self._to_float(samples[start:start + block_frames])
+                yield block.mean(axis=1) if mono else block
+        finally:
+            del samples
+
+
+class FFmpegSource(PCMSource):
+
+    def __init__(self, path, frames=None, channels=None, sample_rate=DECODE_SAMPLE_RATE):
+        if not shutil.which('ffmpeg'):
+            raise AudioDecodeError('ffmpeg is not installed')
+        super().__init__(path, sample_rate, frames, channels or 2)
+
+    def decode(self, block_frames, mono):
+        # レートの変換は ffmpeg に任せる
+        channels = 1 if mono else self.channels
+        process = subprocess.Popen(
+            ['ffmpeg', '-v', 'error', '-i', self.path,
+             '-f', 'f32le', '-ac', str(channels), '-ar', str(self.sample_rate), '-'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        finished = False
+        try:
+            frame_bytes = 4 * channels
+            block_bytes = block_frames * frame_bytes
+            while True:
+                raw = process.stdout.read(block_bytes)
+                if not raw:
+                    break
+                usable = len(raw) - len(raw) % frame_bytes
+                samples = np.frombuffer(raw[:usable], dtype='<f4')
+                yield samples if mono else samples.reshape(-1, channels)
+            finished = True
+        finally:
+            process.stdout.close()
+            if not finished:
+                # 呼び出し側が途中で読むのをやめた（または例外）場合だけ止める
+                process.kill()
+            process.wait()
+        # 最後まで読んだ場合は ffmpeg 自身の終了コードで成否を判断する
+        if process.returncode != 0:
+            raise AudioDecodeError(f'ffmpeg exited with {process.returncode}')
+
+
+def open_pcm(path, duration=None, channels=None, sample_rate=None, decode_rate=DECODE_SAMPLE_RATE):
+    """
+    ファイル形式に応じた PCMSource を返す
+
+    sample_rate を指定するとどの形式でもそのレートで返す。指定しない場合、
+    WAV は元のレートのまま、それ以外は decode_rate でデコードする。
+    duration（秒）が分かっている場合は総フレーム数の見積もりに、channels は
+    ffmpeg でチャンネルごとに読む（mono=False）場合のチャンネル数に使う。
+    """
+    if path.lower().endswith('.wav'):
+        try:
+            return WavSource(path, sample_rate=sample_rate)
+        except AudioDecodeError:
+            # 圧縮された WAV（ADPCM など）は ffmpeg に任せる
+            pass
+    rate = sample_rate or decode_rate
+    frames = int(duration * rate) if duration else None
+    return FFmpegSource(path, frames=frames, channels=channels, sample_rate=rate)
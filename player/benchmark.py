@@ -0,0 +1,481 @@
+"""
+プレイヤー API の性能ベンチマーク
+
+合成した WAV / MP3 / FLAC（synth）を使って、アップロード（multipart・分割）、
+ファイル URL 取得、音声配信、再生位置の保存・取得、音声コマンドの各 API を
+次の経路で呼び出し、スループットと p50 / p95 / p99 レイテンシ、メモリ使用量を測る。
+
+    client  Django のテストクライアント（ミドルウェアと View だけ）
+    wsgi    プロセス内の WSGI サーバー（wsgiref、スレッド）
+    asgi    プロセス内の uvicorn（async_views を使う）
+
+レイテンシの計測中は tracemalloc を止めておき、シナリオごとに別に数回だけ
+tracemalloc を有効にして Python ヒープのピークを測る（計測による遅れが
+レイテンシに混ざらないようにする）。RSS はプロセスの最大値（ru_maxrss）。
+
+結果は JSON で保存し、compare() で別のコミットの結果と比べられる。
+"""
+import http.client
+import importlib
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+import django
+import numpy as np
+from django.conf import settings
+from django.test import Client
+from django.urls import clear_url_caches
+
+from . import keywords, synth
+
+# 結果に含めるレイテンシのパーセンタイル
+PERCENTILES = (50, 95, 99)
+FORMATS = ('wav', 'mp3', 'flac')
+CONTENT_TYPES = {'wav': 'audio/wav', 'mp3': 'audio/mpeg', 'flac': 'audio/flac'}
+
+
+def make_fixture(extension, seconds):
+    """形式と長さを指定して合成音声を生成"""
+    if extension == 'wav':
+        return synth.wav_bytes(seconds=seconds)
+    if extension == 'mp3':
+        return synth.mp3_bytes(seconds=seconds)
+    if extension == 'flac':
+        return synth.flac_bytes(seconds=seconds)
+    raise ValueError(f'unsupported format: {extension}')
+
+
+def unique_variant(data, extension, number):
+    """
+    解析結果を変えずに内容ハッシュだけが異なるコピーを作る
+
+    同じ内容は重複排除されて書き込みも解析もされないため、アップロードの
+    計測では毎回このコピーを送る。FLAC は STREAMINFO の MD5、それ以外は
+    末尾のバイト（WAV の最後のサンプル、MP3 の最後のフレームの埋め草）を書き換える。
+    """
+    data = bytearray(data)
+    stamp = number.to_bytes(8, 'little')
+    if extension == 'flac':
+        data[26:34] = stamp
+    else:
+        data[-8:] = stamp
+    return bytes(data)
+
+
+def _multipart(data, filename, content_type):
+    boundary = uuid.uuid4().hex
+    body = (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        f'Content-Type: {content_type}\r\n\r\n'
+    ).encode('ascii') + data + f'\r\n--{boundary}--\r\n'.encode('ascii')
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+class ClientTransport:
+    """Django のテストクライアントで View を直接呼ぶ"""
+
+    name = 'client'
+
+    def __init__(self):
+        self.client = Client()
+
+    def clone(self):
+        return self
+
+    def request(self, method, path, body=b'', content_type=None, headers=None):
+        extra = {f'HTTP_{key.upper().replace("-", "_")}': value for key, value in (headers or {}).items()}
+        response = self.client.generic(
+            method, path, body, content_type=content_type or 'application/octet-stream', **extra
+        )
+        if response.streaming:
+            content = b''.join(response.streaming_content)
+        else:
+            content = response.content
+        return response.status_code, content
+
+    def close(self):
+        pass
+
+
+class HTTPTransport:
+    """プロセス内サーバーへ keep-alive の HTTP で接続する"""
+
+    def __init__(self, name, port, cookies=None):
+        self.name = name
+        self.port = port
+        self.cookies = {} if cookies is None else cookies  # クローン間で共有する
+        self.connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+
+    def clone(self):
+        return HTTPTransport(self.name, self.port, self.cookies)
+
+    def request(self, method, path, body=b'', content_type=None, headers=None):
+        headers = dict(headers or {})
+        if content_type:
+            headers['Content-Type'] = content_type
+        if self.cookies:
+            headers['Cookie'] = '; '.join(f'{key}={value}' for key, value in self.cookies.items())
+        try:
+            self.connection.request(method, path, body=body or None, headers=headers)
+            response = self.connection.getresponse()
+        except (http.client.HTTPException, OSError):
+            # サーバーが keep-alive を切った場合はつなぎ直す
+            self.connection.close()
+            self.connection.request(method, path, body=body or None, headers=headers)
+            response = self.connection.getresponse()
+        content = response.read()
+        for header in response.headers.get_all('Set-Cookie') or []:
+            key, _, rest = header.partition('=')
+            self.cookies[key.strip()] = rest.split(';', 1)[0]
+        return response.status, content
+
+    def close(self):
+        self.connection.close()
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _use_async_views(enabled):
+    """
+    urls.py を読み直して、同期版・非同期版の View を切り替える
+
+    ルートの URLconf の include() はリゾルバーが読み込み済みの urlpatterns を
+    持ち続けるので、player.urls だけでなくルートの URLconf も読み直す。
+    """
+    from . import urls
+    settings.PLAYER_ASYNC_VIEWS = enabled
+    importlib.reload(urls)
+    importlib.reload(importlib.import_module(settings.ROOT_URLCONF))
+    clear_url_caches()
+
+
+class WSGIServerThread:
+    """wsgiref のスレッドサーバー"""
+
+    def __init__(self):
+        from django.core.wsgi import get_wsgi_application
+        self.server = make_server(
+            '127.0.0.1', 0, get_wsgi_application(),
+            server_class=_ThreadingWSGIServer, handler_class=_QuietHandler,
+        )
+        self.port = self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ASGIServerThread:
+    """uvicorn を別スレッドのイベントループで動かす（非同期版の View を使う）"""
+
+    def __init__(self):
+        import uvicorn
+        from django.core.asgi import get_asgi_application
+        self.port = _free_port()
+        config = uvicorn.Config(
+            get_asgi_application(), host='127.0.0.1', port=self.port,
+            log_level='warning', access_log=False, lifespan='off',
+        )
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def __enter__(self):
+        self.previous = settings.PLAYER_ASYNC_VIEWS
+        _use_async_views(True)
+        self.thread.start()
+        deadline = time.monotonic() + 10
+        while not self.server.started:
+            if time.monotonic() > deadline or not self.thread.is_alive():
+                raise RuntimeError('uvicorn did not start')
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+        _use_async_views(self.previous)
+
+
+def summarize(latencies, elapsed, errors, transferred=0):
+    """レイテンシ（秒）の列から集計値を計算"""
+    result = {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+    }
+    if latencies:
+        milliseconds = np.array(latencies) * 1000
+        for percentile in PERCENTILES:
+            result[f'p{percentile}_ms'] = float(np.percentile(milliseconds, percentile))
+        result['mean_ms'] = float(milliseconds.mean())
+        result['max_ms'] = float(milliseconds.max())
+    if transferred:
+        result['mb_per_s'] = transferred / elapsed / 1e6 if elapsed else 0.0
+    return result
+
+
+def _max_rss():
+    """プロセスの最大 RSS（バイト）"""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+
+class Benchmark:
+    """
+    シナリオを順に実行して結果の dict を作る
+
+    シナリオは (名前, 1 回分の処理) で、処理は transport と回数を受け取り
+    (HTTP ステータス, 送受信したバイト数) を返す。
+    """
+
+    def __init__(self, durations=(5, 30), formats=FORMATS, iterations=50,
+                 upload_iterations=5, memory_iterations=3, concurrency=1, log=None):
+        self.durations = durations
+        self.formats = formats
+        self.iterations = iterations
+        self.upload_iterations = upload_iterations
+        self.memory_iterations = memory_iterations
+        self.concurrency = concurrency
+        self.log = log or (lambda message: None)
+        self.fixtures = {}
+
+    def prepare(self):
+        for extension in self.formats:
+            for seconds in self.durations:
+                self.fixtures[(extension, seconds)] = make_fixture(extension, seconds)
+        # 照合対象の登録音声（全員共通）
+        self.word = synth.wav_bytes(seconds=0.6, sample_rate=16000, channels=1, frequency=330.0)
+        keywords.enroll('', 'go_back', self.word)
+
+    def fixture_info(self):
+        return [
+            {'format': extension, 'seconds': seconds, 'bytes': len(data)}
+            for (extension, seconds), data in self.fixtures.items()
+        ]
+
+    def _upload(self, transport, data, name):
+        body, content_type = _multipart(data, name, CONTENT_TYPES[name.rsplit('.', 1)[-1]])
+        status, content = transport.request('POST', '/api/upload-lightweight/', body, content_type)
+        return status, content
+
+    def _upload_resumable(self, transport, data, name):
+        status, content = transport.request(
+            'POST', '/api/uploads/', json.dumps({'name': name, 'size': len(data)}).encode(),
+            'application/json'
+        )
+        if status != 201:
+            return status, content
+        upload = json.loads(content)
+        chunk_size = upload['chunk_size']
+        for index in range(upload['chunks']):
+            status, content = transport.request(
+                'PUT', f"/api/uploads/{upload['upload_id']}/chunks/{index}/",
+                data[index * chunk_size:(index + 1) * chunk_size], 'application/octet-stream'
+            )
+            if status != 200:
+                return status, content
+        return transport.request('POST', f"/api/uploads/{upload['upload_id']}/finalize/")
+
+    def scenarios(self, transport):
+        """(名前, 回数, 処理) の列。アップロードの後に読み出し系を並べる"""
+        counter = iter(range(1, 1 << 62))
+
+        def upload(extension, seconds, resumable):
+            data = self.fixtures[(extension, seconds)]
+            send = self._upload_resumable if resumable else self._upload
+
+            def run(transport):
+                variant = unique_variant(data, extension, next(counter))
+                status, _ = send(transport, variant, f'bench.{extension}')
+                return status, len(variant)
+            return run
+
+        for extension, seconds in self.fixtures:
+            yield f'upload:{extension}:{seconds}s', self.upload_iterations, upload(extension, seconds, False)
+            yield f'upload-resumable:{extension}:{seconds}s', self.upload_iterations, upload(extension, seconds, True)
+
+        # 読み出し系は最も長い WAV（無ければ最初のフィクスチャ）を登録して使う
+        key = max(self.fixtures, key=lambda key: (key[0] == 'wav', key[1]))
+        status, content = self._upload(transport, self.fixtures[key], f'reference.{key[0]}')
+        if status != 200:
+            raise RuntimeError(f'reference upload failed: {status} {content[:200]!r}')
+        file_id = json.loads(content)['file']['id']
+        middle = key[1] / 2
+
+        def simple(method, path, body=b'', content_type=None, headers=None):
+            def run(transport):
+                status, content = transport.request(method, path, body, content_type, headers)
+                return status, len(content)
+            return run
+
+        position = json.dumps({'file_id': file_id, 'position': 12.5}).encode()
+        yield 'file-url', self.iterations, simple('GET', f'/api/file-url-lightweight/{file_id}/')
+        yield 'stream:range-64k', self.iterations, simple(
+            'GET', f'/api/stream/{file_id}/', headers={'Range': 'bytes=0-65535'})
+        yield 'stream:seek', self.iterations, simple(
+            'GET', f'/api/stream/{file_id}/?t={middle}', headers={'Range': 'bytes=0-65535'})
+        yield 'stream:full', max(self.iterations // 10, 1), simple('GET', f'/api/stream/{file_id}/')
+        yield 'position:save', self.iterations, simple(
+            'POST', '/api/save-position/', position, 'application/json')
+        yield 'position:get', self.iterations, simple('GET', f'/api/get-position/{file_id}/')
+        yield 'voice:match', self.iterations, simple(
+            'POST', '/api/voice-command/match/', json.dumps({'text': 'ちょっと戻って'}).encode(),
+            'application/json')
+        yield 'voice:clip', self.iterations, simple(
+            'POST', '/api/voice-command/clip/', self.word, 'audio/wav')
+
+    def _measure(self, transport, iterations, run):
+        """iterations 回を concurrency 本に分けて実行し、レイテンシを集める"""
+        latencies = []
+        errors = 0
+        transferred = 0
+        lock = threading.Lock()
+        remaining = iter(range(iterations))
+
+        def worker(worker_transport):
+            nonlocal errors, transferred
+            for _ in remaining:
+                started = time.perf_counter()
+                try:
+                    status, size = run(worker_transport)
+                except Exception:
+                    status, size = 599, 0
+                elapsed = time.perf_counter() - started
+                with lock:
+                    latencies.append(elapsed)
+                    transferred += size
+                    if status >= 400:
+                        errors += 1
+
+        concurrency = 1 if transport.name == 'client' else self.concurrency
+        transports = [transport] + [transport.clone() for _ in range(concurrency - 1)]
+        started = time.perf_counter()
+        if concurrency == 1:
+            worker(transport)
+        else:
+            threads = [threading.Thread(target=worker, args=(t,)) for t in transports]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        elapsed = time.perf_counter() - started
+        for extra in transports[1:]:
+            extra.close()
+        return summarize(latencies, elapsed, errors, transferred)
+
+    def run_transport(self, transport):
+        results = {}
+        for name, iterations, run in self.scenarios(transport):
+            result = self._measure(transport, iterations, run)
+
+            tracemalloc.start()
+            try:
+                for _ in range(min(self.memory_iterations, iterations)):
+                    run(transport)
+                result['tracemalloc_peak'] = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            result['max_rss'] = _max_rss()
+
+            results[name] = result
+            self.log(
+                f"{transport.name:6} {name:28} {result['throughput']:8.1f} req/s  "
+                f"p50 {result.get('p50_ms', 0):8.2f} ms  p99 {result.get('p99_ms', 0):8.2f} ms  "
+                f"errors {result['errors']}"
+            )
+        return results
+
+    def run(self, transports=('client',)):
+        self.prepare()
+        report = {
+            'environment': environment(),
+            'options': {
+                'durations': list(self.durations),
+                'formats': list(self.formats),
+                'iterations': self.iterations,
+                'upload_iterations': self.upload_iterations,
+                'concurrency': self.concurrency,
+            },
+            'fixtures': self.fixture_info(),
+            'results': {},
+        }
+        for name in transports:
+            if name == 'client':
+                report['results'][name] = self.run_transport(ClientTransport())
+                continue
+            server_class = WSGIServerThread if name == 'wsgi' else ASGIServerThread
+            with server_class() as server:
+                transport = HTTPTransport(name, server.port)
+                try:
+                    report['results'][name] = self.run_transport(transport)
+                finally:
+                    transport.close()
+        return report
+
+
+def environment():
+    """結果と一緒に保存する実行環境"""
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=settings.BASE_DIR, timeout=5,
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = ''
+    return {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def compare(baseline, current, metric='p50_ms', threshold=0.1):
+    """
+    2 つの結果を比べて、metric が threshold（比率）以上悪化したシナリオを返す
+
+    戻り値は (経路, シナリオ, 以前の値, 今回の値, 変化率) のリスト。
+    """
+    regressions = []
+    for transport, scenarios in current.get('results', {}).items():
+        for name, result in scenarios.items():
+            before = baseline.get('results', {}).get(transport, {}).get(name, {}).get(metric)
+            after = result.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            if change >= threshold:
+                regressions.append((transport, name, before, after, change))
+    return regressions
@@ -0,0 +1,58 @@
+"""
+ブロッキング処理用の上限付きスレッドプール
+
+ASGI で動かす場合、ファイル I/O・mutagen による解析・DB アクセスは
+イベントループを止めないようこのプールで実行する。スレッド数に上限が
+あるため、遅いクライアントが大量に接続してもスレッドや DB 接続は
+PLAYER_BLOCKING_THREADS 本を超えて増えない。
+"""
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """プロセスで共有するスレッドプールを返す（初回呼び出し時に作成）"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=settings.PLAYER_BLOCKING_THREADS,
+                    thread_name_prefix='player-blocking',
+                )
+    return _executor
+
+
+def _call(func, args, kwargs):
+    # プールのスレッドはリクエストの開始・終了シグナルを受けないため、
+    # 期限切れや壊れた DB 接続の後始末をここで行う
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    同期関数をスレッドプールで実行して結果を待つ
+
+    PLAYER_BLOCKING_THREADS が 0 以下の場合は Django 標準の
+    sync_to_async（thread_sensitive）で実行する。
+    """
+    if settings.PLAYER_BLOCKING_THREADS <= 0:
+        return await sync_to_async(func, thread_sensitive=True)(*args, **kwargs)
+    loop = asyncio.get_running_loop()
+    # トレースなどの contextvars をプールのスレッドへ引き継ぐ
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(get_executor(), functools.partial(context.run, _call, func, args, kwargs))
@@ -0,0 +1,337 @@
+"""
+音響指紋による同じ録音の検出（スペクトルのピークの組の転置索引）
+
+同じ曲でも形式やビットレートを変えて再エンコードすると内容ハッシュが
+変わり、再生位置もテンポ・ラウドネスの解析もやり直しになる。そこで
+アップロード後のジョブ（jobs.py の 'fingerprint'）で音声の指紋を求め、
+索引に登録済みの録音と照合する。
+
+    1. 8 kHz モノラルに変換した PCM をブロック単位で STFT する
+    2. 周波数・時間の近傍で最大のビンをピークとして残す（コンステレーション）
+    3. 各ピークを、後に続く FAN_OUT 個のピークと組にして
+       (周波数1, 周波数2, 時間差) を 24 ビットのハッシュにする
+    4. ハッシュ -> (録音, 先頭からのフレーム) の転置索引（FingerprintHash）を引き、
+       同じ時間差で一致したハッシュの数が MIN_MATCHES 以上の録音を同じ曲とする
+
+指紋の計算は子プロセス（DB なし）で行い、結果は音声ファイルの横の
+ファイル（FINGERPRINT_SUFFIX）に書く。照合と登録はワーカーの親プロセスで
+行い（register）、索引に登録するのは最初の 1 つの音声の指紋だけにする。
+照合には指紋全体から LOOKUP_HASHES 個を均等に選んだハッシュだけを使うので、
+索引の大きさによらず 1 回の問い合わせで済む。
+
+同じ録音と分かった音声は、解析済みのテンポ・セクション・ラウドネスを
+時刻のずれ（AudioFingerprint.offset）を合わせて引き継ぎ、再生位置も
+同じ録音の別の音声で再生した位置から再開できる（versions）。
+
+音声（AudioBlob）を削除すると指紋も削除する（forget）。索引を持つ最初の音声を
+削除した場合は、残っている版の 1 つを最初の音声にして索引と再生位置を引き継ぐ。
+"""
+import logging
+import os
+from collections import Counter
+
+import numpy as np
+from django.db.models import F
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from numpy.lib.stride_tricks import sliding_window_view
+
+from .audio import open_pcm
+from .models import (
+    AudioBlob, AudioFingerprint, AudioLoudness, AudioMetadata, FingerprintHash, MusicAnalysis, PlaybackPosition,
+)
+from .storage import path_for
+
+logger = logging.getLogger(__name__)
+
+FINGERPRINT_SUFFIX = '.fp'
+
+SAMPLE_RATE = 8000
+BLOCK_FRAMES = 8192
+N_FFT = 1024
+HOP = 256  # 32 ms
+MIN_BIN = 8  # 62.5 Hz 未満は使わない
+PEAK_BINS = 20  # ピークの近傍（周波数方向の片側のビン数）
+PEAK_FRAMES = 10  # ピークの近傍（時間方向の片側のフレーム数）
+MIN_PEAK_DB = -60.0  # 振幅 1 の正弦波を 0 dB とした、ピークとみなす下限
+
+FAN_OUT = 5  # 1 つのピークと組にする後続のピークの数
+MAX_PAIR_FRAMES = 63  # 組にするピークの時間差の上限（6 ビット）
+MAX_PAIR_BINS = 128  # 組にするピークの周波数差の上限
+
+LOOKUP_HASHES = 400  # 照合に使うハッシュの数
+MIN_MATCHES = 20  # 同じ録音とみなす、時間差のそろった一致数の下限
+MAX_DURATION_DIFFERENCE = 2.0  # 同じ録音とみなす長さ（秒）の差の上限
+INSERT_BATCH = 500
+
+
+def fingerprint_path(audio_path):
+    """音声ファイルに対応する指紋ファイルのパス"""
+    return audio_path + FINGERPRINT_SUFFIX
+
+
+def find_peaks(source):
+    """
+    PCMSource のスペクトログラムのピークを求める
+
+    戻り値は (フレーム番号, 周波数ビン) の [ピーク数, 2] の配列（フレーム順）。
+    時間方向の近傍を見るため、直前の 2 * PEAK_FRAMES フレームだけを次の
+    ブロックに持ち越す。先頭と末尾は -inf のフレームで埋めて同じように扱う。
+    """
+    window = np.hanning(N_FFT).astype(np.float32)
+    scale = 1.0 / (window.sum() / 2) ** 2
+    bins = N_FFT // 2 + 1
+    tail = np.full((PEAK_FRAMES, bins), -np.inf, dtype=np.float32)
+    tail_start = -PEAK_FRAMES  # tail の先頭のフレーム番号
+    carry = np.zeros(N_FFT // 2, dtype=np.float32)
+    peaks = []
+
+    def decide(spectra):
+        nonlocal tail, tail_start
+        rows = np.concatenate([tail, spectra])
+        padded = np.pad(rows, ((0, 0), (PEAK_BINS, PEAK_BINS)), constant_values=-np.inf)
+        local = sliding_window_view(padded, 2 * PEAK_BINS + 1, axis=1).max(axis=-1)
+        if len(rows) > 2 * PEAK_FRAMES:
+            local = sliding_window_view(local, 2 * PEAK_FRAMES + 1, axis=0).max(axis=-1)
+            center = rows[PEAK_FRAMES:len(rows) - PEAK_FRAMES]
+            found = (center == local) & (center > MIN_PEAK_DB)
+            found[:, :MIN_BIN] = False
+            frame, index = np.nonzero(found)
+            peaks.append(np.stack([frame + tail_start + PEAK_FRAMES, index], axis=1))
+        tail_start += len(rows) - min(len(rows), 2 * PEAK_FRAMES)
+        tail = rows[-2 * PEAK_FRAMES:]
+
+    for block in source.blocks(BLOCK_FRAMES):
+        buffer = np.concatenate([carry, block.astype(np.float32, copy=False)])
+        count = (len(buffer) - N_FFT) // HOP + 1
+        if count <= 0:
+            carry = buffer
+            continue
+        frames = sliding_window_view(buffer, N_FFT)[::HOP][:count]
+        spectrum = np.fft.rfft(frames * window, axis=1)
+        power = (spectrum.real ** 2 + spectrum.imag ** 2).astype(np.float32)
+        power *= scale
+        decide(10 * np.log10(power + 1e-10))
+        carry = buffer[count * HOP:]
+    decide(np.full((PEAK_FRAMES, bins), -np.inf, dtype=np.float32))
+
+    return np.concatenate(peaks) if peaks else np.zeros((0, 2), dtype=np.int64)
+
+
+def pair_hashes(peaks):
+    """
+    ピークを後続のピークと組にしてハッシュにする
+
+    ハッシュは 周波数1（9 ビット）・周波数2（9 ビット）・時間差（6 ビット）。
+    戻り値は (ハッシュ, 組の先頭のフレーム番号) の [組数, 2] の int64 配列。
+    """
+    frame, index = peaks[:, 0], np.minimum(peaks[:, 1], 511)
+    pairs = []
+    for step in range(1, FAN_OUT + 1):
+        if len(peaks) <= step:
+            break
+        delta = frame[step:] - frame[:-step]
+        valid = (delta > 0) & (delta <= MAX_PAIR_FRAMES) & (np.abs(index[step:] - index[:-step]) <= MAX_PAIR_BINS)
+        hashes = (index[:-step] << 15) | (index[step:] << 6) | delta
+        pairs.append(np.stack([hashes[valid], frame[:-step][valid]], axis=1))
+    if not pairs:
+        return np.zeros((0, 2), dtype=np.int64)
+    pairs = np.concatenate(pairs)
+    return pairs[np.argsort(pairs[:, 1], kind='stable')]
+
+
+def compute(path, duration=None):
+    """音声ファイルの指紋（pair_hashes の配列）。デコードできない場合は AudioDecodeError"""
+    source = open_pcm(path, duration=duration, sample_rate=SAMPLE_RATE)
+    return pair_hashes(find_peaks(source))
+
+
+def build_fingerprint(path, duration=None):
+    """指紋を計算して指紋ファイルに保存し、ハッシュの数を返す"""
+    fingerprint = compute(path, duration=duration)
+    output_path = fingerprint_path(path)
+    temp_path = output_path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        np.save(f, fingerprint.astype(np.int32))
+    os.replace(temp_path, output_path)
+    return len(fingerprint)
+
+
+def load_fingerprint(path):
+    """保存済みの指紋（無ければ None）"""
+    try:
+        return np.load(fingerprint_path(path)).astype(np.int64)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def lookup(fingerprint):
+    """
+    索引から同じ録音を探す
+
+    時間差（索引のフレーム - 指紋のフレーム）ごとに一致したハッシュを数え、
+    ±1 フレームのずれまで合わせた数が最も多い録音を返す。戻り値は
+    (AudioFingerprint, 一致数, 時間差（秒）)。MIN_MATCHES に届かなければ None。
+    """
+    if not len(fingerprint):
+        return None
+    picks = np.unique(np.linspace(0, len(fingerprint) - 1, min(LOOKUP_HASHES, len(fingerprint))).astype(int))
+    query = {}
+    for value, frame in fingerprint[picks]:
+        query.setdefault(int(value), []).append(int(frame))
+
+    votes = Counter()
+    rows = FingerprintHash.objects.filter(hash__in=list(query)).values_list('hash', 'fingerprint_id', 'offset')
+    for value, fingerprint_id, offset in rows:
+        for frame in query[value]:
+            votes[fingerprint_id, offset - frame] += 1
+
+    best = None
+    for (fingerprint_id, delta), count in votes.items():
+        score = count + votes.get((fingerprint_id, delta - 1), 0) + votes.get((fingerprint_id, delta + 1), 0)
+        if best is None or score > best[0]:
+            best = (score, fingerprint_id, delta)
+    if best is None or best[0] < MIN_MATCHES:
+        return None
+    score, fingerprint_id, delta = best
+    return AudioFingerprint.objects.get(pk=fingerprint_id), score, delta * HOP / SAMPLE_RATE
+
+
+def _duration(sha256):
+    return AudioMetadata.objects.filter(sha256=sha256).values_list('duration', flat=True).first() or 0.0
+
+
+def register(sha256):
+    """
+    指紋ファイルを索引と照合して AudioFingerprint を登録する
+
+    同じ録音が見つかればその録音の版として登録し、解析結果を引き継ぐ。
+    見つからなければ新しい録音として指紋を索引に加える。戻り値は
+    引き継いだ処理名（'analysis', 'loudness'）のリスト。
+    """
+    if AudioFingerprint.objects.filter(sha256=sha256).exists():
+        return []
+    blob = AudioBlob.objects.filter(pk=sha256).first()
+    path = path_for(blob) if blob else None
+    fingerprint = load_fingerprint(path) if path else None
+    if fingerprint is None:
+        AudioFingerprint.objects.create(sha256=sha256, error='指紋がありません')
+        return []
+
+    match = lookup(fingerprint)
+    if match is not None:
+        track, score, offset = match
+        duration, track_duration = _duration(sha256), _duration(track.sha256)
+        if duration and track_duration and abs(duration - track_duration) > MAX_DURATION_DIFFERENCE:
+            # 同じ音源を含む別の編集（ラジオエディットなど）は別の録音として扱う
+            match = None
+
+    if match is None:
+        record = AudioFingerprint.objects.create(sha256=sha256, hashes=len(fingerprint))
+        for start in range(0, len(fingerprint), INSERT_BATCH):
+            FingerprintHash.objects.bulk_create([
+                FingerprintHash(hash=int(value), fingerprint=record, offset=int(frame))
+                for value, frame in fingerprint[start:start + INSERT_BATCH]
+            ])
+        inherited = []
+    else:
+        record = AudioFingerprint.objects.create(
+            sha256=sha256, track=track, offset=round(offset, 3), matches=score, hashes=len(fingerprint)
+        )
+        inherited = inherit(record)
+        logger.info('%s matched %s (%d hashes, offset %.2fs)', sha256[:12], track.sha256[:12], score, offset)
+    os.remove(fingerprint_path(path))
+    return inherited
+
+
+def versions(sha256):
+    """
+    同じ録音の音声の sha256 -> その音声の時刻をこの音声の時刻に直すために足す秒数
+
+    自身も含む（ずれは 0）。指紋が無ければ自身だけ。
+    """
+    record = AudioFingerprint.objects.filter(sha256=sha256).values('id', 'track_id', 'offset').first()
+    if record is None:
+        return {sha256: 0.0}
+    track = record['track_id'] or record['id']
+    rows = AudioFingerprint.objects.filter(track_id=track) | AudioFingerprint.objects.filter(pk=track)
+    return {other: round(offset - record['offset'], 3) for other, offset in rows.values_list('sha256', 'offset')}
+
+
+def forget(sha256):
+    """
+    音声の AudioFingerprint を削除する
+
+    同じ録音の版が残っていれば、削除する音声の再生位置をその版の時刻に直して移す。
+    削除するのが最初の音声（索引を持つ）なら、最も古い版を最初の音声にして、
+    ほかの版の時刻のずれと索引のフレームをその版の時刻に付け替える。
+    """
+    record = AudioFingerprint.objects.filter(sha256=sha256).first()
+    if record is None:
+        return
+    if record.track_id is None:
+        heir = record.versions.order_by('id').first()
+    else:
+        heir = record.track
+    if heir is not None:
+        # offset は「最初の音声の時刻 - この音声の時刻」（最初の音声は 0）なので
+        # heir の時刻 = この音声の時刻 + record.offset - heir.offset
+        PlaybackPosition.objects.filter(sha256=sha256).update(
+            sha256=heir.sha256, position=F('position') + record.offset - heir.offset
+        )
+    if record.track_id is None and heir is not None:
+        record.versions.exclude(pk=heir.pk).update(track=heir, offset=F('offset') - heir.offset)
+        FingerprintHash.objects.filter(fingerprint=record).update(
+            fingerprint=heir, offset=F('offset') - round(heir.offset * SAMPLE_RATE / HOP)
+        )
+        AudioFingerprint.objects.filter(pk=heir.pk).update(track=None, offset=0.0)
+    record.delete()
+
+
+@receiver(post_delete, sender=AudioBlob)
+def _forget_fingerprint(sender, instance, **kwargs):
+    forget(instance.sha256)
+
+
+def shift_analysis(result, shift, duration=None):
+    """解析結果の時刻を shift 秒ずらす（0 秒より前と長さより後は切り捨てる）"""
+    end = duration or float('inf')
+    sections = []
+    for section in result.get('sections') or []:
+        start, stop = max(0.0, section['start'] + shift), min(end, section['end'] + shift)
+        if stop > start:
+            sections.append({**section, 'start': round(start, 3), 'end': round(stop, 3)})
+    return {
+        'bpm': result.get('bpm'),
+        'beat_times': [round(t + shift, 3) for t in result.get('beat_times') or [] if 0.0 <= t + shift <= end],
+        'sections': sections,
+    }
+
+
+def inherit(record):
+    """
+    同じ録音の他の音声の解析結果を record の音声にコピーする
+
+    テンポ・セクションは時刻のずれを合わせ、ラウドネスはそのまま使う。
+    戻り値はコピーした処理名のリスト。
+    """
+    shifts = versions(record.sha256)
+    others = [sha256 for sha256 in shifts if sha256 != record.sha256]
+    inherited = []
+
+    analysis = MusicAnalysis.objects.filter(sha256__in=others, error='').first()
+    if analysis is not None:
+        result = shift_analysis(
+            {'bpm': analysis.bpm, 'beat_times': analysis.beat_times, 'sections': analysis.sections},
+            shifts[analysis.sha256], _duration(record.sha256),
+        )
+        MusicAnalysis.objects.update_or_create(sha256=record.sha256, defaults=result)
+        inherited.append('analysis')
+
+    loudness = AudioLoudness.objects.filter(sha256__in=others, error='').first()
+    if loudness is not None:
+        AudioLoudness.objects.update_or_create(sha256=record.sha256, defaults={
+            'integrated': loudness.integrated, 'true_peak': loudness.true_peak,
+        })
+        inherited.append('loudness')
+    return inherited
@@ -0,0 +1,445 @@
+"""
+アップロード後の重い処理を行う DB のジョブキュー
+
+波形ピーク・シークインデックスなど、ヘッダーの解析より重い処理は
+アップロードのリクエスト内では行わず、音声（AudioBlob）ごとの Job として
+登録して runworker コマンドのワーカーで実行する。Redis などのブローカーは不要。
+
+    @jobs.register('peaks', on_complete=_set_has_peaks)
+    def build_peaks_job(path, info):      # 子プロセスで実行（DB には触れない）
+        return {'has_peaks': ...}          # JSON にできる結果
+
+ジョブの取り出しは、PostgreSQL では SELECT ... FOR UPDATE SKIP LOCKED で
+複数のワーカーが同じ行を取らないようにし、行ロックの無い SQLite では
+「status が queued のままなら running にする」条件付き UPDATE で取り合う。
+
+ハンドラーはファイルだけを扱い、DB への反映（on_complete）はワーカーの
+親プロセスで行う。子プロセスがタイムアウトした場合は kill して作り直し、
+ジョブは PLAYER_JOB_RETRY_DELAY 秒から倍々に間隔を空けて再試行する
+（PLAYER_JOB_MAX_ATTEMPTS 回まで）。PLAYER_BACKGROUND_JOBS が False の場合は
+登録したその場で実行する（ワーカーを動かさない開発環境用）。
+"""
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from datetime import timedelta
+from multiprocessing.connection import wait
+
+from django.conf import settings
+from django.db import connection, connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import analysis, artwork, fingerprint, loudness, storage
+from .audio import AudioDecodeError
+from .models import AudioBlob, AudioMetadata, Job
+from .peaks import build_peaks
+from .seekindex import build_seek_index
+from .tracing import span
+
+logger = logging.getLogger(__name__)
+
+
+class JobError(Exception):
+    """ジョブを実行できない場合の例外"""
+
+
+class JobType:
+    def __init__(self, kind, func, timeout=None, on_complete=None):
+        self.kind = kind
+        self.func = func
+        self.timeout = timeout
+        self.on_complete = on_complete
+
+    def time_limit(self):
+        return self.timeout or settings.PLAYER_JOB_TIMEOUT
+
+
+JOB_TYPES = {}  # 登録順にアップロード後に実行する
+
+
+def register(kind, timeout=None, on_complete=None):
+    """
+    ジョブの処理を登録するデコレーター
+
+    func(path, info) は子プロセスで実行され、JSON にできる dict を返す。
+    info は sha256・拡張子・長さ（秒）・チャンネル数（不明なら None）。on_complete(blob_id, result) は
+    成功時に親プロセスで呼ばれ、結果を DB に反映する。
+    """
+    def decorate(func):
+        JOB_TYPES[kind] = JobType(kind, func, timeout, on_complete)
+        return func
+    return decorate
+
+
+def worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def enqueue(blob, kinds=None):
+    """音声に対するジョブを登録する（登録済みの処理は何もしない）"""
+    kinds = list(JOB_TYPES) if kinds is None else list(kinds)
+    Job.objects.bulk_create([Job(kind=kind, blob=blob) for kind in kinds], ignore_conflicts=True)
+    if not settings.PLAYER_BACKGROUND_JOBS:
+        run_pending(blob_id=blob.pk, kind__in=kinds)
+
+
+def claim(limit, worker=None, **filters):
+    """実行できるジョブを最大 limit 件取り出して running にする"""
+    now = timezone.now()
+    worker = worker or worker_name()
+    queryset = Job.objects.filter(status=Job.QUEUED, run_after__lte=now, **filters).order_by('run_after', 'id')
+    claimed = {
+        'status': Job.RUNNING, 'attempts': F('attempts') + 1, 'locked_by': worker, 'locked_at': now,
+    }
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            ids = list(queryset.select_for_update(skip_locked=True).values_list('pk', flat=True)[:limit])
+            Job.objects.filter(pk__in=ids).update(**claimed)
+    else:
+        # 行ロックが無いので、他のワーカーより先に状態を変えられた行だけを取る
+        ids = [
+            pk for pk in queryset.values_list('pk', flat=True)[:limit]
+            if Job.objects.filter(pk=pk, status=Job.QUEUED).update(**claimed)
+        ]
+    return list(Job.objects.filter(pk__in=ids).order_by('run_after', 'id'))
+
+
+def payload(job):
+    """子プロセスに渡す実行内容（子プロセスでは DB を使わない）"""
+    blob = AudioBlob.objects.filter(pk=job.blob_id).first()
+    if blob is None:
+        raise JobError('音声が削除されています')
+    path = storage.path_for(blob)
+    if not os.path.exists(path):
+        raise JobError('音声ファイルがありません')
+    duration, channels = AudioMetadata.objects.filter(sha256=blob.sha256).values_list(
+        'duration', 'channels'
+    ).first() or (None, None)
+    return {
+        'job': job.pk,
+        'kind': job.kind,
+        'path': path,
+        'info': {
+            'sha256': blob.sha256, 'extension': blob.extension,
+            'duration': duration, 'channels': channels or None,
+        },
+    }
+
+
+def execute(task):
+    """payload() の内容を実行して結果を返す（子プロセスでもその場でも使う）"""
+    job_type = JOB_TYPES.get(task['kind'])
+    if job_type is None:
+        raise JobError(f"unknown job kind: {task['kind']}")
+    with span(f"job.{task['kind']}"):
+        return job_type.func(task['path'], task['info']) or {}
+
+
+def complete(job, result):
+    """成功したジョブの結果を保存して DB に反映する"""
+    updated = Job.objects.filter(pk=job.pk, status=Job.RUNNING, locked_by=job.locked_by).update(
+        status=Job.DONE, result=result, error='', locked_at=None, updated_at=timezone.now()
+    )
+    job_type = JOB_TYPES.get(job.kind)
+    if updated and job_type and job_type.on_complete:
+        job_type.on_complete(job.blob_id, result)
+
+
+def fail(job, error):
+    """失敗したジョブを再試行待ちに戻す（回数を使い切ったら failed）"""
+    job.refresh_from_db(fields=['attempts'])
+    fields = {'error': str(error)[:2000], 'locked_at': None, 'updated_at': timezone.now()}
+    if job.attempts < settings.PLAYER_JOB_MAX_ATTEMPTS:
+        delay = settings.PLAYER_JOB_RETRY_DELAY * 2 ** (job.attempts - 1)
+        fields.update(status=Job.QUEUED, run_after=timezone.now() + timedelta(seconds=delay))
+    else:
+        fields.update(status=Job.FAILED)
+    Job.objects.filter(pk=job.pk, status=Job.RUNNING).update(**fields)
+    logger.warning('job %s %s failed (attempt %d): %s', job.kind, job.blob_id[:12], job.attempts, error)
+
+
+def skip(blob_id, kinds, result):
+    """まだ実行していないジョブを、結果が既にあるものとして完了にする"""
+    return Job.objects.filter(blob_id=blob_id, kind__in=kinds, status=Job.QUEUED).update(
+        status=Job.DONE, result=result, error='', updated_at=timezone.now()
+    )
+
+
+def requeue(job):
+    """停止するワーカーが実行中だったジョブを試行回数を数えずに戻す"""
+    Job.objects.filter(pk=job.pk, status=Job.RUNNING).update(
+        status=Job.QUEUED, attempts=F('attempts') - 1, locked_at=None, run_after=timezone.now()
+    )
+
+
+def reclaim_stale(now=None):
+    """制限時間を大きく過ぎても running のままのジョブ（ワーカーが落ちた）を失敗として扱う"""
+    now = now or timezone.now()
+    grace = timedelta(seconds=settings.PLAYER_JOB_STALE_GRACE)
+    count = 0
+    for job in Job.objects.filter(status=Job.RUNNING, locked_at__lt=now - grace):
+        job_type = JOB_TYPES.get(job.kind)
+        limit = job_type.time_limit() if job_type else settings.PLAYER_JOB_TIMEOUT
+        if job.locked_at < now - grace - timedelta(seconds=limit):
+            fail(job, f'worker {job.locked_by} stopped responding')
+            count += 1
+    return count
+
+
+def _run_claimed(job):
+    try:
+        result = execute(payload(job))
+    except Exception as e:
+        fail(job, f'{type(e).__name__}: {e}')
+    else:
+        complete(job, result)
+
+
+def run_pending(limit=None, **filters):
+    """待機中のジョブをこのプロセスで順に実行する（タイムアウトは無い）"""
+    count = 0
+    while limit is None or count < limit:
+        jobs = claim(1, **filters)
+        if not jobs:
+            break
+        _run_claimed(jobs[0])
+        count += 1
+    return count
+
+
+def statuses(sha256):
+    """音声のジョブの状態（処理名 -> dict）"""
+    return {
+        job.kind: {
+            'status': job.status,
+            'attempts': job.attempts,
+            'result': job.result,
+            'error': job.error,
+        }
+        for job in Job.objects.filter(blob_id=sha256)
+    }
+
+
+def _child_main(conn):
+    """プールの子プロセス: 親から受け取った payload を実行して結果を返す"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        try:
+            conn.send((task['job'], True, execute(task)))
+        except Exception as e:
+            conn.send((task['job'], False, f'{type(e).__name__}: {e}'))
+
+
+class _Child:
+    def __init__(self, context):
+        # 親の DB 接続を子プロセスに引き継がない
+        connections.close_all()
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_child_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.job = None
+        self.deadline = None
+
+    def start(self, job, task, time_limit):
+        self.job = job
+        self.deadline = time.monotonic() + time_limit
+        self.conn.send(task)
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.kill()
+
+
+class WorkerPool:
+    """
+    ジョブを子プロセスで実行するワーカー
+
+    子プロセスは使い回し、制限時間を過ぎたジョブや異常終了した子プロセスは
+    kill して新しい子プロセスに置き換える。
+    """
+
+    def __init__(self, processes=2, poll_interval=None, log=None):
+        self.context = multiprocessing.get_context('fork')
+        self.processes = max(processes, 1)
+        self.poll_interval = settings.PLAYER_JOB_POLL_INTERVAL if poll_interval is None else poll_interval
+        self.log = log or logger.info
+        self.children = []
+        self.stopping = False
+        self.completed = 0
+        self.failed = 0
+        self._last_reclaim = 0.0
+
+    def start(self):
+        self.children = [_Child(self.context) for _ in range(self.processes)]
+
+    def _replace(self, child):
+        child.kill()
+        self.children[self.children.index(child)] = _Child(self.context)
+
+    def _finish(self, child, ok, value):
+        job = child.job
+        child.job = None
+        if ok:
+            complete(job, value)
+            self.completed += 1
+            self.log(f'done   {job.kind:12} {job.blob_id[:12]}')
+        else:
+            fail(job, value)
+            self.failed += 1
+            self.log(f'failed {job.kind:12} {job.blob_id[:12]}: {value}')
+
+    def _collect(self, timeout):
+        busy = [child for child in self.children if child.job is not None]
+        ready = wait([child.conn for child in busy], timeout=timeout) if busy else []
+        for child in busy:
+            if child.conn in ready:
+                try:
+                    job_id, ok, value = child.conn.recv()
+                except (EOFError, OSError):
+                    job = child.job
+                    child.job = None
+                    fail(job, f'worker process exited ({child.process.exitcode})')
+                    self.failed += 1
+                    self._replace(child)
+                    continue
+                self._finish(child, ok, value)
+            elif time.monotonic() > child.deadline:
+                job = child.job
+                child.job = None
+                self._replace(child)
+                limit = JOB_TYPES[job.kind].time_limit() if job.kind in JOB_TYPES else settings.PLAYER_JOB_TIMEOUT
+                fail(job, f'timed out after {limit} seconds')
+                self.failed += 1
+                self.log(f'killed {job.kind:12} {job.blob_id[:12]} (timeout)')
+
+    def _dispatch(self):
+        idle = [child for child in self.children if child.job is None]
+        if not idle or self.stopping:
+            return 0
+        jobs = claim(len(idle))
+        for child, job in zip(idle, jobs):
+            try:
+                task = payload(job)
+            except Exception as e:
+                fail(job, f'{type(e).__name__}: {e}')
+                self.failed += 1
+                continue
+            limit = JOB_TYPES[job.kind].time_limit() if job.kind in JOB_TYPES else settings.PLAYER_JOB_TIMEOUT
+            child.start(job, task, limit)
+            self.log(f'start  {job.kind:12} {job.blob_id[:12]} (attempt {job.attempts})')
+        return len(jobs)
+
+    def run_once(self):
+        """1 周分の処理（結果の回収・タイムアウト・取り出し）。取り出した件数を返す"""
+        if time.monotonic() - self._last_reclaim > settings.PLAYER_JOB_STALE_GRACE:
+            self._last_reclaim = time.monotonic()
+            reclaim_stale()
+        busy = any(child.job is not None for child in self.children)
+        self._collect(timeout=self.poll_interval if busy else 0)
+        return self._dispatch()
+
+    def run(self, until_empty=False):
+        """停止するまで（until_empty なら待機中のジョブが無くなるまで）実行する"""
+        self.start()
+        try:
+            while not self.stopping:
+                dispatched = self.run_once()
+                busy = any(child.job is not None for child in self.children)
+                if not dispatched and not busy:
+                    if until_empty:
+                        break
+                    time.sleep(self.poll_interval)
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        for child in self.children:
+            if child.job is not None:
+                requeue(child.job)
+                child.job = None
+                child.kill()
+            else:
+                child.stop()
+        self.children = []
+
+
+def _set_has_peaks(blob_id, result):
+    AudioBlob.objects.filter(pk=blob_id).update(has_peaks=result.get('has_peaks', False))
+
+
+@register('peaks', on_complete=_set_has_peaks)
+def peaks_job(path, info):
+    """波形表示用の多段ピーク"""
+    return {'has_peaks': build_peaks(path, duration=info.get('duration')) is not None}
+
+
+@register('seekindex')
+def seek_index_job(path, info):
+    """秒数からバイト位置を引くシークインデックス"""
+    return {'has_seek_index': build_seek_index(path) is not None}
+
+
+def _register_fingerprint(blob_id, result):
+    inherited = fingerprint.register(blob_id)
+    if inherited:
+        # 同じ録音の解析結果を引き継いだので、この後の解析は行わない
+        skip(blob_id, inherited, {'inherited': True})
+
+
+@register('fingerprint', on_complete=_register_fingerprint)
+def fingerprint_job(path, info):
+    """同じ録音を探すための音響指紋（照合と索引への登録は on_complete で行う）"""
+    try:
+        return {'hashes': fingerprint.build_fingerprint(path, duration=info.get('duration'))}
+    except AudioDecodeError as e:
+        return {'hashes': 0, 'error': str(e)}
+
+
+@register('analysis', on_complete=analysis.save_analysis)
+def analysis_job(path, info):
+    """テンポ・ビート・セクション"""
+    try:
+        return analysis.analyze(path, duration=info.get('duration'))
+    except AudioDecodeError as e:
+        # 形式の問題なので再試行せず、解析できなかったことを保存する
+        return {'bpm': None, 'beat_times': [], 'sections': [], 'error': str(e)}
+
+
+@register('loudness', on_complete=loudness.save_loudness)
+def loudness_job(path, info):
+    """積分ラウドネスとトゥルーピーク（再生ゲイン用）"""
+    try:
+        return loudness.analyze(path, duration=info.get('duration'), channels=info.get('channels'))
+    except AudioDecodeError as e:
+        return {'integrated': None, 'true_peak': None, 'error': str(e)}
+
+
+@register('artwork', on_complete=artwork.save_artwork)
+def artwork_job(path, info):
+    """埋め込みアートワークのサムネイル"""
+    try:
+        return artwork.extract(path)
+    except artwork.ArtworkError as e:
+        return {'artwork': '', 'sizes': [], 'error': str(e)}
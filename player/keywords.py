@@ -0,0 +1,279 @@
+"""
+オフラインの音声コマンド認識（キーワードスポッティング）
+
+ブラウザで録音した短いクリップ（PCM の WAV）から MFCC を計算し、
+ユーザーが登録した音声（VoiceTemplate）と DTW（動的時間伸縮）で照合する。
+外部サービスやマイクをサーバー側で使わず、数十ミリ秒で結果を返す。
+
+特徴量:
+    16kHz に変換 → 無音区間を除去 → 25ms / 10ms の窓で MFCC 12 次元
+    （第 0 係数は音量に依存するので除く）＋ Δ 12 次元を、発話ごとに
+    平均・分散で正規化したもの
+"""
+import logging
+import threading
+import time
+
+import numpy as np
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .audio import AudioDecodeError, WavSource
+from .metadata import LRUCache
+from .models import VoiceTemplate
+from .tracing import span, traced
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 16000
+FRAME_LENGTH = 400  # 25ms
+HOP_LENGTH = 160  # 10ms
+N_FFT = 512
+N_MELS = 26
+N_MFCC = 13
+DELTA_WIDTH = 2
+# 照合に使う最小フレーム数（これより短い発話は認識しない）
+MIN_FRAMES = 10
+# 長さがこの比率以上違う登録音声とは照合しない
+MAX_LENGTH_RATIO = 2.5
+
+# 認識できるコマンド（アクション → 表示メッセージ）
+ACTIONS = {
+    'go_back': '前回再生位置に戻ります',
+    'restart': '最初から再生します',
+    'stop': '再生を停止します',
+    'play': '再生を開始します',
+}
+
+
+class ClipError(Exception):
+    """クリップを解析できない場合の例外"""
+
+
+@traced('voice.decode')
+def decode_clip(data):
+    """WAV のバイト列を 16kHz モノラルの float32 配列に変換"""
+    try:
+        source = WavSource(data, sample_rate=SAMPLE_RATE)
+    except AudioDecodeError as e:
+        raise ClipError(f'WAV を読み込めません: {e}')
+    if not source.native_frames:
+        raise ClipError('音声データがありません')
+    return np.concatenate(list(source.blocks(SAMPLE_RATE)))
+
+
+def _mel_filterbank():
+    def hz_to_mel(hz):
+        return 2595.0 * np.log10(1.0 + hz / 700.0)
+
+    def mel_to_hz(mel):
+        return 700.0 * (10 ** (mel / 2595.0) - 1.0)
+
+    mels = np.linspace(hz_to_mel(0.0), hz_to_mel(SAMPLE_RATE / 2), N_MELS + 2)
+    bins = np.floor((N_FFT + 1) * mel_to_hz(mels) / SAMPLE_RATE).astype(int)
+    bank = np.zeros((N_MELS, N_FFT // 2 + 1), dtype=np.float32)
+    for i in range(N_MELS):
+        left, center, right = bins[i], bins[i + 1], bins[i + 2]
+        if center > left:
+            bank[i, left:center] = (np.arange(left, center) - left) / (center - left)
+        if right > center:
+            bank[i, center:right] = (right - np.arange(center, right)) / (right - center)
+    return bank
+
+
+def _dct_matrix():
+    n = np.arange(N_MELS)
+    k = np.arange(N_MFCC)[:, None]
+    return (np.cos(np.pi * k * (2 * n + 1) / (2 * N_MELS)) * np.sqrt(2.0 / N_MELS)).astype(np.float32)
+
+
+MEL_FILTERBANK = _mel_filterbank()
+DCT_MATRIX = _dct_matrix()
+WINDOW = np.hamming(FRAME_LENGTH).astype(np.float32)
+
+
+def _frames(signal):
+    if len(signal) < FRAME_LENGTH:
+        signal = np.pad(signal, (0, FRAME_LENGTH - len(signal)))
+    count = 1 + (len(signal) - FRAME_LENGTH) // HOP_LENGTH
+    index = np.arange(FRAME_LENGTH)[None, :] + HOP_LENGTH * np.arange(count)[:, None]
+    return signal[index]
+
+
+def trim_silence(frames, floor_db=-30.0):
+    """最大音量から floor_db 以上小さいフレームを前後から取り除く"""
+    energy = 10 * np.log10((frames ** 2).mean(axis=1) + 1e-10)
+    voiced = np.flatnonzero(energy > energy.max() + floor_db)
+    if voiced.size == 0:
+        return frames[:0]
+    return frames[max(voiced[0] - 2, 0):voiced[-1] + 3]
+
+
+def _deltas(features):
+    padded = np.pad(features, ((DELTA_WIDTH, DELTA_WIDTH), (0, 0)), mode='edge')
+    weights = np.arange(-DELTA_WIDTH, DELTA_WIDTH + 1, dtype=np.float32)
+    total = len(features)
+    deltas = sum(w * padded[DELTA_WIDTH + int(w):DELTA_WIDTH + int(w) + total] for w in weights if w)
+    return deltas / (weights ** 2).sum()
+
+
+@traced('voice.mfcc')
+def mfcc(signal):
+    """16kHz の信号から正規化済みの特徴量 [frames, 24] を計算"""
+    signal = np.append(signal[:1], signal[1:] - 0.97 * signal[:-1])  # プリエンファシス
+    frames = trim_silence(_frames(signal.astype(np.float32)))
+    if len(frames) < MIN_FRAMES:
+        raise ClipError('発話が短すぎるか、音声が検出できません')
+
+    power = np.abs(np.fft.rfft(frames * WINDOW, N_FFT)) ** 2 / N_FFT
+    mel = np.log(power @ MEL_FILTERBANK.T + 1e-10)
+    cepstra = (mel @ DCT_MATRIX.T)[:, 1:]
+    features = np.hstack([cepstra, _deltas(cepstra)])
+    features -= features.mean(axis=0)
+    features /= features.std(axis=0) + 1e-5
+    return features.astype(np.float32)
+
+
+def dtw_distance(a, b):
+    """
+    2 つの特徴量系列の DTW 距離（経路長で正規化）
+
+    行ごとの漸化式 D[i, j] = c[i, j] + min(D[i-1, j], D[i-1, j-1], D[i, j-1]) の
+    横方向の依存を累積和と minimum.accumulate に置き換え、1 行をまとめて計算する。
+    """
+    cost = np.sqrt(((a[:, None, :] - b[None, :, :]) ** 2).sum(axis=2))
+    row = np.cumsum(cost[0])
+    for i in range(1, len(a)):
+        diagonal = np.concatenate([[np.inf], row[:-1]])
+        best_above = cost[i] + np.minimum(row, diagonal)
+        running = np.cumsum(cost[i])
+        row = running + np.minimum.accumulate(best_above - running)
+    return float(row[-1] / (len(a) + len(b)))
+
+
+class TemplateCache:
+    """
+    照合対象の登録音声のキャッシュ
+
+    全員共通の登録音声は 1 組だけ持ち、所有者ごとの登録音声は件数に上限のある
+    LRU に分けて持つ（未ログインのセッションごとに共通分を複製しない）。
+    このプロセスでの保存・削除はシグナルで破棄し、他のプロセスでの変更は
+    PLAYER_KWS_CACHE_TTL 秒で読み直して反映する。
+    """
+
+    def __init__(self, maxsize=None):
+        self._owners = LRUCache(maxsize or settings.PLAYER_KWS_CACHE_SIZE)
+        self._global = None  # (登録音声, 世代, 読み込んだ時刻)
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _load(owner):
+        rows = VoiceTemplate.objects.filter(owner=owner).values_list('action', 'features', 'frames')
+        return [
+            (action, np.frombuffer(bytes(features), dtype=np.float32).reshape(frames, -1))
+            for action, features, frames in rows
+        ]
+
+    def _fresh(self, entry):
+        if entry is None:
+            return False
+        _, generation, loaded_at = entry
+        return generation == self._generation and time.monotonic() - loaded_at < settings.PLAYER_KWS_CACHE_TTL
+
+    def get(self, owner):
+        """共通の登録音声 + 所有者の登録音声"""
+        entry = self._global
+        if not self._fresh(entry):
+            generation = self._generation
+            entry = (self._load(''), generation, time.monotonic())
+            self._global = entry
+        templates = entry[0]
+        if not owner:
+            return templates
+
+        entry = self._owners.get(owner)
+        if not self._fresh(entry):
+            generation = self._generation
+            entry = (self._load(owner), generation, time.monotonic())
+            self._owners.set(owner, entry)
+        return templates + entry[0]
+
+    def invalidate(self, owner):
+        if owner:
+            self._owners.discard(owner)
+        else:
+            # 世代を進めて、読み込み中だった古い内容も次の get で読み直させる
+            with self._lock:
+                self._generation += 1
+                self._global = None
+
+
+template_cache = TemplateCache()
+
+
+@receiver([post_save, post_delete], sender=VoiceTemplate)
+def _invalidate_templates(sender, instance, **kwargs):
+    template_cache.invalidate(instance.owner)
+
+
+def enroll(owner, action, data, limit=None):
+    """
+    クリップを登録音声として保存
+
+    所有者・コマンドごとに新しい方から limit 件（既定は PLAYER_KWS_MAX_TEMPLATES_PER_ACTION）
+    だけ残し、それより古い登録音声は削除する。
+    """
+    if action not in ACTIONS:
+        raise ClipError(f'対応していないコマンドです: {action}')
+    features = mfcc(decode_clip(data))
+    template = VoiceTemplate.objects.create(
+        owner=owner, action=action, features=features.tobytes(), frames=len(features)
+    )
+    limit = limit or settings.PLAYER_KWS_MAX_TEMPLATES_PER_ACTION
+    stale = list(
+        VoiceTemplate.objects.filter(owner=owner, action=action)
+        .order_by('-created_at', '-id').values_list('id', flat=True)[limit:]
+    )
+    if stale:
+        VoiceTemplate.objects.filter(id__in=stale).delete()
+    return template
+
+
+def recognize(owner, data):
+    """
+    クリップに最も近い登録音声のアクションを返す
+
+    戻り値は (action, distance)。登録音声が無い場合や、最も近いものでも
+    PLAYER_KWS_THRESHOLD より遠い場合、2 番目のアクションとの差が
+    PLAYER_KWS_MARGIN に満たない場合は action が None になる。
+    """
+    with span('voice.templates'):
+        templates = template_cache.get(owner)
+    if not templates:
+        return None, None
+    features = mfcc(decode_clip(data))
+
+    best = {}
+    with span('voice.dtw') as dtw_span:
+        compared = 0
+        for action, template in templates:
+            ratio = max(len(features), len(template)) / min(len(features), len(template))
+            if ratio >= MAX_LENGTH_RATIO:
+                continue
+            distance = dtw_distance(features, template)
+            compared += 1
+            if distance < best.get(action, np.inf):
+                best[action] = distance
+        dtw_span.set(templates=compared)
+    if not best:
+        return None, None
+
+    ranked = sorted(best.items(), key=lambda item: item[1])
+    action, distance = ranked[0]
+    if distance > settings.PLAYER_KWS_THRESHOLD:
+        return None, distance
+    if len(ranked) > 1 and ranked[1][1] - distance < settings.PLAYER_KWS_MARGIN:
+        return None, distance
+    return action, distance
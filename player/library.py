@@ -0,0 +1,208 @@
+"""
+ログインユーザーごとのライブラリ（MusicFile）
+
+セッションには 1 ファイルしか置けず、次のアップロードで前のファイルは
+解放される。残しておきたい曲はライブラリに追加する。音声の実体はストアの
+AudioBlob を参照するだけで複製しない（追加で参照数を 1 つ増やす）。
+
+一覧は OFFSET を使わず、前のページの最後の行のキー（カーソル）より後を
+読むキーセットページネーションにする。並び順ごとに (user, キー, id) の
+複合インデックスがあるので、何ページ目でもインデックスの範囲を
+limit + 1 行読むだけで済む。
+
+    sort=recent  追加の新しい順（musicfile_user_recent_idx を逆順に読む）
+    sort=title   タイトルの正規化キー（title_key）の順（musicfile_user_title_idx）
+
+タイトル検索（q）は既定では前方一致で、title_key の範囲条件
+（q 以上 q + U+10FFFF 未満）にしてインデックスを使う。範囲が前方一致に
+なるのはバイト順で比べる場合だけなので、PostgreSQL では "C" 照合順序で比べ、
+その式インデックス（musicfile_title_prefix_idx）を使う（SQLite は既定でバイト順）。
+match=trigram は部分一致で、PostgreSQL では pg_trgm の
+GIN インデックス（musicfile_title_trgm_idx）による単語類似度（表記ゆれも拾う）、
+それ以外のデータベースではユーザーの曲の中の部分一致にする。
+
+ライブラリの曲のファイルID は 'track-<id>' で、セッションのファイルと同じ
+API（配信・ピーク・解析・再生位置）で扱える（views._find_session_file）。
+再生キュー（upcoming）は現在の曲をカーソルにして、同じ並び順で次の数曲を返す。
+"""
+import base64
+import json
+import re
+from datetime import datetime
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.functions import Collate
+
+from . import storage
+from .models import AudioBlob, MusicFile, normalize_title
+
+TRACK_ID_RE = re.compile(r'^track-(\d+)$')
+SORTS = {
+    'recent': (('-uploaded_at', '-id'), 'uploaded_at'),
+    'title': (('title_key', 'id'), 'title_key'),
+}
+MATCHES = ('prefix', 'trigram')
+PREFIX_END = '\U0010ffff'  # 前方一致の範囲の上限（q + 最大のコードポイント）
+
+
+class LibraryError(Exception):
+    """ライブラリの操作が不正な場合の例外（status は返す HTTP ステータス）"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def track_file_id(pk):
+    return f'track-{pk}'
+
+
+def file_info_for(track):
+    """セッションのファイル情報と同じ形の dict（views._register_session_file を参照）"""
+    blob = track.blob
+    return {
+        'id': track_file_id(track.pk),
+        'title': track.title,
+        'filename': f'{blob.sha256}.{blob.extension}' if blob else '',
+        'file_path': storage.path_for(blob) if blob else '',
+        'sha256': blob.sha256 if blob else '',
+        'duration': track.duration,
+        'has_peaks': blob.has_peaks if blob else False,
+        'file_size': track.file_size,
+        'uploaded_at': track.uploaded_at.isoformat(),
+    }
+
+
+def find_track(user, file_id):
+    """ユーザーのライブラリの曲のファイル情報（無ければ None）"""
+    match = TRACK_ID_RE.match(file_id or '')
+    if not match or not user.is_authenticated:
+        return None
+    track = MusicFile.objects.select_related('blob').filter(pk=int(match.group(1)), user=user).first()
+    return file_info_for(track) if track else None
+
+
+def add_track(user, file_info, title=None):
+    """セッションのファイルをライブラリに追加する（同じ音声が既にあればその曲を返す）"""
+    blob = AudioBlob.objects.filter(sha256=file_info.get('sha256') or '').first()
+    if blob is None:
+        raise LibraryError('ライブラリに追加できないファイルです')
+    # (user, blob) の一意制約があるので、同時に追加されても曲は 1 つで参照も 1 つしか増えない
+    with transaction.atomic():
+        track, created = MusicFile.objects.select_related('blob').get_or_create(user=user, blob=blob, defaults={
+            'title': (title or file_info.get('title') or '')[:200],
+            'duration': file_info.get('duration') or 0,
+            'file_size': blob.size,
+        })
+        if created and not storage.acquire(blob):
+            # 追加する間に音声が削除された（曲の作成も取り消す）
+            raise LibraryError('ライブラリに追加できないファイルです')
+    return track, created
+
+
+def rename_track(user, pk, title):
+    track = MusicFile.objects.select_related('blob').filter(pk=pk, user=user).first()
+    if track is None:
+        raise LibraryError('曲が見つかりません', status=404)
+    track.title = title[:200]
+    track.save(update_fields=['title', 'title_key'])
+    return track
+
+
+def remove_track(user, pk):
+    """ライブラリから外し、音声の参照を解放する"""
+    track = MusicFile.objects.filter(pk=pk, user=user).first()
+    if track is None:
+        raise LibraryError('曲が見つかりません', status=404)
+    sha256 = track.blob_id
+    track.delete()
+    if sha256:
+        storage.release(sha256)
+
+
+def encode_cursor(sort, track):
+    key = track.uploaded_at.isoformat() if sort == 'recent' else track.title_key
+    raw = json.dumps([sort, key, track.pk], ensure_ascii=False).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(sort, cursor):
+    """カーソルから (キー, id) を取り出す（別の並び順のカーソルは不正）"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_sort, key, pk = json.loads(raw)
+        if cursor_sort != sort or not isinstance(pk, int) or not isinstance(key, str):
+            raise ValueError
+        if sort == 'recent':
+            key = datetime.fromisoformat(key)
+    except (ValueError, TypeError):
+        raise LibraryError('cursor が不正です')
+    return key, pk
+
+
+def _search(queryset, q, match):
+    key = normalize_title(q)
+    if not key:
+        return queryset
+    if match == 'prefix':
+        if connection.vendor == 'postgresql':
+            # データベースの照合順序（ja_JP.UTF-8 など）では範囲が前方一致にならないので
+            # バイト順の "C" で比べる（musicfile_title_prefix_idx を使う）
+            queryset = queryset.alias(title_bytes=Collate('title_key', 'C'))
+            return queryset.filter(title_bytes__gte=key, title_bytes__lt=key + PREFIX_END)
+        return queryset.filter(title_key__gte=key, title_key__lt=key + PREFIX_END)
+    if connection.vendor == 'postgresql':
+        # pg_trgm の単語類似度（musicfile_title_trgm_idx を使う）
+        return queryset.extra(where=['%s <%% "player_musicfile"."title_key"'], params=[key])
+    return queryset.filter(title_key__contains=key)
+
+
+def list_tracks(user, sort='recent', q='', match='prefix', cursor=None, limit=None):
+    """
+    ライブラリの 1 ページ分の曲
+
+    戻り値は (MusicFile のリスト, 次のページのカーソル（最後のページなら None）)。
+    """
+    if sort not in SORTS:
+        raise LibraryError('sort が不正です')
+    if match not in MATCHES:
+        raise LibraryError('match が不正です')
+    limit = min(limit or settings.PLAYER_LIBRARY_PAGE_SIZE, settings.PLAYER_LIBRARY_MAX_PAGE_SIZE)
+    if limit <= 0:
+        raise LibraryError('limit が不正です')
+    ordering, field = SORTS[sort]
+
+    queryset = _search(MusicFile.objects.filter(user=user), q, match)
+    if cursor:
+        key, pk = decode_cursor(sort, cursor)
+        if sort == 'recent':
+            queryset = queryset.filter(Q(**{f'{field}__lt': key}) | Q(**{field: key, 'id__lt': pk}))
+        else:
+            queryset = queryset.filter(Q(**{f'{field}__gt': key}) | Q(**{field: key, 'id__gt': pk}))
+    tracks = list(queryset.select_related('blob').order_by(*ordering)[:limit + 1])
+    if len(tracks) <= limit:
+        return tracks, None
+    tracks = tracks[:limit]
+    return tracks, encode_cursor(sort, tracks[-1])
+
+
+def upcoming(user, current_id=None, sort='recent', q='', match='prefix', count=None):
+    """
+    再生キュー：current_id の曲の次から count 曲（一覧と同じ並び順・検索条件）
+
+    current_id がライブラリの曲でなければ（セッションのファイルなど）先頭から返す。
+    現在の曲の位置をカーソルにするので、一覧と同じくインデックスの範囲を読むだけで済む。
+    """
+    count = min(count or settings.PLAYER_QUEUE_SIZE, settings.PLAYER_QUEUE_MAX_SIZE)
+    if count <= 0:
+        raise LibraryError('count が不正です')
+    cursor = None
+    match_id = TRACK_ID_RE.match(current_id or '')
+    if match_id and sort in SORTS:
+        current = MusicFile.objects.filter(pk=int(match_id.group(1)), user=user).first()
+        if current:
+            cursor = encode_cursor(sort, current)
+    tracks, _ = list_tracks(user, sort=sort, q=q, match=match, cursor=cursor, limit=count)
+    return tracks
@@ -0,0 +1,235 @@
+"""
+ラウドネスの解析（ITU-R BS.1770 / EBU R128 のゲート付き積分ラウドネスとトゥルーピーク）
+
+曲ごとの音量差（10 dB 以上になることもある）をクライアントの GainNode
+1 つで揃えるため、アップロード後のジョブ（jobs.py の 'loudness'）として
+内容ハッシュごとに一度だけ測定し、AudioLoudness に保存する。
+
+    1. K 特性フィルター（高域シェルフ + 38 Hz ハイパス）を掛ける
+    2. 100 ms ごとのチャンネル別の二乗和から、400 ms（75% 重なり）のブロックの
+       ラウドネスを求める
+    3. -70 LUFS の絶対ゲートと、それを通ったブロックの平均 -10 LU の相対ゲートを
+       通ったブロックの平均を積分ラウドネスとする
+    4. 4 倍オーバーサンプリングしたサンプルの最大値をトゥルーピークとする
+
+PCM は固定長のチャンクで読み、フィルターの状態（直前のサンプル）だけを
+次のチャンクに引き継ぐ。ブロックのラウドネスは 0.01 LU 刻みのヒストグラムに
+数えるので、曲の長さによらずメモリは一定になる。
+
+K 特性フィルター（双二次 IIR）はサンプルごとの漸化式を Python で回すと
+遅いため、インパルス応答を十分な長さで打ち切った FIR として FFT で畳み込む
+（打ち切りによる誤差は 0.01 dB 未満）。
+
+再生時のゲインは PLAYER_LOUDNESS_TARGET に合わせ、トゥルーピークが
+PLAYER_TRUE_PEAK_CEILING を超えない範囲に抑える（gain_db）。目標を変えても
+測定し直さずに済むよう、保存するのは測定値だけにする。
+"""
+import functools
+import math
+
+import numpy as np
+from django.conf import settings
+from numpy.lib.stride_tricks import sliding_window_view
+
+from .audio import open_pcm
+from .models import AudioLoudness
+
+CHUNK_FRAMES = 16384
+BLOCK_SECONDS = 0.4
+STEP_SECONDS = 0.1  # ブロックの間隔（75% 重なり）
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+HISTOGRAM_STEP = 0.01  # LU
+HISTOGRAM_MAX = 5.0  # これより大きいブロックは最後の区間に数える
+
+OVERSAMPLING = 4
+INTERPOLATION_TAPS = 12  # 1 相あたりのタップ数
+
+DECODE_SAMPLE_RATE = 48000  # ffmpeg でデコードする場合（BS.1770 の基準）
+IMPULSE_TOLERANCE = 1e-7  # インパルス応答をここまで減衰したら打ち切る
+MAX_IMPULSE_TAPS = 32768
+
+
+def k_weighting(sample_rate):
+    """K 特性の 2 段の双二次フィルター係数 [(b, a), (b, a)]（任意のサンプリングレート用）"""
+    # 1 段目: 高域シェルフ（頭部の音響効果）
+    f0, gain, q = 1681.974450955533, 3.999843853973347, 0.7071752369554196
+    k = math.tan(math.pi * f0 / sample_rate)
+    vh = 10 ** (gain / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = (
+        [(vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0],
+        [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0],
+    )
+    # 2 段目: ハイパス（RLB 特性）
+    f0, q = 38.13547087602444, 0.5003270373238773
+    k = math.tan(math.pi * f0 / sample_rate)
+    a0 = 1 + k / q + k * k
+    highpass = (
+        [1.0, -2.0, 1.0],
+        [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0],
+    )
+    return [shelf, highpass]
+
+
+@functools.lru_cache(maxsize=8)
+def k_weighting_impulse(sample_rate):
+    """K 特性フィルターのインパルス応答（十分に減衰したところで打ち切る）"""
+    response = np.zeros(MAX_IMPULSE_TAPS)
+    response[0] = 1.0
+    for b, a in k_weighting(sample_rate):
+        x1 = x2 = y1 = y2 = 0.0
+        for n in range(MAX_IMPULSE_TAPS):
+            x0 = response[n]
+            y0 = b[0] * x0 + b[1] * x1 + b[2] * x2 - a[1] * y1 - a[2] * y2
+            x2, x1, y2, y1 = x1, x0, y1, y0
+            response[n] = y0
+    magnitude = np.abs(response)
+    above = np.flatnonzero(magnitude > IMPULSE_TOLERANCE * magnitude.max())
+    return response[:above[-1] + 1]
+
+
+@functools.lru_cache(maxsize=1)
+def _interpolation_phases():
+    """4 倍オーバーサンプリング用の窓付き sinc を相ごとに分けた [OVERSAMPLING, INTERPOLATION_TAPS]"""
+    taps = OVERSAMPLING * INTERPOLATION_TAPS
+    n = np.arange(taps) - (taps - 1) / 2
+    kernel = np.sinc(n / OVERSAMPLING) * np.kaiser(taps, 8.0)
+    phases = kernel.reshape(INTERPOLATION_TAPS, OVERSAMPLING).T
+    return phases / phases.sum(axis=1, keepdims=True)
+
+
+class LoudnessMeter:
+    """チャンクを順に渡して積分ラウドネスとトゥルーピークを求める"""
+
+    def __init__(self, sample_rate, channels):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.impulse = k_weighting_impulse(sample_rate)
+        self.history = np.zeros((len(self.impulse) - 1, channels))
+        self.step = max(1, int(round(STEP_SECONDS * sample_rate)))
+        self.steps_per_block = int(round(BLOCK_SECONDS / STEP_SECONDS))
+        self.partial = np.zeros(channels)
+        self.partial_frames = 0
+        self.recent = np.zeros((0, channels))  # 直前のブロックに使う 100 ms ごとの二乗和
+        bins = int(round((HISTOGRAM_MAX - ABSOLUTE_GATE) / HISTOGRAM_STEP)) + 1
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.energies = np.zeros(bins)
+        self.peak_history = np.zeros((INTERPOLATION_TAPS - 1, channels))
+        self.sample_peak = 0.0
+        self.true_peak = 0.0
+
+    def _filter(self, samples):
+        """K 特性フィルター（FIR の重畳保存法）"""
+        taps = len(self.impulse)
+        buffer = np.concatenate([self.history, samples])
+        size = 1 << int(math.ceil(math.log2(len(buffer))))
+        spectrum = np.fft.rfft(buffer, size, axis=0) * np.fft.rfft(self.impulse, size)[:, None]
+        self.history = buffer[len(buffer) - (taps - 1):] if taps > 1 else buffer[:0]
+        return np.fft.irfft(spectrum, size, axis=0)[taps - 1:len(buffer)]
+
+    def _add_steps(self, sums):
+        """100 ms ごとの二乗和から 400 ms ブロックのラウドネスをヒストグラムに数える"""
+        steps = np.concatenate([self.recent, sums])
+        count = self.steps_per_block
+        self.recent = steps[-(count - 1):] if count > 1 else steps[:0]
+        if len(steps) < count:
+            return
+        # 各ブロックの平均二乗（チャンネルの重みはすべて 1.0）
+        blocks = sliding_window_view(steps, count, axis=0).sum(axis=-1) / (count * self.step)
+        energy = blocks.sum(axis=1)
+        with np.errstate(divide='ignore'):
+            loudness = -0.691 + 10 * np.log10(energy)
+        gated = loudness > ABSOLUTE_GATE
+        index = np.minimum(((loudness[gated] - ABSOLUTE_GATE) / HISTOGRAM_STEP).astype(int), len(self.counts) - 1)
+        np.add.at(self.counts, index, 1)
+        np.add.at(self.energies, index, energy[gated])
+
+    def _measure_peaks(self, samples):
+        self.sample_peak = max(self.sample_peak, float(np.abs(samples).max()))
+        buffer = np.concatenate([self.peak_history, samples])
+        self.peak_history = buffer[len(buffer) - (INTERPOLATION_TAPS - 1):]
+        phases = _interpolation_phases()[:, ::-1]
+        for channel in range(self.channels):
+            windows = sliding_window_view(buffer[:, channel], INTERPOLATION_TAPS)
+            self.true_peak = max(self.true_peak, float(np.abs(windows @ phases.T).max()))
+
+    def add(self, samples):
+        """[フレーム数, channels] の float PCM を追加する"""
+        if not len(samples):
+            return
+        self._measure_peaks(samples)
+        squares = self._filter(samples) ** 2
+
+        # 前のチャンクの途中までの 100 ms 区間を埋める
+        offset = min(self.step - self.partial_frames, len(squares))
+        self.partial += squares[:offset].sum(axis=0)
+        self.partial_frames += offset
+        if self.partial_frames < self.step:
+            return
+        completed = [self.partial]
+        rest = squares[offset:]
+        whole = len(rest) // self.step * self.step
+        sums = rest[:whole].reshape(-1, self.step, self.channels).sum(axis=1)
+        self.partial = rest[whole:].sum(axis=0)
+        self.partial_frames = len(rest) - whole
+        self._add_steps(np.concatenate([np.array(completed), sums]))
+
+    def integrated(self):
+        """ゲート付きの積分ラウドネス（LUFS）。絶対ゲートを通るブロックが無ければ None"""
+        total = self.counts.sum()
+        if not total:
+            return None
+        relative = -0.691 + 10 * math.log10(self.energies.sum() / total) + RELATIVE_GATE
+        start = max(0, int(math.ceil((relative - ABSOLUTE_GATE) / HISTOGRAM_STEP)))
+        counts = self.counts[start:].sum()
+        if not counts:
+            return None
+        return -0.691 + 10 * math.log10(self.energies[start:].sum() / counts)
+
+    def true_peak_db(self):
+        peak = max(self.sample_peak, self.true_peak)
+        return 20 * math.log10(peak) if peak > 0 else None
+
+
+def analyze(path, duration=None, channels=None):
+    """
+    音声ファイルの積分ラウドネス（LUFS）とトゥルーピーク（dBTP）を求める
+
+    戻り値は AudioLoudness の各列の dict。デコードできない場合は AudioDecodeError。
+    """
+    source = open_pcm(path, duration=duration, channels=channels, decode_rate=DECODE_SAMPLE_RATE)
+    meter = LoudnessMeter(source.sample_rate, source.channels)
+    for block in source.blocks(CHUNK_FRAMES, mono=False):
+        meter.add(block.astype(np.float64, copy=False))
+    integrated = meter.integrated()
+    true_peak = meter.true_peak_db()
+    return {
+        'integrated': round(integrated, 2) if integrated is not None else None,
+        'true_peak': round(true_peak, 2) if true_peak is not None else None,
+    }
+
+
+def gain_db(integrated, true_peak):
+    """目標のラウドネスに合わせる再生ゲイン（dB）。トゥルーピークが上限を超えないよう抑える"""
+    if integrated is None:
+        return None
+    gain = settings.PLAYER_LOUDNESS_TARGET - integrated
+    if true_peak is not None:
+        gain = min(gain, settings.PLAYER_TRUE_PEAK_CEILING - true_peak)
+    return round(gain, 2)
+
+
+def get_gain(sha256):
+    """保存済みの測定値から再生ゲインを求める（未測定なら None）"""
+    measured = AudioLoudness.objects.filter(sha256=sha256).values_list('integrated', 'true_peak').first()
+    return gain_db(*measured) if measured else None
+
+
+def save_loudness(sha256, result):
+    AudioLoudness.objects.update_or_create(sha256=sha256, defaults={
+        'integrated': result.get('integrated'),
+        'true_peak': result.get('true_peak'),
+        'error': result.get('error', ''),
+    })
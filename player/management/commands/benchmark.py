@@ -0,0 +1,95 @@
+"""
+プレイヤー API のベンチマーク
+
+一時的なテスト用データベースと MEDIA_ROOT を作って合成音声で各 API を呼び出し、
+結果を JSON に保存する。--compare に以前の結果を渡すと悪化したシナリオを表示する。
+
+    python manage.py benchmark --output bench-$(git rev-parse --short HEAD).json
+    python manage.py benchmark --transports client --durations 5 --compare bench-abc123.json
+"""
+import json
+import os
+import shutil
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test.utils import override_settings
+
+from player.benchmark import FORMATS, Benchmark, compare
+from player.positions import position_buffer
+
+
+def _csv(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+class Command(BaseCommand):
+    help = '合成音声でプレイヤー API のスループット・レイテンシ・メモリ使用量を測り、JSON に保存する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--transports', default='client,wsgi,asgi', help='client / wsgi / asgi（カンマ区切り）')
+        parser.add_argument('--formats', default=','.join(FORMATS), help='フィクスチャの形式（カンマ区切り）')
+        parser.add_argument('--durations', default='5,30', help='フィクスチャの長さ（秒、カンマ区切り）')
+        parser.add_argument('--iterations', type=int, default=50, help='読み出し系シナリオの実行回数')
+        parser.add_argument('--upload-iterations', type=int, default=5, help='アップロード系シナリオの実行回数')
+        parser.add_argument('--memory-iterations', type=int, default=3, help='tracemalloc を有効にして実行する回数')
+        parser.add_argument('--concurrency', type=int, default=1, help='wsgi / asgi で同時に送るリクエスト数')
+        parser.add_argument('--output', default='benchmark.json', help='結果の保存先')
+        parser.add_argument('--compare', default=None, help='比較する以前の結果（JSON）')
+        parser.add_argument('--metric', default='p50_ms', help='比較に使う指標')
+        parser.add_argument('--threshold', type=float, default=0.1, help='悪化とみなす変化率')
+
+    def handle(self, *args, **options):
+        transports = _csv(options['transports'])
+        unknown = set(transports) - {'client', 'wsgi', 'asgi'}
+        if unknown:
+            raise CommandError(f'unknown transports: {", ".join(sorted(unknown))}')
+        formats = _csv(options['formats'])
+        if set(formats) - set(FORMATS):
+            raise CommandError(f'formats must be chosen from {", ".join(FORMATS)}')
+        try:
+            durations = [float(value) for value in _csv(options['durations'])]
+        except ValueError:
+            raise CommandError('durations must be numbers')
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)
+
+        benchmark = Benchmark(
+            durations=durations,
+            formats=formats,
+            iterations=options['iterations'],
+            upload_iterations=options['upload_iterations'],
+            memory_iterations=options['memory_iterations'],
+            concurrency=max(options['concurrency'], 1),
+            log=self.stdout.write,
+        )
+
+        workdir = tempfile.mkdtemp(prefix='player-benchmark-')
+        connection = connections['default']
+        if connection.vendor == 'sqlite':
+            # スレッドのサーバーからも同じ DB を見られるようファイルにする
+            connection.settings_dict.setdefault('TEST', {})['NAME'] = os.path.join(workdir, 'benchmark.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            with override_settings(MEDIA_ROOT=os.path.join(workdir, 'media'), DEBUG=False):
+                try:
+                    report = benchmark.run(transports)
+                finally:
+                    position_buffer.flush()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        self.stdout.write(f"results written to {options['output']}")
+
+        if baseline is not None:
+            regressions = compare(baseline, report, options['metric'], options['threshold'])
+            for transport, name, before, after, change in regressions:
+                self.stdout.write(f'{transport:6} {name:28} {before:10.2f} -> {after:10.2f} ({change:+.0%})')
+            if not regressions:
+                self.stdout.write(f"no regressions in {options['metric']} (threshold {options['threshold']:.0%})")
@@ -0,0 +1,49 @@
+"""
+録音済みのクリップを全員共通の登録音声として読み込む
+
+    python manage.py loadvoicetemplates voice_templates/
+
+ディレクトリは <アクション>/<任意の名前>.wav の構成にする（例: stop/01.wav）。
+読み込んだアクションの共通の登録音声は、ディレクトリの内容で置き換える。
+"""
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from player import keywords
+from player.models import VoiceTemplate
+
+
+class Command(BaseCommand):
+    help = '録音済みの WAV を全員共通の音声コマンドの登録音声として読み込む'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='<アクション>/*.wav を置いたディレクトリ')
+
+    def handle(self, *args, **options):
+        root = options['directory']
+        if not os.path.isdir(root):
+            raise CommandError(f'ディレクトリがありません: {root}')
+
+        for action in sorted(os.listdir(root)):
+            folder = os.path.join(root, action)
+            if not os.path.isdir(folder):
+                continue
+            if action not in keywords.ACTIONS:
+                self.stderr.write(f'skip {action}: 対応していないコマンドです')
+                continue
+            names = sorted(name for name in os.listdir(folder) if name.lower().endswith('.wav'))
+            with transaction.atomic():
+                VoiceTemplate.objects.filter(owner='', action=action).delete()
+                loaded = 0
+                for name in names:
+                    with open(os.path.join(folder, name), 'rb') as f:
+                        data = f.read()
+                    try:
+                        keywords.enroll('', action, data, limit=len(names))
+                    except keywords.ClipError as e:
+                        self.stderr.write(f'skip {action}/{name}: {e}')
+                    else:
+                        loaded += 1
+            self.stdout.write(f'{action}: {loaded} templates')
@@ -0,0 +1,50 @@
+"""
+期限切れ・孤立したアップロードファイルを回収する
+
+    python manage.py reap_uploads                 # 一巡して終了
+    python manage.py reap_uploads --loop          # 常駐して PLAYER_REAPER_INTERVAL 秒ごとに実行
+    python manage.py reap_uploads --quota 500000000
+"""
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from player.reaper import Reaper, ReapResult
+
+
+class Command(BaseCommand):
+    help = 'セッションの切れたアップロードファイルを削除し、容量制限を超えた分を古い順に追い出す'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='常駐して定期的に実行する')
+        parser.add_argument('--interval', type=float, default=None, help='--loop の実行間隔（秒）')
+        parser.add_argument('--quota', type=int, default=None, help='合計サイズの上限（バイト、0 で無制限）')
+        parser.add_argument('--grace', type=int, default=None, help='対象外にする作成・アクセスからの秒数')
+        parser.add_argument('--batch-size', type=int, default=64, help='1 回に走査するシャードディレクトリ数')
+
+    def handle(self, *args, **options):
+        reaper = Reaper(quota=options['quota'], grace=options['grace'], batch_size=options['batch_size'])
+
+        if not options['loop']:
+            result = reaper.run_full()
+            self.stdout.write(f'{result} ({result.scanned_dirs} dirs scanned)')
+            return
+
+        interval = options['interval'] or settings.PLAYER_REAPER_INTERVAL
+        total = ReapResult()
+        try:
+            while True:
+                close_old_connections()
+                try:
+                    result = reaper.run()
+                except Exception as e:
+                    self.stderr.write(f'reap failed: {e}')
+                else:
+                    total.merge(result)
+                    if result.bytes_reclaimed:
+                        self.stdout.write(f'{result} (total {total.bytes_reclaimed} bytes)')
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            self.stdout.write(f'stopped: {total}')
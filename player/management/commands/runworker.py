@@ -0,0 +1,41 @@
+"""
+アップロード後の処理（Job）を実行するワーカー
+
+    python manage.py runworker                   # 常駐（同じファイルシステムの PLAYER_BACKGROUND_JOBS=True の web と組み合わせる）
+    python manage.py runworker --processes 4
+    python manage.py runworker --until-empty     # 待機中のジョブが無くなったら終了
+"""
+import os
+import signal
+
+from django.core.management.base import BaseCommand
+
+from player.jobs import WorkerPool
+
+
+class Command(BaseCommand):
+    help = '波形ピーク・シークインデックスなどのジョブを子プロセスで実行する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help='同時に実行するジョブ数')
+        parser.add_argument('--poll-interval', type=float, default=None, help='待機中のジョブが無い場合の確認間隔（秒）')
+        parser.add_argument('--until-empty', action='store_true', help='待機中のジョブが無くなったら終了する')
+
+    def handle(self, *args, **options):
+        pool = WorkerPool(
+            processes=options['processes'],
+            poll_interval=options['poll_interval'],
+            log=self.stdout.write,
+        )
+
+        def stop(signum, frame):
+            # 実行中のジョブは試行回数を数えずに待機中へ戻して終了する
+            pool.stopping = True
+
+        signal.signal(signal.SIGTERM, stop)
+        self.stdout.write(f"worker started with {pool.processes} processes")
+        try:
+            pool.run(until_empty=options['until_empty'])
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(f'stopped: {pool.completed} done, {pool.failed} failed')
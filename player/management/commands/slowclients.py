@@ -0,0 +1,210 @@
+"""
+遅いクライアントを大量に接続する負荷試験
+
+モバイル回線のように少しずつ送受信するクライアントを --clients 本同時に
+接続したまま、別の接続で /test-api/ を定期的に呼び出して応答時間を測る。
+同期ワーカー（gunicorn sync）では遅いクライアントがワーカーを占有するため
+ワーカー数を超えたところでプローブが詰まり、uvicorn ワーカーでは
+クライアント数を増やしてもプローブの応答時間がほぼ変わらない。
+
+    python manage.py slowclients http://localhost:8000 --clients 200 --mode download
+"""
+import asyncio
+import io
+import json
+import ssl
+import statistics
+import time
+import uuid
+import wave
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+def _silent_wav(size):
+    """おおよそ size バイトの無音 WAV を生成"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(8000)
+        wav.writeframes(b'\0' * (max(size - 44, 2) // 2 * 2))
+    return buffer.getvalue()
+
+
+def _multipart(data, filename):
+    boundary = uuid.uuid4().hex
+    body = (
+        f'--{boundary}\r\n'
+        f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        'Content-Type: audio/wav\r\n\r\n'
+    ).encode('ascii') + data + f'\r\n--{boundary}--\r\n'.encode('ascii')
+    return body, f'multipart/form-data; boundary={boundary}'
+
+
+class Command(BaseCommand):
+    help = '遅いクライアントを同時接続したまま、他のリクエストの応答時間を測る'
+
+    def add_arguments(self, parser):
+        parser.add_argument('url', help='対象サーバーのベース URL（例: http://localhost:8000）')
+        parser.add_argument('--clients', type=int, default=100, help='同時に接続する遅いクライアント数')
+        parser.add_argument('--mode', choices=['upload', 'download'], default='download')
+        parser.add_argument('--rate', type=int, default=16 * 1024, help='クライアントあたりの送受信速度（バイト/秒）')
+        parser.add_argument('--size', type=int, default=4 * 1024 * 1024, help='送受信するファイルのサイズ（バイト）')
+        parser.add_argument('--duration', type=float, default=30.0, help='計測時間（秒）')
+        parser.add_argument('--probe-interval', type=float, default=0.5)
+        parser.add_argument('--probe-timeout', type=float, default=5.0)
+
+    def handle(self, *args, **options):
+        target = urlsplit(options['url'])
+        if target.scheme not in ('http', 'https') or not target.hostname:
+            raise CommandError('url は http(s)://host[:port] の形式で指定してください')
+        self.options = options
+        self.host = target.hostname
+        self.port = target.port or (443 if target.scheme == 'https' else 80)
+        self.ssl = ssl.create_default_context() if target.scheme == 'https' else None
+        self.prefix = target.path.rstrip('/')
+
+        result = asyncio.run(self.run())
+
+        self.stdout.write(f"mode={options['mode']} clients={options['clients']} rate={options['rate']}B/s")
+        self.stdout.write(
+            f"held={result['held']} completed={result['completed']} "
+            f"waiting={result['waiting']} failed={result['failed']}"
+        )
+        latencies = result['latencies']
+        if latencies:
+            latencies.sort()
+            p95 = latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+            self.stdout.write(
+                f"probe ok={len(latencies)} timeout={result['probe_failures']} "
+                f"p50={statistics.median(latencies) * 1000:.1f}ms "
+                f"p95={p95 * 1000:.1f}ms max={latencies[-1] * 1000:.1f}ms"
+            )
+        else:
+            self.stdout.write(f"probe ok=0 timeout={result['probe_failures']}")
+
+    async def run(self):
+        options = self.options
+        self.deadline = time.monotonic() + options['duration']
+        data = _silent_wav(options['size'])
+
+        cookie = stream_path = None
+        if options['mode'] == 'download':
+            cookie, stream_path = await self.prepare_download(data)
+
+        if options['mode'] == 'upload':
+            clients = [self.slow_upload(data) for _ in range(options['clients'])]
+        else:
+            clients = [self.slow_download(stream_path, cookie) for _ in range(options['clients'])]
+        probe = asyncio.ensure_future(self.probe())
+        outcomes = await asyncio.gather(*clients, return_exceptions=True)
+        latencies, probe_failures = await probe
+
+        return {
+            'held': outcomes.count('held'),
+            'completed': outcomes.count('completed'),
+            'waiting': outcomes.count('waiting'),
+            'failed': len(outcomes) - sum(outcomes.count(key) for key in ('held', 'completed', 'waiting')),
+            'latencies': latencies,
+            'probe_failures': probe_failures,
+        }
+
+    async def connect(self):
+        return await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+
+    def request_head(self, method, path, headers):
+        lines = [f'{method} {self.prefix}{path} HTTP/1.1', f'Host: {self.host}', 'Connection: close']
+        lines += [f'{key}: {value}' for key, value in headers.items()]
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    async def read_response_head(self, reader):
+        head = await reader.readuntil(b'\r\n\r\n')
+        status_line, *header_lines = head.decode('latin-1').split('\r\n')
+        headers = {}
+        for line in header_lines:
+            if ':' in line:
+                key, value = line.split(':', 1)
+                headers.setdefault(key.strip().lower(), []).append(value.strip())
+        return int(status_line.split()[1]), headers
+
+    async def prepare_download(self, data):
+        """配信対象のファイルを 1 つ通常速度でアップロードし、セッションと URL を得る"""
+        body, content_type = _multipart(data, 'slowclients.wav')
+        reader, writer = await self.connect()
+        writer.write(self.request_head('POST', '/api/upload-lightweight/', {
+            'Content-Type': content_type,
+            'Content-Length': len(body),
+        }) + body)
+        await writer.drain()
+        status, headers = await self.read_response_head(reader)
+        payload = await reader.read()
+        writer.close()
+        if status != 200:
+            raise CommandError(f'アップロードに失敗しました: {status} {payload[:200]!r}')
+        cookies = [value.split(';', 1)[0] for value in headers.get('set-cookie', [])]
+        file_id = json.loads(payload)['file']['id']
+        return '; '.join(cookies), f'/api/stream/{file_id}/'
+
+    async def slow_upload(self, data):
+        body, content_type = _multipart(data, 'slowclients.wav')
+        reader, writer = await self.connect()
+        try:
+            writer.write(self.request_head('POST', '/api/upload-lightweight/', {
+                'Content-Type': content_type,
+                'Content-Length': len(body),
+            }))
+            step = max(self.options['rate'] // 4, 1)
+            for offset in range(0, len(body), step):
+                if time.monotonic() >= self.deadline:
+                    return 'held'
+                writer.write(body[offset:offset + step])
+                await writer.drain()
+                await asyncio.sleep(0.25)
+            status, _ = await self.read_response_head(reader)
+            return 'completed' if status == 200 else f'status {status}'
+        finally:
+            writer.close()
+
+    async def slow_download(self, path, cookie):
+        reader, writer = await self.connect()
+        try:
+            writer.write(self.request_head('GET', path, {'Cookie': cookie}))
+            await writer.drain()
+            try:
+                status, _ = await asyncio.wait_for(
+                    self.read_response_head(reader), max(self.deadline - time.monotonic(), 0.1)
+                )
+            except asyncio.TimeoutError:
+                # 空いているワーカーが無く、応答が始まらないまま計測が終わった
+                return 'waiting'
+            if status != 200:
+                return f'status {status}'
+            step = max(self.options['rate'] // 4, 1)
+            while time.monotonic() < self.deadline:
+                if not await reader.read(step):
+                    return 'completed'
+                await asyncio.sleep(0.25)
+            return 'held'
+        finally:
+            writer.close()
+
+    async def probe(self):
+        """遅いクライアントとは別に、軽いリクエストの応答時間を定期的に測る"""
+        latencies = []
+        failures = 0
+        while time.monotonic() < self.deadline:
+            started = time.monotonic()
+            try:
+                reader, writer = await asyncio.wait_for(self.connect(), self.options['probe_timeout'])
+                try:
+                    writer.write(self.request_head('GET', '/test-api/', {}))
+                    await asyncio.wait_for(self.read_response_head(reader), self.options['probe_timeout'])
+                finally:
+                    writer.close()
+                latencies.append(time.monotonic() - started)
+            except (asyncio.TimeoutError, OSError):
+                failures += 1
+            await asyncio.sleep(self.options['probe_interval'])
+        return latencies, failures
@@ -0,0 +1,52 @@
+"""
+トレースファイルを集計して時間のかかっている処理段階を表示する
+
+    python manage.py trace_summary
+    python manage.py trace_summary --route api/upload-lightweight/ --sort p95 --slowest 5
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from player.tracing import read_traces, summarize
+
+SORT_KEYS = {'total': 'total_ms', 'p50': 'p50_ms', 'p95': 'p95_ms', 'max': 'max_ms', 'count': 'count'}
+
+
+class Command(BaseCommand):
+    help = 'PLAYER_TRACE_FILE のトレースを処理段階ごとに集計し、遅い段階とリクエストを表示する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', default=None, help='トレースファイル（既定は PLAYER_TRACE_FILE）')
+        parser.add_argument('--route', default=None, help='このルートを含むトレースだけを集計する')
+        parser.add_argument('--sort', default='total', choices=sorted(SORT_KEYS), help='並べ替えの基準')
+        parser.add_argument('--top', type=int, default=20, help='表示する段階の数')
+        parser.add_argument('--slowest', type=int, default=0, help='最も遅いリクエストをこの件数だけ表示する')
+
+    def handle(self, *args, **options):
+        path = options['file'] or settings.PLAYER_TRACE_FILE
+        traces = [
+            trace for trace in read_traces(path)
+            if not options['route'] or options['route'] in trace.get('name', '')
+        ]
+        if not traces:
+            raise CommandError(f'no traces in {path} (is PLAYER_TRACE_SAMPLE_RATE set?)')
+
+        stages = summarize(traces)
+        stages.sort(key=lambda stage: stage[SORT_KEYS[options['sort']]], reverse=True)
+        self.stdout.write(f'{len(traces)} traces')
+        self.stdout.write(f"{'stage':32} {'count':>7} {'total ms':>11} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9} {'share':>6}")
+        for stage in stages[:options['top']]:
+            self.stdout.write(
+                f"{stage['name']:32} {stage['count']:7d} {stage['total_ms']:11.1f} {stage['p50_ms']:9.2f} "
+                f"{stage['p95_ms']:9.2f} {stage['max_ms']:9.2f} {stage['share']:6.1%}"
+            )
+
+        if options['slowest']:
+            self.stdout.write('')
+            for trace in sorted(traces, key=lambda trace: trace['duration_ms'], reverse=True)[:options['slowest']]:
+                self.stdout.write(
+                    f"{trace['trace_id']} {trace.get('method', ''):6} {trace['name']} "
+                    f"{trace['duration_ms']:.1f} ms (status {trace.get('status', '-')})"
+                )
+                for item in sorted(trace['spans'], key=lambda item: item['duration_ms'], reverse=True)[:5]:
+                    self.stdout.write(f"    {item['name']:32} {item['duration_ms']:9.2f} ms")
@@ -0,0 +1,229 @@
+"""
+音声コマンドの照合（VoiceCommand テーブル + 既定のコマンド）
+
+有効な VoiceCommand（全員共通 + 本人）と既定のコマンドを、かな正規化した
+パターンとして 1 つの Aho-Corasick オートマトンにまとめる。ユーザーが
+いくつコマンドを追加しても、照合は認識テキストの長さに比例する時間で済む。
+
+オートマトンはユーザーごとにプロセス内でキャッシュし、VoiceCommand の
+保存・削除シグナルで破棄する（他のプロセスは PLAYER_COMMAND_CACHE_TTL 秒で
+作り直す）。完全一致が無い場合は、設定により編集距離で近いパターンを探す（既定では無効）。
+"""
+import threading
+import time
+import unicodedata
+from collections import deque
+
+from django.conf import settings
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .metadata import LRUCache
+from .models import VoiceCommand
+from .tracing import traced
+
+# 既定のコマンド（上にあるものほど優先）
+DEFAULT_COMMANDS = [
+    ('戻って', 'go_back'),
+    ('もどって', 'go_back'),
+    ('最初から', 'restart'),
+    ('初めから', 'restart'),
+    ('停止', 'stop'),
+    ('とめる', 'stop'),
+    ('ストップ', 'stop'),
+    ('再生', 'play'),
+    ('さいせい', 'play'),
+    ('スタート', 'play'),
+]
+
+# 照合の優先順位（ユーザー独自 → 全員共通 → 既定）
+SCOPE_USER = 0
+SCOPE_GLOBAL = 1
+SCOPE_DEFAULT = 2
+
+_IGNORED_CATEGORIES = ('Z', 'P', 'C')  # 空白・句読点・制御文字
+
+
+def normalize(text):
+    """NFKC 正規化・カタカナをひらがなに統一・小文字化し、空白と記号を除く"""
+    result = []
+    for char in unicodedata.normalize('NFKC', text or '').lower():
+        if unicodedata.category(char)[0] in _IGNORED_CATEGORIES:
+            continue
+        code = ord(char)
+        if 0x30A1 <= code <= 0x30F6:
+            char = chr(code - 0x60)
+        result.append(char)
+    return ''.join(result)
+
+
+class Match:
+    """照合結果"""
+
+    def __init__(self, action, pattern, scope, distance=0):
+        self.action = action
+        self.pattern = pattern
+        self.scope = scope
+        self.distance = distance  # 曖昧一致の場合の編集距離
+
+    def __repr__(self):
+        return f'Match({self.action!r}, {self.pattern!r}, scope={self.scope}, distance={self.distance})'
+
+
+class CommandMatcher:
+    """複数のパターンを 1 回の走査で探す Aho-Corasick オートマトン"""
+
+    def __init__(self, commands):
+        """commands は (パターン, アクション, スコープ) の列"""
+        self.patterns = {}  # 正規化したパターン -> (優先度, アクション, スコープ)
+        for index, (pattern, action, scope) in enumerate(commands):
+            key = normalize(pattern)
+            if not key:
+                continue
+            rank = (scope, -len(key), index)
+            if key not in self.patterns or rank < self.patterns[key][0]:
+                self.patterns[key] = (rank, action, scope)
+
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        for key in self.patterns:
+            self._add(key)
+        self._link()
+
+    def _add(self, key):
+        state = 0
+        for char in key:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = next_state
+        self._output[state].append(key)
+
+    def _link(self):
+        """幅優先で失敗遷移を張り、失敗先の出力を引き継ぐ"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[next_state] = self._goto[fallback].get(char, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def find_all(self, text):
+        """テキスト中に現れるパターンをすべて返す"""
+        found = set()
+        state = 0
+        for char in normalize(text):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            found.update(self._output[state])
+        return found
+
+    def match(self, text, fuzzy=None):
+        """テキストに含まれる最も優先度の高いコマンドを返す（無ければ None）"""
+        found = self.find_all(text)
+        if found:
+            key = min(found, key=lambda key: self.patterns[key][0])
+            _, action, scope = self.patterns[key]
+            return Match(action, key, scope)
+        if fuzzy is None:
+            fuzzy = settings.PLAYER_COMMAND_FUZZY
+        if fuzzy:
+            return self.fuzzy_match(text)
+        return None
+
+    def fuzzy_match(self, text):
+        """
+        編集距離がパターン長 × PLAYER_COMMAND_FUZZY_RATIO 以内で一致するコマンドを探す
+
+        完全一致が無い場合だけ使う。テキストとの長さの差が許す編集距離を超える
+        パターンとは比べないので、長いテキストでは比べるパターンが無くなり、
+        計算量はパターンの長さの 2 乗の程度に収まる。
+        """
+        normalized = normalize(text)
+        best = None
+        for key, (rank, action, scope) in self.patterns.items():
+            limit = int(len(key) * settings.PLAYER_COMMAND_FUZZY_RATIO)
+            if limit < 1 or abs(len(normalized) - len(key)) > limit:
+                continue
+            distance = substring_distance(key, normalized)
+            if distance <= limit and (best is None or (distance, rank) < best[0]):
+                best = ((distance, rank), Match(action, key, scope, distance))
+        return best[1] if best else None
+
+
+def substring_distance(pattern, text):
+    """pattern とテキスト中の任意の部分文字列との最小編集距離"""
+    previous = [0] * (len(text) + 1)
+    for i, pattern_char in enumerate(pattern, 1):
+        current = [i] + [0] * len(text)
+        for j, text_char in enumerate(text, 1):
+            current[j] = min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (pattern_char != text_char),
+            )
+        previous = current
+    return min(previous)
+
+
+def _commands_for(user_id):
+    rows = VoiceCommand.objects.filter(is_active=True)
+    if user_id is None:
+        rows = rows.filter(user__isnull=True)
+    else:
+        rows = rows.filter(Q(user__isnull=True) | Q(user_id=user_id))
+    commands = [
+        (command, action, SCOPE_GLOBAL if owner is None else SCOPE_USER)
+        for command, action, owner in rows.order_by('id').values_list('command', 'action', 'user_id')
+    ]
+    commands += [(pattern, action, SCOPE_DEFAULT) for pattern, action in DEFAULT_COMMANDS]
+    return commands
+
+
+_matchers = LRUCache(settings.PLAYER_COMMAND_CACHE_SIZE)
+_generation = 0
+_generation_lock = threading.Lock()
+
+
+@traced('voice.matcher')
+def get_matcher(user=None):
+    """ユーザー（未ログインなら共通）のコマンドをまとめたオートマトンを返す"""
+    user_id = user.pk if user is not None and user.is_authenticated else None
+    cached = _matchers.get(user_id)
+    if cached is not None:
+        matcher, generation, built_at = cached
+        if generation == _generation and time.monotonic() - built_at < settings.PLAYER_COMMAND_CACHE_TTL:
+            return matcher
+
+    generation = _generation
+    matcher = CommandMatcher(_commands_for(user_id))
+    _matchers.set(user_id, (matcher, generation, time.monotonic()))
+    return matcher
+
+
+def invalidate(user_id=None):
+    """ユーザーのキャッシュを破棄（user_id が None なら全員分）"""
+    global _generation
+    if user_id is None:
+        # 全員共通のコマンドは全ユーザーのオートマトンに含まれる
+        with _generation_lock:
+            _generation += 1
+        _matchers.clear()
+    else:
+        _matchers.discard(user_id)
+
+
+@receiver([post_save, post_delete], sender=VoiceCommand)
+def _invalidate_commands(sender, instance, **kwargs):
+    invalidate(instance.user_id)
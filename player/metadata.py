@@ -0,0 +1,262 @@
+"""
+内容ハッシュ単位の音声メタデータ取得サービス
+
+再生時間・ビットレート・サンプリングレート・チャンネル数・コーデック・
+タグを内容ハッシュごとに一度だけ解析し、AudioMetadata テーブルに保存する。
+同じ内容の再アップロードや再参照では、プロセス内 LRU または DB から
+返すため mutagen を呼ばない。
+
+WAV と FLAC はヘッダー部分のバイトだけを自前で解析し、音声データ本体は
+読まない。それ以外の形式は mutagen に任せる（mutagen もフレームヘッダーと
+タグだけを読む）。
+"""
+import logging
+import os
+import struct
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from mutagen import File as MutagenFile
+
+from .models import AudioMetadata
+from .tracing import traced
+
+logger = logging.getLogger(__name__)
+
+# タグ値を DB に保存する際の最大文字数
+MAX_TAG_LENGTH = 200
+
+
+class LRUCache:
+    """スレッドセーフな小さな LRU キャッシュ"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+                return self._data[key]
+            except KeyError:
+                return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+_cache = LRUCache(settings.PLAYER_METADATA_CACHE_SIZE)
+
+
+class ProbeError(Exception):
+    """メタデータを解析できない場合の例外"""
+
+
+def _probe_wav(path):
+    """RIFF のチャンクヘッダーだけを読んで WAV の情報を得る"""
+    with open(path, 'rb') as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+            raise ProbeError('not a RIFF/WAVE file')
+        fmt = None
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                raise ProbeError('data chunk not found')
+            chunk_id, chunk_size = struct.unpack('<4sI', chunk)
+            if chunk_id == b'fmt ':
+                fmt = f.read(chunk_size)
+                if chunk_size % 2:
+                    f.seek(1, os.SEEK_CUR)
+            elif chunk_id == b'data':
+                data_size = chunk_size
+                break
+            else:
+                f.seek(chunk_size + chunk_size % 2, os.SEEK_CUR)
+
+    if fmt is None or len(fmt) < 16:
+        raise ProbeError('fmt chunk not found')
+    audio_format, channels, sample_rate, byte_rate, _, bits = struct.unpack_from('<HHIIHH', fmt)
+    if audio_format == 0xFFFE and len(fmt) >= 26:
+        # WAVE_FORMAT_EXTENSIBLE はサブフォーマット GUID の先頭 2 バイトが形式
+        audio_format = struct.unpack_from('<H', fmt, 24)[0]
+    if audio_format == 1:
+        codec = 'pcm_u8' if bits == 8 else f'pcm_s{bits}le'
+    elif audio_format == 3:
+        codec = f'pcm_f{bits}le'
+    else:
+        codec = f'wav_0x{audio_format:04x}'
+
+    # ストリーミング書き込みされた WAV はサイズが 0xFFFFFFFF のことがある
+    data_size = min(data_size, os.path.getsize(path))
+    return {
+        'duration': data_size / byte_rate if byte_rate else 0.0,
+        'bitrate': byte_rate * 8,
+        'sample_rate': sample_rate,
+        'channels': channels,
+        'codec': codec,
+        'tags': {},
+    }
+
+
+def _parse_vorbis_comment(block):
+    tags = {}
+    vendor_length = struct.unpack_from('<I', block)[0]
+    offset = 4 + vendor_length
+    count = struct.unpack_from('<I', block, offset)[0]
+    offset += 4
+    for _ in range(count):
+        length = struct.unpack_from('<I', block, offset)[0]
+        offset += 4
+        comment = block[offset:offset + length].decode('utf-8', 'replace')
+        offset += length
+        key, _, value = comment.partition('=')
+        tags.setdefault(key.lower(), value)
+    return tags
+
+
+def _probe_flac(path):
+    """FLAC のメタデータブロック（STREAMINFO / VORBIS_COMMENT）だけを読む"""
+    info = None
+    tags = {}
+    with open(path, 'rb') as f:
+        if f.read(4) != b'fLaC':
+            raise ProbeError('not a FLAC file')
+        while True:
+            block_header = f.read(4)
+            if len(block_header) < 4:
+                break
+            is_last = block_header[0] & 0x80
+            block_type = block_header[0] & 0x7F
+            length = int.from_bytes(block_header[1:], 'big')
+            if block_type == 0:
+                streaminfo = f.read(length)
+                packed = int.from_bytes(streaminfo[10:18], 'big')
+                sample_rate = packed >> 44
+                channels = ((packed >> 41) & 0x7) + 1
+                bits = ((packed >> 36) & 0x1F) + 1
+                total_samples = packed & 0xFFFFFFFFF
+                info = (sample_rate, channels, bits, total_samples)
+            elif block_type == 4:
+                try:
+                    tags = _parse_vorbis_comment(f.read(length))
+                except struct.error:
+                    tags = {}
+            else:
+                f.seek(length, os.SEEK_CUR)
+            if is_last:
+                break
+
+    if info is None:
+        raise ProbeError('STREAMINFO not found')
+    sample_rate, channels, bits, total_samples = info
+    duration = total_samples / sample_rate if sample_rate else 0.0
+    return {
+        'duration': duration,
+        'bitrate': int(os.path.getsize(path) * 8 / duration) if duration else 0,
+        'sample_rate': sample_rate,
+        'channels': channels,
+        'codec': 'flac',
+        'tags': tags,
+    }
+
+
+@traced('metadata.mutagen')
+def _probe_mutagen(path):
+    try:
+        audio = MutagenFile(path, easy=True)
+    except Exception as e:
+        raise ProbeError(f'mutagen failed: {e}') from e
+    if audio is None or audio.info is None:
+        raise ProbeError('unrecognized audio format')
+
+    codec = type(audio.info).__module__.rsplit('.', 1)[-1]
+    if codec.startswith('ogg') and len(codec) > 3:
+        codec = codec[3:]
+    tags = {}
+    for key, value in (audio.tags or {}).items():
+        if isinstance(value, list):
+            value = value[0] if value else ''
+        tags[key.lower()] = str(value)
+    return {
+        'duration': float(getattr(audio.info, 'length', 0) or 0),
+        'bitrate': int(getattr(audio.info, 'bitrate', 0) or 0),
+        'sample_rate': int(getattr(audio.info, 'sample_rate', 0) or 0),
+        'channels': int(getattr(audio.info, 'channels', 0) or 0),
+        'codec': codec,
+        'tags': tags,
+    }
+
+
+HEADER_PROBES = {
+    'wav': _probe_wav,
+    'flac': _probe_flac,
+}
+
+
+@traced('metadata.probe')
+def probe(path):
+    """ファイルを解析してメタデータの dict を返す（失敗時は ProbeError）"""
+    extension = path.rsplit('.', 1)[-1].lower()
+    header_probe = HEADER_PROBES.get(extension)
+    if header_probe:
+        try:
+            result = header_probe(path)
+        except (ProbeError, struct.error, OSError) as e:
+            logger.info('header probe failed for %s, falling back to mutagen: %s', path, e)
+            result = _probe_mutagen(path)
+    else:
+        result = _probe_mutagen(path)
+    result['tags'] = {
+        key[:64]: value[:MAX_TAG_LENGTH] for key, value in result['tags'].items()
+    }
+    return result
+
+
+def get_metadata(sha256, path=None):
+    """
+    内容ハッシュに対応するメタデータを返す
+
+    プロセス内 LRU → DB の順に探し、どちらにも無ければ path を解析して保存する。
+    path が無く未解析の場合は None を返す。
+    """
+    metadata = _cache.get(sha256)
+    if metadata is not None:
+        return metadata
+
+    metadata = AudioMetadata.objects.filter(sha256=sha256).first()
+    if metadata is None:
+        if path is None:
+            return None
+        try:
+            fields = probe(path)
+            fields['probe_error'] = ''
+        except ProbeError as e:
+            logger.warning('metadata probe failed for %s: %s', path, e)
+            fields = {'probe_error': str(e)}
+        metadata, _ = AudioMetadata.objects.update_or_create(sha256=sha256, defaults=fields)
+
+    _cache.set(sha256, metadata)
+    return metadata
+
+
+def clear_cache():
+    _cache.clear()
@@ -0,0 +1,416 @@
+"""
+リクエストのメトリクスと Server-Timing
+
+MetricsMiddleware がルートごとのレイテンシ（ヒストグラム）・ステータス別の件数・
+リクエスト / レスポンスのバイト数・セッション Cookie のサイズ・処理中のリクエスト数を
+記録し、ブラウザの開発者ツールで見られるよう Server-Timing ヘッダーを付ける。
+値は /metrics で Prometheus のテキスト形式として返す（外部のコレクターは不要）。
+
+gunicorn の複数ワーカーで集計できるよう、各プロセスは自分の値を
+PLAYER_METRICS_DIR/<pid>.db（mmap したファイル）に書き、/metrics では
+ディレクトリ内の全ファイルを合算する。終了したプロセスのファイルは集計時に
+archive.db へ畳み込む（処理中のリクエスト数は捨てる）。
+
+    <pid>.db  先頭 8 バイトが使用済みバイト数。以降は (キー長, キー, 値) のエントリが並ぶ。
+              キーは JSON の [メトリクス名, 接尾辞, ラベル値]、値は float64
+
+ストリーミング応答のレイテンシは、本文の送信を始める前（View が応答を返すまで）の時間。
+"""
+import bisect
+import fcntl
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from . import tracing
+
+HEADER = struct.Struct('<I4x')
+KEY_LENGTH = struct.Struct('<I')
+VALUE = struct.Struct('<d')
+INITIAL_SIZE = 64 * 1024
+ARCHIVE_NAME = 'archive.db'
+
+# 秒単位のレイテンシのバケット
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COOKIE_BUCKETS = (32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+
+def _padded(length):
+    return (length + 7) & ~7
+
+
+def _format(value):
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def _entries(data, used):
+    """(キー, 値, 値の位置) を順に返す"""
+    offset = HEADER.size
+    while offset < used:
+        (length,) = KEY_LENGTH.unpack_from(data, offset)
+        key = bytes(data[offset + KEY_LENGTH.size:offset + KEY_LENGTH.size + length]).decode('utf-8')
+        position = offset + _padded(KEY_LENGTH.size + length)
+        (value,) = VALUE.unpack_from(data, position)
+        yield key, value, position
+        offset = position + VALUE.size
+
+
+def read_values(path):
+    """他のプロセスの値ファイルを読む（書き込み中でも使用済みの範囲だけを見る）"""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return {}
+    if len(data) < HEADER.size:
+        return {}
+    (used,) = HEADER.unpack_from(data, 0)
+    return {key: value for key, value, _ in _entries(data, min(used, len(data)))}
+
+
+class ValueFile:
+    """キーごとの float64 を mmap したファイルに置く（1 プロセスだけが書き込む）"""
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(self._fd).st_size
+        if size < INITIAL_SIZE:
+            os.ftruncate(self._fd, INITIAL_SIZE)
+            size = INITIAL_SIZE
+        self._map = mmap.mmap(self._fd, size)
+        (self._used,) = HEADER.unpack_from(self._map, 0)
+        if self._used < HEADER.size:
+            self._used = HEADER.size
+            HEADER.pack_into(self._map, 0, self._used)
+        self._positions = {key: position for key, _, position in _entries(self._map, self._used)}
+
+    def keys(self):
+        return list(self._positions)
+
+    def _position(self, key):
+        position = self._positions.get(key)
+        if position is not None:
+            return position
+        encoded = key.encode('utf-8')
+        entry_size = _padded(KEY_LENGTH.size + len(encoded)) + VALUE.size
+        if self._used + entry_size > len(self._map):
+            self._grow(self._used + entry_size)
+        KEY_LENGTH.pack_into(self._map, self._used, len(encoded))
+        self._map[self._used + KEY_LENGTH.size:self._used + KEY_LENGTH.size + len(encoded)] = encoded
+        position = self._used + _padded(KEY_LENGTH.size + len(encoded))
+        VALUE.pack_into(self._map, position, 0.0)
+        # エントリを書き終えてから使用済みバイト数を進める（読み手が途中を見ないように）
+        self._used += entry_size
+        HEADER.pack_into(self._map, 0, self._used)
+        self._positions[key] = position
+        return position
+
+    def _grow(self, needed):
+        size = len(self._map)
+        while size < needed:
+            size *= 2
+        self._map.close()
+        os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+
+    def add(self, key, amount):
+        position = self._position(key)
+        (value,) = VALUE.unpack_from(self._map, position)
+        VALUE.pack_into(self._map, position, value + amount)
+
+    def set(self, key, value):
+        VALUE.pack_into(self._map, self._position(key), value)
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+
+def metrics_dir():
+    directory = settings.PLAYER_METRICS_DIR
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+class _ProcessValues:
+    """このプロセスの値ファイル（fork 後や設定の変更後は開き直す）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._file = None
+        self._owner = None
+
+    def _values(self):
+        owner = (os.getpid(), settings.PLAYER_METRICS_DIR)
+        if self._owner != owner:
+            if self._file is not None:
+                self._file.close()
+            self._file = ValueFile(os.path.join(metrics_dir(), f'{owner[0]}.db'))
+            self._owner = owner
+            # 同じ PID の以前のプロセスが残した処理中の数は引き継がない
+            for key in self._file.keys():
+                if isinstance(REGISTRY.get(json.loads(key)[0]), Gauge):
+                    self._file.set(key, 0.0)
+        return self._file
+
+    def add(self, key, amount):
+        with self._lock:
+            self._values().add(key, amount)
+
+
+_values = _ProcessValues()
+REGISTRY = {}
+
+
+def _key(name, suffix, labels):
+    return json.dumps([name, suffix, list(labels)], ensure_ascii=False)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        REGISTRY[name] = self
+
+    def _check(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}')
+        return [str(label) for label in labels]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1.0):
+        _values.add(_key(self.name, '', self._check(labels)), amount)
+
+
+class Gauge(Metric):
+    """終了したプロセスの分は集計しない値（処理中の数など）"""
+
+    kind = 'gauge'
+
+    def inc(self, *labels, amount=1.0):
+        _values.add(_key(self.name, '', self._check(labels)), amount)
+
+    def dec(self, *labels, amount=1.0):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self.bounds = [_format(bound) for bound in self.buckets] + ['+Inf']
+
+    def observe(self, value, *labels):
+        labels = self._check(labels)
+        # バケットごとの件数（累積は出力時に計算する）
+        bound = self.bounds[bisect.bisect_left(self.buckets, value)]
+        _values.add(_key(self.name, '_bucket', labels + [bound]), 1.0)
+        _values.add(_key(self.name, '_sum', labels), value)
+        _values.add(_key(self.name, '_count', labels), 1.0)
+
+
+REQUEST_DURATION = Histogram(
+    'player_request_duration_seconds', 'View が応答を返すまでの時間（秒）', ('route', 'method'))
+REQUESTS = Counter(
+    'player_requests_total', 'ステータスコード別のリクエスト数', ('route', 'method', 'status'))
+REQUEST_BYTES = Counter(
+    'player_request_bytes_total', 'リクエスト本文のバイト数（Content-Length）', ('route',))
+RESPONSE_BYTES = Counter(
+    'player_response_bytes_total', 'レスポンス本文のバイト数', ('route',))
+SESSION_COOKIE_BYTES = Histogram(
+    'player_session_cookie_bytes', 'リクエストのセッション Cookie のサイズ（バイト）', buckets=COOKIE_BUCKETS)
+IN_FLIGHT = Gauge(
+    'player_requests_in_flight', '処理中のリクエスト数')
+STAGE_DURATION = Histogram(
+    'player_stage_duration_seconds', 'View 内の処理段階ごとの時間（秒）', ('stage',))
+
+
+@contextmanager
+def timing(request, name):
+    """View 内の処理段階を計測して Server-Timing とヒストグラム（トレース中ならスパン）に記録する"""
+    started = time.perf_counter()
+    try:
+        with tracing.span(name):
+            yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_DURATION.observe(elapsed, name)
+        stages = getattr(request, '_server_timing', None)
+        if stages is not None:
+            stages.append((name, elapsed))
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+@contextmanager
+def _directory_lock(directory):
+    with open(os.path.join(directory, '.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _is_gauge(key):
+    return isinstance(REGISTRY.get(json.loads(key)[0]), Gauge)
+
+
+def collect():
+    """全プロセスの値を合算する（終了したプロセスのファイルは archive.db へ畳み込む）"""
+    directory = metrics_dir()
+    totals = defaultdict(float)
+    with _directory_lock(directory):
+        files = [name for name in os.listdir(directory) if name.endswith('.db')]
+        dead = [
+            name for name in files
+            if name[:-3].isdigit() and int(name[:-3]) != os.getpid() and not _alive(int(name[:-3]))
+        ]
+        if dead:
+            archive = ValueFile(os.path.join(directory, ARCHIVE_NAME))
+            try:
+                for name in dead:
+                    path = os.path.join(directory, name)
+                    for key, value in read_values(path).items():
+                        if value and not _is_gauge(key):
+                            archive.add(key, value)
+                    os.remove(path)
+            finally:
+                archive.close()
+        for name in os.listdir(directory):
+            if name.endswith('.db'):
+                for key, value in read_values(os.path.join(directory, name)).items():
+                    totals[key] += value
+    return totals
+
+
+def render(totals=None):
+    """Prometheus のテキスト形式（version 0.0.4）"""
+    if totals is None:
+        totals = collect()
+    samples = defaultdict(dict)  # メトリクス名 -> {(接尾辞, ラベル値): 値}
+    for key, value in totals.items():
+        name, suffix, labels = json.loads(key)
+        samples[name][(suffix, tuple(labels))] = value
+
+    lines = []
+    for name, metric in REGISTRY.items():
+        lines.append(f'# HELP {name} {metric.documentation}')
+        lines.append(f'# TYPE {name} {metric.kind}')
+        values = samples.get(name, {})
+        if isinstance(metric, Histogram):
+            series = sorted({labels for suffix, labels in values if suffix == '_count'})
+            for labels in series:
+                cumulative = 0.0
+                for bound in metric.bounds:
+                    cumulative += values.get(('_bucket', labels + (bound,)), 0.0)
+                    lines.append(
+                        f'{name}_bucket{_labels(metric.labelnames + ("le",), labels + (bound,))} {_format(cumulative)}')
+                lines.append(f'{name}_sum{_labels(metric.labelnames, labels)} {_format(values[("_sum", labels)])}')
+                lines.append(f'{name}_count{_labels(metric.labelnames, labels)} {_format(values[("_count", labels)])}')
+        else:
+            for (suffix, labels), value in sorted(values.items()):
+                lines.append(f'{name}{suffix}{_labels(metric.labelnames, labels)} {_format(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+def _content_length(value):
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+class MetricsMiddleware:
+    """リクエストごとのメトリクスを記録して Server-Timing ヘッダーを付ける（同期・非同期の両対応）"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.PLAYER_METRICS:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        started = self._start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            IN_FLIGHT.dec()
+        return self._finish(request, response, started)
+
+    async def __acall__(self, request):
+        started = self._start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            IN_FLIGHT.dec()
+        return self._finish(request, response, started)
+
+    def _start(self, request):
+        IN_FLIGHT.inc()
+        request._server_timing = []
+        return time.perf_counter()
+
+    def _finish(self, request, response, started):
+        elapsed = time.perf_counter() - started
+        route = tracing.route_for(request)
+        REQUEST_DURATION.observe(elapsed, route, request.method)
+        REQUESTS.inc(route, request.method, response.status_code)
+        REQUEST_BYTES.inc(route, amount=_content_length(request.META.get('CONTENT_LENGTH')))
+        if response.has_header('Content-Length'):
+            size = _content_length(response['Content-Length'])
+        else:
+            size = 0 if response.streaming else len(response.content)
+        RESPONSE_BYTES.inc(route, amount=size)
+        SESSION_COOKIE_BYTES.observe(len(request.COOKIES.get(settings.SESSION_COOKIE_NAME, '')))
+
+        if settings.PLAYER_SERVER_TIMING:
+            entries = [f'{name};dur={seconds * 1000:.1f}' for name, seconds in request._server_timing]
+            entries.append(f'app;dur={elapsed * 1000:.1f}')
+            response['Server-Timing'] = ', '.join(entries)
+        return response
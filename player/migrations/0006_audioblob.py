@@ -0,0 +1,44 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("player", "0005_alter_musicfile_user_alter_voicecommand_user"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AudioBlob",
+            fields=[
+                (
+                    "sha256",
+                    models.CharField(max_length=64, primary_key=True, serialize=False),
+                ),
+                ("extension", models.CharField(max_length=10)),
+                ("size", models.BigIntegerField(default=0)),
+                ("ref_count", models.PositiveIntegerField(default=0)),
+                ("duration", models.FloatField(default=0.0)),
+                ("has_peaks", models.BooleanField(default=False)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "last_accessed_at",
+                    models.DateTimeField(default=django.utils.timezone.now),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name="musicfile",
+            name="blob",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                to="player.audioblob",
+            ),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:02
+
+from django.db import migrations, models
+
+
+def copy_blob_durations(apps, schema_editor):
+    """AudioBlob に保存していた再生時間を AudioMetadata に移す"""
+    AudioBlob = apps.get_model("player", "AudioBlob")
+    AudioMetadata = apps.get_model("player", "AudioMetadata")
+    AudioMetadata.objects.bulk_create(
+        [
+            AudioMetadata(sha256=blob.sha256, duration=blob.duration)
+            for blob in AudioBlob.objects.all()
+        ],
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("player", "0006_audioblob"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AudioMetadata",
+            fields=[
+                (
+                    "sha256",
+                    models.CharField(max_length=64, primary_key=True, serialize=False),
+                ),
+                ("duration", models.FloatField(default=0.0)),
+                ("bitrate", models.IntegerField(default=0)),
+                ("sample_rate", models.IntegerField(default=0)),
+                ("channels", models.IntegerField(default=0)),
+                ("codec", models.CharField(blank=True, max_length=32)),
+                ("tags", models.JSONField(blank=True, default=dict)),
+                ("probe_error", models.TextField(blank=True)),
+                ("probed_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(copy_blob_durations, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name="audioblob",
+            name="duration",
+        ),
+    ]
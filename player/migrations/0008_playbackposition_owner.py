@@ -0,0 +1,52 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_owner_and_file_id(apps, schema_editor):
+    """既存の行はユーザーと MusicFile の ID から所有者とファイルIDを埋める"""
+    PlaybackPosition = apps.get_model("player", "PlaybackPosition")
+    for position in PlaybackPosition.objects.all():
+        position.owner = f"user:{position.user_id}" if position.user_id else f"row:{position.pk}"
+        position.file_id = str(position.music_file_id)
+        position.save(update_fields=["owner", "file_id"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("player", "0007_audiometadata"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="playbackposition",
+            name="owner",
+            field=models.CharField(default="", max_length=80),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name="playbackposition",
+            name="file_id",
+            field=models.CharField(default="", max_length=64),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_owner_and_file_id, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name="playbackposition",
+            name="music_file",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                to="player.musicfile",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="playbackposition",
+            constraint=models.UniqueConstraint(
+                fields=("owner", "file_id"), name="unique_position_per_owner_file"
+            ),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("player", "0008_playbackposition_owner"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="VoiceTemplate",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("action", models.CharField(max_length=100)),
+                ("owner", models.CharField(blank=True, db_index=True, max_length=80)),
+                ("features", models.BinaryField()),
+                ("frames", models.PositiveIntegerField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
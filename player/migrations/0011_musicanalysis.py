@@ -0,0 +1,30 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("player", "0010_job"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MusicAnalysis",
+            fields=[
+                (
+                    "sha256",
+                    models.CharField(max_length=64, primary_key=True, serialize=False),
+                ),
+                ("bpm", models.FloatField(blank=True, null=True)),
+                ("beat_times", models.JSONField(default=list)),
+                ("sections", models.JSONField(default=list)),
+                ("error", models.TextField(blank=True)),
+                ("analyzed_at", models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                "verbose_name_plural": "music analyses",
+            },
+        ),
+    ]
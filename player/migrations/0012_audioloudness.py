@@ -0,0 +1,29 @@
+# Generated by Django 4.2.7 on 2026-10-18 15:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("player", "0011_musicanalysis"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AudioLoudness",
+            fields=[
+                (
+                    "sha256",
+                    models.CharField(max_length=64, primary_key=True, serialize=False),
+                ),
+                ("integrated", models.FloatField(blank=True, null=True)),
+                ("true_peak", models.FloatField(blank=True, null=True)),
+                ("error", models.TextField(blank=True)),
+                ("analyzed_at", models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                "verbose_name_plural": "audio loudness",
+            },
+        ),
+    ]
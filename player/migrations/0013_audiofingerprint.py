@@ -0,0 +1,76 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("player", "0012_audioloudness"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AudioFingerprint",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("sha256", models.CharField(max_length=64, unique=True)),
+                ("offset", models.FloatField(default=0.0)),
+                ("matches", models.IntegerField(default=0)),
+                ("hashes", models.IntegerField(default=0)),
+                ("error", models.TextField(blank=True)),
+                ("fingerprinted_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "track",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="versions",
+                        to="player.audiofingerprint",
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name="playbackposition",
+            name="sha256",
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.CreateModel(
+            name="FingerprintHash",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("hash", models.IntegerField()),
+                ("offset", models.IntegerField()),
+                (
+                    "fingerprint",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="player.audiofingerprint",
+                    ),
+                ),
+            ],
+            options={
+                "indexes": [models.Index(fields=["hash"], name="fingerprint_hash_idx")],
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("player", "0013_audiofingerprint"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AudioArtwork",
+            fields=[
+                (
+                    "sha256",
+                    models.CharField(max_length=64, primary_key=True, serialize=False),
+                ),
+                ("artwork", models.CharField(blank=True, max_length=64)),
+                ("width", models.IntegerField(default=0)),
+                ("height", models.IntegerField(default=0)),
+                ("sizes", models.JSONField(default=list)),
+                ("error", models.TextField(blank=True)),
+                ("extracted_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:07
+
+import unicodedata
+
+from django.db import migrations, models
+
+
+def fill_title_key(apps, schema_editor):
+    """既存の行のタイトルの正規化キーを埋める（models.normalize_title と同じ）"""
+    MusicFile = apps.get_model("player", "MusicFile")
+    for music_file in MusicFile.objects.all():
+        music_file.title_key = unicodedata.normalize("NFKC", music_file.title or "").casefold().strip()[:200]
+        music_file.save(update_fields=["title_key"])
+
+
+def create_trigram_index(apps, schema_editor):
+    """PostgreSQL ではタイトルの部分一致・あいまい検索用に pg_trgm の GIN インデックスを作る"""
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    schema_editor.execute(
+        "CREATE INDEX IF NOT EXISTS musicfile_title_trgm_idx "
+        "ON player_musicfile USING gin (title_key gin_trgm_ops)"
+    )
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute("DROP INDEX IF EXISTS musicfile_title_trgm_idx")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("player", "0014_audioartwork"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="musicfile",
+            name="title_key",
+            field=models.CharField(blank=True, editable=False, max_length=200),
+        ),
+        migrations.AddIndex(
+            model_name="musicfile",
+            index=models.Index(
+                fields=["user", "uploaded_at", "id"], name="musicfile_user_recent_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="musicfile",
+            index=models.Index(
+                fields=["user", "title_key", "id"], name="musicfile_user_title_idx"
+            ),
+        ),
+        migrations.RunPython(fill_title_key, migrations.RunPython.noop),
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:28
+
+from django.db import migrations, models
+from django.db.models import Count, F, Min
+
+
+def remove_duplicate_tracks(apps, schema_editor):
+    """同じユーザー・同じ音声の重複した曲は最初の 1 曲だけ残し、余分に増えた参照数を戻す"""
+    MusicFile = apps.get_model("player", "MusicFile")
+    AudioBlob = apps.get_model("player", "AudioBlob")
+    duplicates = (
+        MusicFile.objects.filter(blob__isnull=False)
+        .values("user", "blob")
+        .annotate(count=Count("id"), first=Min("id"))
+        .filter(count__gt=1)
+    )
+    for group in duplicates:
+        MusicFile.objects.filter(user=group["user"], blob=group["blob"]).exclude(pk=group["first"]).delete()
+        AudioBlob.objects.filter(pk=group["blob"], ref_count__gte=group["count"] - 1).update(
+            ref_count=F("ref_count") - (group["count"] - 1)
+        )
+
+
+def create_title_prefix_index(apps, schema_editor):
+    """
+    PostgreSQL ではタイトルの前方一致（範囲条件）用に "C" 照合順序の式インデックスを作る
+
+    ja_JP.UTF-8 などの照合順序では title_key の範囲条件が前方一致にならないため、
+    library._search はバイト順の "C" で比べる。
+    """
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute(
+        "CREATE INDEX IF NOT EXISTS musicfile_title_prefix_idx "
+        'ON player_musicfile (user_id, (title_key COLLATE "C"))'
+    )
+
+
+def drop_title_prefix_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute("DROP INDEX IF EXISTS musicfile_title_prefix_idx")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("player", "0015_musicfile_library_indexes"),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_tracks, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="musicfile",
+            constraint=models.UniqueConstraint(
+                fields=("user", "blob"), name="unique_track_per_user_blob"
+            ),
+        ),
+        migrations.RunPython(create_title_prefix_index, drop_title_prefix_index),
+    ]
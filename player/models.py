@@ -1,6 +1,115 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.core.validators import FileExtensionValidator
+from django.utils import timezone
+import unicodedata
+
+
+def normalize_title(title):
+    """タイトルの並び替え・前方一致検索用のキー（NFKC で正規化して大文字小文字を区別しない）"""
+    return unicodedata.normalize('NFKC', title or '').casefold().strip()[:200]
+
+class AudioBlob(models.Model):
+    """SHA-256 をキーに重複排除して保存した音声データ"""
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    extension = models.CharField(max_length=10)
+    size = models.BigIntegerField(default=0)  # バイト数
+    ref_count = models.PositiveIntegerField(default=0)  # セッション・MusicFile からの参照数
+    has_peaks = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_accessed_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.sha256[:12]}.{self.extension} ({self.ref_count} refs)"
+
+class AudioMetadata(models.Model):
+    """内容ハッシュごとに一度だけ取得した音声メタデータ"""
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    duration = models.FloatField(default=0.0)  # 秒数
+    bitrate = models.IntegerField(default=0)  # bps
+    sample_rate = models.IntegerField(default=0)
+    channels = models.IntegerField(default=0)
+    codec = models.CharField(max_length=32, blank=True)
+    tags = models.JSONField(default=dict, blank=True)
+    probe_error = models.TextField(blank=True)  # 解析に失敗した場合の理由
+    probed_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.sha256[:12]} {self.codec} {self.duration:.1f}s"
+
+class MusicAnalysis(models.Model):
+    """内容ハッシュごとに一度だけ行った曲の解析（テンポ・ビート・セクション）"""
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    bpm = models.FloatField(null=True, blank=True)
+    beat_times = models.JSONField(default=list)  # ビート位置（秒）の配列
+    sections = models.JSONField(default=list)  # [{start, end, label}, ...]
+    error = models.TextField(blank=True)  # 解析できなかった場合の理由
+    analyzed_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = "music analyses"
+
+    def __str__(self):
+        bpm = f"{self.bpm:.1f} BPM" if self.bpm else "no tempo"
+        return f"{self.sha256[:12]} {bpm} {len(self.sections)} sections"
+
+class AudioLoudness(models.Model):
+    """内容ハッシュごとに一度だけ測定したラウドネス（BS.1770）"""
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    integrated = models.FloatField(null=True, blank=True)  # ゲート付き積分ラウドネス（LUFS）
+    true_peak = models.FloatField(null=True, blank=True)  # dBTP
+    error = models.TextField(blank=True)  # 測定できなかった場合の理由
+    analyzed_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = "audio loudness"
+
+    def __str__(self):
+        if self.integrated is None:
+            return f"{self.sha256[:12]} silent"
+        return f"{self.sha256[:12]} {self.integrated:.1f} LUFS"
+
+class AudioArtwork(models.Model):
+    """内容ハッシュごとに一度だけ抽出した埋め込みアートワーク（サムネイルは画像のハッシュで共有）"""
+    sha256 = models.CharField(max_length=64, primary_key=True)
+    artwork = models.CharField(max_length=64, blank=True)  # 画像の sha256（埋め込み画像が無ければ空）
+    width = models.IntegerField(default=0)  # 元の画像の大きさ
+    height = models.IntegerField(default=0)
+    sizes = models.JSONField(default=list)  # 作成したサムネイルの長辺（px）
+    error = models.TextField(blank=True)
+    extracted_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        if not self.artwork:
+            return f"{self.sha256[:12]} no artwork"
+        return f"{self.sha256[:12]} {self.width}x{self.height} -> {self.artwork[:12]}"
+
+class AudioFingerprint(models.Model):
+    """音響指紋を照合した音声。同じ録音の別の音声は track に最初の音声を持つ"""
+    sha256 = models.CharField(max_length=64, unique=True)
+    # 同じ録音として最初に登録された音声（自身が最初なら None。索引にはこちらの指紋だけがある）
+    track = models.ForeignKey('self', on_delete=models.CASCADE, null=True, blank=True, related_name='versions')
+    offset = models.FloatField(default=0.0)  # track の時刻 - この音声の時刻（秒）
+    matches = models.IntegerField(default=0)  # 照合で一致したハッシュの数
+    hashes = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    fingerprinted_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        if self.track_id:
+            return f"{self.sha256[:12]} = {self.track.sha256[:12]} ({self.matches} matches)"
+        return f"{self.sha256[:12]} ({self.hashes} hashes)"
+
+class FingerprintHash(models.Model):
+    """音響指紋の転置索引（ハッシュ -> 録音, 先頭からのフレーム）"""
+    hash = models.IntegerField()
+    fingerprint = models.ForeignKey(AudioFingerprint, on_delete=models.CASCADE, related_name='+')
+    offset = models.IntegerField()  # フレーム番号（fingerprint.HOP / SAMPLE_RATE 秒単位）
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['hash'], name='fingerprint_hash_idx'),
+        ]
 
 class MusicFile(models.Model):
     title = models.CharField(max_length=200)
@@ -12,6 +121,19 @@ class MusicFile(models.Model):
     file_size = models.IntegerField(default=0)  # バイト数
     uploaded_at = models.DateTimeField(auto_now_add=True)
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
+    blob = models.ForeignKey(AudioBlob, on_delete=models.SET_NULL, null=True, blank=True)
+    title_key = models.CharField(max_length=200, blank=True, editable=False)  # normalize_title(title)
+
+    class Meta:
+        # ライブラリの一覧（library.py）のキーセットページネーション用
+        indexes = [
+            models.Index(fields=['user', 'uploaded_at', 'id'], name='musicfile_user_recent_idx'),
+            models.Index(fields=['user', 'title_key', 'id'], name='musicfile_user_title_idx'),
+        ]
+        # 同じ音声はユーザーのライブラリに 1 曲だけ（同時に追加しても参照数を 1 つしか増やさない）
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'blob'], name='unique_track_per_user_blob'),
+        ]
 
     def __str__(self):
         return self.title
@@ -19,20 +141,28 @@ class MusicFile(models.Model):
     def save(self, *args, **kwargs):
         if self.file:
             self.file_size = self.file.size
+        self.title_key = normalize_title(self.title)
         super().save(*args, **kwargs)
 
 class PlaybackPosition(models.Model):
     """前回再生位置を記憶するモデル"""
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
-    music_file = models.ForeignKey(MusicFile, on_delete=models.CASCADE)
+    music_file = models.ForeignKey(MusicFile, on_delete=models.CASCADE, null=True, blank=True)
+    # 所有者（"user:<id>" または "session:<key>"）とファイルID（セッションのファイルも対象）
+    owner = models.CharField(max_length=80)
+    file_id = models.CharField(max_length=64)
+    sha256 = models.CharField(max_length=64, blank=True, db_index=True)  # 再生した音声（同じ曲の別ファイルへの引き継ぎ用）
     position = models.FloatField(default=0.0)  # 秒数
     last_played_at = models.DateTimeField(auto_now=True)
     
     class Meta:
         unique_together = ['user', 'music_file']
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'file_id'], name='unique_position_per_owner_file'),
+        ]
     
     def __str__(self):
-        return f"{self.user.username if self.user else 'Anonymous'} - {self.music_file.title} at {self.position}s"
+        return f"{self.owner} - {self.file_id} at {self.position}s"
 
 class VoiceCommand(models.Model):
     command = models.CharField(max_length=100)
@@ -45,3 +175,51 @@ class VoiceCommand(models.Model):
 
     class Meta:
         unique_together = ['command', 'user']
+
+class VoiceTemplate(models.Model):
+    """オフライン認識用に登録した音声コマンドの特徴量（MFCC）"""
+    action = models.CharField(max_length=100)
+    # 所有者（"user:<id>" または "session:<key>"）。空なら全員共通
+    owner = models.CharField(max_length=80, blank=True, db_index=True)
+    features = models.BinaryField()  # float32 [frames, 次元数]
+    frames = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.action} ({self.owner or 'global'}, {self.frames} frames)"
+
+class Job(models.Model):
+    """アップロード後に音声ごとに行う重い処理（波形ピーク・シークインデックスなど）"""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, '待機中'),
+        (RUNNING, '実行中'),
+        (DONE, '完了'),
+        (FAILED, '失敗'),
+    ]
+
+    kind = models.CharField(max_length=32)  # jobs.register で登録した処理名
+    blob = models.ForeignKey(AudioBlob, on_delete=models.CASCADE, related_name='jobs')
+    status = models.CharField(max_length=8, choices=STATUS_CHOICES, default=QUEUED)
+    attempts = models.PositiveIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)  # 再試行はこの時刻以降に取り出す
+    locked_by = models.CharField(max_length=100, blank=True)  # 実行中のワーカー（ホスト名:PID）
+    locked_at = models.DateTimeField(null=True, blank=True)
+    result = models.JSONField(default=dict, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'blob'], name='unique_job_per_blob'),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='job_claim_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.blob_id[:12]} ({self.status}, {self.attempts} attempts)"
@@ -0,0 +1,206 @@
+"""
+波形表示用のピーク（最小値・最大値ペア）の事前計算
+
+アップロード時にサーバー側で一度だけ計算し、音声ファイルの隣に
+小さなバイナリとして保存する。クライアントは数 KB のピークだけを
+取得すればよく、端末上で音声全体をデコードする必要がなくなる。
+
+ピークは 2 倍ずつ間引いた多段解像度（ミップマップ）として 1 ファイルに
+まとめて保存し、numpy.memmap で必要な範囲だけを読み出す。
+
+保存ファイル形式（リトルエンディアン）:
+    magic        4s   b'PKPY'
+    version      B
+    bits         B    8 固定（int8）
+    levels       H    段数
+    sample_rate  I
+    base_samples_per_peak I   第 0 段の 1 ピークあたりのサンプル数
+    level table  levels × (offset I, length I)  data 先頭からのピーク位置と数
+    data         int8 [sum(length), 2]（min, max の順）
+
+API レスポンス形式（指定区間の切り出し）:
+    magic        4s   b'PEAK'
+    version      B    2
+    bits         B    8
+    level        H
+    sample_rate  I
+    samples_per_peak I
+    start_index  I    先頭ピークの（その段での）インデックス
+    length       I
+    data         int8 [length, 2]
+"""
+import logging
+import math
+import os
+import struct
+
+import numpy as np
+from django.conf import settings
+
+from .audio import AudioDecodeError, open_pcm
+
+logger = logging.getLogger(__name__)
+
+PYRAMID_MAGIC = b'PKPY'
+PYRAMID_VERSION = 1
+PYRAMID_HEADER = struct.Struct('<4sBBHII')
+LEVEL_ENTRY = struct.Struct('<II')
+
+MAGIC = b'PEAK'
+VERSION = 2
+HEADER = struct.Struct('<4sBBHIIII')
+
+PEAKS_SUFFIX = '.peaks'
+
+
+def peaks_path(audio_path):
+    """音声ファイルに対応するピークファイルのパス"""
+    return audio_path + PEAKS_SUFFIX
+
+
+def compute_peaks(source, samples_per_peak):
+    """
+    PCMSource からピークを計算して int8 の (N, 2) 配列を返す
+
+    ブロックごとに (-1, samples_per_peak) へ reshape して min/max を
+    ベクトル演算でまとめて求める。ブロック境界の端数は次のブロックへ持ち越す。
+    """
+    block_frames = samples_per_peak * max(65536 // samples_per_peak, 1)
+    carry = np.empty(0, dtype=np.float32)
+    mins = []
+    maxs = []
+    for block in source.blocks(block_frames):
+        if carry.size:
+            block = np.concatenate([carry, block])
+        usable = block.size - block.size % samples_per_peak
+        if usable:
+            frames = block[:usable].reshape(-1, samples_per_peak)
+            mins.append(frames.min(axis=1))
+            maxs.append(frames.max(axis=1))
+        carry = block[usable:]
+    if carry.size:
+        mins.append(carry.min(keepdims=True))
+        maxs.append(carry.max(keepdims=True))
+
+    if not mins:
+        return np.zeros((0, 2), dtype=np.int8)
+    pairs = np.stack([np.concatenate(mins), np.concatenate(maxs)], axis=1)
+    return np.clip(np.round(pairs * 127.0), -127, 127).astype(np.int8)
+
+
+def decimate_peaks(pairs):
+    """隣り合う 2 ピークをまとめて解像度を半分にする"""
+    if len(pairs) % 2:
+        pairs = np.concatenate([pairs, pairs[-1:]])
+    grouped = pairs.reshape(-1, 2, 2)
+    return np.stack([grouped[:, :, 0].min(axis=1), grouped[:, :, 1].max(axis=1)], axis=1)
+
+
+def build_pyramid(base):
+    """第 0 段から 1 ピークになるまで 2 倍ずつ間引いた段のリストを返す"""
+    levels = [base]
+    while len(levels[-1]) > 1:
+        levels.append(decimate_peaks(levels[-1]))
+    return levels
+
+
+def encode_pyramid(levels, sample_rate, base_samples_per_peak):
+    """多段ピークを保存用バイナリに変換"""
+    header = PYRAMID_HEADER.pack(
+        PYRAMID_MAGIC, PYRAMID_VERSION, 8, len(levels), sample_rate, base_samples_per_peak
+    )
+    table = []
+    offset = 0
+    for level in levels:
+        table.append(LEVEL_ENTRY.pack(offset, len(level)))
+        offset += len(level)
+    data = b''.join(np.ascontiguousarray(level, dtype=np.int8).tobytes() for level in levels)
+    return header + b''.join(table) + data
+
+
+def build_peaks(audio_path, duration=None):
+    """
+    音声ファイルの多段ピークを計算してファイルに保存する
+
+    デコードできない形式（ffmpeg 未導入など）の場合は None を返す。
+    """
+    try:
+        source = open_pcm(audio_path, duration=duration)
+        samples_per_peak = settings.PLAYER_PEAKS_BASE_SAMPLES
+        base = compute_peaks(source, samples_per_peak)
+    except AudioDecodeError as e:
+        logger.info('peaks skipped for %s: %s', audio_path, e)
+        return None
+
+    output_path = peaks_path(audio_path)
+    temp_path = output_path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(encode_pyramid(build_pyramid(base), source.sample_rate, samples_per_peak))
+    os.replace(temp_path, output_path)
+    return output_path
+
+
+class PeakPyramid:
+    """保存済みの多段ピークを memmap で読み出す"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            header = f.read(PYRAMID_HEADER.size)
+            if len(header) < PYRAMID_HEADER.size:
+                raise ValueError('truncated peaks file')
+            magic, version, bits, levels, sample_rate, base_spp = PYRAMID_HEADER.unpack(header)
+            if magic != PYRAMID_MAGIC or version != PYRAMID_VERSION or bits != 8:
+                raise ValueError('unsupported peaks file')
+            table = f.read(LEVEL_ENTRY.size * levels)
+        self.sample_rate = sample_rate
+        self.base_samples_per_peak = base_spp
+        self.levels = [LEVEL_ENTRY.unpack_from(table, i * LEVEL_ENTRY.size) for i in range(levels)]
+        data_offset = PYRAMID_HEADER.size + LEVEL_ENTRY.size * levels
+        total = sum(length for _, length in self.levels)
+        if total:
+            self.data = np.memmap(path, dtype=np.int8, mode='r', offset=data_offset, shape=(total, 2))
+        else:
+            self.data = np.zeros((0, 2), dtype=np.int8)
+
+    @property
+    def duration(self):
+        if not self.levels:
+            return 0.0
+        return self.levels[0][1] * self.base_samples_per_peak / self.sample_rate
+
+    def samples_per_peak(self, level):
+        return self.base_samples_per_peak << level
+
+    def choose_level(self, start, end, width):
+        """区間内のピーク数が width 以上となる最も粗い段を選ぶ"""
+        span = max(end - start, 0.0) * self.sample_rate
+        level = 0
+        for candidate in range(len(self.levels)):
+            if span / self.samples_per_peak(candidate) >= width:
+                level = candidate
+            else:
+                break
+        return level
+
+    def window(self, start, end, width):
+        """指定区間・画素数に対応する段の切り出しを返す"""
+        level = self.choose_level(start, end, width)
+        offset, length = self.levels[level]
+        spp = self.samples_per_peak(level)
+        first = min(max(int(start * self.sample_rate // spp), 0), length)
+        last = min(max(math.ceil(end * self.sample_rate / spp), first), length)
+        return level, spp, first, self.data[offset + first:offset + last]
+
+    def encode_window(self, start, end, width):
+        """区間の切り出しを API レスポンス形式に変換"""
+        level, spp, first, pairs = self.window(start, end, width)
+        header = HEADER.pack(MAGIC, VERSION, 8, level, self.sample_rate, spp, first, len(pairs))
+        return header + np.ascontiguousarray(pairs).tobytes()
+
+
+def remove_peaks(audio_path):
+    """音声ファイルに対応するピークファイルを削除"""
+    try:
+        os.remove(peaks_path(audio_path))
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,229 @@
+"""
+再生位置の書き込みをまとめる write-behind ストア
+
+一時停止・音声コマンド・ページ離脱のたびに届く再生位置を、
+(所有者, ファイルID) ごとに最新の値だけメモリ上に残し、一定間隔で
+PlaybackPosition へ bulk_create(update_conflicts=True) でまとめて書き込む。
+頻繁に操作するユーザーでも DB 書き込みは間隔あたり 1 回で済む。
+
+再生位置には再生した音声の sha256 も残し、ファイルID に記録が無い場合は
+同じ録音の音声（fingerprint.versions）で最後に再生した位置から再開する。
+"""
+import atexit
+import logging
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.db import OperationalError, close_old_connections, transaction
+
+from .models import PlaybackPosition
+from .sessions import SAVED_AT_KEY
+
+logger = logging.getLogger(__name__)
+
+MAX_FILE_ID_LENGTH = PlaybackPosition._meta.get_field('file_id').max_length
+
+
+def parse_position(file_id, position, ts=None):
+    """
+    クライアントから届いた再生位置を検証して (file_id, position, ts) にする
+
+    バッファに入った不正な値は書き込みのたびに失敗するので、ここで ValueError にする。
+    """
+    file_id = str(file_id or '')
+    if not file_id or len(file_id) > MAX_FILE_ID_LENGTH:
+        raise ValueError('file_id is invalid')
+    position = float(position)
+    ts = float(ts) if ts is not None else None
+    if not math.isfinite(position) or position < 0 or (ts is not None and not math.isfinite(ts)):
+        raise ValueError('position is invalid')
+    return file_id, position, ts
+
+
+def keep_session_alive(request):
+    """
+    再生位置の保存のついでにセッションの期限を延ばす
+
+    SESSION_SAVE_EVERY_REQUEST を使わないので、内容が変わらないとセッションの期限は
+    延びない。前回の保存から PLAYER_SESSION_REFRESH_INTERVAL 秒以上経っていれば
+    保存し直させ、聴いている間にセッション（とアップロードしたファイル）が切れないようにする。
+    """
+    session = request.session
+    if not session.session_key:
+        return
+    saved_at = session.get(SAVED_AT_KEY, 0)
+    if time.time() - saved_at >= settings.PLAYER_SESSION_REFRESH_INTERVAL:
+        session.modified = True
+
+
+def owner_for(request):
+    """ログインユーザーならユーザー、それ以外はセッション単位の所有者キー"""
+    if request.user.is_authenticated:
+        return f'user:{request.user.pk}'
+    if not request.session.session_key:
+        request.session.create()
+    return f'session:{request.session.session_key}'
+
+
+class PositionBuffer:
+    """(所有者, ファイルID) ごとに最新の再生位置だけを保持するバッファ"""
+
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self._pending = {}  # (owner, file_id) -> (position, ts, sha256)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._flusher = None
+
+    def record(self, owner, file_id, position, ts=None, sha256=''):
+        """再生位置を記録（ts が古い更新は捨てる）"""
+        self._put(owner, file_id, position, ts, sha256)
+        self._after_record()
+
+    def record_many(self, owner, items):
+        """複数の再生位置をまとめて記録（items は (file_id, position, ts, sha256) の列）"""
+        for file_id, position, ts, sha256 in items:
+            self._put(owner, file_id, position, ts, sha256)
+        self._after_record()
+
+    def _put(self, owner, file_id, position, ts, sha256):
+        ts = time.time() * 1000 if ts is None else ts
+        key = (owner, file_id)
+        with self._lock:
+            current = self._pending.get(key)
+            if current is None or ts >= current[1]:
+                self._pending[key] = (position, ts, sha256 or '')
+
+    def _after_record(self):
+        if self.flush_interval <= 0:
+            self.flush()
+        elif time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+        else:
+            self._ensure_flusher()
+
+    def get(self, owner, file_id, versions=None):
+        """
+        未書き込みの値を優先して再生位置を返す
+
+        versions（fingerprint.versions の 同じ録音の sha256 -> この音声への時刻のずれ）を
+        渡すと、ファイルID に記録が無い場合にそれらの音声で最後に再生した位置を
+        この音声の時刻に直して返す。
+        """
+        with self._lock:
+            pending = self._pending.get((owner, file_id))
+        if pending is not None:
+            return pending[0]
+        position = PlaybackPosition.objects.filter(owner=owner, file_id=file_id).values_list(
+            'position', flat=True
+        ).first()
+        if position is not None:
+            return position
+        return self._get_version(owner, versions) if versions else 0.0
+
+    def _get_version(self, owner, versions):
+        with self._lock:
+            candidates = [
+                (ts, sha256, position) for (key_owner, _), (position, ts, sha256) in self._pending.items()
+                if key_owner == owner and sha256 in versions
+            ]
+        if candidates:
+            _, sha256, position = max(candidates)
+        else:
+            latest = PlaybackPosition.objects.filter(owner=owner, sha256__in=list(versions)).order_by(
+                '-last_played_at'
+            ).values_list('sha256', 'position').first()
+            if latest is None:
+                return 0.0
+            sha256, position = latest
+        return max(0.0, position + versions[sha256])
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    def forget_owner(self, owner):
+        """所有者の再生位置を未書き込み分も含めて削除"""
+        with self._lock:
+            for key in [key for key in self._pending if key[0] == owner]:
+                del self._pending[key]
+        PlaybackPosition.objects.filter(owner=owner).delete()
+
+    def flush(self):
+        """溜まっている再生位置をまとめて DB に書き込む"""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._last_flush = time.monotonic()
+            if not pending:
+                return 0
+            rows = [
+                PlaybackPosition(owner=owner, file_id=file_id, sha256=sha256, position=position)
+                for (owner, file_id), (position, _, sha256) in pending.items()
+            ]
+            try:
+                self._write(rows)
+            except OperationalError:
+                # DB に繋がらない場合は、より新しい値が来ていなければ戻して次の書き込みで再試行する
+                with self._lock:
+                    for key, value in pending.items():
+                        current = self._pending.get(key)
+                        if current is None or value[1] > current[1]:
+                            self._pending[key] = value
+                raise
+            except Exception:
+                # 書き込めない行が混じっている場合は 1 行ずつ書き、失敗した行だけ捨てる
+                # （戻すと以降の書き込みがすべてその行で失敗し続ける）
+                written = 0
+                for row in rows:
+                    try:
+                        self._write([row])
+                        written += 1
+                    except Exception:
+                        logger.exception('dropped playback position %s %s', row.owner, row.file_id)
+                return written
+            return len(rows)
+
+    def _write(self, rows):
+        with transaction.atomic():
+            PlaybackPosition.objects.bulk_create(
+                rows,
+                update_conflicts=True,
+                unique_fields=['owner', 'file_id'],
+                update_fields=['position', 'sha256', 'last_played_at'],
+            )
+
+    def _ensure_flusher(self):
+        """リクエストが途絶えても一定間隔で書き込むバックグラウンドスレッドを起動"""
+        if not settings.PLAYER_POSITION_FLUSH_THREAD:
+            return
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        with self._lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+            self._flusher = threading.Thread(target=self._run_flusher, name='position-flusher', daemon=True)
+            self._flusher.start()
+
+    def _run_flusher(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                close_old_connections()
+                self.flush()
+            except Exception:
+                logger.exception('failed to flush playback positions')
+
+
+position_buffer = PositionBuffer(settings.PLAYER_POSITION_FLUSH_INTERVAL)
+
+
+@atexit.register
+def _flush_at_exit():
+    try:
+        position_buffer.flush()
+    except Exception:
+        logger.exception('failed to flush playback positions at exit')
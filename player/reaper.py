@@ -0,0 +1,280 @@
+"""
+アップロード済みファイルの回収（リーパー）
+
+セッションの期限切れでクッキーが消えると、そのセッションが持っていた
+ファイルを解放する機会が無くなり、ストアが際限なく大きくなる。
+リーパーは定期的に次の処理を行い、回収したバイト数を報告する。
+
+1. 参照数の再計算: 有効なセッションと MusicFile からの参照を数え直し、
+   参照が無くなった AudioBlob を実体ごと削除する。
+2. ファイルの走査: blobs/ 以下のシャードを少しずつ走査し、AudioBlob の行が
+   無いファイル、途中で止まったアップロード、旧方式のセッション別ファイル
+   （temp_uploads/・temp/<session_key>/）を削除する。一巡するごとに、どの
+   AudioArtwork からも参照されないアートワークのサムネイルも削除する。
+3. 容量制限: 合計サイズが PLAYER_STORAGE_QUOTA を超えていれば、ライブラリの曲以外を最後に
+   アクセスされたのが古い順に追い出す。
+
+アップロード直後や再生中のファイルを消さないよう、PLAYER_REAPER_GRACE 秒
+以内に作成・アクセスされたものは対象外にする。
+"""
+import logging
+import os
+import shutil
+import time
+from collections import Counter
+from dataclasses import dataclass
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.db import transaction
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from . import artwork, storage
+from .models import AudioArtwork, AudioBlob
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ReapResult:
+    """1 回の回収結果"""
+    expired: int = 0  # 参照が無くなって削除した AudioBlob
+    orphaned: int = 0  # 行の無いファイル・途中のアップロード・旧方式のファイル
+    evicted: int = 0  # 容量制限で追い出した AudioBlob
+    bytes_reclaimed: int = 0
+    scanned_dirs: int = 0
+
+    def merge(self, other):
+        self.expired += other.expired
+        self.orphaned += other.orphaned
+        self.evicted += other.evicted
+        self.bytes_reclaimed += other.bytes_reclaimed
+        self.scanned_dirs += other.scanned_dirs
+
+    def __str__(self):
+        return (
+            f'expired={self.expired} orphaned={self.orphaned} evicted={self.evicted} '
+            f'reclaimed={self.bytes_reclaimed} bytes'
+        )
+
+
+def _remove_path(path):
+    """ファイルまたはディレクトリを削除して解放したバイト数を返す"""
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            size = sum(
+                os.path.getsize(os.path.join(root, name))
+                for root, _, names in os.walk(path) for name in names
+            )
+            shutil.rmtree(path, ignore_errors=True)
+            return size
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+    except FileNotFoundError:
+        return 0
+
+
+def live_session_refs():
+    """
+    有効なセッションが持っているファイルを数える
+
+    戻り値は (内容ハッシュごとの参照数, セッションキーの集合, 旧方式のファイルパスの集合)。
+    """
+    refs = Counter()
+    session_keys = set()
+    legacy_paths = set()
+    sessions = Session.objects.filter(expire_date__gt=timezone.now())
+    for session in sessions.iterator(chunk_size=500):
+        session_keys.add(session.session_key)
+        try:
+            files = session.get_decoded().get('uploaded_files', [])
+        except Exception:
+            continue
+        for file_info in files:
+            if file_info.get('sha256'):
+                refs[file_info['sha256']] += 1
+            elif file_info.get('file_path'):
+                legacy_paths.add(os.path.abspath(file_info['file_path']))
+    return refs, session_keys, legacy_paths
+
+
+class Reaper:
+    """
+    ストアの回収処理
+
+    ファイルの走査は 1 回あたり batch_size 個のシャードディレクトリまでに
+    とどめ、続きは次回の run() で再開する。
+    """
+
+    def __init__(self, quota=None, grace=None, batch_size=64):
+        self.quota = settings.PLAYER_STORAGE_QUOTA if quota is None else quota
+        self.grace = settings.PLAYER_REAPER_GRACE if grace is None else grace
+        self.batch_size = batch_size
+        self._shards = None
+
+    def run(self):
+        """参照の再計算・ファイルの走査（batch_size 分）・容量制限を 1 回ずつ行う"""
+        refs, session_keys, legacy_paths = live_session_refs()
+        result = self.expire(refs)
+        result.merge(self.sweep(session_keys, legacy_paths))
+        result.merge(self.enforce_quota())
+        if result.bytes_reclaimed:
+            logger.info('reaper: %s', result)
+        return result
+
+    def run_full(self):
+        """ファイルの走査が一巡するまで run() を繰り返す"""
+        result = self.run()
+        while self._shards:
+            result.merge(self.run())
+        return result
+
+    def _cutoff(self):
+        return timezone.now() - timedelta(seconds=self.grace)
+
+    def expire(self, refs):
+        """参照数を数え直し、参照の無くなった AudioBlob を削除する"""
+        result = ReapResult()
+        library_refs = dict(
+            AudioBlob.objects.filter(musicfile__isnull=False)
+            .annotate(n=Count('musicfile')).values_list('sha256', 'n')
+        )
+        # 猶予期間内に参照された AudioBlob は、セッションへの登録前かもしれないので触らない
+        candidates = AudioBlob.objects.filter(last_accessed_at__lt=self._cutoff())
+        for blob in candidates.iterator(chunk_size=500):
+            count = refs.get(blob.sha256, 0) + library_refs.get(blob.sha256, 0)
+            if count:
+                if count != blob.ref_count:
+                    AudioBlob.objects.filter(sha256=blob.sha256).update(ref_count=count)
+                continue
+            reclaimed = self._delete_blob(blob.sha256)
+            if reclaimed is not None:
+                result.expired += 1
+                result.bytes_reclaimed += reclaimed
+        return result
+
+    def _delete_blob(self, sha256):
+        """猶予期間内に参照されていなければ AudioBlob を削除し、解放したバイト数を返す"""
+        with transaction.atomic():
+            blob = AudioBlob.objects.select_for_update().filter(
+                sha256=sha256, last_accessed_at__lt=self._cutoff()
+            ).first()
+            if blob is None:
+                return None
+            base = storage.path_for(blob)
+            blob.delete()
+            # 同じ内容を取り込む storage.store_file() と競合しないよう行ロックの中で消す
+            return storage.delete_blob_files(base)
+
+    def _next_shards(self):
+        """走査するシャードディレクトリ（blobs/ab/cd）を batch_size 個ずつ返す"""
+        if not self._shards:
+            self._shards = self._list_shards()
+        batch = self._shards[:self.batch_size]
+        self._shards = self._shards[self.batch_size:]
+        return batch
+
+    def _list_shards(self):
+        root = storage.blob_root()
+        shards = []
+        if not os.path.isdir(root):
+            return shards
+        with os.scandir(root) as level1:
+            for first in sorted(entry.name for entry in level1 if entry.is_dir()):
+                if first == 'tmp':
+                    continue
+                with os.scandir(os.path.join(root, first)) as level2:
+                    shards.extend(
+                        os.path.join(root, first, entry.name) for entry in level2 if entry.is_dir()
+                    )
+        return shards
+
+    def sweep(self, session_keys, legacy_paths):
+        """行の無いファイル・途中のアップロード・旧方式のファイルを削除する"""
+        result = ReapResult()
+        cutoff = time.time() - self.grace
+
+        shards = self._next_shards()
+        for shard in shards:
+            result.scanned_dirs += 1
+            with os.scandir(shard) as entries:
+                files = [entry for entry in entries if entry.is_file()]
+            shas = {entry.name.split('.', 1)[0] for entry in files}
+            known = set(AudioBlob.objects.filter(sha256__in=shas).values_list('sha256', flat=True))
+            for entry in files:
+                if entry.name.split('.', 1)[0] in known or entry.stat().st_mtime >= cutoff:
+                    continue
+                result.orphaned += 1
+                result.bytes_reclaimed += _remove_path(entry.path)
+
+        # 途中で止まったアップロードと旧方式のファイルは一巡するごとにまとめて見る
+        if not self._shards:
+            for directory, keep in (
+                (storage.staging_dir(), lambda entry: False),
+                (os.path.join(settings.MEDIA_ROOT, 'temp_uploads'),
+                 lambda entry: os.path.abspath(entry.path) in legacy_paths),
+                (os.path.join(settings.MEDIA_ROOT, 'temp'),
+                 lambda entry: entry.name in session_keys),
+            ):
+                if not os.path.isdir(directory):
+                    continue
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if keep(entry) or entry.stat().st_mtime >= cutoff:
+                            continue
+                        result.orphaned += 1
+                        result.bytes_reclaimed += _remove_path(entry.path)
+            result.merge(self.sweep_artwork(cutoff))
+        return result
+
+    def sweep_artwork(self, cutoff):
+        """どの AudioArtwork からも参照されないサムネイル（と作りかけの一時ファイル）を削除する"""
+        result = ReapResult()
+        root = artwork.artwork_root()
+        if not os.path.isdir(root):
+            return result
+        with os.scandir(root) as shards:
+            directories = [entry.path for entry in shards if entry.is_dir()]
+        for directory in directories:
+            with os.scandir(directory) as entries:
+                files = [entry for entry in entries if entry.is_file()]
+            keys = {entry.name.split('-', 1)[0] for entry in files}
+            known = set(AudioArtwork.objects.filter(artwork__in=keys).values_list('artwork', flat=True))
+            for entry in files:
+                if entry.stat().st_mtime >= cutoff:
+                    continue
+                if entry.name.split('-', 1)[0] in known and not entry.name.endswith('.tmp'):
+                    continue
+                result.orphaned += 1
+                result.bytes_reclaimed += _remove_path(entry.path)
+        return result
+
+    def enforce_quota(self):
+        """合計サイズが上限を超えていれば、最終アクセスの古い AudioBlob から削除する"""
+        result = ReapResult()
+        if not self.quota:
+            return result
+        # 途中のアップロード（分割アップロードの確保済み領域を含む）も数える
+        total = (AudioBlob.objects.aggregate(total=Sum('size'))['total'] or 0) + storage.staged_bytes()
+        if total <= self.quota:
+            return result
+
+        # ライブラリの曲（MusicFile）は利用者が残したものなので追い出さない
+        candidates = AudioBlob.objects.filter(
+            last_accessed_at__lt=self._cutoff(), musicfile__isnull=True
+        ).order_by('last_accessed_at')
+        for blob in candidates.iterator(chunk_size=100):
+            if total <= self.quota:
+                break
+            reclaimed = self._delete_blob(blob.sha256)
+            if reclaimed is None:
+                continue
+            total -= blob.size
+            result.evicted += 1
+            result.bytes_reclaimed += reclaimed
+        if total > self.quota:
+            logger.warning('storage quota exceeded by recently used files: %d > %d bytes', total, self.quota)
+        return result
@@ -0,0 +1,290 @@
+"""
+再開可能な分割アップロード
+
+回線が切れても最初からやり直さずに済むよう、ファイルを固定長のチャンクに
+分けて送る。チャンクは順不同・並行に送ってよく、受信済みのチャンクを
+問い合わせて足りない分だけ送り直せる。
+
+    POST   /api/uploads/                        {name, size, sha256?} でアップロード ID を発行
+    PUT    /api/uploads/<id>/chunks/<index>/    チャンク本体（最後以外は chunk_size バイト）
+    GET    /api/uploads/<id>/                   受信済みのチャンク番号
+    POST   /api/uploads/<id>/finalize/          ハッシュを検証してストアへ取り込む
+    DELETE /api/uploads/<id>/                   中止
+
+状態はすべてストアの一時領域（blobs/tmp/）に置くので、同じファイル
+システムを見ているワーカー間で共有される。
+
+    <id>.json      所有者・ファイル名・サイズなど（作成時に書き、チャンクを受け取るたびに mtime を更新）
+    <id>.<ext>.part  サイズ分を確保済みの本体。チャンクは os.pwrite で書き込む
+    <id>.map       チャンクごとに 1 バイトの受信済みフラグ（これも os.pwrite）
+
+チャンクごとのロックは不要で、書き終えてからフラグを立てるため、途中で
+切れたチャンクは未受信のまま残る。放置されたアップロードはリーパーが
+一時領域の他のファイルと同様に回収する（チャンクが届いている間は 3 つとも
+mtime が新しいので回収されない）。
+
+サイズ分の領域を作成時に確保するので、所有者ごとの同時に進められる数を
+PLAYER_RESUMABLE_MAX_OPEN までにし、一時領域の合計は PLAYER_STORAGE_QUOTA に数える。
+"""
+import errno
+import hashlib
+import json
+import os
+import re
+import uuid
+
+from django.conf import settings
+
+from .storage import staged_bytes, staging_dir
+from .tracing import traced
+from .uploadhandlers import ALLOWED_EXTENSIONS, sniff_audio_format
+
+UPLOAD_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+READ_SIZE = 64 * 1024
+
+
+class UploadError(Exception):
+    """分割アップロードを続けられない場合の例外（status は返す HTTP ステータス）"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def _preallocate(fd, size):
+    """ファイルの領域を先に確保する（容量不足はここで分かる）"""
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except AttributeError:
+        os.ftruncate(fd, size)
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            raise UploadError('ディスク容量が不足しています', status=507)
+        # fallocate に対応していないファイルシステム
+        os.ftruncate(fd, size)
+
+
+def open_uploads():
+    """一時領域にある途中の分割アップロードの (所有者, サイズ) の列"""
+    uploads = []
+    with os.scandir(staging_dir()) as entries:
+        names = [entry.name for entry in entries if entry.name.endswith('.json')]
+    for name in names:
+        try:
+            with open(os.path.join(staging_dir(), name)) as f:
+                info = json.load(f)
+        except (FileNotFoundError, ValueError):
+            continue
+        uploads.append((info.get('owner'), info.get('size', 0)))
+    return uploads
+
+
+class ResumableUpload:
+    """一時領域にある分割アップロード"""
+
+    def __init__(self, upload_id, info):
+        self.upload_id = upload_id
+        self.owner = info['owner']
+        self.name = info['name']
+        self.extension = info['extension']
+        self.size = info['size']
+        self.chunk_size = info['chunk_size']
+        self.sha256 = info.get('sha256') or None
+        self.file_id = info['file_id']
+
+    @staticmethod
+    def _base(upload_id):
+        return os.path.join(staging_dir(), upload_id)
+
+    @property
+    def info_path(self):
+        return self._base(self.upload_id) + '.json'
+
+    @property
+    def data_path(self):
+        return f'{self._base(self.upload_id)}.{self.extension}.part'
+
+    @property
+    def map_path(self):
+        return self._base(self.upload_id) + '.map'
+
+    @property
+    def chunks(self):
+        return -(-self.size // self.chunk_size)
+
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    @classmethod
+    def create(cls, owner, name, size, sha256=None):
+        extension = name.rsplit('.', 1)[-1].lower() if '.' in name else ''
+        if extension not in ALLOWED_EXTENSIONS:
+            raise UploadError(f'対応していないファイル形式です: {extension}')
+        if size <= 0:
+            raise UploadError('size が不正です')
+        if size > settings.PLAYER_RESUMABLE_MAX_SIZE:
+            limit_mb = settings.PLAYER_RESUMABLE_MAX_SIZE // (1024 * 1024)
+            raise UploadError(f'ファイルサイズが大きすぎます（{limit_mb}MB以下）', status=413)
+        if sha256 is not None and not re.fullmatch(r'[0-9a-f]{64}', sha256):
+            raise UploadError('sha256 が不正です')
+        limit = settings.PLAYER_RESUMABLE_MAX_OPEN
+        if sum(1 for upload_owner, _ in open_uploads() if upload_owner == owner) >= limit:
+            raise UploadError(f'同時に進められる分割アップロードは {limit} 個までです', status=429)
+        if settings.PLAYER_STORAGE_QUOTA and staged_bytes() + size > settings.PLAYER_STORAGE_QUOTA:
+            raise UploadError('一時領域の容量が不足しています', status=507)
+
+        upload = cls(uuid.uuid4().hex, {
+            'owner': owner,
+            'name': name,
+            'extension': extension,
+            'size': size,
+            'chunk_size': settings.PLAYER_UPLOAD_CHUNK_SIZE,
+            'sha256': sha256,
+            'file_id': str(uuid.uuid4()),
+        })
+        fd = os.open(upload.data_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            _preallocate(fd, size)
+        except UploadError:
+            os.close(fd)
+            os.remove(upload.data_path)
+            raise
+        os.close(fd)
+        with open(upload.map_path, 'wb') as f:
+            f.write(b'\x00' * upload.chunks)
+        with open(upload.info_path, 'w') as f:
+            json.dump({
+                'owner': owner, 'name': name, 'extension': extension, 'size': size,
+                'chunk_size': upload.chunk_size, 'sha256': sha256, 'file_id': upload.file_id,
+            }, f)
+        return upload
+
+    @classmethod
+    def load(cls, upload_id, owner):
+        """所有者が一致するアップロードを返す（無ければ 404 の UploadError）"""
+        if not UPLOAD_ID_RE.match(upload_id):
+            raise UploadError('アップロードが見つかりません', status=404)
+        try:
+            with open(cls._base(upload_id) + '.json') as f:
+                info = json.load(f)
+        except (FileNotFoundError, ValueError):
+            raise UploadError('アップロードが見つかりません', status=404)
+        if info.get('owner') != owner:
+            raise UploadError('アップロードが見つかりません', status=404)
+        upload = cls(upload_id, info)
+        if not os.path.exists(upload.data_path):
+            raise UploadError('アップロードが見つかりません', status=404)
+        return upload
+
+    def received(self):
+        """受信済みのチャンク番号"""
+        with open(self.map_path, 'rb') as f:
+            flags = f.read()
+        return [index for index, flag in enumerate(flags) if flag]
+
+    @traced('upload.write_chunk')
+    def write_chunk(self, index, stream, length, checksum=None):
+        """
+        stream から length バイトを読み、チャンク index の位置に書き込む
+
+        checksum（SHA-256）が指定されていれば受信しながら計算して照合する。
+        最後まで受け取れた場合だけ受信済みにする。
+        """
+        if not 0 <= index < self.chunks:
+            raise UploadError('チャンク番号が不正です')
+        expected = self.chunk_length(index)
+        if length != expected:
+            raise UploadError(f'チャンクのサイズが違います（{expected} バイト）')
+
+        hasher = hashlib.sha256() if checksum else None
+        offset = index * self.chunk_size
+        written = 0
+        try:
+            fd = os.open(self.data_path, os.O_WRONLY)
+        except FileNotFoundError:
+            raise UploadError('アップロードが見つかりません', status=404)
+        try:
+            while written < expected:
+                data = stream.read(min(READ_SIZE, expected - written))
+                if not data:
+                    break
+                os.pwrite(fd, data, offset + written)
+                written += len(data)
+                if hasher:
+                    hasher.update(data)
+        finally:
+            os.close(fd)
+        if written != expected:
+            raise UploadError('チャンクを最後まで受信できませんでした')
+        if hasher and hasher.hexdigest() != checksum.lower():
+            raise UploadError('チャンクのハッシュが一致しません', status=409)
+
+        try:
+            fd = os.open(self.map_path, os.O_WRONLY)
+        except FileNotFoundError:
+            raise UploadError('アップロードが見つかりません', status=404)
+        try:
+            os.pwrite(fd, b'\x01', index)
+        finally:
+            os.close(fd)
+        # 作成時に書いたきりの情報ファイルも、受信中はリーパーに回収されないようにする
+        try:
+            os.utime(self.info_path)
+        except FileNotFoundError:
+            raise UploadError('アップロードが見つかりません', status=404)
+
+    @traced('upload.claim')
+    def claim(self):
+        """
+        全チャンクがそろっていれば本体を取り出してハッシュを検証する
+
+        戻り値は (一時ファイルのパス, sha256, 拡張子)。取り出したファイルは
+        呼び出し側がストアへ取り込む。同時に finalize された場合は片方だけが成功する。
+        """
+        missing = self.chunks - len(self.received())
+        if missing:
+            raise UploadError(f'未受信のチャンクがあります（{missing} 個）', status=409)
+
+        claimed_path = os.path.join(staging_dir(), f'{uuid.uuid4().hex}.{self.extension}.part')
+        try:
+            os.replace(self.data_path, claimed_path)
+        except FileNotFoundError:
+            raise UploadError('アップロードが見つかりません', status=404)
+        self._remove_state()
+
+        hasher = hashlib.sha256()
+        with open(claimed_path, 'rb') as f:
+            head = f.read(16)
+            hasher.update(head)
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                hasher.update(block)
+        sha256 = hasher.hexdigest()
+        if self.sha256 and sha256 != self.sha256:
+            os.remove(claimed_path)
+            raise UploadError('ファイルのハッシュが一致しません', status=409)
+        return claimed_path, sha256, sniff_audio_format(head) or self.extension
+
+    def abort(self):
+        for path in (self.data_path, self.map_path, self.info_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _remove_state(self):
+        for path in (self.map_path, self.info_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def as_dict(self):
+        received = self.received()
+        return {
+            'upload_id': self.upload_id,
+            'size': self.size,
+            'chunk_size': self.chunk_size,
+            'chunks': self.chunks,
+            'received': received,
+            'complete': len(received) == self.chunks,
+        }
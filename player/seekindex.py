@@ -0,0 +1,533 @@
+"""
+時間 → バイト位置のシークインデックス
+
+VBR の MP3 や FLAC は再生時間からバイト位置を計算できないため、ブラウザは
+推測で Range を要求するか、ファイル全体を読むまでシークできない。
+アップロード時にフレームヘッダーを一度だけ走査し、フレームの先頭サンプル
+番号とバイト位置の組を音声ファイルの隣に小さなバイナリとして保存しておく。
+
+    WAV   data チャンクの位置とブロック長から計算する（エントリは持たない）
+    MP3   フレームヘッダーを順にたどる（Xing / Info / VBRI フレームは数えない）
+    FLAC  SEEKTABLE が十分細かければそれを使い、無ければ同期コードの候補を
+          numpy でまとめて探し、ヘッダーの CRC-8 とサンプル番号の連続性で確かめる
+
+エントリは PLAYER_SEEK_INDEX_INTERVAL 秒に 1 つまで間引く。
+解析できなかったファイルには空のインデックスファイルを置き、t 指定の配信の
+たびにファイル全体を走査し直さないようにする。
+
+保存ファイル形式（リトルエンディアン）:
+    magic         4s  b'SKIX'
+    version       B
+    kind          B   0: WAV, 1: MP3, 2: FLAC
+    reserved      H
+    sample_rate   I
+    block_align   I   WAV の 1 サンプルフレームのバイト数（それ以外は 0）
+    total_samples Q
+    data_start    Q   最初のフレーム（WAV は data チャンク本体）の位置
+    data_end      Q   最後のフレームの終端
+    count         I
+    entries       count × (sample Q, offset Q)
+"""
+import bisect
+import logging
+import mmap
+import os
+import struct
+from collections import namedtuple
+
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'SKIX'
+VERSION = 1
+HEADER = struct.Struct('<4sBBHIIQQQI')
+ENTRY_DTYPE = np.dtype([('sample', '<u8'), ('offset', '<u8')])
+
+KIND_WAV = 0
+KIND_MP3 = 1
+KIND_FLAC = 2
+KINDS = {'wav': KIND_WAV, 'mp3': KIND_MP3, 'flac': KIND_FLAC}
+
+SEEK_INDEX_SUFFIX = '.seek'
+
+# (MPEG バージョン, レイヤー) -> ビットレート（kbps、インデックス 0〜14）
+MPEG_BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+MPEG_SAMPLE_RATES = {1: [44100, 48000, 32000], 2: [22050, 24000, 16000], 25: [11025, 12000, 8000]}
+MPEG_VERSIONS = {3: 1, 2: 2, 0: 25}  # ヘッダーの値 -> MPEG-1 / 2 / 2.5
+
+# 同期コードの候補を探すときに一度に見るバイト数
+FLAC_SCAN_WINDOW = 4 * 1024 * 1024
+
+Segment = namedtuple('Segment', ['prefix', 'start', 'end', 'time'])
+
+
+class SeekIndexError(Exception):
+    """シークインデックスを作れない場合の例外"""
+
+
+def _crc_table(polynomial, width):
+    top = 1 << (width - 1)
+    mask = (1 << width) - 1
+    table = []
+    for byte in range(256):
+        crc = byte << (width - 8)
+        for _ in range(8):
+            crc = ((crc << 1) ^ polynomial) if crc & top else (crc << 1)
+        table.append(crc & mask)
+    return table
+
+
+CRC8_TABLE = _crc_table(0x07, 8)
+
+
+def crc8(data):
+    """FLAC のフレームヘッダー用 CRC-8（多項式 x^8 + x^2 + x + 1）"""
+    crc = 0
+    for byte in data:
+        crc = CRC8_TABLE[crc ^ byte]
+    return crc
+
+
+def seek_index_path(audio_path):
+    """音声ファイルに対応するシークインデックスのパス"""
+    return audio_path + SEEK_INDEX_SUFFIX
+
+
+def _kind_for(path):
+    return KINDS.get(path.rsplit('.', 1)[-1].lower())
+
+
+class _Entries:
+    """サンプル位置が step 以上離れたフレームだけを残しながら集める"""
+
+    def __init__(self, step):
+        self.step = max(int(step), 1)
+        self.samples = []
+        self.offsets = []
+
+    def add(self, sample, offset):
+        if not self.samples or sample - self.samples[-1] >= self.step:
+            self.samples.append(sample)
+            self.offsets.append(offset)
+
+    def array(self):
+        entries = np.empty(len(self.samples), dtype=ENTRY_DTYPE)
+        entries['sample'] = self.samples
+        entries['offset'] = self.offsets
+        return entries
+
+
+def _scan_wav(path, data):
+    if data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+        raise SeekIndexError('not a RIFF/WAVE file')
+    position = 12
+    fmt = None
+    while position + 8 <= len(data):
+        chunk_id, chunk_size = struct.unpack_from('<4sI', data, position)
+        position += 8
+        if chunk_id == b'fmt ':
+            fmt = data[position:position + chunk_size]
+        elif chunk_id == b'data':
+            break
+        position += chunk_size + chunk_size % 2
+    else:
+        raise SeekIndexError('data chunk not found')
+    if fmt is None or len(fmt) < 16:
+        raise SeekIndexError('fmt chunk not found')
+
+    audio_format, _, sample_rate, _, block_align, _ = struct.unpack_from('<HHIIHH', fmt)
+    if audio_format == 0xFFFE and len(fmt) >= 26:
+        audio_format = struct.unpack_from('<H', fmt, 24)[0]
+    if audio_format not in (1, 3) or not block_align or not sample_rate:
+        raise SeekIndexError(f'unsupported WAV format: 0x{audio_format:04x}')
+
+    # ストリーミング書き込みされた WAV はサイズが 0xFFFFFFFF のことがある
+    data_size = min(chunk_size, len(data) - position)
+    data_size -= data_size % block_align
+    return {
+        'sample_rate': sample_rate,
+        'block_align': block_align,
+        'total_samples': data_size // block_align,
+        'data_start': position,
+        'data_end': position + data_size,
+        'entries': np.empty(0, dtype=ENTRY_DTYPE),
+    }
+
+
+def _mp3_frame(data, offset):
+    """offset の MPEG オーディオフレームヘッダーを解析して (長さ, サンプル数, サンプリングレート) を返す"""
+    if offset + 4 > len(data):
+        return None
+    b0, b1, b2, b3 = data[offset:offset + 4]
+    if b0 != 0xFF or b1 & 0xE0 != 0xE0:
+        return None
+    version = MPEG_VERSIONS.get((b1 >> 3) & 0x3)
+    layer = 4 - ((b1 >> 1) & 0x3)
+    bitrate_index = b2 >> 4
+    rate_index = (b2 >> 2) & 0x3
+    if version is None or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+
+    bitrate = MPEG_BITRATES[(min(version, 2), layer)][bitrate_index] * 1000
+    sample_rate = MPEG_SAMPLE_RATES[version][rate_index]
+    padding = (b2 >> 1) & 0x1
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4, 384, sample_rate
+    samples = 576 if layer == 3 and version != 1 else 1152
+    return samples // 8 * bitrate // sample_rate + padding, samples, sample_rate
+
+
+def _mp3_sync(data, offset):
+    """offset 以降で、続くフレームのヘッダーも正しい最初のフレーム位置を探す"""
+    while True:
+        offset = data.find(b'\xff', offset)
+        if offset < 0:
+            return None
+        frame = _mp3_frame(data, offset)
+        if frame:
+            following = offset + frame[0]
+            if following >= len(data) or _mp3_frame(data, following):
+                return offset
+        offset += 1
+
+
+def _is_vbr_header_frame(data, offset):
+    """Xing / Info / VBRI のヘッダーだけを持つ（音声を含まない）フレームか"""
+    b1, b3 = data[offset + 1], data[offset + 3]
+    mono = (b3 >> 6) == 3
+    if MPEG_VERSIONS.get((b1 >> 3) & 0x3) == 1:
+        side_info = 17 if mono else 32
+    else:
+        side_info = 9 if mono else 17
+    tag = data[offset + 4 + side_info:offset + 8 + side_info]
+    return tag in (b'Xing', b'Info') or data[offset + 36:offset + 40] == b'VBRI'
+
+
+def _scan_mp3(path, data, step_seconds):
+    offset = 0
+    if data[:3] == b'ID3' and len(data) >= 10:
+        size = 0
+        for byte in data[6:10]:
+            size = (size << 7) | (byte & 0x7F)
+        offset = 10 + size + (10 if data[5] & 0x10 else 0)
+
+    offset = _mp3_sync(data, offset)
+    if offset is None:
+        raise SeekIndexError('no MPEG audio frames found')
+    sample_rate = _mp3_frame(data, offset)[2]
+    entries = _Entries(step_seconds * sample_rate)
+    if _is_vbr_header_frame(data, offset):
+        offset += _mp3_frame(data, offset)[0]
+    data_start = offset
+
+    sample = 0
+    data_end = offset
+    while offset < len(data):
+        frame = _mp3_frame(data, offset)
+        if frame is None or offset + frame[0] > len(data):
+            if data[offset:offset + 3] == b'TAG':
+                break  # ID3v1
+            offset = _mp3_sync(data, offset + 1)
+            if offset is None:
+                break
+            continue
+        length, samples, _ = frame
+        entries.add(sample, offset)
+        sample += samples
+        offset += length
+        data_end = offset
+
+    return {
+        'sample_rate': sample_rate,
+        'block_align': 0,
+        'total_samples': sample,
+        'data_start': data_start,
+        'data_end': data_end,
+        'entries': entries.array(),
+    }
+
+
+def _flac_frame(data, offset, fixed_block_size):
+    """offset の FLAC フレームヘッダーを解析して (先頭サンプル番号, ブロック長) を返す"""
+    header = data[offset:offset + 16]
+    if len(header) < 6 or header[0] != 0xFF or header[1] & 0xFE != 0xF8:
+        return None
+    variable = header[1] & 0x1
+    size_code, rate_code = header[2] >> 4, header[2] & 0xF
+    if size_code == 0 or rate_code == 15 or header[3] >> 4 > 10 or (header[3] >> 1) & 0x7 in (3, 7) or header[3] & 0x1:
+        return None
+
+    # フレーム番号（可変ブロック長ならサンプル番号）は UTF-8 と同じ可変長符号
+    lead = header[4]
+    if lead < 0x80:
+        number, extra = lead, 0
+    elif 0xC0 <= lead < 0xFE:
+        extra = 1
+        while lead & (0x40 >> extra):
+            extra += 1
+        number = lead & (0x3F >> extra)
+    elif lead == 0xFE:
+        number, extra = 0, 6
+    else:
+        return None
+    position = 5
+    for byte in header[position:position + extra]:
+        if byte & 0xC0 != 0x80:
+            return None
+        number = (number << 6) | (byte & 0x3F)
+    position += extra
+
+    if size_code == 1:
+        block_size = 192
+    elif size_code <= 5:
+        block_size = 576 << (size_code - 2)
+    elif size_code == 6:
+        block_size = header[position] + 1
+        position += 1
+    elif size_code == 7:
+        block_size = int.from_bytes(header[position:position + 2], 'big') + 1
+        position += 2
+    else:
+        block_size = 256 << (size_code - 8)
+    position += {12: 1, 13: 2, 14: 2}.get(rate_code, 0)
+
+    if position >= len(header) or crc8(header[:position]) != header[position]:
+        return None
+    return (number if variable else number * fixed_block_size), block_size
+
+
+def _scan_flac(path, data, step_seconds):
+    if data[:4] != b'fLaC':
+        raise SeekIndexError('not a FLAC file')
+    position = 4
+    streaminfo = None
+    seek_points = []
+    while True:
+        if position + 4 > len(data):
+            raise SeekIndexError('truncated metadata')
+        is_last = data[position] & 0x80
+        block_type = data[position] & 0x7F
+        length = int.from_bytes(data[position + 1:position + 4], 'big')
+        body = data[position + 4:position + 4 + length]
+        if block_type == 0:
+            streaminfo = body
+        elif block_type == 3:
+            for i in range(0, len(body) - 17, 18):
+                sample, offset, _ = struct.unpack_from('>QQH', body, i)
+                if sample != 0xFFFFFFFFFFFFFFFF:  # プレースホルダー
+                    seek_points.append((sample, offset))
+        position += 4 + length
+        if is_last:
+            break
+    if streaminfo is None or len(streaminfo) < 18:
+        raise SeekIndexError('STREAMINFO not found')
+
+    data_start = position
+    min_block_size, max_block_size = struct.unpack_from('>HH', streaminfo)
+    min_frame_size = int.from_bytes(streaminfo[4:7], 'big')
+    packed = int.from_bytes(streaminfo[10:18], 'big')
+    sample_rate = packed >> 44
+    total_samples = packed & 0xFFFFFFFFF
+    if not sample_rate:
+        raise SeekIndexError('invalid sample rate')
+    entries = _Entries(step_seconds * sample_rate)
+
+    # SEEKTABLE がインデックスの間隔より細かければ走査しない
+    gaps = np.diff([0] + [sample for sample, _ in seek_points] + [total_samples])
+    if seek_points and total_samples and gaps.max() <= entries.step:
+        for sample, offset in seek_points:
+            entries.add(sample, data_start + offset)
+        return {
+            'sample_rate': sample_rate,
+            'block_align': 0,
+            'total_samples': total_samples,
+            'data_start': data_start,
+            'data_end': len(data),
+            'entries': entries.array(),
+        }
+
+    fixed_block_size = max_block_size if min_block_size == max_block_size else 0
+    expected = None  # 次のフレームの先頭サンプル番号
+    next_offset = data_start  # これより前の候補は直前のフレームの内部
+    for window in range(data_start, len(data) - 1, FLAC_SCAN_WINDOW):
+        chunk = np.frombuffer(data[window:window + FLAC_SCAN_WINDOW + 1], dtype=np.uint8)
+        candidates = np.flatnonzero((chunk[:-1] == 0xFF) & ((chunk[1:] & 0xFE) == 0xF8)) + window
+        for offset in candidates.tolist():
+            if offset < next_offset:
+                continue
+            frame = _flac_frame(data, offset, fixed_block_size)
+            if frame is None:
+                continue
+            sample, block_size = frame
+            if expected is not None and sample != expected:
+                continue
+            entries.add(sample, offset)
+            expected = sample + block_size
+            next_offset = offset + max(min_frame_size, 1)
+    if expected is None:
+        raise SeekIndexError('no FLAC frames found')
+
+    return {
+        'sample_rate': sample_rate,
+        'block_align': 0,
+        'total_samples': total_samples or expected,
+        'data_start': data_start,
+        'data_end': len(data),
+        'entries': entries.array(),
+    }
+
+
+def scan(path, step_seconds=None):
+    """音声ファイルを走査してインデックスの内容を dict で返す（失敗時は SeekIndexError）"""
+    kind = _kind_for(path)
+    if kind is None:
+        raise SeekIndexError('unsupported format')
+    if step_seconds is None:
+        step_seconds = settings.PLAYER_SEEK_INDEX_INTERVAL
+    if os.path.getsize(path) == 0:
+        raise SeekIndexError('empty file')
+
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        try:
+            if kind == KIND_WAV:
+                result = _scan_wav(path, data)
+            elif kind == KIND_MP3:
+                result = _scan_mp3(path, data, step_seconds)
+            else:
+                result = _scan_flac(path, data, step_seconds)
+        except (struct.error, IndexError, ValueError) as e:
+            raise SeekIndexError(f'malformed file: {e}') from e
+    result['kind'] = kind
+    return result
+
+
+def encode(result):
+    """走査結果を保存用バイナリに変換"""
+    entries = np.ascontiguousarray(result['entries'], dtype=ENTRY_DTYPE)
+    header = HEADER.pack(
+        MAGIC, VERSION, result['kind'], 0, result['sample_rate'], result['block_align'],
+        result['total_samples'], result['data_start'], result['data_end'], len(entries),
+    )
+    return header + entries.tobytes()
+
+
+def build_seek_index(audio_path):
+    """
+    音声ファイルのシークインデックスを作ってファイルに保存する
+
+    対応していない形式や解析できないファイルの場合は None を返す（解析できなかった
+    ことは空のインデックスファイルとして残す）。
+    """
+    output_path = seek_index_path(audio_path)
+    try:
+        data = encode(scan(audio_path))
+    except SeekIndexError as e:
+        logger.info('seek index skipped for %s: %s', audio_path, e)
+        data = b''
+
+    temp_path = output_path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, output_path)
+    return output_path if data else None
+
+
+class SeekIndex:
+    """保存済みのシークインデックス"""
+
+    def __init__(self, audio_path):
+        self.audio_path = audio_path
+        with open(seek_index_path(audio_path), 'rb') as f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                raise ValueError('truncated seek index')
+            (magic, version, self.kind, _, self.sample_rate, self.block_align,
+             self.total_samples, self.data_start, self.data_end, count) = HEADER.unpack(header)
+            if magic != MAGIC or version != VERSION or not self.sample_rate:
+                raise ValueError('unsupported seek index')
+            entries = np.frombuffer(f.read(count * ENTRY_DTYPE.itemsize), dtype=ENTRY_DTYPE)
+        if len(entries) != count:
+            raise ValueError('truncated seek index')
+        self.samples = entries['sample'].tolist()
+        self.offsets = entries['offset'].tolist()
+
+    @property
+    def duration(self):
+        return self.total_samples / self.sample_rate
+
+    def locate(self, seconds):
+        """seconds を含むフレームの (バイト位置, 先頭サンプル番号) を返す"""
+        sample = min(max(int(seconds * self.sample_rate), 0), self.total_samples)
+        if self.kind == KIND_WAV:
+            return self.data_start + sample * self.block_align, sample
+        i = bisect.bisect_right(self.samples, sample) - 1
+        if i < 0:
+            return self.data_start, 0
+        return self.offsets[i], self.samples[i]
+
+    def segment(self, seconds):
+        """
+        seconds を含むフレームから始まる内容を返す
+
+        単体で再生できるよう、WAV はサイズを書き換えた RIFF ヘッダー、FLAC は
+        総サンプル数を書き換えた STREAMINFO を prefix として前に付ける。
+        MP3 のフレームは単独で復号できるので prefix は持たない。
+        """
+        offset, sample = self.locate(seconds)
+        length = self.data_end - offset
+        if self.kind == KIND_WAV:
+            with open(self.audio_path, 'rb') as f:
+                prefix = bytearray(f.read(self.data_start))
+            struct.pack_into('<I', prefix, 4, len(prefix) - 8 + length)
+            struct.pack_into('<I', prefix, len(prefix) - 4, length)
+        elif self.kind == KIND_FLAC:
+            with open(self.audio_path, 'rb') as f:
+                prefix = bytearray(f.read(8 + 34))
+            prefix[4] = 0x80  # STREAMINFO を最後のメタデータブロックにする
+            packed = int.from_bytes(prefix[18:26], 'big')
+            remaining = max(self.total_samples - sample, 0)
+            packed = (packed & ~0xFFFFFFFFF) | remaining
+            prefix[18:26] = packed.to_bytes(8, 'big')
+            prefix[26:42] = b'\x00' * 16  # MD5 は元の全体に対する値なので消す
+        else:
+            prefix = b''
+        return Segment(bytes(prefix), offset, self.data_end, sample / self.sample_rate)
+
+
+def load(audio_path):
+    """
+    音声ファイルのシークインデックスを返す
+
+    インデックスより前にアップロードされたファイルはここで作る。
+    対応していない形式や、解析できなかったファイル（空のインデックス）の場合は None を返す。
+    """
+    if _kind_for(audio_path) is None:
+        return None
+    try:
+        if os.path.getsize(seek_index_path(audio_path)) == 0:
+            return None
+    except FileNotFoundError:
+        if build_seek_index(audio_path) is None:
+            return None
+    try:
+        return SeekIndex(audio_path)
+    except (OSError, ValueError) as e:
+        logger.warning('broken seek index for %s: %s', audio_path, e)
+        return None
+
+
+def remove_seek_index(audio_path):
+    """音声ファイルに対応するシークインデックスを削除"""
+    try:
+        os.remove(seek_index_path(audio_path))
+    except FileNotFoundError:
+        pass
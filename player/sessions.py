@@ -0,0 +1,23 @@
+"""
+セッションの保存時間をトレースに記録する cached_db バックエンド
+
+セッションの保存（シリアライズ・DB とキャッシュへの書き込み）は View の後の
+SessionMiddleware で行われるため、View 内のスパンでは測れない。
+
+保存した時刻（＝期限を延ばした時刻）を SAVED_AT_KEY に残し、
+positions.keep_session_alive が延長の間隔を決めるのに使う。
+"""
+import time
+
+from django.contrib.sessions.backends.cached_db import SessionStore as CachedDBSessionStore
+
+from .tracing import span
+
+SAVED_AT_KEY = '_saved_at'
+
+
+class SessionStore(CachedDBSessionStore):
+    def save(self, must_create=False):
+        with span('session.save'):
+            self._session[SAVED_AT_KEY] = int(time.time())
+            super().save(must_create=must_create)
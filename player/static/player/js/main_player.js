@@ -33,7 +33,7 @@ document.addEventListener('DOMContentLoaded', function() {
     let currentActiveBar = 0;
     let currentSpeed = 1.0;
     let seekTimeout = null;
-    let audioData = null;  // 音声データ（波形表示用）
+    let audioData = null;  // 波形ピーク（{rows: [第1段, 第2段]}）
     let audioDuration = 0;  // 音声の長さ
     let currentFileId = null;  // 現在選択されているファイルのID
     let previousPosition = 0;  // 前回再生位置
@@ -79,25 +79,34 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     
-    // 前回再生位置を保存する関数
-    async function savePlaybackPosition(position) {
-        if (!currentFileId) return;
-        
-        // ローカルストレージに保存
-        savePlaybackPositionToLocalStorage(currentFileId, position);
+    // サーバーに未送信の再生位置（ファイルIDごとに最新の値だけを残す）
+    const pendingPositions = {};
+    let positionFlushTimer = null;
+    
+    function takePendingPositions() {
+        const positions = Object.entries(pendingPositions).map(([fileId, entry]) => ({
+            file_id: fileId,
+            position: entry.position,
+            ts: entry.ts
+        }));
+        Object.keys(pendingPositions).forEach(fileId => delete pendingPositions[fileId]);
+        return positions;
+    }
+    
+    // 溜まった再生位置をまとめてサーバーに送る
+    async function flushPlaybackPositions() {
+        positionFlushTimer = null;
+        const positions = takePendingPositions();
+        if (!positions.length) return;
         
-        // サーバーにも保存（オプション）
         try {
-            const response = await fetch('/api/save-position/', {
+            const response = await fetch('/api/save-positions/', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
                     'X-CSRFToken': getCSRFToken()
                 },
-                body: JSON.stringify({
-                    file_id: currentFileId,
-                    position: position
-                })
+                body: JSON.stringify({ positions: positions })
             });
             
             const data = await response.json();
@@ -109,6 +118,20 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     
+    // 前回再生位置を保存する関数
+    function savePlaybackPosition(position) {
+        if (!currentFileId) return;
+        
+        // ローカルストレージに保存
+        savePlaybackPositionToLocalStorage(currentFileId, position);
+        
+        // サーバーにはまとめて送る（オプション）
+        pendingPositions[currentFileId] = { position: position, ts: Date.now() };
+        if (!positionFlushTimer) {
+            positionFlushTimer = setTimeout(flushPlaybackPositions, 2000);
+        }
+    }
+    
     // 前回再生位置を取得する関数
     async function getPlaybackPosition(fileId) {
         // まずローカルストレージから取得
@@ -133,6 +156,134 @@ document.addEventListener('DOMContentLoaded', function() {
         return localPosition;
     }
     
+    // ファイルの SHA-256（crypto.subtle が使えない場合は null）
+    async function fileSha256(file) {
+        // crypto.subtle は安全なコンテキスト（HTTPS / localhost）でのみ使える
+        if (!window.crypto || !window.crypto.subtle) return null;
+        
+        try {
+            const digest = await window.crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+            return Array.from(new Uint8Array(digest))
+                .map(b => b.toString(16).padStart(2, '0'))
+                .join('');
+        } catch (error) {
+            console.error('ハッシュの計算に失敗しました:', error);
+            return null;
+        }
+    }
+    
+    // 同じ内容のファイルがサーバーにあれば本体を送らずに登録する
+    async function uploadByHash(file, sha256) {
+        try {
+            const response = await fetch('/api/upload-by-hash/', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                    'X-CSRFToken': getCSRFToken()
+                },
+                body: JSON.stringify({ sha256: sha256, name: file.name })
+            });
+            if (!response.ok) return null;
+            return await response.json();
+        } catch (error) {
+            console.error('ハッシュによる登録に失敗しました:', error);
+            return null;
+        }
+    }
+    
+    // これより大きいファイルはチャンクに分けて並行に送る（切れても続きから再開できる）
+    const RESUMABLE_THRESHOLD = 8 * 1024 * 1024;
+    const PARALLEL_CHUNKS = 4;
+    const CHUNK_RETRIES = 3;
+    
+    // チャンクを 1 つ送る（通信エラーとサーバーエラーは間隔を空けて送り直す）
+    async function sendChunk(upload, file, index) {
+        const start = index * upload.chunk_size;
+        const body = file.slice(start, Math.min(start + upload.chunk_size, file.size));
+        
+        for (let attempt = 0; ; attempt++) {
+            let response = null;
+            try {
+                response = await fetch(`/api/uploads/${upload.upload_id}/chunks/${index}/`, {
+                    method: 'PUT',
+                    headers: {
+                        'Content-Type': 'application/octet-stream',
+                        'X-CSRFToken': getCSRFToken()
+                    },
+                    body: body
+                });
+            } catch (error) {
+                console.warn(`チャンク ${index} の送信に失敗しました:`, error);
+            }
+            if (response && response.ok) return;
+            if (response && response.status < 500) {
+                const data = await response.json();
+                throw new Error(data.error);
+            }
+            if (attempt >= CHUNK_RETRIES) {
+                throw new Error(`チャンク ${index} を送信できませんでした`);
+            }
+            await new Promise(resolve => setTimeout(resolve, 500 * 2 ** attempt));
+        }
+    }
+    
+    // 再開可能な分割アップロード
+    async function uploadResumable(file, sha256) {
+        const key = `resumable-upload:${file.name}:${file.size}:${file.lastModified}`;
+        const progressBar = uploadProgress.querySelector('.progress-bar');
+        let upload = null;
+        
+        // 前回途中で止まったアップロードがあれば受信済みのチャンクを問い合わせる
+        const savedId = localStorage.getItem(key);
+        if (savedId) {
+            const response = await fetch(`/api/uploads/${savedId}/`);
+            if (response.ok) {
+                upload = await response.json();
+            }
+        }
+        if (!upload) {
+            const response = await fetch('/api/uploads/', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                    'X-CSRFToken': getCSRFToken()
+                },
+                body: JSON.stringify({ name: file.name, size: file.size, sha256: sha256 })
+            });
+            upload = await response.json();
+            if (!response.ok) return upload;
+            localStorage.setItem(key, upload.upload_id);
+        }
+        
+        const received = new Set(upload.received);
+        const pending = [];
+        for (let index = 0; index < upload.chunks; index++) {
+            if (!received.has(index)) pending.push(index);
+        }
+        let done = received.size;
+        progressBar.style.width = `${Math.round(done / upload.chunks * 100)}%`;
+        
+        const workers = Array.from({ length: Math.min(PARALLEL_CHUNKS, pending.length) }, async () => {
+            while (pending.length > 0) {
+                await sendChunk(upload, file, pending.shift());
+                done++;
+                progressBar.style.width = `${Math.round(done / upload.chunks * 100)}%`;
+            }
+        });
+        await Promise.all(workers);
+        
+        const response = await fetch(`/api/uploads/${upload.upload_id}/finalize/`, {
+            method: 'POST',
+            headers: {
+                'X-CSRFToken': getCSRFToken()
+            }
+        });
+        if (response.ok) {
+            localStorage.removeItem(key);
+        }
+        return await response.json();
+    }
+    
     // ファイルをアップロードする関数
     async function uploadFile(file) {
         const formData = new FormData();
@@ -143,15 +294,21 @@ document.addEventListener('DOMContentLoaded', function() {
             uploadProgress.querySelector('.progress-bar').style.width = '0%';
             uploadStatus.innerHTML = '<small class="text-info">アップロード中...</small>';
             
-            const response = await fetch('/api/upload-lightweight/', {
-                method: 'POST',
-                headers: {
-                    'X-CSRFToken': getCSRFToken()
-                },
-                body: formData
-            });
-            
-            const data = await response.json();
+            const sha256 = await fileSha256(file);
+            let data = sha256 ? await uploadByHash(file, sha256) : null;
+            if (!data && file.size > RESUMABLE_THRESHOLD) {
+                data = await uploadResumable(file, sha256);
+            } else if (!data) {
+                const response = await fetch('/api/upload-lightweight/', {
+                    method: 'POST',
+                    headers: {
+                        'X-CSRFToken': getCSRFToken()
+                    },
+                    body: formData
+                });
+                
+                data = await response.json();
+            }
             
             if (data.success) {
                 uploadStatus.innerHTML = '<small class="text-success">アップロード成功!</small>';
@@ -268,6 +425,54 @@ document.addEventListener('DOMContentLoaded', function() {
         listGroup.appendChild(fileItem);
     }
     
+    // 曲ごとの音量差をサーバーで測定した再生ゲインで揃える（GainNode 1 つだけ）
+    let playbackContext = null;
+    let gainNode = null;
+    function applyGain(gainDb) {
+        if (typeof gainDb !== 'number') {
+            if (gainNode) gainNode.gain.value = 1.0;
+            return;
+        }
+        if (!gainNode) {
+            playbackContext = new (window.AudioContext || window.webkitAudioContext)();
+            gainNode = playbackContext.createGain();
+            playbackContext.createMediaElementSource(audioPlayer).connect(gainNode);
+            gainNode.connect(playbackContext.destination);
+        }
+        if (playbackContext.state === 'suspended') {
+            playbackContext.resume();
+        }
+        gainNode.gain.value = Math.pow(10, gainDb / 20);
+    }
+    
+    // 埋め込みアートワークを表示（サムネイルの URL は内容で決まるので一度取得すればキャッシュされる）
+    function showArtwork(thumbnails) {
+        const artwork = document.getElementById('artwork');
+        if (!artwork) return;
+        if (!Array.isArray(thumbnails) || thumbnails.length === 0) {
+            artwork.hidden = true;
+            return;
+        }
+        document.getElementById('artwork-webp').srcset = thumbnails.map(t => `${t.webp} ${t.size}w`).join(', ');
+        const img = document.getElementById('artwork-img');
+        img.srcset = thumbnails.map(t => `${t.jpg} ${t.size}w`).join(', ');
+        img.src = thumbnails[0].jpg;
+        artwork.hidden = false;
+    }
+    
+    // アートワークの抽出がバックグラウンドで終わったら表示し直す
+    async function refreshArtwork(fileId) {
+        await waitForJob(fileId, 'artwork');
+        if (fileId !== currentFileId) return;
+        try {
+            const response = await fetch(`/api/file-url-lightweight/${fileId}/`);
+            const data = await response.json();
+            if (data.success) showArtwork(data.file_info.artwork);
+        } catch (error) {
+            console.error('アートワークの取得に失敗しました:', error);
+        }
+    }
+    
     // ファイルのURLを取得する関数（軽量版）
     async function getFileUrl(fileId) {
         try {
@@ -275,6 +480,9 @@ document.addEventListener('DOMContentLoaded', function() {
             const data = await response.json();
             
             if (data.success) {
+                applyGain(data.file_info.gain_db);
+                showArtwork(data.file_info.artwork);
+                if (!data.file_info.artwork) refreshArtwork(fileId);
                 return data.file_url;
             } else {
                 console.error('ファイルURLの取得に失敗しました:', data.error);
@@ -367,15 +575,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 console.log('認識されたコマンド:', transcript);
                 
                 // コマンドの判定
-                if (transcript.includes('戻って') || transcript.includes('もどって')) {
-                    resolve('go_back');
-                } else if (transcript.includes('停止') || transcript.includes('とめる')) {
-                    resolve('stop');
-                } else if (transcript.includes('再生') || transcript.includes('さいせい')) {
-                    resolve('play');
-                } else {
-                    resolve(null);
-                }
+                matchCommand(transcript).then(resolve, reject);
             };
             
             commandRecognition.onerror = function(event) {
@@ -558,10 +758,8 @@ document.addEventListener('DOMContentLoaded', function() {
         ctx.clearRect(0, 0, canvasWidth, canvasHeight);
         ctx2.clearRect(0, 0, canvasWidth, canvasHeight);
         
-        // データを2段に分割
-        const halfLength = Math.floor(audioData.length / 2);
-        const firstHalf = audioData.slice(0, halfLength);
-        const secondHalf = audioData.slice(halfLength);
+        // 第1段・第2段にはそれぞれの区間のピークが入っている
+        const [firstHalf, secondHalf] = audioData.rows;
         
         // 第1段の波形を描画
         drawWaveformSegment(ctx, firstHalf, canvasWidth, canvasHeight, 0, audioDuration / 2);
@@ -570,25 +768,28 @@ document.addEventListener('DOMContentLoaded', function() {
         drawWaveformSegment(ctx2, secondHalf, canvasWidth, canvasHeight, audioDuration / 2, audioDuration);
     }
     
-    function drawWaveformSegment(ctx, data, width, height, startTime, endTime) {
-        const step = Math.ceil(data.length / width);
+    function drawWaveformSegment(ctx, peaks, width, height, startTime, endTime) {
+        const length = peaks.mins.length;
+        if (!length) return;
         const centerY = height / 2;
         
         ctx.strokeStyle = '#007bff';
         ctx.lineWidth = 1;
         ctx.beginPath();
         
-        for (let i = 0; i < width; i++) {
-            const dataIndex = i * step;
-            if (dataIndex < data.length) {
-                const value = data[dataIndex];
-                const y = centerY + (value * centerY);
-                if (i === 0) {
-                    ctx.moveTo(i, y);
-                } else {
-                    ctx.lineTo(i, y);
-                }
+        // 1ピクセルごとに該当範囲のピークの最小・最大を縦線で描く
+        for (let x = 0; x < width; x++) {
+            const from = Math.floor(x * length / width);
+            const to = Math.max(Math.floor((x + 1) * length / width), from + 1);
+            let min = 1;
+            let max = -1;
+            for (let i = from; i < to && i < length; i++) {
+                if (peaks.mins[i] < min) min = peaks.mins[i];
+                if (peaks.maxs[i] > max) max = peaks.maxs[i];
             }
+            if (max < min) continue;
+            ctx.moveTo(x + 0.5, centerY - max * centerY);
+            ctx.lineTo(x + 0.5, centerY - min * centerY + 1);
         }
         
         ctx.stroke();
@@ -635,20 +836,118 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     
+    // サーバーで事前計算されたピーク（int8 の min/max ペア）を解析する
+    function parsePeaks(buffer) {
+        const view = new DataView(buffer);
+        const magic = String.fromCharCode(
+            view.getUint8(0), view.getUint8(1), view.getUint8(2), view.getUint8(3)
+        );
+        if (magic !== 'PEAK' || view.getUint8(4) !== 2) return null;
+        
+        const sampleRate = view.getUint32(8, true);
+        const samplesPerPeak = view.getUint32(12, true);
+        const startIndex = view.getUint32(16, true);
+        const length = view.getUint32(20, true);
+        const pairs = new Int8Array(buffer, 24, length * 2);
+        const mins = new Float32Array(length);
+        const maxs = new Float32Array(length);
+        for (let i = 0; i < length; i++) {
+            mins[i] = pairs[i * 2] / 127;
+            maxs[i] = pairs[i * 2 + 1] / 127;
+        }
+        return {
+            mins,
+            maxs,
+            start: startIndex * samplesPerPeak / sampleRate,
+            end: (startIndex + length) * samplesPerPeak / sampleRate
+        };
+    }
+    
+    // 指定区間の波形ピークをキャンバス幅分の解像度で取得する（拡大表示にも使える）
+    async function fetchPeaksWindow(fileId, start, end, width) {
+        const params = new URLSearchParams({ start, end, width });
+        const response = await fetch(`/api/peaks/${fileId}/?${params}`);
+        if (!response.ok) return null;
+        return parsePeaks(await response.arrayBuffer());
+    }
+    
+    // アップロード後の処理（波形ピークなど）がサーバーのワーカーで終わるまで待つ
+    async function waitForJob(fileId, kind, timeoutMs = 30000) {
+        const deadline = Date.now() + timeoutMs;
+        while (Date.now() < deadline) {
+            try {
+                const response = await fetch(`/api/jobs/${fileId}/`);
+                if (!response.ok) return;
+                const job = (await response.json()).jobs[kind];
+                if (!job || job.status === 'done' || job.status === 'failed') return;
+            } catch (error) {
+                return;
+            }
+            await new Promise(resolve => setTimeout(resolve, 1000));
+        }
+    }
+    
+    // デコードしたPCMからピクセル数分のピークを作る（サーバーにピークが無い場合）
+    function peaksFromChannelData(channelData, length) {
+        const mins = new Float32Array(length);
+        const maxs = new Float32Array(length);
+        const step = Math.ceil(channelData.length / length);
+        for (let i = 0; i < length; i++) {
+            let min = 1;
+            let max = -1;
+            const end = Math.min((i + 1) * step, channelData.length);
+            for (let j = i * step; j < end; j++) {
+                const value = channelData[j];
+                if (value < min) min = value;
+                if (value > max) max = value;
+            }
+            mins[i] = max < min ? 0 : min;
+            maxs[i] = max < min ? 0 : max;
+        }
+        return { mins, maxs };
+    }
+    
     // 音声データを読み込む
     async function loadAudioData() {
-        if (!audioPlayer.src) return;
+        if (!audioPlayer.src || !currentFileId) return;
         
         try {
+            // まず事前計算済みのピークを段ごとの区間・画素数で取得（数KB）
+            const duration = audioPlayer.duration;
+            if (duration) {
+                await waitForJob(currentFileId, 'peaks');
+                const width = waveformCanvas.width;
+                const rows = await Promise.all([
+                    fetchPeaksWindow(currentFileId, 0, duration / 2, width),
+                    fetchPeaksWindow(currentFileId, duration / 2, duration, width)
+                ]);
+                if (rows[0] && rows[1]) {
+                    audioData = { rows };
+                    audioDuration = duration;
+                    drawWaveform();
+                    return;
+                }
+            }
+            
+            // ピークが無い場合のみ音声全体をデコードする（波形が非表示なら何もしない）
+            const waveformContainer = document.querySelector('.waveform-container');
+            if (waveformContainer && waveformContainer.style.display === 'none') return;
             const audioContext = new (window.AudioContext || window.webkitAudioContext)();
             const response = await fetch(audioPlayer.src);
             const arrayBuffer = await response.arrayBuffer();
             const audioBuffer = await audioContext.decodeAudioData(arrayBuffer);
             
-            // 音声データを取得
+            // 描画に必要なピークだけを残し、PCM全体は保持しない
             const channelData = audioBuffer.getChannelData(0);
-            audioData = channelData;
+            const half = Math.floor(channelData.length / 2);
+            audioData = {
+                rows: [
+                    peaksFromChannelData(channelData.subarray(0, half), waveformCanvas.width),
+                    peaksFromChannelData(channelData.subarray(half), waveformCanvas.width)
+                ]
+            };
             audioDuration = audioBuffer.duration;
+            audioContext.close();
             
             // 波形を描画
             drawWaveform();
@@ -676,12 +975,71 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     
+    // 再生キュー：次に再生する曲（配信 URL・再生位置・ゲイン・アートワーク・波形ピーク）
+    let upcomingQueue = [];
+    // 次の曲を再生位置から先読みしておく待機用の audio 要素（鳴らさない）。
+    // 配信 URL が同じなので、切り替え後の Range リクエストはブラウザのキャッシュから返る
+    const standbyPlayer = new Audio();
+    standbyPlayer.preload = 'auto';
+    standbyPlayer.muted = true;
+    
+    // メディアフラグメント（#t=秒）で再生位置から読み込ませる
+    function urlAt(url, position) {
+        return position > 0 ? `${url}#t=${position.toFixed(3)}` : url;
+    }
+    
+    function decodeQueuePeaks(peaks) {
+        if (!peaks) return null;
+        const rows = peaks.rows.map(row => {
+            const binary = atob(row);
+            const bytes = new Uint8Array(binary.length);
+            for (let i = 0; i < binary.length; i++) bytes[i] = binary.charCodeAt(i);
+            return parsePeaks(bytes.buffer);
+        });
+        return rows.every(row => row) ? { rows, duration: peaks.duration } : null;
+    }
+    
+    // 再生中の曲の次の曲をまとめて取得し、先頭の曲を先読みする（ライブラリが無ければ空）
+    async function prefetchQueue(fileId) {
+        try {
+            const params = new URLSearchParams({ current: fileId, width: waveformCanvas.width });
+            const response = await fetch(`/api/queue/?${params}`);
+            if (!response.ok || fileId !== currentFileId) return;
+            upcomingQueue = (await response.json()).queue;
+        } catch (error) {
+            console.error('再生キューの取得に失敗しました:', error);
+            return;
+        }
+        const next = upcomingQueue[0];
+        if (!next) {
+            standbyPlayer.removeAttribute('src');
+            return;
+        }
+        next.position = Math.max(next.position, getPlaybackPositionFromLocalStorage(next.id));
+        next.audioData = decodeQueuePeaks(next.peaks);
+        const url = urlAt(next.stream_url, next.position);
+        if (standbyPlayer.src !== new URL(url, location.href).href) {
+            standbyPlayer.src = url;
+            standbyPlayer.load();
+        }
+    }
+    
     // ファイルを自動再生する関数
     async function playFile(fileId) {
         if (!fileId) return;
         currentFileId = fileId;
-        // ファイルのURLを取得（軽量版）
-        const fileUrl = await getFileUrl(fileId);
+        // キューで先読み済みの曲なら、URL・再生位置・波形ピークを取りに行かない
+        const queued = upcomingQueue.find(item => item.id === fileId);
+        let fileUrl;
+        if (queued) {
+            applyGain(queued.gain_db);
+            showArtwork(queued.artwork);
+            fileUrl = urlAt(queued.stream_url, queued.position);
+        } else {
+            // ファイルのURLを取得（軽量版）
+            fileUrl = await getFileUrl(fileId);
+        }
+        upcomingQueue = [];
         if (fileUrl) {
             // 1. srcをセットし、load()を必ず呼ぶ
             audioPlayer.src = fileUrl;
@@ -694,15 +1052,31 @@ document.addEventListener('DOMContentLoaded', function() {
                 playPauseBtn.disabled = false;
                 playPauseBtn.classList.remove('btn-secondary');
                 playPauseBtn.classList.add('btn-primary');
-                // 前回再生位置を取得
-                const savedPosition = await getPlaybackPosition(currentFileId);
-                previousPosition = savedPosition;
-                if (savedPosition > 0) {
-                    audioPlayer.currentTime = savedPosition;
+                if (queued) {
+                    // 再生位置は #t= で読み込み済み、波形ピークもキューの応答に含まれている
+                    previousPosition = queued.position;
+                    if (queued.audioData) {
+                        audioData = { rows: queued.audioData.rows };
+                        audioDuration = queued.audioData.duration;
+                        drawWaveform();
+                    } else {
+                        loadAudioData();
+                    }
+                } else {
+                    // 前回再生位置を取得
+                    const savedPosition = await getPlaybackPosition(currentFileId);
+                    previousPosition = savedPosition;
+                    if (savedPosition > 0) {
+                        audioPlayer.currentTime = savedPosition;
+                    }
+                    // 波形ピークを読み込む
+                    loadAudioData();
                 }
                 // 4. 自動再生
                 audioPlayer.play();
                 playPauseBtn.innerHTML = '<i class="bi bi-pause-fill"></i>';
+                // 次の曲を先読みしておく
+                prefetchQueue(currentFileId);
                 // 5. isVoiceCommandActiveリセット＆マイクON
                 isVoiceCommandActive = false;
                 setTimeout(() => {
@@ -741,10 +1115,23 @@ document.addEventListener('DOMContentLoaded', function() {
     // 音声プレーヤーのイベント
     audioPlayer.addEventListener('timeupdate', updateTimeDisplay);
     
+    // 再生中も 1 分ごとに再生位置を保存する（サーバー側のセッションの期限もこれで延びる）
+    let lastPeriodicSave = Date.now();
+    audioPlayer.addEventListener('timeupdate', function() {
+        if (audioPlayer.paused || !currentFileId) return;
+        if (Date.now() - lastPeriodicSave < 60000) return;
+        lastPeriodicSave = Date.now();
+        savePlaybackPosition(audioPlayer.currentTime);
+    });
+    
     audioPlayer.addEventListener('ended', function() {
         if (loopCheck.checked) {
             audioPlayer.currentTime = 0;
             audioPlayer.play();
+        } else if (upcomingQueue.length) {
+            // 次の曲へ（先読み済みなので待たずに始まる）
+            savePlaybackPosition(0);
+            playFile(upcomingQueue[0].id);
         } else {
             playPauseBtn.innerHTML = '<i class="bi bi-play-fill"></i>';
         }
@@ -859,22 +1246,56 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     });
     
-    // ページ離脱時に再生位置を保存
+    // ページ離脱時に再生位置を保存（sendBeaconで確実に送る）
     window.addEventListener('beforeunload', function() {
         if (currentFileId && audioPlayer.currentTime > 0) {
             savePlaybackPosition(audioPlayer.currentTime);
         }
+        const positions = takePendingPositions();
+        if (positions.length && navigator.sendBeacon) {
+            const body = new Blob([JSON.stringify({ positions: positions })], { type: 'application/json' });
+            navigator.sendBeacon('/api/save-positions/', body);
+        }
     });
     
+    // 認識したテキストをサーバーで音声コマンドに照合してアクションを返す
+    async function matchCommand(commandText) {
+        const response = await fetch('/api/voice-command/match/', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-CSRFToken': getCSRFToken()
+            },
+            // 「戻って」の戻り先（直前のセクション）をサーバーで決めるため再生中の位置も送る
+            body: JSON.stringify({ text: commandText, file_id: currentFileId, position: audioPlayer.currentTime })
+        });
+        const result = await response.json();
+        return result.success ? result : null;
+    }
+    
     // コマンド実行
-    function executeCommand(commandText) {
+    async function executeCommand(commandText) {
         console.log('⚡ コマンドを実行中:', commandText);
-        
         try {
-            // コマンドの判定
-            if (commandText.includes('戻って') || commandText.includes('もどって')) {
+            const result = await matchCommand(commandText);
+            runAction(result && result.command, commandText, result && result.seek_to);
+        } catch (error) {
+            console.error('❌ コマンド照合エラー:', error);
+            voiceStatus.innerHTML = '<small class="text-danger">コマンド実行中にエラーが発生しました</small>';
+        }
+    }
+    
+    // アクションを実行
+    function runAction(action, commandText, seekTo) {
+        try {
+            if (action === 'go_back') {
                 console.log('🔄 「戻って」コマンドを実行');
-                if (previousPosition > 0 && currentFileId) {
+                if (typeof seekTo === 'number' && audioPlayer.readyState >= 1) {
+                    // 曲の解析が済んでいれば直前のセクションの先頭に戻る
+                    audioPlayer.currentTime = seekTo;
+                    voiceStatus.innerHTML = '<small class="text-success">前のセクションに戻りました</small>';
+                    console.log('✅ 前のセクションに戻りました:', formatTime(seekTo));
+                } else if (previousPosition > 0 && currentFileId) {
                     console.log('🔄 前回再生位置:', previousPosition, '現在のファイルID:', currentFileId);
                     // audioPlayerが準備できているか確認
                     if (audioPlayer.readyState >= 2) { // HAVE_CURRENT_DATA以上
@@ -895,7 +1316,7 @@ document.addEventListener('DOMContentLoaded', function() {
                     voiceStatus.innerHTML = '<small class="text-warning">前回再生位置がありません</small>';
                     console.log('⚠️ 前回再生位置がありません');
                 }
-            } else if (commandText.includes('最初から') || commandText.includes('初めから')) {
+            } else if (action === 'restart') {
                 console.log('🔄 「最初から」コマンドを実行');
                 // audioPlayerが準備できているか確認
                 if (audioPlayer.readyState >= 2) { // HAVE_CURRENT_DATA以上
@@ -916,7 +1337,7 @@ document.addEventListener('DOMContentLoaded', function() {
                         console.log('✅ 最初から再生を開始しました');
                     }, { once: true });
                 }
-            } else if (commandText.includes('停止') || commandText.includes('とめる') || commandText.includes('ストップ')) {
+            } else if (action === 'stop') {
                 console.log('🔄 「停止」コマンドを実行');
                 // 停止前に現在位置を保存
                 if (currentFileId && audioPlayer.duration) {
@@ -929,7 +1350,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 playPauseBtn.innerHTML = '<i class="bi bi-play-fill"></i>';
                 voiceStatus.innerHTML = '<small class="text-success">再生を停止しました</small>';
                 console.log('✅ 再生を停止しました');
-            } else if (commandText.includes('再生') || commandText.includes('さいせい') || commandText.includes('スタート')) {
+            } else if (action === 'play') {
                 console.log('🔄 「再生」コマンドを実行');
                 if (audioPlayer.readyState >= 2) { // HAVE_CURRENT_DATA以上
                     audioPlayer.play();
@@ -948,7 +1369,7 @@ document.addEventListener('DOMContentLoaded', function() {
                     }, { once: true });
                 }
             } else {
-                console.log('❓ 認識できないコマンド:', commandText);
+                console.log('❓ 認識できないコマンド:', commandText || action);
                 voiceStatus.innerHTML = '<small class="text-warning">認識できないコマンドです</small>';
             }
         } catch (error) {
@@ -957,6 +1378,163 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     
+    // ===== オフライン音声コマンド（録音したクリップをサーバーの登録音声と照合） =====
+    const CLIP_SAMPLE_RATE = 16000;
+    const CLIP_DURATION_MS = 1500;
+    
+    // float32 PCM を 16bit モノラルの WAV に変換
+    function encodeWav(samples, sampleRate) {
+        const buffer = new ArrayBuffer(44 + samples.length * 2);
+        const view = new DataView(buffer);
+        const writeString = (offset, text) => {
+            for (let i = 0; i < text.length; i++) view.setUint8(offset + i, text.charCodeAt(i));
+        };
+        writeString(0, 'RIFF');
+        view.setUint32(4, 36 + samples.length * 2, true);
+        writeString(8, 'WAVE');
+        writeString(12, 'fmt ');
+        view.setUint32(16, 16, true);
+        view.setUint16(20, 1, true);
+        view.setUint16(22, 1, true);
+        view.setUint32(24, sampleRate, true);
+        view.setUint32(28, sampleRate * 2, true);
+        view.setUint16(32, 2, true);
+        view.setUint16(34, 16, true);
+        writeString(36, 'data');
+        view.setUint32(40, samples.length * 2, true);
+        for (let i = 0; i < samples.length; i++) {
+            const sample = Math.max(-1, Math.min(1, samples[i]));
+            view.setInt16(44 + i * 2, sample < 0 ? sample * 0x8000 : sample * 0x7FFF, true);
+        }
+        return new Blob([buffer], { type: 'audio/wav' });
+    }
+    
+    // サンプリングレートを下げる（区間平均）
+    function downsample(samples, fromRate, toRate) {
+        if (fromRate <= toRate) return samples;
+        const ratio = fromRate / toRate;
+        const result = new Float32Array(Math.floor(samples.length / ratio));
+        for (let i = 0; i < result.length; i++) {
+            const start = Math.floor(i * ratio);
+            const end = Math.min(Math.floor((i + 1) * ratio), samples.length);
+            let sum = 0;
+            for (let j = start; j < end; j++) sum += samples[j];
+            result[i] = sum / Math.max(end - start, 1);
+        }
+        return result;
+    }
+    
+    // マイクから durationMs ミリ秒録音して WAV の Blob を返す
+    async function recordClip(durationMs) {
+        const stream = await navigator.mediaDevices.getUserMedia({ audio: true });
+        const context = new (window.AudioContext || window.webkitAudioContext)();
+        const source = context.createMediaStreamSource(stream);
+        const processor = context.createScriptProcessor(4096, 1, 1);
+        const chunks = [];
+        processor.onaudioprocess = function(event) {
+            chunks.push(new Float32Array(event.inputBuffer.getChannelData(0)));
+        };
+        source.connect(processor);
+        processor.connect(context.destination);
+        
+        await new Promise(resolve => setTimeout(resolve, durationMs));
+        
+        processor.disconnect();
+        source.disconnect();
+        stream.getTracks().forEach(track => track.stop());
+        const sampleRate = context.sampleRate;
+        await context.close();
+        
+        const samples = new Float32Array(chunks.reduce((total, chunk) => total + chunk.length, 0));
+        let offset = 0;
+        for (const chunk of chunks) {
+            samples.set(chunk, offset);
+            offset += chunk.length;
+        }
+        return encodeWav(downsample(samples, sampleRate, CLIP_SAMPLE_RATE), Math.min(sampleRate, CLIP_SAMPLE_RATE));
+    }
+    
+    // 録音したクリップからコマンドを認識して実行
+    async function recognizeClipCommand() {
+        try {
+            voiceStatus.innerHTML = '<small class="text-warning">コマンドを聞いています...</small>';
+            const clip = await recordClip(CLIP_DURATION_MS);
+            const formData = new FormData();
+            formData.append('clip', clip, 'clip.wav');
+            
+            const params = new URLSearchParams({ file_id: currentFileId || '', position: audioPlayer.currentTime });
+            const response = await fetch(`/api/voice-command/clip/?${params}`, {
+                method: 'POST',
+                body: formData,
+                headers: { 'X-CSRFToken': getCSRFToken() }
+            });
+            const result = await response.json();
+            if (result.success) {
+                console.log('🎯 クリップ認識:', result.command, result.elapsed_ms + 'ms');
+                runAction(result.command, undefined, result.seek_to);
+            } else if (result.enrolled === false && ('webkitSpeechRecognition' in window || 'SpeechRecognition' in window)) {
+                // 登録音声が無い場合はブラウザの音声認識で聞き直し、既定のコマンドと照合する
+                const match = await listenForCommand();
+                if (match) {
+                    runAction(match.command, undefined, match.seek_to);
+                } else {
+                    voiceStatus.innerHTML = '<small class="text-warning">対応していないコマンドです</small>';
+                }
+            } else {
+                voiceStatus.innerHTML = `<small class="text-warning">${result.message || result.error}</small>`;
+            }
+        } catch (error) {
+            console.error('クリップ認識エラー:', error);
+            voiceStatus.innerHTML = '<small class="text-danger">音声コマンドの実行に失敗しました</small>';
+        } finally {
+            isVoiceCommandActive = false;
+            voiceCommandBtn.disabled = false;
+        }
+    }
+    
+    // 録音したクリップを登録音声として送信
+    async function enrollClip(action) {
+        const enrollStatus = document.getElementById('enroll-status');
+        try {
+            enrollStatus.innerHTML = '<small class="text-warning">録音中...コマンドを話してください</small>';
+            const clip = await recordClip(CLIP_DURATION_MS);
+            const formData = new FormData();
+            formData.append('action', action);
+            formData.append('clip', clip, 'clip.wav');
+            
+            const response = await fetch('/api/voice-command/enroll/', {
+                method: 'POST',
+                body: formData,
+                headers: { 'X-CSRFToken': getCSRFToken() }
+            });
+            const result = await response.json();
+            if (result.success) {
+                enrollStatus.innerHTML = `<small class="text-success">${result.message}</small>`;
+            } else {
+                enrollStatus.innerHTML = `<small class="text-danger">${result.error}</small>`;
+            }
+        } catch (error) {
+            console.error('音声の登録に失敗しました:', error);
+            enrollStatus.innerHTML = '<small class="text-danger">音声の登録に失敗しました</small>';
+        }
+    }
+    
+    document.getElementById('voice-enroll-btn').addEventListener('click', function() {
+        showModal('voiceModal');
+    });
+    
+    document.getElementById('enroll-record-btn').addEventListener('click', function() {
+        enrollClip(document.getElementById('enroll-action').value);
+    });
+    
+    document.getElementById('voiceModalClose').addEventListener('click', function() {
+        hideModal('voiceModal');
+    });
+    
+    document.getElementById('voiceModalCloseBtn').addEventListener('click', function() {
+        hideModal('voiceModal');
+    });
+    
     // 音声認識の初期化
     function initializeSpeechRecognition() {
         if (!('webkitSpeechRecognition' in window || 'SpeechRecognition' in window)) {
@@ -994,11 +1572,14 @@ document.addEventListener('DOMContentLoaded', function() {
             if (finalTranscript) {
                 console.log('🎯 最終認識結果:', finalTranscript);
                 
-                // キーワードチェック
-                const keyword = checkKeyword(finalTranscript);
-                if (keyword) {
-                    startVoiceCommandFromKeyword(finalTranscript, keyword);
-                }
+                // コマンドの照合
+                matchCommand(finalTranscript).then(action => {
+                    if (action) {
+                        startVoiceCommandFromKeyword(finalTranscript, action);
+                    }
+                }).catch(error => {
+                    console.error('❌ コマンド照合エラー:', error);
+                });
             }
             
             // 中間結果がある場合（デバッグ用）
@@ -1040,21 +1621,9 @@ document.addEventListener('DOMContentLoaded', function() {
         };
     }
     
-    // キーワードチェック
-    function checkKeyword(text) {
-        const keywords = ['戻って', 'もどって', '停止', 'とめる', 'ストップ', '再生', 'さいせい', 'スタート', '最初から', '初めから'];
-        
-        for (const keyword of keywords) {
-            if (text.includes(keyword)) {
-                return keyword;
-            }
-        }
-        return null;
-    }
-    
     // キーワードから音声コマンドを開始
-    function startVoiceCommandFromKeyword(keywordText, keyword) {
-        console.log('🎯 キーワード検出:', keyword, 'テキスト:', keywordText);
+    function startVoiceCommandFromKeyword(keywordText, action) {
+        console.log('🎯 コマンド検出:', action, 'テキスト:', keywordText);
         
         // 音声認識を一時停止
         if (recognition) {
@@ -1062,7 +1631,7 @@ document.addEventListener('DOMContentLoaded', function() {
         }
         
         // コマンドを実行
-        executeCommand(keywordText);
+        runAction(action, keywordText);
         
         // 少し待ってから音声認識を再開
         setTimeout(() => {
@@ -1086,6 +1655,12 @@ document.addEventListener('DOMContentLoaded', function() {
         isVoiceCommandActive = true;
         voiceCommandBtn.disabled = true;
         
+        // 音声認識 API が無いブラウザでは録音したクリップをサーバーで認識する
+        if (!recognition) {
+            recognizeClipCommand();
+            return;
+        }
+        
         // 継続的な音声認識を開始
         shouldKeepListening = true;
         startContinuousListening();
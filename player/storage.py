@@ -0,0 +1,169 @@
+"""
+内容アドレス（SHA-256）による重複排除ストレージ
+
+音声データは MEDIA_ROOT/blobs/ab/cd/<sha256>.<ext> に一度だけ保存し、
+AudioBlob の参照カウントで寿命を管理する。同じファイルが何度
+アップロードされても書き込み・メタデータ取得は最初の一回だけで済む。
+"""
+import glob
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import AudioBlob
+
+# touch() が最後に最終アクセス時刻を更新した時刻（内容ハッシュ -> time.monotonic()）
+_touched = {}
+_touched_lock = threading.Lock()
+_TOUCHED_MAX = 4096
+# 取り込み中に同じ内容の行が作られた・削除された場合にやり直す回数
+STORE_ATTEMPTS = 3
+
+
+def blob_root():
+    return os.path.join(settings.MEDIA_ROOT, 'blobs')
+
+
+def staging_dir():
+    """アップロード途中のファイル置き場（rename できるよう同じファイルシステム上に置く）"""
+    path = os.path.join(blob_root(), 'tmp')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def staged_bytes():
+    """一時領域（途中のアップロード・分割アップロードの確保済み領域）の合計バイト数"""
+    total = 0
+    with os.scandir(staging_dir()) as entries:
+        for entry in entries:
+            try:
+                total += entry.stat().st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def new_staging_path(extension):
+    return os.path.join(staging_dir(), f'{uuid.uuid4().hex}.{extension}.part')
+
+
+def blob_path(sha256, extension):
+    """ハッシュ先頭 2 バイトで 2 階層に振り分けたパス"""
+    return os.path.join(blob_root(), sha256[:2], sha256[2:4], f'{sha256}.{extension}')
+
+
+def path_for(blob):
+    return blob_path(blob.sha256, blob.extension)
+
+
+def store_file(staged_path, sha256, extension, size):
+    """
+    一時ファイルをストアへ取り込み、参照を 1 つ増やす
+
+    既に同じ内容が保存されている場合は一時ファイルを捨てて既存の
+    AudioBlob を返す。戻り値は (blob, created)。
+
+    行の確認・ファイルの移動・参照数の更新は AudioBlob の行ロックの中で行うので、
+    release() が同じ内容の行と実体を削除している最中に取り込むことはない。
+    """
+    for attempt in range(STORE_ATTEMPTS):
+        try:
+            with transaction.atomic():
+                blob, _ = AudioBlob.objects.select_for_update().get_or_create(
+                    sha256=sha256,
+                    defaults={'extension': extension, 'size': size},
+                )
+                # 形式判定が異なっても内容は同一なので既存の拡張子に合わせる
+                final_path = path_for(blob)
+                if os.path.exists(final_path):
+                    os.remove(staged_path)
+                    created = False
+                else:
+                    # 行だけ残っていて実体が消えていた場合も作り直したものとして扱う
+                    os.makedirs(os.path.dirname(final_path), exist_ok=True)
+                    os.replace(staged_path, final_path)
+                    created = True
+                acquire(blob)
+                blob.refresh_from_db()
+            return blob, created
+        except IntegrityError:
+            # 同時に作られた行が、ロックを取る前に削除された。最初からやり直す
+            if attempt == STORE_ATTEMPTS - 1:
+                raise
+
+
+def acquire(blob):
+    """参照を 1 つ増やす（行が削除されていた場合は False）"""
+    return AudioBlob.objects.filter(sha256=blob.sha256).update(
+        ref_count=F('ref_count') + 1,
+        last_accessed_at=timezone.now(),
+    ) > 0
+
+
+def acquire_existing(sha256):
+    """実体のある AudioBlob の参照を 1 つ増やして返す（無い場合は None）"""
+    with transaction.atomic():
+        blob = AudioBlob.objects.select_for_update().filter(sha256=sha256).first()
+        if blob is None or not os.path.exists(path_for(blob)):
+            return None
+        acquire(blob)
+        blob.refresh_from_db()
+    return blob
+
+
+def touch(sha256):
+    """
+    最終アクセス時刻を更新する（リーパーの追い出し順に使う）
+
+    Range リクエストのたびに書き込まないよう、同じ内容については
+    PLAYER_BLOB_TOUCH_INTERVAL 秒に 1 回だけ更新する。
+    """
+    now = time.monotonic()
+    with _touched_lock:
+        last = _touched.get(sha256)
+        if last is not None and now - last < settings.PLAYER_BLOB_TOUCH_INTERVAL:
+            return False
+        if len(_touched) >= _TOUCHED_MAX:
+            _touched.clear()
+        _touched[sha256] = now
+    AudioBlob.objects.filter(sha256=sha256).update(last_accessed_at=timezone.now())
+    return True
+
+
+def release(sha256):
+    """
+    参照を 1 つ減らし、参照が無くなったら実体と派生ファイルを削除する
+
+    ファイルの削除も行ロックの中で行い、同じ内容を取り込む store_file() を待たせる。
+    """
+    with transaction.atomic():
+        blob = AudioBlob.objects.select_for_update().filter(sha256=sha256).first()
+        if blob is None:
+            return False
+        if blob.ref_count > 1:
+            AudioBlob.objects.filter(sha256=sha256).update(ref_count=F('ref_count') - 1)
+            return False
+        base = path_for(blob)
+        blob.delete()
+        delete_blob_files(base)
+    return True
+
+
+def delete_blob_files(base):
+    """音声本体と、その隣に置いたピークなどの派生ファイルを削除して解放したバイト数を返す"""
+    reclaimed = 0
+    for path in [base] + glob.glob(glob.escape(base) + '.*'):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            reclaimed += size
+        except FileNotFoundError:
+            pass
+    return reclaimed
+
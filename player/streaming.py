@@ -0,0 +1,285 @@
+"""
+アップロード済み音声ファイルの Range 対応ストリーミング
+
+DEBUG=False でも動作するよう、static() に頼らず View から直接配信する。
+シーク時は必要なバイト範囲だけを返すため、ファイル全体を再取得しない。
+"""
+import mimetypes
+import os
+import re
+import uuid
+
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+
+from .executor import run_blocking
+
+RANGE_RE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+# mimetypes に登録されていない環境があるため音声形式は明示する
+AUDIO_CONTENT_TYPES = {
+    'mp3': 'audio/mpeg',
+    'wav': 'audio/wav',
+    'flac': 'audio/flac',
+    'aac': 'audio/aac',
+    'ogg': 'audio/ogg',
+}
+
+
+def content_type_for(filename):
+    """ファイル名から Content-Type を決定"""
+    extension = filename.rsplit('.', 1)[-1].lower()
+    if extension in AUDIO_CONTENT_TYPES:
+        return AUDIO_CONTENT_TYPES[extension]
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+def file_etag(stat_result):
+    """サイズと更新時刻から強い ETag を生成"""
+    return f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+
+
+def parse_range_header(header, size):
+    """
+    Range ヘッダーを解析して (start, end) のリストを返す（end は含む）
+
+    bytes 単位以外や構文エラーの場合は None（Range を無視して全体を返す）、
+    満たせる範囲が一つもない場合は空リスト（416）を返す。
+
+    重なる・隣接する範囲は昇順に並べてまとめる。"bytes=0-,0-,..." のように応答を
+    何倍にも膨らませる指定（CVE-2011-3192）を避けるため、範囲の長さの合計が
+    ファイルサイズを超える場合や、まとめた後も PLAYER_MAX_RANGES 個を超える場合も None を返す。
+    """
+    if not header or '=' not in header:
+        return None
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+
+    ranges = []
+    for part in spec.split(','):
+        match = RANGE_RE.match(part)
+        if not match:
+            return None
+        first, last = match.groups()
+        if not first and not last:
+            return None
+        if not first:
+            # 末尾から N バイト
+            length = int(last)
+            if length == 0:
+                continue
+            start, end = max(size - length, 0), size - 1
+        else:
+            start = int(first)
+            end = int(last) if last else size - 1
+            if last and end < start:
+                return None
+            end = min(end, size - 1)
+        if start < size:
+            ranges.append((start, end))
+
+    if sum(end - start + 1 for start, end in ranges) > size:
+        return None
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    if len(merged) > settings.PLAYER_MAX_RANGES:
+        return None
+    return merged
+
+
+def iter_file_range(path, start, end, chunk_size=None):
+    """ファイルの [start, end] をチャンク単位で読み出すジェネレータ"""
+    chunk_size = chunk_size or settings.PLAYER_STREAM_CHUNK_SIZE
+    remaining = end - start + 1
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+async def aiter_file_range(path, start, end, chunk_size=None):
+    """iter_file_range の非同期版（読み出しはスレッドプールで行う）"""
+    chunk_size = chunk_size or settings.PLAYER_STREAM_CHUNK_SIZE
+    remaining = end - start + 1
+    f = await run_blocking(open, path, 'rb')
+    try:
+        await run_blocking(f.seek, start)
+        while remaining > 0:
+            chunk = await run_blocking(f.read, min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+class FileWindow:
+    """
+    ファイルの [start, end) の前に prefix を付けた内容
+
+    シーク位置から始まる音声を、元のファイルをコピーせずに Range 対応で配信するのに使う。
+    """
+
+    def __init__(self, path, start=0, end=None, prefix=b''):
+        self.path = path
+        self.start = start
+        self.end = os.path.getsize(path) if end is None else end
+        self.prefix = prefix
+
+    @property
+    def size(self):
+        return len(self.prefix) + self.end - self.start
+
+    def _split(self, start, end):
+        """内容上の [start, end] を prefix 部分とファイル上の範囲に分ける"""
+        head = self.prefix[start:end + 1]
+        file_start = self.start + max(start - len(self.prefix), 0)
+        file_end = self.start + end - len(self.prefix)
+        return head, file_start, file_end
+
+    def iter_range(self, start, end):
+        head, file_start, file_end = self._split(start, end)
+        if head:
+            yield head
+        if file_end >= file_start:
+            yield from iter_file_range(self.path, file_start, file_end)
+
+    async def aiter_range(self, start, end):
+        head, file_start, file_end = self._split(start, end)
+        if head:
+            yield head
+        if file_end >= file_start:
+            async for chunk in aiter_file_range(self.path, file_start, file_end):
+                yield chunk
+
+
+async def _aiter_empty():
+    return
+    yield
+
+
+def _part_header(start, end, size, content_type, boundary):
+    return (
+        f'\r\n--{boundary}\r\n'
+        f'Content-Type: {content_type}\r\n'
+        f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n'
+    )
+
+
+def _iter_multipart(window, ranges, size, content_type, boundary):
+    for start, end in ranges:
+        yield _part_header(start, end, size, content_type, boundary).encode('ascii')
+        yield from window.iter_range(start, end)
+    yield f'\r\n--{boundary}--\r\n'.encode('ascii')
+
+
+async def _aiter_multipart(window, ranges, size, content_type, boundary):
+    for start, end in ranges:
+        yield _part_header(start, end, size, content_type, boundary).encode('ascii')
+        async for chunk in window.aiter_range(start, end):
+            yield chunk
+    yield f'\r\n--{boundary}--\r\n'.encode('ascii')
+
+
+def _multipart_length(ranges, size, content_type, boundary):
+    length = 0
+    for start, end in ranges:
+        length += len(_part_header(start, end, size, content_type, boundary)) + (end - start + 1)
+    return length + len(f'\r\n--{boundary}--\r\n')
+
+
+def _if_range_matches(if_range, etag, mtime):
+    """If-Range が現在のファイルと一致する場合のみ Range を有効にする"""
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        # 弱い ETag は If-Range では一致とみなさない
+        return if_range == etag
+    since = parse_http_date_safe(if_range)
+    return since is not None and int(mtime) <= since
+
+
+def range_file_response(request, path, content_type=None, etag=None, asynchronous=False, window=None):
+    """
+    Range / If-Range / If-None-Match に対応したファイルレスポンスを生成
+
+    内容ハッシュが分かっている場合は etag に渡すと更新時刻に依存しない。
+    asynchronous=True の場合は本文を非同期イテレータで返す（ASGI 用）。
+    window（FileWindow）を渡すとファイル全体の代わりにその内容を配信する。
+    """
+    stat_result = os.stat(path)
+    if window is None:
+        window = FileWindow(path, 0, stat_result.st_size)
+    iter_range = window.aiter_range if asynchronous else window.iter_range
+    iter_multipart = _aiter_multipart if asynchronous else _iter_multipart
+    empty = _aiter_empty if asynchronous else tuple
+    size = window.size
+    etag = etag or file_etag(stat_result)
+    if content_type is None:
+        content_type = content_type_for(path)
+
+    common_headers = {
+        'Accept-Ranges': 'bytes',
+        'ETag': etag,
+        'Last-Modified': http_date(stat_result.st_mtime),
+        'Cache-Control': 'private, max-age=3600',
+    }
+
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(',')]:
+        response = HttpResponse(status=304)
+        for key, value in common_headers.items():
+            response[key] = value
+        return response
+
+    ranges = None
+    if _if_range_matches(request.headers.get('If-Range'), etag, stat_result.st_mtime):
+        ranges = parse_range_header(request.headers.get('Range'), size)
+
+    if ranges == []:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        for key, value in common_headers.items():
+            response[key] = value
+        return response
+
+    if ranges is None:
+        status = 200
+        content_length = size
+        body = iter_range(0, size - 1) if size else empty()
+        response_content_type = content_type
+    elif len(ranges) == 1:
+        status = 206
+        start, end = ranges[0]
+        content_length = end - start + 1
+        body = iter_range(start, end)
+        response_content_type = content_type
+    else:
+        status = 206
+        boundary = uuid.uuid4().hex
+        content_length = _multipart_length(ranges, size, content_type, boundary)
+        body = iter_multipart(window, ranges, size, content_type, boundary)
+        response_content_type = f'multipart/byteranges; boundary={boundary}'
+
+    if request.method == 'HEAD':
+        response = HttpResponse(status=status, content_type=response_content_type)
+    else:
+        response = StreamingHttpResponse(body, status=status, content_type=response_content_type)
+    response['Content-Length'] = str(content_length)
+    if status == 206 and len(ranges) == 1:
+        response['Content-Range'] = f'bytes {ranges[0][0]}-{ranges[0][1]}/{size}'
+    for key, value in common_headers.items():
+        response[key] = value
+    return response
@@ -0,0 +1,248 @@
+"""
+テスト・ベンチマーク用の合成音声ファイル（WAV / MP3 / FLAC）
+
+外部のエンコーダーを使わずに、各形式のフレーム構造を正しく持つファイルを
+生成する。
+
+    WAV   16bit PCM の正弦波 + ノイズ（またはテンポのあるクリック + 持続音）
+    MP3   MPEG-1 Layer III。サイド情報が 0 の無音フレームを、ビットレートを
+          フレームごとに変えて並べる（VBR）。ID3v2 タグと Xing ヘッダーも付けられる
+    FLAC  VERBATIM サブフレーム（非圧縮）のフレーム。CRC-8 / CRC-16 も正しく計算する
+"""
+import io
+import struct
+import wave
+
+import numpy as np
+
+from .seekindex import _crc_table, crc8
+
+# MPEG-1 Layer III のビットレート（kbps、インデックス 1〜14）
+MP3_BITRATES = [32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320]
+MP3_SAMPLE_RATES = {44100: 0, 48000: 1, 32000: 2}
+MP3_FRAME_SAMPLES = 1152
+
+FLAC_SAMPLE_RATES = {
+    8000: 4, 16000: 5, 22050: 8, 24000: 6, 32000: 7, 44100: 9, 48000: 10, 96000: 11,
+}
+
+
+CRC16_TABLE = _crc_table(0x8005, 16)
+
+
+def crc16(data):
+    """FLAC のフレーム全体用 CRC-16（多項式 x^16 + x^15 + x^2 + 1）"""
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ CRC16_TABLE[(crc >> 8) ^ byte]
+    return crc
+
+
+def tone(seconds, sample_rate, channels=1, frequency=440.0, noise=0.05, seed=0):
+    """正弦波にノイズを加えた int16 の [frames, channels] 配列"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    signal = 0.5 * np.sin(2 * np.pi * frequency * t)
+    samples = signal[:, None] + noise * rng.standard_normal((len(t), channels))
+    return (np.clip(samples, -1, 1) * 32767).astype(np.int16)
+
+
+def wav_bytes(seconds=1.0, sample_rate=44100, channels=2, **kwargs):
+    """16bit PCM の WAV を生成"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(tone(seconds, sample_rate, channels, **kwargs).astype('<i2').tobytes())
+    return buffer.getvalue()
+
+
+def pcm_wav_bytes(samples, sample_rate, bits=16, floating=False, extensible=False):
+    """
+    [frames, channels] の float 配列（-1〜1）を任意のサンプル形式の WAV にする
+
+    wave モジュールが扱えない 24bit・浮動小数点・WAVE_FORMAT_EXTENSIBLE も書ける。
+    """
+    samples = np.asarray(samples, dtype=np.float64)
+    channels = samples.shape[1]
+    if floating:
+        data = samples.astype('<f4' if bits == 32 else '<f8').tobytes()
+        format_tag = 3
+    else:
+        scaled = np.round(np.clip(samples, -1, 1 - 2.0 ** (1 - bits)) * 2.0 ** (bits - 1)).astype(np.int64)
+        format_tag = 1
+        if bits == 8:
+            data = (scaled + 128).astype(np.uint8).tobytes()
+        elif bits == 24:
+            data = (scaled & 0xFFFFFF).astype('<u4').view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+        else:
+            data = scaled.astype(f'<i{bits // 8}').tobytes()
+    block_align = channels * bits // 8
+    fmt = struct.pack('<HHIIHH', 0xFFFE if extensible else format_tag, channels, sample_rate,
+                      sample_rate * block_align, block_align, bits)
+    if extensible:
+        # cbSize, 有効ビット数, チャンネルマスク, SubFormat GUID
+        fmt += struct.pack('<HHI', 22, bits, 0) + struct.pack('<H', format_tag) + bytes.fromhex(
+            '000000001000800000aa00389b71')
+    chunks = b'fmt ' + struct.pack('<I', len(fmt)) + fmt
+    chunks += b'LIST' + struct.pack('<I', 4) + b'INFO'  # 読み飛ばすべき別のチャンク
+    chunks += b'data' + struct.pack('<I', len(data)) + data + b'\x00' * (len(data) % 2)
+    return b'RIFF' + struct.pack('<I', 4 + len(chunks)) + b'WAVE' + chunks
+
+
+def click_wav_bytes(parts, bpm=120.0, sample_rate=22050, seed=0):
+    """
+    bpm の間隔で鳴るクリックに持続音を重ねたモノラル WAV を生成（テンポ・セクション解析用）
+
+    parts は (秒数, 持続音の周波数) の列で、区間ごとに音色が変わる。
+    """
+    rng = np.random.default_rng(seed)
+    signal = np.concatenate([
+        0.3 * np.sin(2 * np.pi * frequency * np.arange(int(seconds * sample_rate)) / sample_rate)
+        for seconds, frequency in parts
+    ])
+    click_length = int(0.03 * sample_rate)
+    click = rng.standard_normal(click_length) * np.exp(-np.arange(click_length) / (0.005 * sample_rate))
+    for start in np.arange(0, len(signal) - click_length, 60.0 / bpm * sample_rate).astype(int):
+        signal[start:start + click_length] += 0.6 * click
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes((np.clip(signal, -1, 1) * 32767).astype('<i2').tobytes())
+    return buffer.getvalue()
+
+
+def melody(seconds, sample_rate, note_seconds=0.25, seed=0):
+    """
+    seed ごとに異なるランダムな音列（倍音付き）の float PCM（音響指紋用）
+
+    音の高さと長さは時間で決めるので、サンプリングレートを変えても同じ曲になる。
+    """
+    rng = np.random.default_rng(seed)
+    notes = int(np.ceil(seconds / note_seconds))
+    pitches = 220.0 * 2 ** (rng.integers(0, 36, size=(notes, 2)) / 12)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    index = np.minimum((t / note_seconds).astype(int), notes - 1)
+    envelope = np.exp(-(t % note_seconds) * 6)
+    signal = np.zeros(len(t))
+    for voice in range(pitches.shape[1]):
+        frequency = pitches[index, voice]
+        phase = 2 * np.pi * np.cumsum(frequency) / sample_rate
+        for harmonic, level in ((1, 0.25), (2, 0.1), (3, 0.05)):
+            signal += level * np.sin(harmonic * phase) * (harmonic * frequency < sample_rate / 2)
+    return signal * envelope
+
+
+def _id3v2(size=1024):
+    """中身がパディングだけの ID3v2.3 タグ"""
+    syncsafe = bytes((size >> shift) & 0x7F for shift in (21, 14, 7, 0))
+    return b'ID3\x03\x00\x00' + syncsafe + b'\x00' * size
+
+
+def mp3_frame(bitrate, sample_rate=44100, channels=2, payload=b''):
+    """MPEG-1 Layer III の無音フレーム（payload はサイド情報の後ろに置く）"""
+    length = 144 * bitrate * 1000 // sample_rate
+    mode = 3 if channels == 1 else 0
+    header = bytes([
+        0xFF, 0xFB,
+        (MP3_BITRATES.index(bitrate) + 1) << 4 | MP3_SAMPLE_RATES[sample_rate] << 2,
+        mode << 6,
+    ])
+    side_info = b'\x00' * (17 if channels == 1 else 32)
+    body = header + side_info + payload
+    return body + b'\x00' * (length - len(body))
+
+
+def mp3_bytes(seconds=1.0, sample_rate=44100, channels=2, bitrates=None, id3=True, xing=True, seed=0):
+    """
+    VBR の MP3 を生成
+
+    bitrates を省略するとフレームごとに 64〜320kbps から無作為に選ぶ。
+    xing=True の場合は先頭に Xing ヘッダーだけを持つフレームを置く。
+    """
+    rng = np.random.default_rng(seed)
+    count = -(-int(seconds * sample_rate) // MP3_FRAME_SAMPLES)
+    if bitrates is None:
+        bitrates = MP3_BITRATES[4:]
+    chosen = [bitrates[i] for i in rng.integers(0, len(bitrates), size=count)]
+    frames = [mp3_frame(bitrate, sample_rate, channels) for bitrate in chosen]
+
+    parts = [_id3v2()] if id3 else []
+    if xing:
+        total = sum(len(frame) for frame in frames)
+        toc = bytes(min(255, i * 256 // 100) for i in range(100))
+        payload = b'Xing' + struct.pack('>III', 0x7, count, total) + toc
+        parts.append(mp3_frame(128, sample_rate, channels, payload))
+    return b''.join(parts + frames)
+
+
+def _utf8_number(value):
+    """FLAC のフレーム番号に使う UTF-8 風の可変長整数"""
+    if value < 0x80:
+        return bytes([value])
+    length = 2
+    while value >= 1 << (5 * length + 1):
+        length += 1
+    tail = [0x80 | ((value >> (6 * i)) & 0x3F) for i in reversed(range(length - 1))]
+    lead = ((0xFF00 >> length) & 0xFF) | (value >> (6 * (length - 1)))
+    return bytes([lead] + tail)
+
+
+def flac_frame(samples, frame_number, sample_rate, block_size):
+    """int16 の [frames, channels] から VERBATIM サブフレームの FLAC フレームを作る"""
+    frames, channels = samples.shape
+    if frames == block_size and block_size == 4096:
+        size_code, size_bits = 12, b''
+    else:
+        size_code, size_bits = 7, struct.pack('>H', frames - 1)
+    rate_code = FLAC_SAMPLE_RATES.get(sample_rate, 0)
+    header = bytes([0xFF, 0xF8, size_code << 4 | rate_code, (channels - 1) << 4 | 4 << 1])
+    header += _utf8_number(frame_number) + size_bits
+    header += bytes([crc8(header)])
+
+    subframes = b''.join(
+        b'\x02' + samples[:, channel].astype('>i2').tobytes() for channel in range(channels)
+    )
+    frame = header + subframes
+    return frame + struct.pack('>H', crc16(frame))
+
+
+def flac_bytes(seconds=1.0, sample_rate=44100, channels=2, block_size=4096, seektable=None, **kwargs):
+    """
+    非圧縮の FLAC を生成
+
+    seektable に秒数を渡すと、その間隔のシークポイントを持つ SEEKTABLE を付ける。
+    """
+    samples = tone(seconds, sample_rate, channels, **kwargs)
+    frames = [
+        flac_frame(samples[start:start + block_size], number, sample_rate, block_size)
+        for number, start in enumerate(range(0, len(samples), block_size))
+    ]
+
+    total = len(samples)
+    packed = (sample_rate << 44) | ((channels - 1) << 41) | (15 << 36) | total
+    streaminfo = struct.pack('>HH', block_size, block_size)
+    streaminfo += min(len(f) for f in frames).to_bytes(3, 'big') + max(len(f) for f in frames).to_bytes(3, 'big')
+    streaminfo += packed.to_bytes(8, 'big') + b'\x00' * 16
+
+    blocks = [(0, streaminfo)]
+    if seektable:
+        points = []
+        offset = 0
+        next_time = 0.0
+        for number, frame in enumerate(frames):
+            first = number * block_size
+            if first >= next_time * sample_rate:
+                points.append(struct.pack('>QQH', first, offset, min(block_size, total - first)))
+                next_time += seektable
+            offset += len(frame)
+        blocks.append((3, b''.join(points)))
+
+    metadata = b''
+    for i, (block_type, body) in enumerate(blocks):
+        last = 0x80 if i == len(blocks) - 1 else 0
+        metadata += bytes([last | block_type]) + len(body).to_bytes(3, 'big') + body
+    return b'fLaC' + metadata + b''.join(frames)
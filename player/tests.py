@@ -1,3 +1,1821 @@
-from django.test import TestCase
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import tracemalloc
+import wave
+from datetime import timedelta
+from unittest import mock, skipIf
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.contrib.sessions.models import Session
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count
+from django.test import AsyncRequestFactory, Client, RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+from django.utils import timezone
+from mutagen.id3 import APIC, ID3
+from PIL import Image
+
+from .audio import AudioDecodeError, FFmpegSource, PCMSource, WavSource, open_pcm
+from . import analysis, artwork, async_views, benchmark, fingerprint, jobs, keywords, library, loudness, matcher, metadata, metrics, seekindex, storage, synth, tracing, views
+from .executor import run_blocking
+from .models import AudioArtwork, AudioBlob, AudioFingerprint, AudioLoudness, AudioMetadata, FingerprintHash, Job, MusicAnalysis, MusicFile, PlaybackPosition, VoiceCommand, VoiceTemplate, normalize_title
+from .peaks import HEADER, build_pyramid, compute_peaks
+from .positions import position_buffer
+from .reaper import Reaper
+from .views import upload_file_lightweight
+
+
+def make_wav(seconds=1.0, sample_rate=8000, channels=1):
+    """テスト用の無音に近い WAV データを生成"""
+    buffer = io.BytesIO()
+    frames = int(seconds * sample_rate)
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(b''.join(
+            struct.pack('<h', (i * 37) % 2000 - 1000) * channels for i in range(frames)
+        ))
+    return buffer.getvalue()
+
+
+def make_word(pitches, stretch=1.0, noise=0.01, gain=0.5, seed=0):
+    """音高の並びで表した合成の「単語」を 16kHz の WAV で生成"""
+    rng = np.random.default_rng(seed)
+    parts = [np.zeros(3200)]
+    for pitch in pitches:
+        t = np.arange(int(0.15 * stretch * 16000)) / 16000
+        parts.append(sum(np.sin(2 * np.pi * pitch * h * t) / h for h in (1, 2, 3)) * np.hanning(len(t)))
+    parts.append(np.zeros(3200))
+    signal = np.concatenate(parts)
+    signal = gain * signal / np.abs(signal).max() + noise * rng.standard_normal(len(signal))
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(16000)
+        wav.writeframes((np.clip(signal, -1, 1) * 32767).astype('<i2').tobytes())
+    return buffer.getvalue()
+
+
+@override_settings(PLAYER_POSITION_FLUSH_THREAD=False, PLAYER_BACKGROUND_JOBS=False)
+class MediaTestCase(TestCase):
+    """一時 MEDIA_ROOT を使うテストの基底クラス"""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+        metadata.clear_cache()
+        storage._touched.clear()
+        keywords.template_cache.invalidate('')
+
+    def tearDown(self):
+        position_buffer.flush()
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root, ignore_errors=True)
+
+    def upload(self, data, name='test.wav', client=None):
+        upload = io.BytesIO(data)
+        upload.name = name
+        response = (client or self.client).post('/api/upload-lightweight/', {'file': upload})
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()['file']
+
+
+class StreamFileTests(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.data = make_wav(seconds=2.0)
+        self.file_info = self.upload(self.data)
+        self.url = f"/api/stream/{self.file_info['id']}/"
+
+    def test_file_url_points_to_stream_view(self):
+        response = self.client.get(f"/api/file-url-lightweight/{self.file_info['id']}/")
+        self.assertEqual(response.json()['file_url'], self.url)
+
+    def test_full_response_advertises_ranges(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['Content-Length'], str(len(self.data)))
+        self.assertEqual(b''.join(response.streaming_content), self.data)
+
+    def test_single_range_returns_only_requested_bytes(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 100-199/{len(self.data)}')
+        self.assertEqual(b''.join(response.streaming_content), self.data[100:200])
+
+    def test_suffix_range(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-10')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.data[-10:])
+
+    def test_unsatisfiable_range(self):
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={len(self.data)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.data)}')
+
+    def test_stale_if_range_returns_full_body(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+        etag = response['ETag']
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+
+    def test_multiple_ranges_use_multipart(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9,20-29')
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response['Content-Type'].startswith('multipart/byteranges'))
+        body = b''.join(response.streaming_content)
+        self.assertEqual(len(body), int(response['Content-Length']))
+        self.assertIn(self.data[20:30], body)
+
+    def test_overlapping_ranges_are_merged(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=50-99,0-9,5-19,20-29')
+        self.assertEqual(response.status_code, 206)
+        body = b''.join(response.streaming_content)
+        self.assertEqual(body.count(b'Content-Range'), 2)
+        self.assertIn(self.data[0:30], body)
+        self.assertIn(self.data[50:100], body)
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9,10-19')
+        self.assertEqual(response['Content-Range'], f'bytes 0-19/{len(self.data)}')
+
+    def test_amplifying_ranges_return_full_body(self):
+        # 同じ範囲の繰り返し（CVE-2011-3192）と、多すぎる範囲は Range を無視する
+        for header in ['bytes=' + ','.join(['0-'] * 50), 'bytes=' + ','.join(f'{i * 10}-{i * 10}' for i in range(17))]:
+            with self.subTest(header=header[:20]):
+                response = self.client.get(self.url, HTTP_RANGE=header)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response['Content-Length'], str(len(self.data)))
+
+    @override_settings(DEBUG=False)
+    def test_streams_without_debug(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-3')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), b'RIFF')
+
+
+class SeekIndexTests(MediaTestCase):
+
+    def write(self, name, data):
+        path = os.path.join(self.media_root, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_wav_offsets_are_computed(self):
+        path = self.write('a.wav', synth.wav_bytes(seconds=2.0, sample_rate=8000))
+        seekindex.build_seek_index(path)
+        index = seekindex.SeekIndex(path)
+        self.assertEqual(index.total_samples, 16000)
+        self.assertEqual(index.locate(1.5), (44 + 12000 * 4, 12000))
+
+    def test_mp3_scan_skips_id3_and_xing_frames(self):
+        data = synth.mp3_bytes(seconds=3.0)
+        result = seekindex.scan(self.write('a.mp3', data))
+        xing_length = len(synth.mp3_frame(128))
+        self.assertEqual(result['data_start'], 10 + 1024 + xing_length)
+        self.assertEqual(result['total_samples'], 115 * 1152)
+        self.assertEqual(result['data_end'], len(data))
+        for sample, offset in result['entries'].tolist():
+            self.assertEqual(sample % 1152, 0)
+            self.assertEqual(data[offset:offset + 2], b'\xff\xfb')
+        self.assertGreaterEqual(np.diff(result['entries']['sample']).min(), 0.5 * 44100)
+
+    def test_mp3_scan_resyncs_after_garbage(self):
+        frames = [synth.mp3_frame(bitrate) for bitrate in (128, 320, 64, 192)]
+        data = frames[0] + frames[1] + b'\xff\x00junk' + frames[2] + frames[3]
+        result = seekindex.scan(self.write('a.mp3', data), step_seconds=0)
+        self.assertEqual(result['total_samples'], 4 * 1152)
+        self.assertEqual(result['entries']['offset'][2], len(frames[0] + frames[1]) + 6)
+
+    def test_flac_frame_scan_agrees_with_seektable(self):
+        scanned = seekindex.scan(self.write('a.flac', synth.flac_bytes(seconds=3.0)), step_seconds=0)
+        data = synth.flac_bytes(seconds=3.0, seektable=0.05)
+        table = seekindex.scan(self.write('b.flac', data), step_seconds=0.05)
+        self.assertEqual(scanned['total_samples'], 132300)
+        self.assertEqual(len(scanned['entries']), 33)
+        self.assertEqual(list(scanned['entries']['sample']), [i * 4096 for i in range(33)])
+        # SEEKTABLE のオフセットは最初のフレームからの相対位置
+        shift = table['data_start'] - scanned['data_start']
+        self.assertEqual(
+            [offset - shift for offset in table['entries']['offset'].tolist()],
+            scanned['entries']['offset'].tolist()
+        )
+
+    def test_stream_starts_at_requested_time(self):
+        data = synth.flac_bytes(seconds=3.0)
+        file_info = self.upload(data, name='a.flac')
+        self.assertTrue(os.path.exists(seekindex.seek_index_path(file_info['file_path'])))
+
+        url = f"/api/stream/{file_info['id']}/?t=2.0"
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        seek_time = float(response['X-Seek-Time'])
+        self.assertTrue(2.0 - 0.5 - 4096 / 44100 <= seek_time <= 2.0)
+
+        body = b''.join(response.streaming_content)
+        offset = data.index(b'\xff\xf8', 42 + int(seek_time * 44100) * 4 - 4096)
+        self.assertEqual(body[:4], b'fLaC')
+        self.assertEqual(body[42:], data[offset:])
+        packed = int.from_bytes(body[18:26], 'big')
+        self.assertEqual(packed & 0xFFFFFFFFF, 132300 - round(seek_time * 44100))
+
+        response = self.client.get(url, HTTP_RANGE='bytes=40-45')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), body[40:46])
+        self.assertNotEqual(response['ETag'], self.client.get(f"/api/stream/{file_info['id']}/")['ETag'])
+
+    def test_wav_segment_is_playable_and_index_is_built_lazily(self):
+        file_info = self.upload(make_wav(seconds=2.0, sample_rate=8000), name='a.wav')
+        os.remove(seekindex.seek_index_path(file_info['file_path']))
+
+        response = self.client.get(f"/api/stream/{file_info['id']}/?t=0.5")
+        self.assertEqual(response['X-Seek-Time'], '0.500000')
+        with wave.open(io.BytesIO(b''.join(response.streaming_content))) as wav:
+            self.assertEqual(wav.getnframes(), 12000)
+
+        response = self.client.get(f"/api/stream/{file_info['id']}/?t=-1")
+        self.assertEqual(response.status_code, 400)
+
+    def test_unindexable_file_is_not_rescanned(self):
+        path = os.path.join(self.media_root, 'broken.mp3')
+        with open(path, 'wb') as f:
+            f.write(b'not really audio' * 1000)
+        with self.assertLogs('player.seekindex', 'INFO'):
+            self.assertIsNone(seekindex.load(path))
+        self.assertEqual(os.path.getsize(seekindex.seek_index_path(path)), 0)
+        # 失敗も保存してあるので、次の t 指定では走査しない
+        with self.assertNoLogs('player.seekindex', 'INFO'):
+            self.assertIsNone(seekindex.load(path))
+
+
+class PeaksTests(MediaTestCase):
+
+    def test_compute_peaks_vectorized_min_max(self):
+        class ArraySource(PCMSource):
+            def __init__(self, samples):
+                super().__init__('', 8000, len(samples))
+                self.samples = samples
+
+            def blocks(self, block_frames=65536):
+                for start in range(0, len(self.samples), 1000):
+                    yield self.samples[start:start + 1000]
+
+        samples = np.linspace(-1, 1, 2500, dtype=np.float32)
+        pairs = compute_peaks(ArraySource(samples), 100)
+        self.assertEqual(pairs.shape, (25, 2))
+        self.assertEqual(pairs.dtype, np.int8)
+        self.assertEqual(pairs[0, 0], -127)
+        self.assertEqual(pairs[-1, 1], 127)
+        self.assertTrue((pairs[:, 0] <= pairs[:, 1]).all())
+
+    def test_pyramid_levels_halve_resolution(self):
+        base = np.array([[-1, 1], [-5, 2], [-2, 9], [0, 3], [-7, 0]], dtype=np.int8)
+        levels = build_pyramid(base)
+        self.assertEqual([len(level) for level in levels], [5, 3, 2, 1])
+        self.assertEqual(levels[1].tolist(), [[-5, 2], [-2, 9], [-7, 0]])
+        self.assertEqual(levels[-1].tolist(), [[-7, 9]])
+
+    def test_upload_precomputes_peaks(self):
+        file_info = self.upload(make_wav(seconds=3.0))
+        self.assertTrue(file_info['has_peaks'])
+
+        response = self.client.get(f"/api/peaks/{file_info['id']}/")
+        self.assertEqual(response.status_code, 200)
+        body = response.content
+        magic, version, bits, level, sample_rate, spp, start_index, length = HEADER.unpack_from(body)
+        self.assertEqual(magic, b'PEAK')
+        self.assertEqual(sample_rate, 8000)
+        self.assertEqual(start_index, 0)
+        self.assertLessEqual(length, 2000)
+        self.assertEqual(len(body), HEADER.size + length * 2)
+        pairs = np.frombuffer(body, dtype=np.int8, offset=HEADER.size).reshape(-1, 2)
+        self.assertTrue((pairs[:, 0] <= pairs[:, 1]).all())
+
+    def test_window_uses_coarsest_sufficient_level(self):
+        file_info = self.upload(make_wav(seconds=3.0))
+        response = self.client.get(
+            f"/api/peaks/{file_info['id']}/", {'start': 1.0, 'end': 2.0, 'width': 10}
+        )
+        _, _, _, level, sample_rate, spp, start_index, length = HEADER.unpack_from(response.content)
+        # 1 秒 = 8000 サンプルを 10 画素で描くには 800 サンプル/ピーク以下の段が必要
+        self.assertEqual(spp, 512)
+        self.assertEqual(start_index, 8000 // 512)
+        self.assertGreaterEqual(length, 10)
+        self.assertLess(length, 40)
+
+    def test_invalid_window_is_rejected(self):
+        file_info = self.upload(make_wav())
+        response = self.client.get(f"/api/peaks/{file_info['id']}/", {'width': 'wide'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_peaks_missing_for_unknown_file(self):
+        response = self.client.get('/api/peaks/unknown/')
+        self.assertEqual(response.status_code, 404)
+
+
+class StreamingUploadTests(MediaTestCase):
+
+    def test_upload_hashes_and_sniffs_in_one_pass(self):
+        data = make_wav()
+        file_info = self.upload(data, name='recording.mp3')
+        self.assertEqual(file_info['sha256'], hashlib.sha256(data).hexdigest())
+        self.assertEqual(file_info['file_size'], len(data))
+        # 拡張子ではなく中身から判定した形式で保存される
+        self.assertTrue(file_info['filename'].endswith('.wav'))
+        with open(file_info['file_path'], 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_rejects_unsupported_extension(self):
+        upload = io.BytesIO(b'not audio')
+        upload.name = 'notes.txt'
+        response = self.client.post('/api/upload-lightweight/', {'file': upload})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('txt', response.json()['error'])
+
+    @override_settings(PLAYER_MAX_UPLOAD_SIZE=64 * 1024)
+    def test_rejects_oversized_upload_while_streaming(self):
+        upload = io.BytesIO(make_wav(seconds=10.0))
+        upload.name = 'long.wav'
+        response = self.client.post('/api/upload-lightweight/', {'file': upload})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(os.listdir(f'{self.media_root}/blobs/tmp'), [])
+
+    def test_legacy_upload_no_longer_stores_base64(self):
+        upload = io.BytesIO(make_wav())
+        upload.name = 'legacy.wav'
+        response = self.client.post('/api/upload/', {'file': upload})
+        file_info = response.json()['file']
+        self.assertNotIn('file_base64', file_info)
+        self.assertNotIn('file_base64', self.client.session['uploaded_files'][0])
+
+    def test_peak_memory_is_bounded(self):
+        # mutagen などの遅延 import を計測対象から外すため一度アップロードしておく
+        self.upload(make_wav())
+        data = make_wav(seconds=120.0, sample_rate=44100)
+        upload = io.BytesIO(data)
+        upload.name = 'large.wav'
+        request = RequestFactory().post('/api/upload-lightweight/', {'file': upload})
+        SessionMiddleware(lambda r: None).process_request(request)
+
+        tracemalloc.start()
+        try:
+            response = upload_file_lightweight(request)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual(response.status_code, 200)
+        # 10MB 超のファイルでもピークは数 MB に収まる（Base64 方式では約 3 倍）
+        self.assertLess(peak, len(data) // 4)
+
+
+@override_settings(PLAYER_UPLOAD_CHUNK_SIZE=4096)
+class ResumableUploadTests(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.data = make_wav(seconds=1.5)
+        self.sha256 = hashlib.sha256(self.data).hexdigest()
+
+    def create(self, **fields):
+        fields = {'name': 'long.wav', 'size': len(self.data), **fields}
+        return self.client.post('/api/uploads/', fields, content_type='application/json')
+
+    def put(self, upload_id, index, data=None, **extra):
+        if data is None:
+            data = self.data[index * 4096:(index + 1) * 4096]
+        return self.client.put(
+            f'/api/uploads/{upload_id}/chunks/{index}/', data,
+            content_type='application/octet-stream', **extra
+        )
+
+    def test_chunks_out_of_order_then_finalize(self):
+        response = self.create(sha256=self.sha256)
+        self.assertEqual(response.status_code, 201)
+        upload = response.json()
+        self.assertEqual(upload['chunks'], 6)
+        upload_id = upload['upload_id']
+
+        for index in (5, 0, 3, 1):
+            self.assertEqual(self.put(upload_id, index).status_code, 200)
+        status = self.client.get(f'/api/uploads/{upload_id}/').json()
+        self.assertEqual(status['received'], [0, 1, 3, 5])
+        self.assertFalse(status['complete'])
+        self.assertEqual(self.client.post(f'/api/uploads/{upload_id}/finalize/').status_code, 409)
+
+        for index in (4, 2):
+            self.put(upload_id, index)
+        response = self.client.post(f'/api/uploads/{upload_id}/finalize/')
+        self.assertEqual(response.status_code, 200, response.content)
+        file_info = response.json()['file']
+        self.assertEqual(file_info['sha256'], self.sha256)
+        self.assertEqual(file_info['title'], 'long.wav')
+        stream = self.client.get(f"/api/stream/{file_info['id']}/")
+        self.assertEqual(b''.join(stream.streaming_content), self.data)
+
+        # 取り込み後は一時領域に何も残らない
+        self.assertEqual(os.listdir(storage.staging_dir()), [])
+        self.assertEqual(self.client.get(f'/api/uploads/{upload_id}/').status_code, 404)
+
+    def test_rejects_wrong_sizes_and_checksums(self):
+        upload_id = self.create().json()['upload_id']
+        self.assertEqual(self.put(upload_id, 0, b'short').status_code, 400)
+        self.assertEqual(self.put(upload_id, 6).status_code, 400)
+        response = self.put(upload_id, 1, HTTP_X_CHUNK_SHA256='0' * 64)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.client.get(f'/api/uploads/{upload_id}/').json()['received'], [])
+
+        response = self.create(name='movie.mp4')
+        self.assertEqual(response.status_code, 400)
+        with override_settings(PLAYER_RESUMABLE_MAX_SIZE=1024):
+            self.assertEqual(self.create().status_code, 413)
+
+    def test_hash_mismatch_discards_upload(self):
+        upload_id = self.create(sha256='0' * 64).json()['upload_id']
+        for index in range(6):
+            self.put(upload_id, index)
+        response = self.client.post(f'/api/uploads/{upload_id}/finalize/')
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(AudioBlob.objects.exists())
+        self.assertEqual(os.listdir(storage.staging_dir()), [])
+
+    def test_uploads_belong_to_their_session(self):
+        upload_id = self.create().json()['upload_id']
+        other = self.client_class()
+        self.assertEqual(other.get(f'/api/uploads/{upload_id}/').status_code, 404)
+        self.assertEqual(self.put(upload_id, 0).status_code, 200)
+        self.assertEqual(self.client.get('/api/uploads/..secret/').status_code, 404)
+
+        self.assertEqual(self.client.delete(f'/api/uploads/{upload_id}/').status_code, 200)
+        self.assertEqual(os.listdir(storage.staging_dir()), [])
+
+    def test_slow_upload_survives_reaper(self):
+        upload_id = self.create().json()['upload_id']
+        # 作成から猶予時間以上経ってもチャンクが届いていれば情報ファイルも新しい
+        old = time.time() - 7200
+        for name in os.listdir(storage.staging_dir()):
+            os.utime(os.path.join(storage.staging_dir(), name), (old, old))
+        self.assertEqual(self.put(upload_id, 0).status_code, 200)
+        Reaper(quota=0, grace=3600).run_full()
+        self.assertEqual(self.client.get(f'/api/uploads/{upload_id}/').json()['received'], [0])
+
+    @override_settings(PLAYER_RESUMABLE_MAX_OPEN=2)
+    def test_open_uploads_are_limited(self):
+        self.assertEqual(self.create().status_code, 201)
+        self.assertEqual(self.create().status_code, 201)
+        self.assertEqual(self.create().status_code, 429)
+        self.assertEqual(self.client_class().post(
+            '/api/uploads/', {'name': 'long.wav', 'size': len(self.data)}, content_type='application/json'
+        ).status_code, 201)
+
+        # 確保済みの領域は容量の上限に数える
+        with override_settings(PLAYER_STORAGE_QUOTA=len(self.data) * 3 + 1):
+            self.assertGreaterEqual(storage.staged_bytes(), len(self.data) * 3)
+            self.assertEqual(self.client_class().post(
+                '/api/uploads/', {'name': 'long.wav', 'size': len(self.data)}, content_type='application/json'
+            ).status_code, 507)
+
+
+class BlobStorageTests(MediaTestCase):
+
+    def test_blob_path_is_sharded_by_hash(self):
+        data = make_wav()
+        sha256 = hashlib.sha256(data).hexdigest()
+        file_info = self.upload(data)
+        self.assertEqual(
+            file_info['file_path'],
+            os.path.join(self.media_root, 'blobs', sha256[:2], sha256[2:4], f'{sha256}.wav')
+        )
+
+    def test_identical_uploads_share_one_blob(self):
+        data = make_wav()
+        first = self.client_class()
+        second = self.client_class()
+        for client in (first, second):
+            upload = io.BytesIO(data)
+            upload.name = 'same.wav'
+            client.post('/api/upload-lightweight/', {'file': upload})
+
+        blob = AudioBlob.objects.get()
+        self.assertEqual(blob.ref_count, 2)
+        self.assertTrue(blob.has_peaks)
+        self.assertEqual(os.listdir(f'{self.media_root}/blobs/tmp'), [])
+
+        # 片方が削除しても、もう片方が参照している間は実体を残す
+        file_id = first.session['uploaded_files'][0]['id']
+        first.delete(f'/api/delete/{file_id}/')
+        blob.refresh_from_db()
+        self.assertEqual(blob.ref_count, 1)
+        self.assertTrue(os.path.exists(second.session['uploaded_files'][0]['file_path']))
+
+        file_info = second.session['uploaded_files'][0]
+        second.delete(f"/api/delete/{file_info['id']}/")
+        self.assertFalse(AudioBlob.objects.exists())
+        self.assertFalse(os.path.exists(file_info['file_path']))
+        self.assertFalse(os.path.exists(file_info['file_path'] + '.peaks'))
+
+    def test_upload_by_hash_skips_transfer(self):
+        data = make_wav()
+        sha256 = hashlib.sha256(data).hexdigest()
+        response = self.client.post(
+            '/api/upload-by-hash/', {'sha256': sha256, 'name': 'again.wav'},
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 404)
+
+        self.upload(data)
+        other = self.client_class()
+        response = other.post(
+            '/api/upload-by-hash/', {'sha256': sha256, 'name': 'again.wav'},
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['file']['title'], 'again.wav')
+        self.assertEqual(AudioBlob.objects.get().ref_count, 2)
+
+        # 行が残っていても実体が無ければ参照を増やさない
+        os.remove(storage.path_for(AudioBlob.objects.get()))
+        response = other.post(
+            '/api/upload-by-hash/', {'sha256': sha256, 'name': 'again.wav'},
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(AudioBlob.objects.get().ref_count, 2)
+
+    def staged(self, data):
+        path = storage.new_staging_path('wav')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_store_retries_when_row_disappears(self):
+        data = make_wav()
+        sha256 = hashlib.sha256(data).hexdigest()
+        get_or_create = type(AudioBlob.objects.all()).get_or_create
+        calls = []
+
+        def flaky(queryset, **kwargs):
+            # 同時に作られた行が、ロックを取る前に削除された場合と同じ例外
+            calls.append(kwargs)
+            if len(calls) == 1:
+                raise IntegrityError('UNIQUE constraint failed: player_audioblob.sha256')
+            return get_or_create(queryset, **kwargs)
+
+        with mock.patch.object(type(AudioBlob.objects.all()), 'get_or_create', flaky):
+            blob, created = storage.store_file(self.staged(data), sha256, 'wav', len(data))
+        self.assertEqual(len(calls), 2)
+        self.assertTrue(created)
+        self.assertEqual(blob.ref_count, 1)
+        self.assertTrue(os.path.exists(storage.path_for(blob)))
+
+    def test_store_and_release_keep_row_and_file_together(self):
+        data = make_wav()
+        sha256 = hashlib.sha256(data).hexdigest()
+        blob, created = storage.store_file(self.staged(data), sha256, 'wav', len(data))
+        self.assertTrue(created)
+        blob, created = storage.store_file(self.staged(data), sha256, 'mp3', len(data))
+        self.assertFalse(created)
+        self.assertEqual((blob.extension, blob.ref_count), ('wav', 2))
+
+        storage.release(sha256)
+        self.assertTrue(storage.release(sha256))
+        self.assertFalse(os.path.exists(storage.path_for(blob)))
+
+        # 実体だけ消えた行には、次の取り込みで実体を戻す
+        blob, _ = storage.store_file(self.staged(data), sha256, 'wav', len(data))
+        os.remove(storage.path_for(blob))
+        blob, created = storage.store_file(self.staged(data), sha256, 'wav', len(data))
+        self.assertTrue(created)
+        self.assertEqual(blob.ref_count, 2)
+        self.assertTrue(os.path.exists(storage.path_for(blob)))
+        self.assertEqual(os.listdir(storage.staging_dir()), [])
+
+
+def make_flac_header(sample_rate=44100, channels=2, bits=16, total_samples=441000, tags=None):
+    """STREAMINFO と VORBIS_COMMENT だけを持つ FLAC ヘッダーを生成"""
+    packed = (sample_rate << 44) | ((channels - 1) << 41) | ((bits - 1) << 36) | total_samples
+    streaminfo = struct.pack('>HH', 4096, 4096) + b'\x00' * 6 + packed.to_bytes(8, 'big') + b'\x00' * 16
+    comments = [f'{key}={value}'.encode() for key, value in (tags or {}).items()]
+    vorbis = struct.pack('<I', 6) + b'tester' + struct.pack('<I', len(comments))
+    vorbis += b''.join(struct.pack('<I', len(comment)) + comment for comment in comments)
+    return (
+        b'fLaC'
+        + bytes([0]) + len(streaminfo).to_bytes(3, 'big') + streaminfo
+        + bytes([0x84]) + len(vorbis).to_bytes(3, 'big') + vorbis
+    )
+
+
+class MetadataTests(MediaTestCase):
+
+    def write(self, name, data):
+        path = os.path.join(self.media_root, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_wav_header_probe(self):
+        path = self.write('a.wav', make_wav(seconds=2.0, sample_rate=8000, channels=2))
+        result = metadata.probe(path)
+        self.assertAlmostEqual(result['duration'], 2.0)
+        self.assertEqual(result['sample_rate'], 8000)
+        self.assertEqual(result['channels'], 2)
+        self.assertEqual(result['codec'], 'pcm_s16le')
+        self.assertEqual(result['bitrate'], 8000 * 2 * 16)
+
+    def test_flac_header_probe_reads_tags(self):
+        path = self.write('a.flac', make_flac_header(tags={'TITLE': '練習曲', 'ARTIST': 'Band'}))
+        result = metadata.probe(path)
+        self.assertAlmostEqual(result['duration'], 10.0)
+        self.assertEqual(result['channels'], 2)
+        self.assertEqual(result['codec'], 'flac')
+        self.assertEqual(result['tags'], {'title': '練習曲', 'artist': 'Band'})
+
+    def test_lookup_is_cached_per_content_hash(self):
+        path = self.write('a.wav', make_wav())
+        first = metadata.get_metadata('a' * 64, path)
+        self.assertTrue(AudioMetadata.objects.filter(sha256='a' * 64).exists())
+        with self.assertNumQueries(0):
+            self.assertIs(metadata.get_metadata('a' * 64), first)
+
+        # プロセス内キャッシュが空でも DB から返し、再解析しない
+        metadata.clear_cache()
+        os.remove(path)
+        self.assertAlmostEqual(metadata.get_metadata('a' * 64, path).duration, 1.0)
+
+    def test_probe_failure_is_recorded(self):
+        path = self.write('broken.mp3', b'not really audio')
+        with self.assertLogs('player.metadata', 'WARNING'):
+            result = metadata.get_metadata('b' * 64, path)
+        self.assertEqual(result.duration, 0)
+        self.assertNotEqual(result.probe_error, '')
+
+
+class ServerSideSessionTests(MediaTestCase):
+
+    def test_cookie_holds_only_session_id(self):
+        self.upload(make_wav())
+        cookie = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        self.assertLess(len(cookie), 64)
+
+    def test_read_only_requests_do_not_resend_cookie(self):
+        file_info = self.upload(make_wav())
+        response = self.client.get(f"/api/file-url-lightweight/{file_info['id']}/")
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, response.cookies)
+
+    def test_saving_position_does_not_rewrite_session(self):
+        file_info = self.upload(make_wav())
+        payload = {'file_id': file_info['id'], 'position': 12.5}
+        response = self.client.post('/api/save-position/', payload, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, response.cookies)
+
+    def test_saving_position_extends_session_periodically(self):
+        file_info = self.upload(make_wav())
+        session = Session.objects.get()
+        Session.objects.update(expire_date=timezone.now() + timedelta(seconds=60))
+        payload = {'file_id': file_info['id'], 'position': 12.5}
+        # 前回の保存から間隔が過ぎていればセッションを保存し直し、期限を延ばす
+        with override_settings(PLAYER_SESSION_REFRESH_INTERVAL=0):
+            response = self.client.post('/api/save-position/', payload, content_type='application/json')
+        self.assertIn(settings.SESSION_COOKIE_NAME, response.cookies)
+        session.refresh_from_db()
+        self.assertGreater(session.expire_date, timezone.now() + timedelta(seconds=settings.SESSION_COOKIE_AGE - 60))
+        self.assertEqual(self.client.session['uploaded_files'][0]['id'], file_info['id'])
+
+
+class PlaybackPositionTests(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.file_info = self.upload(make_wav())
+        self.owner = f"session:{self.client.session.session_key}"
+
+    def save(self, position, ts=None):
+        return self.client.post(
+            '/api/save-position/',
+            {'file_id': self.file_info['id'], 'position': position, 'ts': ts},
+            content_type='application/json'
+        )
+
+    def test_positions_are_coalesced_until_flush(self):
+        with self.assertNumQueries(0):
+            for second in range(20):
+                self.save(float(second), ts=1000 + second)
+        self.assertFalse(PlaybackPosition.objects.exists())
+
+        # 未書き込みでも最新の値が読める
+        response = self.client.get(f"/api/get-position/{self.file_info['id']}/")
+        self.assertEqual(response.json()['position'], 19.0)
+
+        self.assertEqual(position_buffer.flush(), 1)
+        row = PlaybackPosition.objects.get()
+        self.assertEqual((row.owner, row.file_id, row.position), (self.owner, self.file_info['id'], 19.0))
+
+    def test_flush_updates_existing_row(self):
+        self.save(3.0)
+        position_buffer.flush()
+        self.save(42.0)
+        position_buffer.flush()
+        self.assertEqual(PlaybackPosition.objects.get().position, 42.0)
+
+    def test_bulk_endpoint_keeps_latest_timestamp(self):
+        response = self.client.post('/api/save-positions/', {'positions': [
+            {'file_id': 'a', 'position': 5.0, 'ts': 2},
+            {'file_id': 'a', 'position': 1.0, 'ts': 1},
+            {'file_id': 'b', 'position': 7.0, 'ts': 1},
+        ]}, content_type='application/json')
+        self.assertEqual(response.json()['accepted'], 3)
+        position_buffer.flush()
+        positions = dict(PlaybackPosition.objects.values_list('file_id', 'position'))
+        self.assertEqual(positions, {'a': 5.0, 'b': 7.0})
+
+    def test_bulk_endpoint_validates_items(self):
+        response = self.client.post(
+            '/api/save-positions/', {'positions': [{'position': 1.0}]},
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+    def test_invalid_positions_are_rejected(self):
+        self.assertEqual(self.save(float('nan')).status_code, 400)
+        self.assertEqual(self.save(float('inf')).status_code, 400)
+        response = self.client.post('/api/save-positions/', {'positions': [
+            {'file_id': 'x' * 65, 'position': 1.0},
+        ]}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(position_buffer.pending_count(), 0)
+
+    def test_unwritable_row_does_not_block_others(self):
+        # 検証を経ずにバッファに入った不正な行だけを捨て、他の行は書き込む
+        position_buffer.record('session:other', 'broken', float('nan'))
+        self.save(12.0)
+        with self.assertLogs('player.positions', 'ERROR'):
+            self.assertEqual(position_buffer.flush(), 1)
+        self.assertEqual(position_buffer.pending_count(), 0)
+        self.assertEqual(PlaybackPosition.objects.get().position, 12.0)
+        self.save(13.0)
+        self.assertEqual(position_buffer.flush(), 1)
+
+
+@override_settings(PLAYER_BLOCKING_THREADS=0)
+class AsyncViewTests(MediaTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.data = make_wav(seconds=2.0)
+        self.file_info = self.upload(self.data)
+
+    def request(self, method, path, **extra):
+        request = getattr(AsyncRequestFactory(), method)(path, **extra)
+        request.session = self.client.session
+        request.user = AnonymousUser()
+        return request
+
+    @async_to_sync
+    async def consume(self, response):
+        return b''.join([chunk async for chunk in response.streaming_content])
+
+    def test_stream_reads_range_asynchronously(self):
+        request = self.request('get', '/', headers={'Range': 'bytes=100-4195'})
+        response = async_to_sync(async_views.stream_file)(request, self.file_info['id'])
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response.is_async)
+        self.assertEqual(self.consume(response), self.data[100:4196])
+
+    def test_stream_from_seek_time(self):
+        request = self.request('get', '/?t=1.0', headers={'Range': 'bytes=0-3'})
+        response = async_to_sync(async_views.stream_file)(request, self.file_info['id'])
+        self.assertEqual(response['X-Seek-Time'], '1.000000')
+        self.assertEqual(self.consume(response), b'RIFF')
+
+    def test_stream_rejects_unknown_file_and_method(self):
+        response = async_to_sync(async_views.stream_file)(self.request('get', '/'), 'missing')
+        self.assertEqual(response.status_code, 404)
+        response = async_to_sync(async_views.stream_file)(self.request('post', '/'), self.file_info['id'])
+        self.assertEqual(response.status_code, 405)
+
+    def test_position_views_run_offloaded(self):
+        request = self.request(
+            'post', '/', data={'file_id': self.file_info['id'], 'position': 8.5},
+            content_type='application/json'
+        )
+        self.assertEqual(async_to_sync(async_views.save_playback_position)(request).status_code, 200)
+        response = async_to_sync(async_views.get_playback_position)(self.request('get', '/'), self.file_info['id'])
+        self.assertEqual(json.loads(response.content)['position'], 8.5)
+
+
+class BlockingExecutorTests(TestCase):
+
+    def test_concurrency_is_bounded_by_pool_size(self):
+        lock = threading.Lock()
+        running = [0, 0]  # 実行中, 最大
+
+        def work():
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+
+        @async_to_sync
+        async def run_many():
+            await asyncio.gather(*[run_blocking(work) for _ in range(settings.PLAYER_BLOCKING_THREADS * 3)])
+
+        run_many()
+        self.assertLessEqual(running[1], settings.PLAYER_BLOCKING_THREADS)
+        self.assertGreater(running[1], 1)
+
+
+class ReaperTests(MediaTestCase):
+
+    def age(self, sha256, seconds=7200):
+        AudioBlob.objects.filter(sha256=sha256).update(
+            last_accessed_at=timezone.now() - timedelta(seconds=seconds)
+        )
+
+    def test_blob_of_expired_session_is_reclaimed(self):
+        file_info = self.upload(make_wav())
+        self.age(file_info['sha256'])
+        Session.objects.update(expire_date=timezone.now() - timedelta(seconds=1))
+
+        result = Reaper(quota=0).run_full()
+
+        self.assertEqual(result.expired, 1)
+        self.assertGreaterEqual(result.bytes_reclaimed, file_info['file_size'])
+        self.assertFalse(AudioBlob.objects.exists())
+        self.assertFalse(os.path.exists(file_info['file_path']))
+
+    def test_live_session_keeps_blob_and_fixes_ref_count(self):
+        file_info = self.upload(make_wav())
+        self.age(file_info['sha256'])
+        AudioBlob.objects.update(ref_count=5)
+
+        result = Reaper(quota=0).run_full()
+
+        self.assertEqual(result.bytes_reclaimed, 0)
+        self.assertEqual(AudioBlob.objects.get().ref_count, 1)
+        self.assertTrue(os.path.exists(file_info['file_path']))
+
+    def test_quota_evicts_least_recently_accessed(self):
+        old = self.upload(make_wav(seconds=1.0))
+        recent = Client()
+        upload = io.BytesIO(make_wav(seconds=1.5))
+        upload.name = 'recent.wav'
+        new = recent.post('/api/upload-lightweight/', {'file': upload}).json()['file']
+        self.age(old['sha256'], seconds=9000)
+        self.age(new['sha256'], seconds=7200)
+
+        result = Reaper(quota=new['file_size']).run_full()
+
+        self.assertEqual(result.evicted, 1)
+        self.assertEqual(list(AudioBlob.objects.values_list('sha256', flat=True)), [new['sha256']])
+
+    def test_recently_accessed_blobs_are_not_evicted(self):
+        file_info = self.upload(make_wav())
+        with self.assertLogs('player.reaper', 'WARNING'):
+            result = Reaper(quota=1).run_full()
+        self.assertEqual(result.evicted, 0)
+        self.assertTrue(os.path.exists(file_info['file_path']))
+
+    def test_orphan_files_and_stale_staging_are_removed(self):
+        orphan = storage.blob_path('ab' * 32, 'wav')
+        os.makedirs(os.path.dirname(orphan))
+        for path in (orphan, orphan + '.peaks', storage.new_staging_path('mp3')):
+            with open(path, 'wb') as f:
+                f.write(b'\0' * 100)
+            os.utime(path, (time.time() - 7200, time.time() - 7200))
+
+        result = Reaper(quota=0, batch_size=1).run_full()
+
+        self.assertEqual((result.orphaned, result.bytes_reclaimed), (3, 300))
+        self.assertEqual(os.listdir(storage.staging_dir()), [])
+
+    def test_streaming_touches_blob_at_most_once_per_interval(self):
+        file_info = self.upload(make_wav())
+        self.age(file_info['sha256'])
+        self.client.get(f"/api/stream/{file_info['id']}/", HTTP_RANGE='bytes=0-1')
+        touched = AudioBlob.objects.get().last_accessed_at
+        self.assertGreater(touched, timezone.now() - timedelta(seconds=60))
+
+        with self.assertNumQueries(0):
+            self.assertFalse(storage.touch(file_info['sha256']))
+
+    def test_command_reports_reclaimed_bytes(self):
+        output = io.StringIO()
+        call_command('reap_uploads', '--quota', '0', stdout=output)
+        self.assertIn('reclaimed=0 bytes', output.getvalue())
+
+
+class KeywordSpotterTests(MediaTestCase):
+
+    WORDS = {
+        'go_back': [300, 500, 400],
+        'stop': [700, 350, 350],
+        'play': [450, 450, 900],
+        'restart': [250, 800, 600],
+    }
+
+    def enroll(self, action, data):
+        upload = io.BytesIO(data)
+        upload.name = 'clip.wav'
+        return self.client.post('/api/voice-command/enroll/', {'action': action, 'clip': upload})
+
+    def recognize(self, data):
+        upload = io.BytesIO(data)
+        upload.name = 'clip.wav'
+        return self.client.post('/api/voice-command/clip/', {'clip': upload}).json()
+
+    def enroll_all(self):
+        for action, pitches in self.WORDS.items():
+            for stretch in (0.9, 1.1):
+                self.assertEqual(self.enroll(action, make_word(pitches, stretch=stretch)).status_code, 200)
+
+    def test_dtw_matches_reference_recursion(self):
+        rng = np.random.default_rng(1)
+        a, b = rng.standard_normal((7, 3)), rng.standard_normal((5, 3))
+        cost = np.sqrt(((a[:, None] - b[None]) ** 2).sum(axis=2))
+        table = np.full((8, 6), np.inf)
+        table[0, 0] = 0
+        for i in range(1, 8):
+            for j in range(1, 6):
+                table[i, j] = cost[i - 1, j - 1] + min(table[i - 1, j], table[i, j - 1], table[i - 1, j - 1])
+        self.assertAlmostEqual(keywords.dtw_distance(a, b), table[7, 5] / 12, places=5)
+
+    def test_enrolled_commands_are_recognized(self):
+        self.enroll_all()
+        for action, pitches in self.WORDS.items():
+            result = self.recognize(make_word(pitches, stretch=1.25, noise=0.03, gain=0.2, seed=2))
+            self.assertTrue(result['success'], result)
+            self.assertEqual(result['command'], action)
+            self.assertIn('elapsed_ms', result)
+
+    def test_unknown_sound_is_rejected(self):
+        self.enroll_all()
+        result = self.recognize(make_word([1200, 150, 1000]))
+        self.assertFalse(result['success'])
+
+    def test_reports_when_nothing_is_enrolled(self):
+        result = self.recognize(make_word(self.WORDS['stop']))
+        self.assertEqual(result['message'], '音声コマンドが登録されていません')
+        self.assertFalse(result['enrolled'])
+
+    def test_templates_per_action_are_capped(self):
+        with override_settings(PLAYER_KWS_MAX_TEMPLATES_PER_ACTION=2):
+            for seed in range(4):
+                self.assertEqual(self.enroll('stop', make_word(self.WORDS['stop'], seed=seed)).status_code, 200)
+            self.enroll('play', make_word(self.WORDS['play']))
+        owner = f"session:{self.client.session.session_key}"
+        counts = dict(VoiceTemplate.objects.filter(owner=owner).values_list('action').annotate(n=Count('id')))
+        self.assertEqual(counts, {'stop': 2, 'play': 1})
+        self.assertEqual(len(keywords.template_cache.get(owner)), 3)
+
+    def test_shared_templates_are_loaded_from_directory(self):
+        root = os.path.join(self.media_root, 'voice_templates')
+        for action, pitches in self.WORDS.items():
+            os.makedirs(os.path.join(root, action))
+            for stretch in (0.9, 1.1):
+                with open(os.path.join(root, action, f'{stretch}.wav'), 'wb') as f:
+                    f.write(make_word(pitches, stretch=stretch))
+        call_command('loadvoicetemplates', root, stdout=io.StringIO())
+        call_command('loadvoicetemplates', root, stdout=io.StringIO())  # 読み直しても増えない
+        self.assertEqual(VoiceTemplate.objects.filter(owner='').count(), 8)
+
+        # 自分では何も登録していなくても共通の登録音声で認識できる
+        result = self.recognize(make_word(self.WORDS['play'], stretch=1.25, noise=0.03, gain=0.2, seed=2))
+        self.assertEqual(result['command'], 'play')
+
+    def test_invalid_clip_is_rejected(self):
+        self.assertEqual(self.enroll('stop', b'not a wav').status_code, 400)
+        self.assertEqual(self.enroll('dance', make_word([400])).status_code, 400)
+
+    def test_template_cache_follows_model_changes(self):
+        self.enroll('stop', make_word(self.WORDS['stop']))
+        owner = f"session:{self.client.session.session_key}"
+        self.assertEqual(len(keywords.template_cache.get(owner)), 1)
+
+        features = keywords.mfcc(keywords.decode_clip(make_word(self.WORDS['play'])))
+        VoiceTemplate.objects.create(action='play', owner='', features=features.tobytes(), frames=len(features))
+        self.assertEqual(len(keywords.template_cache.get(owner)), 2)
+
+        self.client.delete('/api/voice-command/templates/')
+        self.assertEqual(len(keywords.template_cache.get(owner)), 1)
+
+    def test_template_cache_is_bounded_and_expires(self):
+        self.enroll('stop', make_word(self.WORDS['stop']))
+        owner = f"session:{self.client.session.session_key}"
+        cache = keywords.TemplateCache(maxsize=2)
+        for index in range(5):
+            cache.get(f'session:other{index}')
+        self.assertEqual(len(cache._owners), 2)
+
+        # 他のプロセスでの変更（シグナルが届かない）は有効期間が過ぎれば反映される
+        self.assertEqual([action for action, _ in cache.get(owner)], ['stop'])
+        VoiceTemplate.objects.filter(owner=owner).update(action='play')
+        self.assertEqual([action for action, _ in cache.get(owner)], ['stop'])
+        with override_settings(PLAYER_KWS_CACHE_TTL=0):
+            self.assertEqual([action for action, _ in cache.get(owner)], ['play'])
+
+
+class CommandMatcherTests(TestCase):
+
+    def setUp(self):
+        matcher.invalidate()
+        self.user = User.objects.create_user('dancer', password='pass')
+
+    def match(self, text, user=None, **kwargs):
+        result = matcher.get_matcher(user).match(text, **kwargs)
+        return result.action if result else None
+
+    def test_normalize_unifies_kana_and_width(self):
+        self.assertEqual(matcher.normalize('ストップ！ ＡＢ'), 'すとっぷab')
+
+    def test_automaton_finds_same_patterns_as_substring_search(self):
+        rng = np.random.default_rng(3)
+        alphabet = 'あいうえお'
+        patterns = {''.join(rng.choice(list(alphabet), size=rng.integers(1, 4))) for _ in range(15)}
+        automaton = matcher.CommandMatcher([(pattern, 'x', 0) for pattern in patterns])
+        for _ in range(20):
+            text = ''.join(rng.choice(list(alphabet), size=12))
+            self.assertEqual(automaton.find_all(text), {p for p in patterns if p in text})
+
+    def test_default_commands_keep_their_priority(self):
+        self.assertEqual(self.match('再生を停止して'), 'stop')
+        self.assertEqual(self.match('最初から再生'), 'restart')
+        self.assertEqual(self.match('スタート'), 'play')
+        self.assertIsNone(self.match('こんにちは', fuzzy=False))
+
+    def test_user_commands_override_defaults(self):
+        VoiceCommand.objects.create(command='ストップ', action='play', user=self.user)
+        VoiceCommand.objects.create(command='もう一回', action='restart', user=None)
+        VoiceCommand.objects.create(command='休憩', action='stop', user=None, is_active=False)
+
+        self.assertEqual(self.match('すとっぷ', user=self.user), 'play')
+        self.assertEqual(self.match('すとっぷ'), 'stop')
+        self.assertEqual(self.match('もう一回お願い'), 'restart')
+        self.assertIsNone(self.match('休憩', fuzzy=False))
+
+    def test_cache_is_invalidated_by_signals(self):
+        self.assertIsNone(self.match('ワンモア', user=self.user, fuzzy=False))
+        command = VoiceCommand.objects.create(command='ワンモア', action='restart', user=self.user)
+        self.assertEqual(self.match('わんもあ', user=self.user), 'restart')
+        command.delete()
+        self.assertIsNone(self.match('わんもあ', user=self.user, fuzzy=False))
+
+    def test_fuzzy_match_tolerates_one_edit(self):
+        result = matcher.get_matcher().match('もどっで', fuzzy=True)
+        self.assertEqual((result.action, result.distance), ('go_back', 1))
+        self.assertIsNone(self.match('もどっで', fuzzy=False))
+        self.assertIsNone(self.match('もどっで'))  # 既定では完全一致のみ
+        # 長さの違うテキストとは比べない（長い文章でテキストの長さに比例した計算をしない）
+        self.assertIsNone(matcher.get_matcher().match('あ' * 1000 + 'もどっで', fuzzy=True))
+
+    def test_match_endpoint(self):
+        response = self.client.post('/api/voice-command/match/', {'text': 'ちょっと戻って'}, content_type='application/json')
+        self.assertEqual(response.json()['command'], 'go_back')
+        response = self.client.post('/api/voice-command/match/', {'text': ''}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class BenchmarkTests(MediaTestCase):
+    def test_client_benchmark_report(self):
+        bench = benchmark.Benchmark(
+            durations=(1,), iterations=2, upload_iterations=1, memory_iterations=1,
+        )
+        report = bench.run(('client',))
+
+        self.assertEqual(set(report), {'environment', 'options', 'fixtures', 'results'})
+        results = report['results']['client']
+        for name in ('upload:flac:1s', 'upload-resumable:mp3:1s', 'stream:seek', 'voice:clip'):
+            self.assertIn(name, results)
+        for name, result in results.items():
+            self.assertEqual(result['errors'], 0, name)
+            self.assertIn('p99_ms', result)
+            self.assertIn('tracemalloc_peak', result)
+
+        slower = json.loads(json.dumps(report))
+        slower['results']['client']['stream:seek']['p50_ms'] *= 2
+        regressions = benchmark.compare(report, slower)
+        self.assertEqual([name for _, name, *_ in regressions], ['stream:seek'])
+        self.assertEqual(benchmark.compare(slower, report), [])
+
+    def test_asgi_transport_resolves_async_views(self):
+        self.addCleanup(benchmark._use_async_views, settings.PLAYER_ASYNC_VIEWS)
+        benchmark._use_async_views(True)
+        match = resolve('/api/stream/x/')
+        self.assertIs(match.func, async_views.stream_file)
+        self.assertTrue(asyncio.iscoroutinefunction(match.func))
+        benchmark._use_async_views(False)
+        self.assertIs(resolve('/api/stream/x/').func, views.stream_file)
+
+
+class MetricsTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.metrics_dir = tempfile.mkdtemp()
+        self.metrics_override = override_settings(PLAYER_METRICS_DIR=self.metrics_dir, PLAYER_METRICS_TOKEN='', DEBUG=True)
+        self.metrics_override.enable()
+
+    def tearDown(self):
+        self.metrics_override.disable()
+        shutil.rmtree(self.metrics_dir, ignore_errors=True)
+        super().tearDown()
+
+    def test_middleware_records_route_and_server_timing(self):
+        response = self.client.get('/test-api/')
+        self.assertRegex(response['Server-Timing'], r'^app;dur=\d+\.\d$')
+        file_info = self.upload(make_wav(seconds=1.0))
+        response = self.client.get(f"/api/stream/{file_info['id']}/?t=0.2")
+        self.assertIn('seek;dur=', response['Server-Timing'])
+
+        text = self.client.get('/metrics').content.decode()
+        self.assertIn('player_request_duration_seconds_count{route="test-api/",method="GET"} 1', text)
+        self.assertIn('player_requests_total{route="api/upload-lightweight/",method="POST",status="200"} 1', text)
+        self.assertIn('player_request_duration_seconds_bucket{route="test-api/",method="GET",le="+Inf"} 1', text)
+        self.assertIn('player_stage_duration_seconds_count{stage="jobs"} 1', text)
+        # /metrics 自身の処理中の 1 件だけが残る
+        self.assertIn('player_requests_in_flight 1', text)
+
+    def test_values_from_exited_workers_are_archived(self):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                metrics.REQUESTS.inc('test-api/', 'GET', 200, amount=3)
+                metrics.IN_FLIGHT.inc()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+        metrics.REQUESTS.inc('test-api/', 'GET', 200)
+
+        key = metrics._key('player_requests_total', '', ['test-api/', 'GET', '200'])
+        totals = metrics.collect()
+        self.assertEqual(totals[key], 4)
+        self.assertEqual(totals[metrics._key('player_requests_in_flight', '', [])], 0)
+        self.assertEqual(sorted(os.listdir(self.metrics_dir)), ['.lock', f'{os.getpid()}.db', 'archive.db'])
+        self.assertEqual(metrics.collect()[key], 4)
+
+    def test_value_file_grows(self):
+        path = os.path.join(self.metrics_dir, 'grow.db')
+        values = metrics.ValueFile(path)
+        for i in range(3000):
+            values.add(f'key-{i}', i)
+        values.add('key-1', 0.5)
+        values.close()
+        self.assertGreater(os.path.getsize(path), metrics.INITIAL_SIZE)
+        loaded = metrics.read_values(path)
+        self.assertEqual((len(loaded), loaded['key-1'], loaded['key-2999']), (3000, 1.5, 2999))
+
+    @override_settings(PLAYER_METRICS_TOKEN='secret')
+    def test_metrics_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+
+    @override_settings(DEBUG=False)
+    def test_metrics_are_private_without_token_in_production(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        staff = User.objects.create_user('ops', password='pw', is_staff=True)
+        self.client.force_login(staff)
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+
+class TracingTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.trace_dir = tempfile.mkdtemp()
+        self.trace_file = os.path.join(self.trace_dir, 'traces.jsonl')
+        self.trace_override = override_settings(PLAYER_TRACE_FILE=self.trace_file, PLAYER_TRACE_SAMPLE_RATE=1.0)
+        self.trace_override.enable()
+
+    def tearDown(self):
+        self.trace_override.disable()
+        shutil.rmtree(self.trace_dir, ignore_errors=True)
+        super().tearDown()
+
+    def test_upload_trace_contains_pipeline_stages(self):
+        self.upload(make_wav())
+        self.upload(make_wav(seconds=2.0))
+
+        traces = list(tracing.read_traces(self.trace_file))
+        self.assertEqual([trace['name'] for trace in traces], ['api/upload-lightweight/'] * 2)
+        spans = {item['name']: item for item in traces[1]['spans']}
+        for name in ('upload.receive', 'store', 'metadata', 'metadata.probe', 'jobs', 'job.peaks', 'job.seekindex',
+                     'upload.release_previous', 'session.save'):
+            self.assertIn(name, spans)
+        self.assertEqual(spans['metadata.probe']['parent'], spans['metadata']['id'])
+        self.assertEqual(spans['upload.release_previous']['attrs'], {'files': 1})
+        self.assertGreater(spans['upload.receive']['attrs']['bytes'], 0)
+
+        out = io.StringIO()
+        call_command('trace_summary', '--file', self.trace_file, '--slowest', '1', stdout=out)
+        self.assertIn('2 traces', out.getvalue())
+        self.assertIn('upload.receive', out.getvalue())
+
+    def test_spans_follow_into_blocking_pool(self):
+        def work():
+            with tracing.span('pool.work'):
+                return threading.current_thread().name
+
+        trace = tracing.Trace('test')
+        token = tracing._trace.set(trace)
+        try:
+            thread_name = async_to_sync(run_blocking)(work)
+        finally:
+            tracing._trace.reset(token)
+        self.assertTrue(thread_name.startswith('player-blocking'))
+        self.assertEqual([item['name'] for item in trace.spans], ['pool.work'])
+
+    @override_settings(PLAYER_TRACE_SAMPLE_RATE=0.0)
+    def test_disabled_tracing_is_a_noop(self):
+        self.assertIs(tracing.span('anything'), tracing.NOOP_SPAN)
+        self.client.get('/test-api/')
+        self.assertFalse(os.path.exists(self.trace_file))
+
+    @override_settings(PLAYER_TRACE_MAX_BYTES=1000, PLAYER_TRACE_BACKUPS=2)
+    def test_trace_file_rotation(self):
+        for number in range(40):
+            tracing.writer.write({'name': 'r', 'number': number, 'duration_ms': 1.0, 'spans': []})
+        self.assertEqual(
+            sorted(os.listdir(self.trace_dir)),
+            ['traces.jsonl', 'traces.jsonl.1', 'traces.jsonl.2', 'traces.jsonl.lock'],
+        )
+        numbers = [trace['number'] for trace in tracing.read_traces(self.trace_file)]
+        self.assertEqual(numbers, sorted(numbers))
+        self.assertEqual(numbers[-1], 39)
+        self.assertTrue(all(os.path.getsize(path) <= 1000 for path in tracing.trace_files(self.trace_file)))
+
+
+def _failing_job(path, info):
+    raise RuntimeError('broken decoder')
+
+
+def _sleeping_job(path, info):
+    time.sleep(30)
+
+
+class JobQueueTests(MediaTestCase):
+    BUILTIN_JOBS = len(jobs.JOB_TYPES)
+
+    def register(self, kind, func, **kwargs):
+        jobs.register(kind, **kwargs)(func)
+        self.addCleanup(jobs.JOB_TYPES.pop, kind)
+
+    def test_jobs_run_inline_without_background_workers(self):
+        file_info = self.upload(make_wav())
+        self.assertTrue(file_info['has_peaks'])
+        response = self.client.get(f"/api/jobs/{file_info['id']}/").json()
+        self.assertFalse(response['pending'])
+        self.assertEqual(response['jobs']['peaks']['status'], 'done')
+        self.assertEqual(response['jobs']['seekindex']['result'], {'has_seek_index': True})
+
+    @override_settings(PLAYER_BACKGROUND_JOBS=True)
+    def test_upload_returns_before_jobs_run(self):
+        file_info = self.upload(make_wav())
+        self.assertFalse(file_info['has_peaks'])
+        self.assertTrue(self.client.get(f"/api/jobs/{file_info['id']}/").json()['pending'])
+
+        self.assertEqual(jobs.run_pending(), self.BUILTIN_JOBS)
+        self.assertTrue(AudioBlob.objects.get(pk=file_info['sha256']).has_peaks)
+        self.assertFalse(self.client.get(f"/api/jobs/{file_info['id']}/").json()['pending'])
+
+    @override_settings(PLAYER_BACKGROUND_JOBS=True, PLAYER_JOB_MAX_ATTEMPTS=2)
+    def test_failed_jobs_are_retried_with_backoff(self):
+        self.register('broken', _failing_job)
+        blob = AudioBlob.objects.get(pk=self.upload(make_wav())['sha256'])
+        jobs.enqueue(blob, ['broken'])
+
+        with self.assertLogs('player.jobs', 'WARNING'):
+            jobs.run_pending(kind='broken')
+        job = Job.objects.get(kind='broken')
+        self.assertEqual((job.status, job.attempts), (Job.QUEUED, 1))
+        self.assertIn('broken decoder', job.error)
+        self.assertGreater(job.run_after, timezone.now())
+        self.assertEqual(jobs.run_pending(kind='broken'), 0)  # 待ち時間が過ぎるまで取り出さない
+
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        with self.assertLogs('player.jobs', 'WARNING'):
+            jobs.run_pending(kind='broken')
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.FAILED, 2))
+
+    @override_settings(PLAYER_BACKGROUND_JOBS=True)
+    def test_worker_pool_kills_jobs_over_time_limit(self):
+        self.register('sleepy', _sleeping_job, timeout=0.5)
+        blob = AudioBlob.objects.get(pk=self.upload(make_wav())['sha256'])
+        jobs.enqueue(blob, ['sleepy'])
+
+        pool = jobs.WorkerPool(processes=2, poll_interval=0.05, log=lambda message: None)
+        pool.start()
+        try:
+            deadline = time.monotonic() + 20
+            with self.assertLogs('player.jobs', 'WARNING'):
+                while (pool.completed, pool.failed) != (self.BUILTIN_JOBS, 1) and time.monotonic() < deadline:
+                    pool.run_once()
+        finally:
+            pool.shutdown()
+
+        self.assertTrue(AudioBlob.objects.get(pk=blob.pk).has_peaks)
+        sleepy = Job.objects.get(kind='sleepy')
+        self.assertEqual((sleepy.status, sleepy.attempts), (Job.QUEUED, 1))
+        self.assertIn('timed out', sleepy.error)
+        self.assertEqual(Job.objects.filter(status=Job.DONE).count(), self.BUILTIN_JOBS)
+
+    def test_stale_running_jobs_are_reclaimed(self):
+        blob = AudioBlob.objects.get(pk=self.upload(make_wav())['sha256'])
+        Job.objects.filter(blob=blob, kind='peaks').update(
+            status=Job.RUNNING, attempts=1, locked_by='gone:1',
+            locked_at=timezone.now() - timedelta(seconds=settings.PLAYER_JOB_TIMEOUT + 120),
+        )
+        with self.assertLogs('player.jobs', 'WARNING'):
+            self.assertEqual(jobs.reclaim_stale(), 1)
+        self.assertEqual(Job.objects.get(blob=blob, kind='peaks').status, Job.QUEUED)
+
+
+class MusicAnalysisTests(MediaTestCase):
+    PARTS = [(20, 220.0), (20, 1500.0), (20, 220.0)]
+
+    def test_tempo_beats_and_sections_of_click_track(self):
+        path = os.path.join(self.media_root, 'clicks.wav')
+        with open(path, 'wb') as f:
+            f.write(synth.click_wav_bytes(self.PARTS, bpm=128))
+
+        result = analysis.analyze(path)
+        self.assertAlmostEqual(result['bpm'], 128, delta=1)
+        self.assertAlmostEqual(np.median(np.diff(result['beat_times'])), 60 / 128, delta=0.02)
+        starts = [section['start'] for section in result['sections']]
+        self.assertEqual(len(starts), 3)
+        np.testing.assert_allclose(starts, [0, 20, 40], atol=0.5)
+        self.assertEqual([section['label'] for section in result['sections']], ['A', 'B', 'A'])
+
+    def test_no_tempo_without_periodic_onsets(self):
+        path = os.path.join(self.media_root, 'tone.wav')
+        with open(path, 'wb') as f:
+            f.write(synth.wav_bytes(3.0))
+        result = analysis.analyze(path)
+        self.assertIsNone(result['bpm'])
+        self.assertEqual(result['sections'], [{'start': 0.0, 'end': 3.0, 'label': 'A'}])
+
+    def test_go_back_jumps_to_previous_section(self):
+        file_info = self.upload(synth.click_wav_bytes(self.PARTS, bpm=128))
+        self.assertTrue(MusicAnalysis.objects.filter(sha256=file_info['sha256']).exists())
+        self.assertAlmostEqual(self.client.get(f"/api/analysis/{file_info['id']}/").json()['bpm'], 128, delta=1)
+
+        def go_back(position):
+            return self.client.post('/api/voice-command/match/', {
+                'text': '戻って', 'file_id': file_info['id'], 'position': position,
+            }, content_type='application/json').json()
+
+        self.assertAlmostEqual(go_back(45.0)['seek_to'], 40, delta=0.5)
+        # 境界の直後ならもう 1 つ前のセクションへ
+        self.assertAlmostEqual(go_back(41.0)['seek_to'], 20, delta=0.5)
+        self.assertEqual(go_back(5.0)['seek_to'], 0.0)
+        response = self.client.post('/api/voice-command/match/', {'text': '戻って'}, content_type='application/json')
+        self.assertNotIn('seek_to', response.json())
+
+
+class LoudnessTests(MediaTestCase):
+    def measure(self, samples, sample_rate=48000, chunk=4096):
+        meter = loudness.LoudnessMeter(sample_rate, samples.shape[1])
+        for start in range(0, len(samples), chunk):
+            meter.add(samples[start:start + chunk])
+        return meter
+
+    def sine(self, seconds=10, sample_rate=48000, frequency=1000.0, amplitude=0.1, phase=0.0):
+        t = np.arange(int(seconds * sample_rate)) / sample_rate
+        return amplitude * np.sin(2 * np.pi * frequency * t + phase)
+
+    def test_integrated_loudness_of_reference_sine(self):
+        # BS.1770: 1 kHz の正弦波は 2 チャンネルで振幅（dBFS）と同じ LUFS、1 チャンネルでは 3 dB 小さい
+        tone = self.sine()
+        stereo = self.measure(np.stack([tone, tone], axis=1))
+        self.assertAlmostEqual(stereo.integrated(), -20.0, delta=0.05)
+        self.assertAlmostEqual(stereo.true_peak_db(), -20.0, delta=0.05)
+        self.assertAlmostEqual(self.measure(tone[:, None], chunk=1000).integrated(), -23.01, delta=0.05)
+
+        # 無音の区間はゲートで除かれる
+        gated = np.concatenate([tone, np.zeros_like(tone)])
+        self.assertAlmostEqual(self.measure(gated[:, None]).integrated(), -23.01, delta=0.1)
+        self.assertIsNone(self.measure(np.zeros((48000, 2))).integrated())
+
+    def test_true_peak_finds_inter_sample_peaks(self):
+        # fs/4 の正弦波を 45° ずらすとサンプル値は振幅の 1/√2 にしかならない
+        tone = self.sine(seconds=1, frequency=12000.0, amplitude=0.9, phase=np.pi / 4)
+        meter = self.measure(tone[:, None])
+        self.assertAlmostEqual(20 * np.log10(meter.sample_peak), 20 * np.log10(0.9 / np.sqrt(2)), delta=0.05)
+        self.assertAlmostEqual(meter.true_peak_db(), 20 * np.log10(0.9), delta=0.2)
+
+    def test_gain_is_returned_with_file_info(self):
+        file_info = self.upload(synth.wav_bytes(5.0, sample_rate=22050))
+        measured = AudioLoudness.objects.get(pk=file_info['sha256'])
+        self.assertLess(measured.integrated, -3)
+
+        response = self.client.get(f"/api/file-url-lightweight/{file_info['id']}/").json()
+        self.assertEqual(response['file_info']['duration'], 5)
+        self.assertAlmostEqual(response['file_info']['gain_db'], -18 - measured.integrated, delta=0.01)
+
+        # 目標まで上げるとトゥルーピークが上限を超える場合は上限で止める
+        with self.settings(PLAYER_LOUDNESS_TARGET=0.0):
+            response = self.client.get(f"/api/file-url-lightweight/{file_info['id']}/").json()
+        self.assertAlmostEqual(response['file_info']['gain_db'], -1.0 - measured.true_peak, delta=0.01)
+
+
+class FingerprintTests(MediaTestCase):
+    def melody_wav(self, seed=1, sample_rate=44100, bits=16, lead=0.0, gain=1.0):
+        samples = np.concatenate([np.zeros(int(lead * sample_rate)), gain * synth.melody(30.0, sample_rate, seed=seed)])
+        return synth.pcm_wav_bytes(samples[:, None], sample_rate, bits)
+
+    def test_reencoded_audio_matches_indexed_track(self):
+        original = self.upload(self.melody_wav())
+        indexed = AudioFingerprint.objects.get(sha256=original['sha256'])
+        self.assertIsNone(indexed.track)
+        self.assertEqual(FingerprintHash.objects.count(), indexed.hashes)
+
+        # サンプリングレート・ビット数・音量が違い、先頭に 0.5 秒の無音がある（元の音声も残す）
+        copy = self.upload(self.melody_wav(sample_rate=22050, bits=8, lead=0.5, gain=0.5), client=self.client_class())
+        matched = AudioFingerprint.objects.get(sha256=copy['sha256'])
+        self.assertEqual(matched.track, indexed)
+        self.assertAlmostEqual(matched.offset, -0.5, delta=0.05)
+        self.assertGreaterEqual(matched.matches, fingerprint.MIN_MATCHES)
+        # 同じ録音の版は索引に加えない
+        self.assertEqual(FingerprintHash.objects.count(), indexed.hashes)
+
+        other = self.upload(self.melody_wav(seed=2), client=self.client_class())
+        self.assertIsNone(AudioFingerprint.objects.get(sha256=other['sha256']).track)
+
+    def test_released_audio_hands_index_to_remaining_version(self):
+        original = self.upload(self.melody_wav())
+        hashes = AudioFingerprint.objects.get(sha256=original['sha256']).hashes
+        copies = [self.client_class(), self.client_class()]
+        first = self.upload(self.melody_wav(sample_rate=22050, lead=0.5), client=copies[0])
+        second = self.upload(self.melody_wav(sample_rate=16000, lead=1.0), client=copies[1])
+        self.client.post('/api/save-position/', {'file_id': original['id'], 'position': 12.0}, content_type='application/json')
+        position_buffer.flush()
+
+        self.client.delete(f"/api/delete/{original['id']}/")
+        self.assertFalse(AudioFingerprint.objects.filter(sha256=original['sha256']).exists())
+        heir = AudioFingerprint.objects.get(sha256=first['sha256'])
+        self.assertEqual((heir.track, heir.offset), (None, 0.0))
+        self.assertEqual(FingerprintHash.objects.filter(fingerprint=heir).count(), hashes)
+        shifts = fingerprint.versions(second['sha256'])
+        self.assertEqual(set(shifts), {first['sha256'], second['sha256']})
+        self.assertAlmostEqual(shifts[first['sha256']], 0.5, delta=0.05)
+        # 削除した音声の再生位置は残った版の時刻に直して引き継ぐ
+        moved = PlaybackPosition.objects.get(file_id=original['id'])
+        self.assertEqual(moved.sha256, first['sha256'])
+        self.assertAlmostEqual(moved.position, 12.5, delta=0.05)
+
+        # 付け替えた索引でも同じ録音として見つかる
+        third = self.upload(self.melody_wav(lead=0.25), client=self.client_class())
+        matched = AudioFingerprint.objects.get(sha256=third['sha256'])
+        self.assertEqual(matched.track, heir)
+        self.assertAlmostEqual(matched.offset, 0.25, delta=0.05)
+
+        for client, file_info in zip(copies, (first, second)):
+            client.delete(f"/api/delete/{file_info['id']}/")
+        self.assertEqual(set(AudioFingerprint.objects.values_list('sha256', flat=True)), {third['sha256']})
+
+    def test_matched_audio_inherits_analysis_and_position(self):
+        original = self.upload(self.melody_wav())
+        self.client.post('/api/save-position/', {'file_id': original['id'], 'position': 12.0}, content_type='application/json')
+        position_buffer.flush()
+
+        copy = self.upload(self.melody_wav(sample_rate=22050, lead=0.5))
+        statuses = jobs.statuses(copy['sha256'])
+        self.assertEqual(statuses['analysis']['result'], {'inherited': True})
+        self.assertEqual(statuses['loudness']['result'], {'inherited': True})
+
+        source = MusicAnalysis.objects.get(pk=original['sha256'])
+        inherited = MusicAnalysis.objects.get(pk=copy['sha256'])
+        self.assertEqual(inherited.bpm, source.bpm)
+        np.testing.assert_allclose(inherited.beat_times[:5], np.array(source.beat_times[:5]) + 0.5, atol=0.05)
+        self.assertEqual(
+            AudioLoudness.objects.get(pk=copy['sha256']).integrated,
+            AudioLoudness.objects.get(pk=original['sha256']).integrated,
+        )
+
+        # 別のファイルID でも、同じ録音で再生した位置（時刻のずれを合わせて）から再開する
+        position = self.client.get(f"/api/get-position/{copy['id']}/").json()['position']
+        self.assertAlmostEqual(position, 12.5, delta=0.05)
+
+
+class ArtworkTests(MediaTestCase):
+    def picture(self, size=(600, 400), format='JPEG', mode='RGB'):
+        buffer = io.BytesIO()
+        Image.new(mode, size, (200, 40, 40)).save(buffer, format)
+        return buffer.getvalue()
+
+    def mp3_with_picture(self, picture, seed=0):
+        path = os.path.join(self.media_root, f'cover-{seed}.mp3')
+        with open(path, 'wb') as f:
+            f.write(synth.mp3_bytes(1.0, id3=False, seed=seed))
+        tags = ID3()
+        tags.add(APIC(encoding=3, mime='image/jpeg', type=3, desc='cover', data=picture))
+        tags.save(path)
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_thumbnails_are_served_immutable(self):
+        file_info = self.upload(self.mp3_with_picture(self.picture()), name='cover.mp3')
+        stored = AudioArtwork.objects.get(pk=file_info['sha256'])
+        self.assertEqual((stored.width, stored.height), (600, 400))
+        self.assertEqual(stored.sizes, [64, 128, 256, 512])
+
+        thumbnails = self.client.get(f"/api/file-url-lightweight/{file_info['id']}/").json()['file_info']['artwork']
+        self.assertEqual([thumbnail['size'] for thumbnail in thumbnails], [64, 128, 256, 512])
+        response = self.client.get(thumbnails[2]['webp'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/webp')
+        self.assertIn('immutable', response['Cache-Control'])
+        with Image.open(io.BytesIO(b''.join(response.streaming_content))) as image:
+            self.assertEqual((image.format, image.size), ('WEBP', (256, 171)))
+
+        response = self.client.get(thumbnails[0]['jpg'], HTTP_IF_NONE_MATCH=f'"{stored.artwork}-64"')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self.client.get(f"/api/artwork/{'0' * 64}/64.webp").status_code, 404)
+
+    def test_same_picture_is_rendered_once(self):
+        picture = self.picture(size=(100, 100), format='PNG', mode='RGBA')
+        first = self.upload(self.mp3_with_picture(picture, seed=1), name='a.mp3')
+        second = self.upload(self.mp3_with_picture(picture, seed=2), name='b.mp3')
+        keys = AudioArtwork.objects.filter(sha256__in=[first['sha256'], second['sha256']]).values_list('artwork', flat=True)
+        self.assertEqual(len(set(keys)), 1)
+        # 元の画像より大きいサムネイルは作らない
+        self.assertEqual(AudioArtwork.objects.get(pk=second['sha256']).sizes, [64])
+        self.assertEqual(len(os.listdir(os.path.dirname(artwork.thumbnail_path(keys[0], 64, 'jpg')))), 2)
+        # 2 曲目のアップロードで解放された 1 曲目の AudioArtwork は残らない
+        self.assertFalse(AudioArtwork.objects.filter(pk=first['sha256']).exists())
+
+    def test_unreferenced_thumbnails_are_reaped(self):
+        picture = self.picture(size=(100, 100))
+        self.upload(self.mp3_with_picture(picture, seed=1), name='a.mp3')
+        other = self.client_class()
+        upload = io.BytesIO(self.mp3_with_picture(picture, seed=2))
+        upload.name = 'b.mp3'
+        shared = other.post('/api/upload-lightweight/', {'file': upload}).json()['file']
+        key = AudioArtwork.objects.get(pk=shared['sha256']).artwork
+        directory = os.path.dirname(artwork.thumbnail_path(key, 64, 'jpg'))
+        self.upload(make_wav())  # 1 曲目を解放する
+        old = time.time() - 3600
+        for name in os.listdir(directory):
+            os.utime(os.path.join(directory, name), (old, old))
+
+        # まだ 2 曲目が同じ画像を参照している
+        Reaper(quota=0, grace=60).run_full()
+        self.assertEqual(len(os.listdir(directory)), 2)
+
+        other.delete(f"/api/delete/{shared['id']}/")
+        self.assertFalse(AudioArtwork.objects.filter(artwork=key).exists())
+        result = Reaper(quota=0, grace=60).run_full()
+        self.assertEqual(result.orphaned, 2)
+        self.assertEqual(os.listdir(directory), [])
+
+    def test_audio_without_picture(self):
+        file_info = self.upload(make_wav())
+        self.assertEqual(AudioArtwork.objects.get(pk=file_info['sha256']).artwork, '')
+        response = self.client.get(f"/api/file-url-lightweight/{file_info['id']}/").json()
+        self.assertIsNone(response['file_info']['artwork'])
+
+
+class LibraryTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('dancer', password='pass')
+        self.client.force_login(self.user)
+
+    def add_tracks(self, titles, user=None):
+        """アップロードを経ずに曲を追加する（uploaded_at は 1 分ずつずらす）"""
+        start = timezone.now() - timedelta(days=1)
+        tracks = MusicFile.objects.bulk_create([
+            MusicFile(user=user or self.user, title=title, title_key=normalize_title(title))
+            for title in titles
+        ])
+        for index, track in enumerate(tracks):
+            MusicFile.objects.filter(pk=track.pk).update(uploaded_at=start + timedelta(minutes=index))
+        return tracks
+
+    def pages(self, **params):
+        titles, cursor = [], None
+        while True:
+            response = self.client.get('/api/library/', {**params, **({'cursor': cursor} if cursor else {})})
+            self.assertEqual(response.status_code, 200, response.content)
+            data = response.json()
+            titles.append([track['title'] for track in data['tracks']])
+            cursor = data['next_cursor']
+            if cursor is None:
+                return titles
+
+    def test_add_session_file_and_stream_it(self):
+        file_info = self.upload(make_wav(), name='first.wav')
+        response = self.client.post('/api/library/', {'file_id': file_info['id'], 'title': 'First'}, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        track = response.json()['track']
+        self.assertEqual(AudioBlob.objects.get(pk=file_info['sha256']).ref_count, 2)
+
+        # 次のアップロードでセッションのファイルが解放されてもライブラリの曲は残る
+        self.upload(make_wav(seconds=2.0), name='second.wav')
+        self.assertEqual(self.client.get(track['stream_url']).status_code, 200)
+        self.assertEqual(self.client.get(f"/api/analysis/{track['id']}/").status_code, 200)
+
+        self.client.force_login(User.objects.create_user('other', password='pass'))
+        self.assertEqual(self.client.get(track['stream_url']).status_code, 404)
+        self.client.logout()
+        self.assertEqual(self.client.get('/api/library/').status_code, 401)
+
+    def test_keyset_pages_cover_all_tracks_in_order(self):
+        titles = [f'Track {index:02d}' for index in range(25)]
+        self.add_tracks(titles)
+        self.add_tracks(['Someone else'], user=User.objects.create_user('other', password='pass'))
+
+        pages = self.pages(limit=10)
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual(sum(pages, []), titles[::-1])
+        self.assertEqual(sum(self.pages(sort='title', limit=7), []), titles)
+
+        # 何ページ目でも OFFSET は使わず、問い合わせの数も同じ
+        first = self.client.get('/api/library/', {'limit': 10}).json()
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/api/library/', {'limit': 10, 'cursor': first['next_cursor']})
+        sql = [query['sql'] for query in queries.captured_queries if 'player_musicfile' in query['sql']]
+        self.assertEqual(len(sql), 1)
+        self.assertNotIn('OFFSET', sql[0].upper())
+
+        response = self.client.get('/api/library/', {'sort': 'title', 'cursor': first['next_cursor']})
+        self.assertEqual(response.status_code, 400)
+
+    def test_same_audio_is_added_once(self):
+        file_info = self.upload(make_wav(), name='first.wav')
+        for _ in range(2):
+            self.client.post('/api/library/', {'file_id': file_info['id']}, content_type='application/json')
+        self.assertEqual(MusicFile.objects.count(), 1)
+        self.assertEqual(AudioBlob.objects.get(pk=file_info['sha256']).ref_count, 2)
+
+        # 既存の曲を見落として作ろうとしても一意制約で防ぐ
+        track = MusicFile.objects.get()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            MusicFile.objects.create(user=self.user, blob=track.blob, title='copy')
+
+    def test_title_search(self):
+        self.add_tracks(['Ｂｅａｔ It', 'beautiful day', 'Heartbeat', 'Another One'])
+        prefix = sum(self.pages(sort='title', q='BEA'), [])
+        self.assertEqual(prefix, ['Ｂｅａｔ It', 'beautiful day'])
+        self.assertEqual(sum(self.pages(sort='title', q='beat', match='trigram'), []), ['Ｂｅａｔ It', 'Heartbeat'])
+
+        # 前方一致の範囲は U+FFFF より後の文字（絵文字など）が続くタイトルも含む
+        self.add_tracks(['beat😀'])
+        self.assertEqual(sum(self.pages(sort='title', q='beat'), []), ['Ｂｅａｔ It', 'beat😀'])
+
+    def test_listing_uses_composite_index(self):
+        self.add_tracks(['a', 'b'])
+        if connection.vendor != 'sqlite':
+            self.skipTest('EXPLAIN QUERY PLAN は SQLite のみ')
+        for sort, index in (('recent', 'musicfile_user_recent_idx'), ('title', 'musicfile_user_title_idx')):
+            queryset, _ = library.SORTS[sort]
+            sql, params = MusicFile.objects.filter(user=self.user).order_by(*queryset)[:10].query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+                plan = ' '.join(str(row) for row in cursor.fetchall())
+            self.assertIn(index, plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+
+
+class QueueTests(MediaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user('listener', password='pass')
+        self.client.force_login(self.user)
+        self.tracks = []
+        for index, seconds in enumerate((1.0, 1.5, 2.0)):
+            file_info = self.upload(make_wav(seconds=seconds), name=f'{index}.wav')
+            response = self.client.post('/api/library/', {'file_id': file_info['id'], 'title': f'Song {index}'}, content_type='application/json')
+            self.tracks.append(response.json()['track'])
+        self.session_file = file_info
+
+    def test_queue_returns_following_tracks_with_positions_and_peaks(self):
+        newest, middle, oldest = self.tracks[::-1]
+        self.client.post('/api/save-position/', {'file_id': middle['id'], 'position': 0.75}, content_type='application/json')
+
+        response = self.client.get('/api/queue/', {'current': newest['id'], 'width': 100})
+        self.assertEqual(response.status_code, 200, response.content)
+        queue = response.json()['queue']
+        self.assertEqual([item['id'] for item in queue], [middle['id'], oldest['id']])
+        self.assertEqual(queue[0]['stream_url'], middle['stream_url'])
+        self.assertAlmostEqual(queue[0]['position'], 0.75)
+        self.assertEqual(queue[1]['position'], 0.0)
+        self.assertEqual(queue[0]['content_type'], 'audio/wav')
+
+        # 波形ピークは get_peaks と同じ形式（2 段分）
+        peaks = queue[0]['peaks']
+        self.assertAlmostEqual(peaks['duration'], 1.5, places=1)
+        for start, end, row in zip((0, peaks['duration'] / 2), (peaks['duration'] / 2, peaks['duration']), peaks['rows']):
+            expected = self.client.get(f"/api/peaks/{middle['id']}/", {'start': start, 'end': end, 'width': 100})
+            self.assertEqual(base64.b64decode(row), expected.content)
+
+        # 曲全体を取得させる preload のヒントは付けない（先読みはクライアントの待機用の要素で行う）
+        self.assertFalse(response.has_header('Link'))
+
+    def test_queue_order_and_limits(self):
+        ids = [track['id'] for track in self.tracks]
+        # セッションのファイルからは先頭から、並び順は一覧と同じ
+        response = self.client.get('/api/queue/', {'current': self.session_file['id'], 'sort': 'title', 'count': 2})
+        self.assertEqual([item['id'] for item in response.json()['queue']], ids[:2])
+        response = self.client.get('/api/queue/', {'current': ids[0], 'sort': 'title'})
+        self.assertEqual([item['id'] for item in response.json()['queue']], ids[1:])
+
+        last = self.client.get('/api/queue/', {'current': ids[0]})
+        self.assertEqual(last.json()['queue'], [])
+
+        self.assertEqual(self.client.get('/api/queue/', {'count': 'x'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/queue/', {'sort': 'random'}).status_code, 400)
+        self.client.logout()
+        self.assertEqual(self.client.get('/api/queue/').status_code, 401)
+
+
+class PCMReaderTests(MediaTestCase):
+    def stereo(self, sample_rate=44100, seconds=1.0):
+        t = np.arange(int(seconds * sample_rate)) / sample_rate
+        return np.stack([0.5 * np.sin(2 * np.pi * 440 * t), 0.25 * np.sin(2 * np.pi * 660 * t)], axis=1)
+
+    def test_wav_sample_formats_are_read_through_memmap(self):
+        samples = self.stereo()
+        for bits, floating, extensible, tolerance in [
+            (8, False, False, 4e-3), (16, False, False, 2e-5), (24, False, True, 1e-7),
+            (32, False, False, 1e-7), (32, True, False, 1e-7), (64, True, True, 1e-7),
+        ]:
+            with self.subTest(bits=bits, floating=floating):
+                path = os.path.join(self.media_root, f'{bits}.wav')
+                with open(path, 'wb') as f:
+                    f.write(synth.pcm_wav_bytes(samples, 44100, bits, floating, extensible))
+                source = open_pcm(path)
+                self.assertIsInstance(source._samples(), np.memmap)
+                blocks = list(source.blocks(10000, mono=False))
+                self.assertEqual([len(block) for block in blocks], [10000] * 4 + [4100])
+                np.testing.assert_allclose(np.concatenate(blocks), samples, atol=tolerance)
+                np.testing.assert_allclose(np.concatenate(list(source.blocks(10000))), samples.mean(axis=1), atol=tolerance)
+
+    def test_resampling_in_stream(self):
+        data = synth.pcm_wav_bytes(self.stereo(), 44100)
+        source = WavSource(data, sample_rate=16000)  # bytes はコピーせずに読む
+        blocks = list(source.blocks(4096, mono=False))
+        self.assertTrue(all(len(block) == 4096 for block in blocks[:-1]))
+        resampled = np.concatenate(blocks)
+        self.assertAlmostEqual(len(resampled), 16000, delta=10)
+        expected = self.stereo(sample_rate=16000)[:len(resampled)]
+        np.testing.assert_allclose(resampled[50:-50], expected[50:-50], atol=2e-3)
+
+    @skipIf(shutil.which('ffmpeg') is None, 'ffmpeg is not installed')
+    def test_ffmpeg_exit_status(self):
+        path = os.path.join(self.media_root, 'tone.wav')
+        with open(path, 'wb') as f:
+            f.write(synth.pcm_wav_bytes(self.stereo(), 44100))
+        source = FFmpegSource(path, sample_rate=16000)
+        decoded = np.concatenate(list(source.blocks(4096)))
+        self.assertAlmostEqual(len(decoded), 16000, delta=10)
+
+        # 途中で読むのをやめても、こちらが止めた ffmpeg はエラーにしない
+        stream = source.blocks(1024)
+        next(stream)
+        stream.close()
+
+        broken = os.path.join(self.media_root, 'broken.mp3')
+        with open(broken, 'wb') as f:
+            f.write(b'not audio' * 100)
+        with self.assertRaises(AudioDecodeError):
+            list(FFmpegSource(broken).blocks(4096))
+
+    def test_ffmpeg_failure_after_output_is_reported(self):
+        # 途中まで出力してから失敗する ffmpeg の代わり
+        bin_dir = os.path.join(self.media_root, 'bin')
+        os.makedirs(bin_dir)
+        fake = os.path.join(bin_dir, 'ffmpeg')
+        with open(fake, 'w') as f:
+            f.write('#!/bin/sh\nprintf "\\000\\000\\000\\000\\000\\000\\000\\000"\nexit 1\n')
+        os.chmod(fake, 0o755)
+        with mock.patch.dict(os.environ, {'PATH': bin_dir + os.pathsep + os.environ['PATH']}):
+            with self.assertRaisesMessage(AudioDecodeError, 'ffmpeg exited with 1'):
+                list(FFmpegSource('song.mp3', channels=2).decode(1024, mono=True))
@@ -0,0 +1,336 @@
+"""
+処理段階ごとのトレース
+
+TracingMiddleware が PLAYER_TRACE_SAMPLE_RATE の割合でリクエストを選んで
+トレースを開始し、その間に span() / @traced で囲んだ処理の開始時刻と所要時間を
+記録する。応答後に 1 リクエスト 1 行の JSON として PLAYER_TRACE_FILE に追記する。
+
+    with tracing.span('upload.release_previous', files=2):
+        ...
+
+    @tracing.traced('metadata.mutagen')
+    def _probe_mutagen(path):
+        ...
+
+トレース中でなければ span() は共有の何もしないオブジェクトを返し、@traced は
+ContextVar を 1 回見るだけで元の関数を呼ぶ。トレースは contextvars で受け渡すので、
+非同期 View からスレッドプール（executor.run_blocking）で実行した処理も同じトレースに入る。
+
+ファイルは PLAYER_TRACE_MAX_BYTES を超えると <file>.1, <file>.2 ... へ
+ずらす（PLAYER_TRACE_BACKUPS 世代まで）。複数のワーカーが同じファイルに
+追記し、ローテートはファイルロックで 1 プロセスだけが行う。
+集計は trace_summary コマンドで行う。
+"""
+import fcntl
+import functools
+import itertools
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+_trace = ContextVar('player_trace', default=None)
+_parent = ContextVar('player_span', default=0)
+
+
+class Trace:
+    """1 リクエスト分のスパン"""
+
+    def __init__(self, name):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.timestamp = time.time()
+        self.started = time.perf_counter()
+        self.spans = []
+        self._ids = itertools.count(1)
+
+    def next_id(self):
+        return next(self._ids)
+
+    def as_dict(self, **attrs):
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'timestamp': round(self.timestamp, 3),
+            'duration_ms': round((time.perf_counter() - self.started) * 1000, 3),
+            'pid': os.getpid(),
+            **attrs,
+            'spans': sorted(self.spans, key=lambda span: span['start_ms']),
+        }
+
+
+class Span:
+    """トレース中の 1 区間（with で使う）"""
+
+    __slots__ = ('trace', 'name', 'attrs', 'id', 'parent', 'started', '_token')
+
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        """区間の途中で分かった属性（件数やバイト数など）を追加する"""
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.id = self.trace.next_id()
+        self.parent = _parent.get()
+        self._token = _parent.set(self.id)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        ended = time.perf_counter()
+        _parent.reset(self._token)
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        self.trace.spans.append(_span_dict(
+            self.trace, self.id, self.parent, self.name, self.started, ended, self.attrs))
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def _span_dict(trace, span_id, parent, name, started, ended, attrs):
+    record = {
+        'id': span_id,
+        'parent': parent,
+        'name': name,
+        'start_ms': round((started - trace.started) * 1000, 3),
+        'duration_ms': round((ended - started) * 1000, 3),
+    }
+    if attrs:
+        record['attrs'] = attrs
+    return record
+
+
+def active():
+    """トレース中か（計測のための前処理を省くのに使う）"""
+    return _trace.get() is not None
+
+
+def span(name, **attrs):
+    """処理段階を計測するコンテキストマネージャー"""
+    trace = _trace.get()
+    if trace is None:
+        return NOOP_SPAN
+    return Span(trace, name, attrs)
+
+
+def record(name, started, ended=None, **attrs):
+    """計測済みの区間（perf_counter の開始・終了時刻）を追加する"""
+    trace = _trace.get()
+    if trace is None:
+        return
+    ended = time.perf_counter() if ended is None else ended
+    trace.spans.append(_span_dict(trace, trace.next_id(), _parent.get(), name, started, ended, attrs))
+
+
+def traced(name=None):
+    """関数全体を 1 つのスパンとして記録するデコレーター（@traced でも @traced('名前') でもよい）"""
+    def decorate(func):
+        span_name = name or f"{func.__module__.rsplit('.', 1)[-1]}.{func.__name__}"
+        if iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                trace = _trace.get()
+                if trace is None:
+                    return await func(*args, **kwargs)
+                with Span(trace, span_name, {}):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            trace = _trace.get()
+            if trace is None:
+                return func(*args, **kwargs)
+            with Span(trace, span_name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+
+    if callable(name):
+        func, name = name, None
+        return decorate(func)
+    return decorate
+
+
+class TraceWriter:
+    """トレースを JSONL に追記し、大きくなったらローテートする"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._fd = None
+        self._path = None
+
+    def _open(self, path):
+        # 他のプロセスがローテートした場合は新しいファイルを開き直す
+        try:
+            inode = os.stat(path).st_ino
+        except FileNotFoundError:
+            inode = None
+        if self._fd is not None and self._path == path and inode == os.fstat(self._fd).st_ino:
+            return self._fd
+        if self._fd is not None:
+            os.close(self._fd)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._path = path
+        return self._fd
+
+    def _rotate(self, path, incoming, max_bytes, backups):
+        with open(path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # ロックを待つ間に他のプロセスがローテートしていれば何もしない
+                size = os.path.getsize(path) if os.path.exists(path) else 0
+                if size and size + incoming > max_bytes:
+                    if backups > 0:
+                        for number in range(backups - 1, 0, -1):
+                            if os.path.exists(f'{path}.{number}'):
+                                os.replace(f'{path}.{number}', f'{path}.{number + 1}')
+                        os.replace(path, f'{path}.1')
+                    else:
+                        os.remove(path)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def write(self, trace_record):
+        line = (json.dumps(trace_record, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+        path = settings.PLAYER_TRACE_FILE
+        max_bytes = settings.PLAYER_TRACE_MAX_BYTES
+        with self._lock:
+            fd = self._open(path)
+            if max_bytes and os.fstat(fd).st_size + len(line) > max_bytes:
+                self._rotate(path, len(line), max_bytes, settings.PLAYER_TRACE_BACKUPS)
+                fd = self._open(path)
+            # O_APPEND の 1 回の write なので他のプロセスの行と混ざらない
+            os.write(fd, line)
+
+
+writer = TraceWriter()
+
+
+def trace_files(path=None):
+    """現在のファイルとローテート済みのファイル（古い順）"""
+    path = path or settings.PLAYER_TRACE_FILE
+    directory = os.path.dirname(path) or '.'
+    prefix = os.path.basename(path) + '.'
+    numbers = sorted(
+        (int(name[len(prefix):]) for name in os.listdir(directory)
+         if name.startswith(prefix) and name[len(prefix):].isdigit()),
+        reverse=True,
+    ) if os.path.isdir(directory) else []
+    files = [os.path.join(directory, f'{prefix}{number}') for number in numbers]
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+
+def read_traces(path=None):
+    for file_path in trace_files(path):
+        with open(file_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue  # 書き込み途中の行
+
+
+def route_for(request):
+    """リクエストの URL パターン（トレース名と metrics のラベルに使う）"""
+    match = getattr(request, 'resolver_match', None)
+    return match.route if match is not None else 'unmatched'
+
+
+class TracingMiddleware:
+    """一定割合のリクエストでトレースを開始し、応答後にファイルへ書き出す（同期・非同期の両対応）"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def _sampled(self):
+        rate = settings.PLAYER_TRACE_SAMPLE_RATE
+        return rate > 0 and (rate >= 1 or random.random() < rate)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not self._sampled():
+            return self.get_response(request)
+        trace = Trace(request.path)
+        token = _trace.set(trace)
+        try:
+            response = self.get_response(request)
+        finally:
+            _trace.reset(token)
+        self._finish(trace, request, response)
+        return response
+
+    async def __acall__(self, request):
+        if not self._sampled():
+            return await self.get_response(request)
+        trace = Trace(request.path)
+        token = _trace.set(trace)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _trace.reset(token)
+        self._finish(trace, request, response)
+        return response
+
+    def _finish(self, trace, request, response):
+        trace.name = route_for(request)
+        writer.write(trace.as_dict(method=request.method, path=request.path, status=response.status_code))
+
+
+def summarize(traces):
+    """スパン名ごとの回数・合計・p50 / p95 / 最大（ミリ秒）と、トレース全体の時間に占める割合"""
+    durations = {}
+    trace_total = 0.0
+    for trace in traces:
+        trace_total += trace.get('duration_ms', 0.0)
+        for item in trace.get('spans', []):
+            durations.setdefault(item['name'], []).append(item['duration_ms'])
+
+    stages = []
+    for name, values in durations.items():
+        values.sort()
+        total = sum(values)
+        stages.append({
+            'name': name,
+            'count': len(values),
+            'total_ms': total,
+            'p50_ms': values[(len(values) - 1) // 2],
+            'p95_ms': values[min(len(values) - 1, int(len(values) * 0.95))],
+            'max_ms': values[-1],
+            'share': total / trace_total if trace_total else 0.0,
+        })
+    return stages
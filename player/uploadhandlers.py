@@ -0,0 +1,137 @@
+"""
+音声ファイル用のストリーミングアップロードハンドラー
+
+multipart のチャンクを受け取るたびにストアと同じファイルシステム上の
+一時ファイルへ直接書き込み、同じパスでハッシュ計算・形式判定・
+サイズ計測を行う。ファイル全体をメモリに載せたり Base64 化したりしない。
+"""
+import hashlib
+import os
+import time
+import uuid
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+
+from . import tracing
+from .storage import new_staging_path
+
+ALLOWED_EXTENSIONS = ['mp3', 'wav', 'flac', 'aac', 'ogg']
+
+
+def sniff_audio_format(head):
+    """先頭バイトから音声形式を判定（不明な場合は None）"""
+    if head.startswith(b'RIFF') and head[8:12] == b'WAVE':
+        return 'wav'
+    if head.startswith(b'fLaC'):
+        return 'flac'
+    if head.startswith(b'OggS'):
+        return 'ogg'
+    if head.startswith(b'ADIF'):
+        return 'aac'
+    if head.startswith(b'ID3'):
+        return 'mp3'
+    if len(head) >= 2 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0:
+        # ADTS（AAC）は layer ビットが 00、MPEG オーディオはそれ以外
+        return 'aac' if head[1] & 0x06 == 0 else 'mp3'
+    return None
+
+
+class StreamedAudioFile(UploadedFile):
+    """ストリーミング保存済みの音声ファイル"""
+
+    def __init__(self, path, name, content_type, size, sha256, extension, file_id):
+        super().__init__(open(path, 'rb'), name, content_type, size)
+        self.path = path
+        self.sha256 = sha256
+        self.extension = extension
+        self.file_id = file_id
+
+    def temporary_file_path(self):
+        return self.path
+
+
+class StreamingAudioUploadHandler(FileUploadHandler):
+    """
+    アップロードをストアの一時領域に直接書き込むハンドラー
+
+    拒否した場合は rejection にエラーメッセージを設定し、View 側で返す。
+    """
+
+    chunk_size = 64 * 2 ** 10
+
+    def __init__(self, request=None, max_size=None):
+        super().__init__(request)
+        self.max_size = max_size or settings.PLAYER_MAX_UPLOAD_SIZE
+        self.rejection = None
+        self.destination = None
+        self.path = None
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.extension = self.file_name.split('.')[-1].lower()
+        if self.extension not in ALLOWED_EXTENSIONS:
+            self.rejection = f'対応していないファイル形式です: {self.extension}'
+            raise StopUpload(connection_reset=False)
+
+        self.file_id = str(uuid.uuid4())
+        self.path = new_staging_path(self.extension)
+        self.destination = open(self.path, 'wb')
+        self.hasher = hashlib.sha256()
+        self.size = 0
+        self.detected_format = None
+        # トレース中だけ、受信開始からの時間とハッシュ計算・書き込みの合計時間を測る
+        self.tracing = tracing.active()
+        self.started = time.perf_counter()
+        self.write_seconds = 0.0
+        self.chunks = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        if start == 0:
+            self.detected_format = sniff_audio_format(raw_data[:16])
+        self.size += len(raw_data)
+        if self.size > self.max_size:
+            limit_mb = self.max_size // (1024 * 1024)
+            self.rejection = f'ファイルサイズが大きすぎます（{limit_mb}MB以下）'
+            self._discard()
+            raise StopUpload(connection_reset=False)
+        if self.tracing:
+            written = time.perf_counter()
+            self.hasher.update(raw_data)
+            self.destination.write(raw_data)
+            self.write_seconds += time.perf_counter() - written
+            self.chunks += 1
+        else:
+            self.hasher.update(raw_data)
+            self.destination.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        self.destination.close()
+        if self.tracing:
+            tracing.record(
+                'upload.receive', self.started, bytes=self.size, chunks=self.chunks,
+                write_ms=round(self.write_seconds * 1000, 3),
+            )
+        # 中身から判定できた場合はその形式の拡張子で保存する
+        return StreamedAudioFile(
+            self.path,
+            self.file_name,
+            self.content_type,
+            file_size,
+            self.hasher.hexdigest(),
+            self.detected_format or self.extension,
+            self.file_id,
+        )
+
+    def upload_interrupted(self):
+        if self.destination and not self.destination.closed:
+            self._discard()
+
+    def _discard(self):
+        self.destination.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -1,18 +1,41 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import async_views, views
+
+# ASGI で動かす場合はアップロード・配信・再生位置の API を非同期版にする
+api = async_views if settings.PLAYER_ASYNC_VIEWS else views
 
 app_name = 'player'
  
 urlpatterns = [
     path('', views.main_player, name='main_player'),
-    path('api/upload/', views.upload_file, name='upload_file'),
-    path('api/upload-lightweight/', views.upload_file_lightweight, name='upload_file_lightweight'),
+    path('api/upload/', api.upload_file, name='upload_file'),
+    path('api/upload-lightweight/', api.upload_file_lightweight, name='upload_file_lightweight'),
+    path('api/upload-by-hash/', views.upload_by_hash, name='upload_by_hash'),
+    path('api/uploads/', api.create_upload, name='create_upload'),
+    path('api/uploads/<str:upload_id>/', api.upload_status, name='upload_status'),
+    path('api/uploads/<str:upload_id>/chunks/<int:index>/', api.upload_chunk, name='upload_chunk'),
+    path('api/uploads/<str:upload_id>/finalize/', api.finalize_upload, name='finalize_upload'),
     path('api/delete/<str:file_id>/', views.delete_file, name='delete_file'),
     path('api/file-data/<str:file_id>/', views.get_file_data, name='get_file_data'),
-    path('api/file-url-lightweight/<str:file_id>/', views.get_file_url_lightweight, name='get_file_url_lightweight'),
-    path('api/save-position/', views.save_playback_position, name='save_playback_position'),
-    path('api/get-position/<str:file_id>/', views.get_playback_position, name='get_playback_position'),
+    path('api/file-url-lightweight/<str:file_id>/', api.get_file_url_lightweight, name='get_file_url_lightweight'),
+    path('api/stream/<str:file_id>/', api.stream_file, name='stream_file'),
+    path('api/peaks/<str:file_id>/', views.get_peaks, name='get_peaks'),
+    path('api/artwork/<str:key>/<int:size>.<str:extension>', views.get_artwork, name='get_artwork'),
+    path('api/jobs/<str:file_id>/', views.get_file_jobs, name='get_file_jobs'),
+    path('api/analysis/<str:file_id>/', views.get_file_analysis, name='get_file_analysis'),
+    path('api/library/', views.library_tracks, name='library_tracks'),
+    path('api/library/<int:track_id>/', views.library_track, name='library_track'),
+    path('api/queue/', views.get_queue, name='get_queue'),
+    path('api/save-position/', api.save_playback_position, name='save_playback_position'),
+    path('api/save-positions/', api.save_playback_positions, name='save_playback_positions'),
+    path('api/get-position/<str:file_id>/', api.get_playback_position, name='get_playback_position'),
     path('api/voice-command/', views.voice_command, name='voice_command'),
+    path('api/voice-command/match/', views.match_voice_command, name='match_voice_command'),
+    path('api/voice-command/clip/', views.voice_command_clip, name='voice_command_clip'),
+    path('api/voice-command/enroll/', views.enroll_voice_command, name='enroll_voice_command'),
+    path('api/voice-command/templates/', views.voice_templates, name='voice_templates'),
     path('api/cleanup/', views.cleanup_session_files, name='cleanup_session_files'),
     path('test-api/', views.test_api, name='test_api'),
+    path('metrics', views.metrics_view, name='metrics'),
 ] 
\ No newline at end of file
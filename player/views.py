@@ -1,24 +1,110 @@
 from django.shortcuts import render, redirect
 from django.contrib import messages
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
+from django.urls import reverse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 import os
+import base64
+import hmac
 import json
+import logging
 import uuid
 import speech_recognition as sr
 from django.conf import settings
+from django.db.models import Count
 import mimetypes
-from mutagen import File as MutagenFile
 import tempfile
 import shutil
+import math
+import time
+from . import analysis, artwork, fingerprint, jobs, keywords, library, loudness, matcher, metadata, metrics, seekindex, storage, tracing
+from .models import VoiceTemplate
+from .peaks import PeakPyramid, peaks_path, remove_peaks
+from .positions import keep_session_alive, owner_for, parse_position, position_buffer
+from .resumable import ResumableUpload, UploadError
+from .streaming import FileWindow, content_type_for, range_file_response
+from .uploadhandlers import StreamingAudioUploadHandler
+
+logger = logging.getLogger(__name__)
 
 # Create your views here.
 
+def _find_session_file(request, file_id):
+    """セッション内のファイル情報を ID で検索（'track-<id>' はログインユーザーのライブラリの曲）"""
+    if file_id.startswith('track-'):
+        return library.find_track(request.user, file_id)
+    for file_info in request.session.get('uploaded_files', []):
+        if file_info['id'] == file_id:
+            return file_info
+    return None
+
+def _release_session_file(file_info):
+    """セッションから外すファイルの実体を解放"""
+    try:
+        if file_info.get('sha256'):
+            storage.release(file_info['sha256'])
+        elif os.path.exists(file_info.get('file_path', '')):
+            # 重複排除ストア導入前のファイル
+            os.remove(file_info['file_path'])
+            remove_peaks(file_info['file_path'])
+            seekindex.remove_seek_index(file_info['file_path'])
+    except:
+        pass  # ファイルが既に削除されている場合
+
+def _register_session_file(request, blob, title, file_id):
+    """ストア上の音声をセッションのファイルとして登録（既存のファイルは解放）"""
+    existing_files = request.session.get('uploaded_files', [])
+    with tracing.span('upload.release_previous', files=len(existing_files)):
+        for existing_file in existing_files:
+            _release_session_file(existing_file)
+    
+    audio_metadata = metadata.get_metadata(blob.sha256, storage.path_for(blob))
+    
+    # セッションにファイル情報を保存（一つだけ）
+    file_info = {
+        'id': file_id,
+        'title': title,
+        'filename': f'{blob.sha256}.{blob.extension}',
+        'file_path': storage.path_for(blob),
+        'sha256': blob.sha256,
+        'duration': int(audio_metadata.duration) if audio_metadata else 0,
+        'has_peaks': blob.has_peaks,
+        'file_size': blob.size,
+        'uploaded_at': str(uuid.uuid4())
+    }
+    request.session['uploaded_files'] = [file_info]
+    request.session.modified = True
+    return file_info
+
 def test_api(request):
     """テスト用のAPIエンドポイント"""
     return JsonResponse({'message': 'API is working!'})
 
+def _metrics_allowed(request):
+    """
+    /metrics を返してよいか
+
+    スタッフのユーザーと、PLAYER_METRICS_TOKEN の Bearer トークンを送ったクライアントに返す。
+    トークンが未設定なら DEBUG のときだけ誰にでも返す（本番でルートやステータスを公開しない）。
+    """
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_staff:
+        return True
+    token = settings.PLAYER_METRICS_TOKEN
+    if not token:
+        return settings.DEBUG
+    return hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+
+@require_http_methods(["GET"])
+def metrics_view(request):
+    """全ワーカーのメトリクスを Prometheus のテキスト形式で返す"""
+    if not settings.PLAYER_METRICS:
+        return HttpResponse(status=404)
+    if not _metrics_allowed(request):
+        return HttpResponse(status=403)
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 def main_player(request):
     """
     Single page music player with session-based file management.
@@ -30,92 +116,37 @@ def main_player(request):
 @csrf_exempt
 @require_http_methods(["POST"])
 def upload_file(request):
-    """セッション限定のファイルアップロード"""
+    """
+    セッション限定のファイルアップロード
+    
+    以前の Base64 をセッションに保存する方式は廃止し、
+    ストリーミング保存する軽量版と同じ処理を行う。
+    """
+    return upload_file_lightweight(request)
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def upload_by_hash(request):
+    """
+    SHA-256 が一致する音声が保存済みなら本体を送らずに登録する
+    
+    見つからない場合は 404 を返すので、クライアントは通常のアップロードを行う。
+    """
     try:
-        # セッションを確実に初期化
-        if not request.session.session_key:
-            request.session.create()
-        
-        if 'file' not in request.FILES:
-            return JsonResponse({'error': 'ファイルが選択されていません'}, status=400)
-        
-        uploaded_file = request.FILES['file']
-        
-        # ファイル形式の検証
-        allowed_extensions = ['mp3', 'wav', 'flac', 'aac', 'ogg']
-        file_extension = uploaded_file.name.split('.')[-1].lower()
-        
-        if file_extension not in allowed_extensions:
-            return JsonResponse({'error': f'対応していないファイル形式です: {file_extension}'}, status=400)
-        
-        # ファイルサイズ制限（12MB）
-        if uploaded_file.size > 12 * 1024 * 1024:
-            return JsonResponse({'error': 'ファイルサイズが大きすぎます（12MB以下）'}, status=400)
-        
-        # MEDIA_ROOTとセッション用の一時ディレクトリを必ず作成
-        if not os.path.exists(settings.MEDIA_ROOT):
-            os.makedirs(settings.MEDIA_ROOT, exist_ok=True)
-        session_temp_dir = os.path.join(settings.MEDIA_ROOT, 'temp', str(request.session.session_key))
-        os.makedirs(session_temp_dir, exist_ok=True)
-        
-        # ユニークなファイル名を生成
-        file_id = str(uuid.uuid4())
-        file_extension = uploaded_file.name.split('.')[-1]
-        filename = f"{file_id}.{file_extension}"
-        file_path = os.path.join(session_temp_dir, filename)
-        
-        # ファイルをBase64エンコードしてセッションに保存
-        try:
-            file_content = uploaded_file.read()
-            import base64
-            file_base64 = base64.b64encode(file_content).decode('utf-8')
-            
-            # Base64データのサイズチェック（セッション制限を考慮）
-            if len(file_base64) > 16 * 1024 * 1024:  # 16MB制限（12MBファイルのBase64エンコード後）
-                return JsonResponse({'error': 'ファイルが大きすぎてセッションに保存できません（12MB以下）'}, status=400)
-                
-        except Exception as e:
-            return JsonResponse({'error': f'ファイルの読み込みに失敗しました: {str(e)}'}, status=500)
-        
-        # ファイルのメタデータを取得（一時ファイルから）
-        temp_file_path = os.path.join(session_temp_dir, filename)
-        with open(temp_file_path, 'wb+') as destination:
-            destination.write(file_content)
-        
-        try:
-            audio = MutagenFile(temp_file_path)
-            duration = int(audio.info.length) if audio.info else 0
-        except:
-            duration = 0
+        data = json.loads(request.body)
+        sha256 = str(data.get('sha256', '')).lower()
+        title = data.get('name') or sha256
         
-        # 一時ファイルを削除
-        try:
-            os.remove(temp_file_path)
-        except:
-            pass
+        if len(sha256) != 64:
+            return JsonResponse({'error': 'sha256 is required'}, status=400)
         
-        # 既存のファイルがある場合は削除
-        session_files = request.session.get('uploaded_files', [])
-        if session_files:
-            for existing_file in session_files:
-                try:
-                    if os.path.exists(existing_file.get('file_path', '')):
-                        os.remove(existing_file['file_path'])
-                except:
-                    pass
-        
-        # セッションにファイル情報を保存（一つだけ）
-        file_info = {
-            'id': file_id,
-            'title': uploaded_file.name,
-            'filename': filename,
-            'file_base64': file_base64,
-            'duration': duration,
-            'file_size': uploaded_file.size,
-            'uploaded_at': str(uuid.uuid4())
-        }
-        request.session['uploaded_files'] = [file_info]
-        request.session.modified = True
+        if not request.session.session_key:
+            request.session.create()
+        # 確認と参照の追加は同じ行ロックの中で行う（間に削除されると実体の無いファイルを登録してしまう）
+        blob = storage.acquire_existing(sha256)
+        if blob is None:
+            return JsonResponse({'error': 'ファイルが見つかりません'}, status=404)
+        file_info = _register_session_file(request, blob, title, str(uuid.uuid4()))
         
         return JsonResponse({
             'success': True,
@@ -143,12 +174,8 @@ def delete_file(request, file_id):
         if not file_to_delete:
             return JsonResponse({'error': 'ファイルが見つかりません'}, status=404)
         
-        # ファイルを物理的に削除
-        try:
-            if os.path.exists(file_to_delete.get('file_path', '')):
-                os.remove(file_to_delete['file_path'])
-        except:
-            pass  # ファイルが既に削除されている場合
+        # ファイルの参照を解放（他から参照されていなければ物理的に削除）
+        _release_session_file(file_to_delete)
         
         # セッションから削除
         session_files = [f for f in session_files if f['id'] != file_id]
@@ -163,17 +190,15 @@ def delete_file(request, file_id):
 @csrf_exempt
 @require_http_methods(["GET"])
 def get_file_data(request, file_id):
-    """ファイルのBase64データを取得"""
+    """ファイル情報と配信URLを取得（Base64 データは返さない）"""
     try:
-        session_files = request.session.get('uploaded_files', [])
-        
-        for file_info in session_files:
-            if file_info['id'] == file_id:
-                return JsonResponse({
-                    'success': True,
-                    'file_base64': file_info.get('file_base64', ''),
-                    'file_info': file_info
-                })
+        file_info = _find_session_file(request, file_id)
+        if file_info:
+            return JsonResponse({
+                'success': True,
+                'file_url': reverse('player:stream_file', args=[file_id]),
+                'file_info': file_info
+            })
         
         return JsonResponse({'error': 'ファイルが見つかりません'}, status=404)
         
@@ -183,33 +208,72 @@ def get_file_data(request, file_id):
 @csrf_exempt
 @require_http_methods(["POST"])
 def save_playback_position(request):
-    """再生位置をローカルストレージに保存（クライアントサイドで処理）"""
+    """再生位置を保存（まとめて書き込むためメモリ上のバッファに記録）"""
     try:
         data = json.loads(request.body)
         file_id = data.get('file_id')
-        position = data.get('position', 0.0)
         
         if not file_id:
             return JsonResponse({'error': 'file_id is required'}, status=400)
         
-        # セッションに再生位置を保存（オプション）
-        playback_positions = request.session.get('playback_positions', {})
-        playback_positions[file_id] = position
-        request.session['playback_positions'] = playback_positions
-        request.session.modified = True
+        try:
+            file_id, position, ts = parse_position(file_id, data.get('position', 0.0), data.get('ts'))
+        except (TypeError, ValueError):
+            return JsonResponse({'error': 'position is invalid'}, status=400)
+        
+        file_info = _find_session_file(request, file_id)
+        sha256 = file_info.get('sha256', '') if file_info else ''
+        position_buffer.record(owner_for(request), file_id, position, ts, sha256)
+        keep_session_alive(request)
         
         return JsonResponse({'success': True, 'position': position})
     
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
+@csrf_exempt
+@require_http_methods(["POST"])
+def save_playback_positions(request):
+    """
+    複数の再生位置をまとめて保存
+    
+    {"positions": [{"file_id": ..., "position": ..., "ts": ...}, ...]} を受け取り、
+    同じファイルについては ts が最も新しい値だけを残す。
+    """
+    try:
+        data = json.loads(request.body)
+        positions = data.get('positions')
+        
+        if not isinstance(positions, list):
+            return JsonResponse({'error': 'positions is required'}, status=400)
+        if len(positions) > settings.PLAYER_POSITION_BATCH_LIMIT:
+            return JsonResponse({'error': 'too many positions'}, status=400)
+        
+        items = []
+        for item in positions:
+            try:
+                file_id, position, ts = parse_position(item['file_id'], item.get('position', 0.0), item.get('ts'))
+            except (KeyError, TypeError, ValueError, AttributeError):
+                return JsonResponse({'error': 'positions is invalid'}, status=400)
+            file_info = _find_session_file(request, file_id)
+            items.append((file_id, position, ts, file_info.get('sha256', '') if file_info else ''))
+        
+        position_buffer.record_many(owner_for(request), items)
+        keep_session_alive(request)
+        
+        return JsonResponse({'success': True, 'accepted': len(items)})
+    
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
 @csrf_exempt
 @require_http_methods(["GET"])
 def get_playback_position(request, file_id):
-    """前回再生位置を取得"""
+    """前回再生位置を取得（無ければ同じ録音の別のファイルで再生した位置）"""
     try:
-        playback_positions = request.session.get('playback_positions', {})
-        position = playback_positions.get(file_id, 0.0)
+        file_info = _find_session_file(request, file_id)
+        versions = fingerprint.versions(file_info['sha256']) if file_info and file_info.get('sha256') else None
+        position = position_buffer.get(owner_for(request), file_id, versions)
         
         return JsonResponse({
             'success': True,
@@ -219,6 +283,64 @@ def get_playback_position(request, file_id):
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
+def _seek_target(request, action, params):
+    """
+    「戻って」の場合、再生中のファイルが解析済みなら直前のセクションの先頭（秒）を返す
+    
+    params の file_id と position（現在の再生位置）で判断する。
+    """
+    if action != 'go_back' or not params.get('file_id'):
+        return None
+    try:
+        position = float(params.get('position'))
+    except (TypeError, ValueError):
+        return None
+    file_info = _find_session_file(request, str(params['file_id']))
+    if not file_info or not file_info.get('sha256'):
+        return None
+    result = analysis.get_analysis(file_info['sha256'])
+    if result is None or not result.sections:
+        return None
+    return analysis.previous_boundary(result.sections, position)
+
+def _with_seek_target(payload, seek_to):
+    if seek_to is not None:
+        payload['seek_to'] = seek_to
+        payload['message'] = '前のセクションに戻ります'
+    return payload
+
+def _command_response(text, match, seek_to=None):
+    """照合結果を音声コマンド API のレスポンスに変換"""
+    if match is None:
+        return JsonResponse({
+            'success': False,
+            'message': f'認識された音声: "{text}" は対応していないコマンドです'
+        })
+    return JsonResponse(_with_seek_target({
+        'success': True,
+        'command': match.action,
+        'pattern': match.pattern,
+        'fuzzy': match.distance > 0,
+        'message': keywords.ACTIONS.get(match.action, f'{match.action} を実行します')
+    }, seek_to))
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def match_voice_command(request):
+    """ブラウザで認識したテキストを音声コマンドに照合"""
+    try:
+        data = json.loads(request.body)
+        text = str(data.get('text', ''))
+        if not text:
+            return JsonResponse({'error': 'text is required'}, status=400)
+        
+        match = matcher.get_matcher(request.user).match(text)
+        seek_to = _seek_target(request, match.action, data) if match else None
+        return _command_response(text, match, seek_to)
+    
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
 @csrf_exempt
 @require_http_methods(["POST"])
 def voice_command(request):
@@ -229,38 +351,16 @@ def voice_command(request):
         
         # マイクから音声を取得
         with sr.Microphone() as source:
-            print("音声を聞いています...")
+            logger.debug("音声を聞いています...")
             audio = recognizer.listen(source, timeout=5, phrase_time_limit=3)
         
         # 音声をテキストに変換
         try:
             text = recognizer.recognize_google(audio, language='ja-JP')
-            print(f"認識された音声: {text}")
+            logger.debug("認識された音声: %s", text)
             
-            # コマンドの判定
-            if "戻って" in text or "もどって" in text:
-                return JsonResponse({
-                    'success': True,
-                    'command': 'go_back',
-                    'message': '前回再生位置に戻ります'
-                })
-            elif "停止" in text or "とめる" in text:
-                return JsonResponse({
-                    'success': True,
-                    'command': 'stop',
-                    'message': '再生を停止します'
-                })
-            elif "再生" in text or "さいせい" in text:
-                return JsonResponse({
-                    'success': True,
-                    'command': 'play',
-                    'message': '再生を開始します'
-                })
-            else:
-                return JsonResponse({
-                    'success': False,
-                    'message': f'認識された音声: "{text}" は対応していないコマンドです'
-                })
+            # コマンドの判定（VoiceCommand と既定のコマンドをまとめたオートマトンで照合）
+            return _command_response(text, matcher.get_matcher(request.user).match(text))
         
         except sr.UnknownValueError:
             return JsonResponse({
@@ -276,6 +376,107 @@ def voice_command(request):
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
+def _read_clip(request):
+    """multipart の clip フィールド、または本文そのものから録音クリップを読む"""
+    try:
+        content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        content_length = 0
+    if content_length > settings.PLAYER_KWS_MAX_CLIP_SIZE:
+        raise keywords.ClipError('録音が長すぎます')
+    if request.content_type == 'multipart/form-data':
+        clip = request.FILES.get('clip')
+        if clip is None:
+            raise keywords.ClipError('clip is required')
+        return clip.read()
+    return request.body
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def voice_command_clip(request):
+    """
+    ブラウザで録音したクリップから音声コマンドを認識（オフライン）
+    
+    登録済みの音声（共通 + 本人）と照合するだけなので外部サービスを使わず、
+    サーバー側のマイクも不要。
+    """
+    try:
+        started = time.perf_counter()
+        try:
+            action, distance = keywords.recognize(owner_for(request), _read_clip(request))
+        except keywords.ClipError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+        
+        if action:
+            # 本文はクリップなので、再生中のファイルと位置はクエリで受け取る
+            return JsonResponse(_with_seek_target({
+                'success': True,
+                'command': action,
+                'message': keywords.ACTIONS[action],
+                'distance': distance,
+                'elapsed_ms': elapsed_ms
+            }, _seek_target(request, action, request.GET)))
+        # 登録音声が 1 件も無い場合、クライアントはブラウザの音声認識 + テキスト照合に切り替える
+        enrolled = distance is not None or bool(keywords.template_cache.get(owner_for(request)))
+        if not enrolled:
+            message = '音声コマンドが登録されていません'
+        else:
+            message = '音声を認識できませんでした'
+        return JsonResponse({
+            'success': False,
+            'enrolled': enrolled,
+            'message': message,
+            'distance': distance,
+            'elapsed_ms': elapsed_ms
+        })
+    
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def enroll_voice_command(request):
+    """録音したクリップを音声コマンド（action）の登録音声として保存"""
+    try:
+        action = request.POST.get('action') or request.GET.get('action')
+        try:
+            template = keywords.enroll(owner_for(request), action, _read_clip(request))
+        except keywords.ClipError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+        
+        return JsonResponse({
+            'success': True,
+            'template': {'id': template.id, 'action': template.action, 'frames': template.frames},
+            'message': f'「{keywords.ACTIONS[action]}」の音声を登録しました'
+        })
+    
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+@csrf_exempt
+@require_http_methods(["GET", "DELETE"])
+def voice_templates(request):
+    """登録音声の件数をアクションごとに返す（DELETE で本人の登録音声を削除）"""
+    try:
+        owner = owner_for(request)
+        templates = VoiceTemplate.objects.filter(owner=owner)
+        if request.method == 'DELETE':
+            templates.delete()
+            return JsonResponse({'success': True, 'message': '登録音声を削除しました'})
+        
+        counts = dict(templates.values_list('action').annotate(n=Count('id')))
+        return JsonResponse({
+            'success': True,
+            'actions': [
+                {'action': action, 'message': message, 'count': counts.get(action, 0)}
+                for action, message in keywords.ACTIONS.items()
+            ]
+        })
+    
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
 def cleanup_session_files(request):
     """セッション終了時のクリーンアップ（オプション）"""
     try:
@@ -283,91 +484,302 @@ def cleanup_session_files(request):
         if os.path.exists(session_temp_dir):
             shutil.rmtree(session_temp_dir)
         
-        # セッションデータをクリア
-        request.session['uploaded_files'] = []
-        request.session['playback_positions'] = {}
-        request.session.modified = True
+        # セッションデータをクリア（空でなければ）
+        for file_info in request.session.get('uploaded_files', []):
+            _release_session_file(file_info)
+        if request.session.get('uploaded_files'):
+            request.session['uploaded_files'] = []
+        if request.session.session_key:
+            position_buffer.forget_owner(owner_for(request))
         
         return JsonResponse({'success': True, 'message': 'セッションファイルがクリーンアップされました'})
         
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
+def _store_upload(request, staged_path, sha256, extension, size, title, file_id):
+    """受信し終えた一時ファイルをストアへ取り込み、セッションのファイルとして登録"""
+    # 内容ハッシュでストアへ取り込む（同じ内容が保存済みなら書き込みも解析もしない）
+    with metrics.timing(request, 'store'):
+        blob, created = storage.store_file(staged_path, sha256, extension, size)
+    if created:
+        file_path = storage.path_for(blob)
+        
+        # ファイルのメタデータを取得（同じ内容を解析済みなら DB / キャッシュから）
+        with metrics.timing(request, 'metadata'):
+            metadata.get_metadata(blob.sha256, file_path)
+        
+        # 波形ピーク・シークインデックスなどはジョブとしてワーカーで実行する
+        # （PLAYER_BACKGROUND_JOBS が False ならここで実行される）
+        with metrics.timing(request, 'jobs'):
+            jobs.enqueue(blob)
+        blob.refresh_from_db(fields=['has_peaks'])
+    
+    return _register_session_file(request, blob, title, file_id)
+
 @csrf_exempt
 @require_http_methods(["POST"])
 def upload_file_lightweight(request):
-    """軽量版ファイルアップロード（ファイルシステム使用）"""
+    """軽量版ファイルアップロード（チャンクを保存先へ直接ストリーミング）"""
     try:
         # セッションを確実に初期化
         if not request.session.session_key:
             request.session.create()
         
-        if 'file' not in request.FILES:
-            return JsonResponse({'error': 'ファイルが選択されていません'}, status=400)
-        
-        uploaded_file = request.FILES['file']
+        # request.FILES を参照する前にハンドラーを差し替える
+        upload_handler = StreamingAudioUploadHandler(request)
+        request.upload_handlers = [upload_handler]
         
-        # ファイル形式の検証
-        allowed_extensions = ['mp3', 'wav', 'flac', 'aac', 'ogg']
-        file_extension = uploaded_file.name.split('.')[-1].lower()
+        if upload_handler.rejection is None and 'file' in request.FILES:
+            uploaded_file = request.FILES['file']
+        else:
+            uploaded_file = None
         
-        if file_extension not in allowed_extensions:
-            return JsonResponse({'error': f'対応していないファイル形式です: {file_extension}'}, status=400)
+        # ファイル形式・サイズの検証はハンドラー内で受信しながら行う
+        if upload_handler.rejection:
+            return JsonResponse({'error': upload_handler.rejection}, status=400)
+        if uploaded_file is None:
+            return JsonResponse({'error': 'ファイルが選択されていません'}, status=400)
         
-        # ファイルサイズ制限（12MB）
-        if uploaded_file.size > 12 * 1024 * 1024:
-            return JsonResponse({'error': 'ファイルサイズが大きすぎます（12MB以下）'}, status=400)
+        file_info = _store_upload(
+            request, uploaded_file.path, uploaded_file.sha256, uploaded_file.extension,
+            uploaded_file.size, uploaded_file.name, uploaded_file.file_id
+        )
         
-        # ユニークなファイル名を生成
-        file_id = str(uuid.uuid4())
-        filename = f"{file_id}.{file_extension}"
+        return JsonResponse({
+            'success': True,
+            'file': file_info,
+            'message': 'ファイルが正常にアップロードされました'
+        })
         
-        # 一時ディレクトリに保存
-        temp_dir = os.path.join(settings.MEDIA_ROOT, 'temp_uploads')
-        os.makedirs(temp_dir, exist_ok=True)
-        file_path = os.path.join(temp_dir, filename)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+def _library_track(track):
+    """ライブラリの一覧・追加で返す曲の情報"""
+    file_id = library.track_file_id(track.pk)
+    return {
+        'id': file_id,
+        'title': track.title,
+        'duration': track.duration,
+        'file_size': track.file_size,
+        'uploaded_at': track.uploaded_at.isoformat(),
+        'sha256': track.blob_id or '',
+        'stream_url': reverse('player:stream_file', args=[file_id]),
+    }
+
+@csrf_exempt
+@require_http_methods(["GET", "POST"])
+def library_tracks(request):
+    """
+    ログインユーザーのライブラリ
+    
+    GET  ?sort=recent|title&q=...&match=prefix|trigram&cursor=...&limit=...
+         1 ページ分の曲と次のページのカーソル（next_cursor、最後なら null）を返す
+    POST {file_id, title?} でセッションのファイルをライブラリに追加する
+    """
+    if not request.user.is_authenticated:
+        return JsonResponse({'error': 'ログインが必要です'}, status=401)
+    try:
+        if request.method == 'POST':
+            data = json.loads(request.body)
+            file_info = _find_session_file(request, str(data.get('file_id', '')))
+            if not file_info:
+                return JsonResponse({'error': 'ファイルが見つかりません'}, status=404)
+            track, created = library.add_track(request.user, file_info, data.get('title'))
+            return JsonResponse({'success': True, 'track': _library_track(track)}, status=201 if created else 200)
         
-        # ファイルを保存
-        with open(file_path, 'wb+') as destination:
-            for chunk in uploaded_file.chunks():
-                destination.write(chunk)
+        try:
+            limit = int(request.GET['limit']) if request.GET.get('limit') else None
+        except ValueError:
+            return JsonResponse({'error': 'limit が不正です'}, status=400)
+        tracks, next_cursor = library.list_tracks(
+            request.user,
+            sort=request.GET.get('sort', 'recent'),
+            q=request.GET.get('q', ''),
+            match=request.GET.get('match', 'prefix'),
+            cursor=request.GET.get('cursor') or None,
+            limit=limit,
+        )
+        return JsonResponse({'tracks': [_library_track(track) for track in tracks], 'next_cursor': next_cursor})
+    
+    except library.LibraryError as e:
+        return JsonResponse({'error': str(e)}, status=e.status)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+@csrf_exempt
+@require_http_methods(["PATCH", "DELETE"])
+def library_track(request, track_id):
+    """ライブラリの曲の名前を変える（PATCH {title}）・ライブラリから外す（DELETE）"""
+    if not request.user.is_authenticated:
+        return JsonResponse({'error': 'ログインが必要です'}, status=401)
+    try:
+        if request.method == 'DELETE':
+            library.remove_track(request.user, track_id)
+            return JsonResponse({'success': True})
+        
+        title = str(json.loads(request.body).get('title') or '').strip()
+        if not title:
+            return JsonResponse({'error': 'title is required'}, status=400)
+        track = library.rename_track(request.user, track_id, title)
+        return JsonResponse({'success': True, 'track': _library_track(track)})
+    
+    except library.LibraryError as e:
+        return JsonResponse({'error': str(e)}, status=e.status)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+def _queue_peaks(file_info, width):
+    """波形の 2 段分のピーク（get_peaks と同じ形式を base64 にしたもの。無ければ None）"""
+    path = peaks_path(file_info.get('file_path', ''))
+    if not os.path.exists(path):
+        return None
+    try:
+        pyramid = PeakPyramid(path)
+    except ValueError:
+        return None
+    duration = pyramid.duration
+    rows = [
+        base64.b64encode(pyramid.encode_window(start, end, width)).decode('ascii')
+        for start, end in ((0.0, duration / 2), (duration / 2, duration))
+    ]
+    return {'duration': duration, 'rows': rows}
+
+@require_http_methods(["GET"])
+def get_queue(request):
+    """
+    再生キュー：次に再生する曲をまとめて返す
+    
+    GET ?current=<file_id>&sort=recent|title&q=...&match=prefix|trigram&count=...&width=...
+    
+    曲の切り替えで配信 URL・再生位置・ゲイン・アートワーク・波形ピークを
+    それぞれ取りに行かなくて済むように、次の count 曲分を 1 回で返す。
+    音声の先読みはクライアントが待機用の audio 要素で再生位置から行う
+    （Link: rel=preload は Range を指定できず曲全体を取得させてしまうので付けない）。
+    """
+    if not request.user.is_authenticated:
+        return JsonResponse({'error': 'ログインが必要です'}, status=401)
+    try:
+        try:
+            count = int(request.GET['count']) if request.GET.get('count') else None
+            width = int(request.GET.get('width', settings.PLAYER_PEAKS_TARGET_LENGTH))
+        except ValueError:
+            return JsonResponse({'error': 'count / width が不正です'}, status=400)
+        if width <= 0:
+            return JsonResponse({'error': 'count / width が不正です'}, status=400)
+        width = min(width, settings.PLAYER_PEAKS_MAX_WIDTH)
+        
+        tracks = library.upcoming(
+            request.user,
+            current_id=request.GET.get('current', ''),
+            sort=request.GET.get('sort', 'recent'),
+            q=request.GET.get('q', ''),
+            match=request.GET.get('match', 'prefix'),
+            count=count,
+        )
+        owner = owner_for(request)
+        queue = []
+        for track in tracks:
+            file_info = library.file_info_for(track)
+            if not track.blob_id or not os.path.exists(file_info['file_path']):
+                continue
+            sha256 = file_info['sha256']
+            queue.append({
+                **_library_track(track),
+                'content_type': content_type_for(file_info['filename']),
+                'position': position_buffer.get(owner, file_info['id'], fingerprint.versions(sha256)),
+                'gain_db': loudness.get_gain(sha256),
+                'artwork': artwork.get_artwork(sha256),
+                'peaks': _queue_peaks(file_info, width),
+            })
         
-        # ファイルのメタデータを取得
+        return JsonResponse({'success': True, 'queue': queue})
+    
+    except library.LibraryError as e:
+        return JsonResponse({'error': str(e)}, status=e.status)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def create_upload(request):
+    """再開可能な分割アップロードを開始（アップロード ID とチャンク長を返す）"""
+    try:
+        data = json.loads(request.body)
         try:
-            audio = MutagenFile(file_path)
-            duration = int(audio.info.length) if audio.info else 0
-        except:
-            duration = 0
+            size = int(data.get('size'))
+        except (TypeError, ValueError):
+            return JsonResponse({'error': 'size が不正です'}, status=400)
+        sha256 = str(data['sha256']).lower() if data.get('sha256') else None
         
-        # 既存のファイルがある場合は削除
-        session_files = request.session.get('uploaded_files', [])
-        if session_files:
-            for existing_file in session_files:
-                try:
-                    if os.path.exists(existing_file.get('file_path', '')):
-                        os.remove(existing_file['file_path'])
-                except:
-                    pass
-        
-        # セッションにファイル情報を保存（一つだけ）
-        file_info = {
-            'id': file_id,
-            'title': uploaded_file.name,
-            'filename': filename,
-            'file_path': file_path,
-            'duration': duration,
-            'file_size': uploaded_file.size,
-            'uploaded_at': str(uuid.uuid4())
-        }
-        request.session['uploaded_files'] = [file_info]
-        request.session.modified = True
+        upload = ResumableUpload.create(owner_for(request), str(data.get('name', '')), size, sha256)
+        return JsonResponse(upload.as_dict(), status=201)
+    
+    except UploadError as e:
+        return JsonResponse({'error': str(e)}, status=e.status)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+@csrf_exempt
+@require_http_methods(["GET", "DELETE"])
+def upload_status(request, upload_id):
+    """受信済みのチャンクを返す（DELETE の場合は中止して一時ファイルを消す）"""
+    try:
+        upload = ResumableUpload.load(upload_id, owner_for(request))
+        if request.method == 'DELETE':
+            upload.abort()
+            return JsonResponse({'success': True})
+        return JsonResponse(upload.as_dict())
+    
+    except UploadError as e:
+        return JsonResponse({'error': str(e)}, status=e.status)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+@csrf_exempt
+@require_http_methods(["PUT"])
+def upload_chunk(request, upload_id, index):
+    """
+    チャンクを受け取り、確保済みのファイルの該当位置へ書き込む
+    
+    本文はメモリに溜めずに少しずつ読み出して書き込むので、チャンク長は
+    DATA_UPLOAD_MAX_MEMORY_SIZE に縛られない。X-Chunk-SHA256 ヘッダーが
+    あればチャンク単位でも照合する。
+    """
+    try:
+        upload = ResumableUpload.load(upload_id, owner_for(request))
+        try:
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        upload.write_chunk(index, request, length, request.headers.get('X-Chunk-SHA256'))
+        return JsonResponse({'success': True, 'index': index})
+    
+    except UploadError as e:
+        return JsonResponse({'error': str(e)}, status=e.status)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
+
+@csrf_exempt
+@require_http_methods(["POST"])
+def finalize_upload(request, upload_id):
+    """全チャンクがそろったアップロードのハッシュを検証し、ストアへ取り込む"""
+    try:
+        upload = ResumableUpload.load(upload_id, owner_for(request))
+        staged_path, sha256, extension = upload.claim()
+        file_info = _store_upload(
+            request, staged_path, sha256, extension, upload.size, upload.name, upload.file_id
+        )
         
         return JsonResponse({
             'success': True,
             'file': file_info,
             'message': 'ファイルが正常にアップロードされました'
         })
-        
+    
+    except UploadError as e:
+        return JsonResponse({'error': str(e)}, status=e.status)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
 
@@ -376,22 +788,164 @@ def upload_file_lightweight(request):
 def get_file_url_lightweight(request, file_id):
     """軽量版ファイルURL取得"""
     try:
-        session_files = request.session.get('uploaded_files', [])
-        
-        for file_info in session_files:
-            if file_info['id'] == file_id:
-                # ファイルが存在するかチェック
-                if os.path.exists(file_info.get('file_path', '')):
-                    file_url = f"/media/temp_uploads/{file_info['filename']}"
-                    return JsonResponse({
-                        'success': True,
-                        'file_url': file_url,
-                        'file_info': file_info
-                    })
-                else:
-                    return JsonResponse({'error': 'ファイルが見つかりません'}, status=404)
+        file_info = _find_session_file(request, file_id)
+        
+        # ファイルが存在するかチェック
+        if file_info and os.path.exists(file_info.get('file_path', '')):
+            file_url = reverse('player:stream_file', args=[file_id])
+            # 音量を揃える再生ゲイン（dB、未測定なら None）。クライアントは GainNode に掛けるだけ
+            sha256 = file_info.get('sha256')
+            gain_db = loudness.get_gain(sha256) if sha256 else None
+            # 埋め込みアートワークのサムネイル（サイズごとの URL。クライアントが必要な 1 枚を選ぶ）
+            thumbnails = artwork.get_artwork(sha256) if sha256 else None
+            return JsonResponse({
+                'success': True,
+                'file_url': file_url,
+                'file_info': {**file_info, 'gain_db': gain_db, 'artwork': thumbnails}
+            })
         
         return JsonResponse({'error': 'ファイルが見つかりません'}, status=404)
         
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
+
+def _media_response(request, file_info, asynchronous=False):
+    """
+    セッションのファイルを Range 対応で配信するレスポンスを生成
+    
+    t（秒）を指定すると、シークインデックスでその時刻を含むフレームの位置を求め、
+    そこから始まる単体で再生できる内容を配信する。実際の開始時刻は
+    X-Seek-Time ヘッダーで返す（インデックスを作れない形式では先頭から配信する）。
+    """
+    path = file_info['file_path']
+    sha256 = file_info.get('sha256')
+    etag = f'"{sha256}"' if sha256 else None
+    window = None
+    seek_time = None
+    
+    if request.GET.get('t') is not None:
+        try:
+            seconds = float(request.GET['t'])
+        except ValueError:
+            seconds = -1.0
+        if not math.isfinite(seconds) or seconds < 0:
+            return JsonResponse({'error': 't が不正です'}, status=400)
+        with metrics.timing(request, 'seek'):
+            index = seekindex.load(path)
+            segment = index.segment(seconds) if index is not None else None
+        seek_time = 0.0
+        if segment is not None:
+            window = FileWindow(path, segment.start, segment.end, segment.prefix)
+            seek_time = segment.time
+            if etag:
+                etag = f'"{sha256}-{segment.start}"'
+    
+    response = range_file_response(
+        request,
+        path,
+        content_type=content_type_for(file_info['filename']),
+        etag=etag,
+        asynchronous=asynchronous,
+        window=window
+    )
+    if seek_time is not None:
+        response['X-Seek-Time'] = f'{seek_time:.6f}'
+    return response
+
+@require_http_methods(["GET", "HEAD"])
+def stream_file(request, file_id):
+    """Range リクエスト対応の音声ストリーミング配信"""
+    file_info = _find_session_file(request, file_id)
+    if not file_info or not os.path.exists(file_info.get('file_path', '')):
+        return JsonResponse({'error': 'ファイルが見つかりません'}, status=404)
+    
+    sha256 = file_info.get('sha256')
+    if sha256:
+        storage.touch(sha256)
+    return _media_response(request, file_info)
+
+@require_http_methods(["GET"])
+def get_peaks(request, file_id):
+    """
+    事前計算済みの波形ピーク（int8 の min/max ペア）を返す
+    
+    start / end（秒）と width（画素数）を指定すると、その区間を描画するのに
+    十分な解像度の段から必要な範囲だけを切り出して返す。
+    """
+    file_info = _find_session_file(request, file_id)
+    if not file_info:
+        return JsonResponse({'error': 'ファイルが見つかりません'}, status=404)
+    
+    path = peaks_path(file_info.get('file_path', ''))
+    if not os.path.exists(path):
+        return JsonResponse({'error': '波形データがありません'}, status=404)
+    
+    try:
+        pyramid = PeakPyramid(path)
+    except ValueError:
+        return JsonResponse({'error': '波形データがありません'}, status=404)
+    
+    try:
+        start = float(request.GET.get('start', 0))
+        end = float(request.GET.get('end', pyramid.duration))
+        width = int(request.GET.get('width', settings.PLAYER_PEAKS_TARGET_LENGTH))
+    except ValueError:
+        return JsonResponse({'error': 'start / end / width が不正です'}, status=400)
+    if width <= 0 or end < start:
+        return JsonResponse({'error': 'start / end / width が不正です'}, status=400)
+    width = min(width, settings.PLAYER_PEAKS_MAX_WIDTH)
+    
+    response = HttpResponse(
+        pyramid.encode_window(start, end, width),
+        content_type='application/octet-stream'
+    )
+    response['Cache-Control'] = 'private, max-age=3600'
+    return response
+
+@require_http_methods(["GET", "HEAD"])
+def get_artwork(request, key, size, extension):
+    """
+    アートワークのサムネイルを配信する
+    
+    URL は画像の内容ハッシュとサイズで決まり、同じ URL の内容は変わらないので
+    immutable で 1 年キャッシュさせる。
+    """
+    if not artwork.ARTWORK_KEY_RE.match(key) or extension not in artwork.FORMATS:
+        return JsonResponse({'error': 'アートワークが見つかりません'}, status=404)
+    path = artwork.thumbnail_path(key, size, extension)
+    if not os.path.exists(path):
+        return JsonResponse({'error': 'アートワークが見つかりません'}, status=404)
+    
+    response = range_file_response(
+        request, path, content_type=artwork.FORMATS[extension][1], etag=f'"{key}-{size}"'
+    )
+    response['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
+
+@require_http_methods(["GET"])
+def get_file_jobs(request, file_id):
+    """アップロード後の処理（ジョブ）の状態を返す（クライアントは完了までポーリングする）"""
+    file_info = _find_session_file(request, file_id)
+    if not file_info:
+        return JsonResponse({'error': 'ファイルが見つかりません'}, status=404)
+    
+    statuses = jobs.statuses(file_info['sha256']) if file_info.get('sha256') else {}
+    pending = any(job['status'] in ('queued', 'running') for job in statuses.values())
+    return JsonResponse({'jobs': statuses, 'pending': pending})
+
+@require_http_methods(["GET"])
+def get_file_analysis(request, file_id):
+    """曲のテンポ・ビート位置・セクションを返す（解析が終わっていなければ 404）"""
+    file_info = _find_session_file(request, file_id)
+    if not file_info:
+        return JsonResponse({'error': 'ファイルが見つかりません'}, status=404)
+    
+    result = analysis.get_analysis(file_info['sha256']) if file_info.get('sha256') else None
+    if result is None:
+        return JsonResponse({'error': '解析が完了していません'}, status=404)
+    return JsonResponse({
+        'bpm': result.bpm,
+        'beat_times': result.beat_times,
+        'sections': result.sections,
+        'error': result.error,
+    })